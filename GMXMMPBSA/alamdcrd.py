@@ -23,26 +23,11 @@ scanning.
 #  for more details.                                                           #
 # ##############################################################################
 
+import numpy as np
 from GMXMMPBSA.exceptions import MutateError, MutantResError
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
-def _getCoords(line, coordsperline, coordsize):
-    """ Returns the coordinates of a line in a mdcrd file """
-    holder = []
-    location = 0
-    for i in range(coordsperline):
-        try:
-            tmp = float(line[location:location+coordsize])
-            holder.append(tmp)
-        except:
-            pass
-        location += coordsize
-
-    return holder
-
-#+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-
 def _scaledistance(coords, dist):
     """ Scales the distance between 2 3-D cartesian coordinates to the specified
         distance
@@ -73,6 +58,19 @@ def _scaledistance(coords, dist):
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+def _scalebonds(new_coords, coords, scales):
+    """ Scales the distance of atoms of new_coords to atoms of coords, in every
+        frame of the block at once. scales is a list of (atom in new_coords,
+        atom in coords, distance)
+    """
+    for atom, origin, dist in scales:
+        bond = new_coords[:, atom] - coords[:, origin]
+        length = np.sqrt(np.sum(bond * bond, axis=1))
+        new_coords[:, atom] = coords[:, origin] + bond * (dist / length)[:, np.newaxis]
+    return new_coords
+
+#+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
 def _getnumatms(resname):
     """ Returns the number of atoms in a given Amino acid residue """
     if resname in 'GLY':
@@ -159,7 +157,7 @@ def _ressymbol(resname):
 
 class MutantMdcrd(object):
     """ Class for an alanine-mutated amber trajectory file.
-        ASCII only (no netcdf)
+        ASCII (mdcrd) or NetCDF
     """
 
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
@@ -169,7 +167,6 @@ class MutantMdcrd(object):
         self.orig_prm = prm1
         self.new_prm = prm2
         self.mutres = self.FindMutantResidue()
-        self.hasbox = bool(prm1.ptr('ifbox'))
 
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
@@ -211,120 +208,91 @@ class MutantMdcrd(object):
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
     def MutateTraj(self, newname):
-        """ Mutates a given mdcrd file based on 2 prmtops """
+        """ Mutates a given trajectory (mdcrd or NetCDF) based on 2 prmtops. The
+            frames are mutated in blocks, as NumPy arrays, and the mutant is
+            written in the same format as the original
+        """
+        from GMXMMPBSA.trajio import (MdcrdFile, NetCDFFile, MdcrdWriter, NetCDFWriter,
+                                      BLOCK_FRAMES)
+        from GMXMMPBSA.exceptions import TrajError
 
         mutres = self.mutres
 
         orig_resname = self.orig_prm.parm_data['RESIDUE_LABEL'][mutres-1]
-        resstart = self.orig_prm.parm_data['RESIDUE_POINTER'][mutres-1]
+        natom = self.orig_prm.ptr('natom')
+        resstart = self.orig_prm.parm_data['RESIDUE_POINTER'][mutres-1] - 1
         try:
-            nextresstart = self.orig_prm.parm_data['RESIDUE_POINTER'][mutres]
+            nextresstart = self.orig_prm.parm_data['RESIDUE_POINTER'][mutres] - 1
         except IndexError:
-            nextresstart = self.orig_prm.ptr('natom')
-        number_atoms_mut = self.new_prm.ptr('natom')
-        if self.orig_prm.ptr('ifbox'):
-            number_atoms_mut += 1
-
-        coordsperline = 10 # number of coordinates in each line
-        coordsize = 8      # how large coordinates are in characters
-        counter = 0
-        coords_done = 0
-        coords_tomutate = []
-        temp_holder = []
-        new_coords = []
-
-        # location is 0 before modified coordinates, 1 during modified
-        # coordinates, and 2 after modified coordinates
-        location = 0
+            nextresstart = natom
 
         if orig_resname == 'GLY':
             raise MutateError('You are trying to mutate GLY to ALA! ' +
                               'Not currently supported.')
 
-        new_mdcrd = open(newname, 'w')
-        mdcrd = open(self.traj, 'r')
-
-        for line in mdcrd:
-            counter += 1
-            # First line is always a comment
-            if counter == 1:
-                new_mdcrd.write('%-80s' % (line.strip() + ' and mutated by gmx_MMPBSA for alanine scanning'))
-                continue
-
-            if location == 0 and coords_done <= max(resstart * 3 - 4, 0) and \
-                    coords_done + coordsperline > max(resstart * 3 - 4, 0):
-                location = 1
-                words = _getCoords(line, coordsperline, coordsize)
-                for i in range(coordsperline):
-                    if coords_done <= resstart * 3 - 4:
-                        if coords_done % coordsperline == 0:
-                            new_mdcrd.write('\n')
-                        new_mdcrd.write('%8.3f' % words[i])
-                        coords_done += 1
-                    else:
-                        coords_tomutate.append(words[i])
-                continue
-
-            elif location == 1:
-                words = _getCoords(line, coordsperline, coordsize)
-                if coordsperline + len(coords_tomutate) >= \
-                        3 * (nextresstart - resstart):
-                    location = 2
-                    for i in range(coordsperline):
-                        if len(coords_tomutate) < 3 * (nextresstart - resstart):
-                            coords_tomutate.append(words[i])
-                        else:
-                            temp_holder.append(words[i])
-
-                    new_coords = self._mutate(orig_resname, coords_tomutate)
-                    for i in range(len(new_coords)):
-                        if coords_done % coordsperline == 0:
-                            new_mdcrd.write('\n')
-                        new_mdcrd.write('%8.3f' % new_coords[i])
-                        coords_done += 1
-                    if len(temp_holder) != 0:
-                        for i in range(len(temp_holder)):
-                            if coords_done % coordsperline == 0:
-                                new_mdcrd.write('\n')
-                            new_mdcrd.write('%8.3f' % temp_holder[i])
-                            coords_done += 1
-                    coords_tomutate = []
-                    temp_holder = []
-                else:
-                    for i in range(coordsperline):
-                        coords_tomutate.append(words[i])
-
-                continue
-
-            elif location == 2:
-                words = _getCoords(line, coordsperline, coordsize)
-                for i in range(len(words)):
-                    if coords_done % coordsperline == 0:
-                        if not self.hasbox or coords_done < number_atoms_mut * 3 - 3:
-                            new_mdcrd.write('\n')
-                    new_mdcrd.write('%8.3f' % words[i])
-                    coords_done += 1
-                    if self.hasbox and coords_done == number_atoms_mut * 3 - 3:
-                        new_mdcrd.write('\n')
-
-                if coords_done == number_atoms_mut * 3:
-                    coords_done = 0
-                    location = 0
-                continue
+        # The atoms of the mutant (their index in the original) and the bonds
+        # to shorten, which are the same for every frame
+        keep, scales = self._mutate(orig_resname, nextresstart - resstart)
+        keep = np.concatenate((np.arange(resstart), resstart + np.array(keep, dtype=int),
+                               np.arange(nextresstart, natom)))
+        scales = [(resstart + atom, resstart + origin, dist) for atom, origin, dist in scales]
+        if len(keep) != self.new_prm.ptr('natom'):
+            raise MutateError('Mutant prmtop (%s) has %d atoms, but mutating residue %d of %s leaves %d' %
+                              (self.new_prm.prm_name, self.new_prm.ptr('natom'), mutres,
+                               self.orig_prm.prm_name, len(keep)))
+
+        with open(self.traj, 'rb') as f:
+            netcdf = f.read(3) == b'CDF'
+        try:
+            if netcdf:
+                traj = NetCDFFile(self.traj)
+                new_traj = NetCDFWriter(newname, len(keep))
             else:
-                if coords_done % coordsperline == 0:
-                    new_mdcrd.write('\n')
-                new_mdcrd.write(line[:len(line)-1])
-                coords_done = coords_done + coordsperline
-                continue
+                traj = MdcrdFile(self.traj, natom)
+                new_traj = MdcrdWriter(newname, len(keep), box=traj.hasbox,
+                                       title='%-80s' % (traj.title.strip() +
+                                                        ' and mutated by gmx_MMPBSA for alanine scanning'))
+        except TrajError as e:
+            raise MutateError(str(e))
+        try:
+            if traj.natoms != natom:
+                raise MutateError('%s has %d atoms, but %s has %d' % (self.traj, traj.natoms,
+                                                                     self.orig_prm.prm_name, natom))
+            for first in range(0, len(traj), BLOCK_FRAMES):
+                frames = range(first, min(first + BLOCK_FRAMES, len(traj)))
+                coords = traj.read(frames)
+                new_coords = _scalebonds(coords[:, keep], coords, scales)
+                if netcdf:
+                    new_traj.write(new_coords)
+                else:
+                    new_traj.write(new_coords, traj.read_box(frames))
+        finally:
+            traj.close()
+            new_traj.close()
+
+    #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
-        new_mdcrd.write('\n')
-        mdcrd.close()
-        new_mdcrd.close()
+    @staticmethod
+    def _residue_layout(resname, natoms):
+        """ Returns the index of the first side chain-related atom (2 if the
+            residue is N-terminal) and whether the residue is C-terminal
+        """
+        if _getnumatms(resname) == natoms:
+            return 0, False
+        elif _getnumatms(resname) + 2 == natoms:
+            return 2, False
+        elif _getnumatms(resname) + 1 == natoms:
+            return 0, True
+        raise MutateError(('Mismatch in atom # in residue %s. (%d in alamdcrd.py and %d passed in)') %
+                          (resname, _getnumatms(resname), natoms))
 
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
-    def _mutate(self, resname, coords):
+    def _mutate(self, resname, natoms):
+        """ Returns the atoms of the residue (of natoms atoms) kept in the
+            alanine mutant, in order, and the bonds to scale as (position in
+            the mutant, atom of the residue, distance)
+        """
         list_one = 'ARG ASH ASN ASP CYM CYS CYX GLH GLN GLU HID HIE HIP ' + \
                    'LEU LYN LYS MET PHE SER TRP TYR'
         list_two = 'ILE THR VAL'
@@ -333,96 +301,30 @@ class MutantMdcrd(object):
         chdist = 1.09
         nhdist = 1.01
 
-        coords_tosend = []
-        new_coords  = []
-        coords_received = []
-        cterm = False
-
-        if _getnumatms(resname) * 3 == len(coords):
-            startindex = 0
-            cterm = False
-        elif (_getnumatms(resname) + 2) * 3 == len(coords):
-            startindex = 2
-            cterm = False
-        elif (_getnumatms(resname) + 1) * 3 == len(coords):
-            startindex = 0
-            cterm = True
-        else:
-            raise MutateError(('Mismatch in atom # in residue %s. (%d in alamdcrd.py and %d passed in)') %
-                              (resname, _getnumatms(resname), len(coords)))
+        startindex, cterm = self._residue_layout(resname, natoms)
+        s = startindex
 
         if resname in list_one:
-            for i in range((7+startindex)*3):
-                new_coords.append(coords[i])
-            for i in range(3):
-                coords_tosend.append(coords[(4+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(7+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
+            # CB hydrogen in place of the gamma atom
+            keep = list(range(7 + s)) + [7 + s]
+            scales = [(7 + s, 4 + s, chdist)]
 
         elif resname in list_two:
-            for i in range((6+startindex)*3):
-                new_coords.append(coords[i])
-
-            for i in range(3):
-                coords_tosend.append(coords[(4+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(6+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
-
-            coords_tosend = []
-            coords_received = []
-            for i in range(3):
-                coords_tosend.append(coords[(4+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(10+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[3+i])
+            # CB hydrogens in place of the 2 gamma atoms
+            keep = list(range(6 + s)) + [6 + s, 10 + s]
+            scales = [(6 + s, 4 + s, chdist), (7 + s, 4 + s, chdist)]
 
         elif resname in list_three:
-            for i in range((1+startindex)*3):
-                new_coords.append(coords[i])
-
-            coords_tosend = coords[startindex*3:startindex*3 + 6]
-            coords_received = _scaledistance(coords_tosend, nhdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
-            for i in range(6):
-                new_coords.append(coords[(10+startindex)*3+i])
-            for i in range(9):
-                new_coords.append(coords[(7+startindex)*3+i])
-
-            coords_tosend = []
-            coords_received = []
-            for i in range(3):
-                coords_tosend.append(coords[(7+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(4+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
+            # Backbone N hydrogen in place of CD, CB hydrogen in place of CG
+            keep = list(range(1 + s)) + [1 + s, 10 + s, 11 + s, 7 + s, 8 + s, 9 + s, 4 + s]
+            scales = [(1 + s, s, nhdist), (7 + s, 7 + s, chdist)]
 
         else:
             raise MutateError("Residue %s not recognized! Can't mutate." % resname)
 
-        if cterm:
-            for i in range(9):
-                new_coords.append(coords[len(coords)-9+i])
-        else:
-            for i in range(6):
-                new_coords.append(coords[len(coords)-6+i])
+        keep += list(range(natoms - 3, natoms)) if cterm else list(range(natoms - 2, natoms))
 
-        return new_coords
+        return keep, scales
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
@@ -437,7 +339,11 @@ class GlyMutantMdcrd(MutantMdcrd):
 
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
-    def _mutate(self, resname, coords):
+    def _mutate(self, resname, natoms):
+        """ Returns the atoms of the residue (of natoms atoms) kept in the
+            glycine mutant, in order, and the bonds to scale as (position in
+            the mutant, atom of the residue, distance)
+        """
         list_one = 'ARG ASH ASN ASP CYM CYS CYX GLH GLN GLU HID HIE HIP ' + \
                    'LEU LYN LYS MET PHE SER TRP TYR ALA ILE THR VAL'
         list_two = 'PRO'
@@ -445,71 +351,25 @@ class GlyMutantMdcrd(MutantMdcrd):
         chdist = 1.09
         nhdist = 1.01
 
-        coords_tosend = []    # Coordinates to send to be scaled
-        new_coords  = []      # Mutated coordinates to return
-        coords_received = []  # Scaled coordinates received
-        cterm = False
-
-        if _getnumatms(resname) * 3 == len(coords):
-            startindex = 0
-            cterm = False
-        elif (_getnumatms(resname) + 2) * 3 == len(coords):
-            startindex = 2
-            cterm = False
-        elif (_getnumatms(resname) + 1) * 3 == len(coords):
-            startindex = 0
-            cterm = True
-        else:
-            raise MutateError(('Mismatch in atom # in residue %s. (%d in ' +
-                               'alamdcrd.py and %d passed in)') % (resname,
-                                                                   _getnumatms(resname), len(coords)))
+        startindex, cterm = self._residue_layout(resname, natoms)
+        s = startindex
 
         if resname in list_one:
-            for i in range((4+startindex)*3):
-                new_coords.append(coords[i])
-            for i in range(3):
-                coords_tosend.append(coords[(2+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(4+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
+            # CA hydrogen in place of CB
+            keep = list(range(4 + s)) + [4 + s]
+            scales = [(4 + s, 2 + s, chdist)]
 
         elif resname in list_two:
-            for i in range((1+startindex)*3):
-                new_coords.append(coords[i])
-
-            coords_tosend = coords[startindex*3:startindex*3 + 6]
-            coords_received = _scaledistance(coords_tosend, nhdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
-            for i in range(6):
-                new_coords.append(coords[(10+startindex)*3+i])
-
-            coords_tosend = []
-            coords_received = []
-            for i in range(3):
-                coords_tosend.append(coords[(10+startindex)*3+i])
-            for i in range(3):
-                coords_tosend.append(coords[(7+startindex)*3+i])
-            coords_received = _scaledistance(coords_tosend, chdist)
-
-            for i in range(3):
-                new_coords.append(coords_received[i+3])
+            # Backbone N hydrogen in place of CD, CA hydrogen in place of CB
+            keep = list(range(1 + s)) + [1 + s, 10 + s, 11 + s, 7 + s]
+            scales = [(1 + s, s, nhdist), (4 + s, 10 + s, chdist)]
 
         else:
             raise MutateError("Residue %s not recognized! Can't mutate." % resname)
 
-        if cterm:
-            for i in range(9):
-                new_coords.append(coords[len(coords)-9+i])
-        else:
-            for i in range(6):
-                new_coords.append(coords[len(coords)-6+i])
+        keep += list(range(natoms - 3, natoms)) if cterm else list(range(natoms - 2, natoms))
 
-        return new_coords
+        return keep, scales
 
     #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
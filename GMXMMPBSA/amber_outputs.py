@@ -3,7 +3,8 @@ This module contains all of the classes and code to collect data and calculate
 statistics from the output files of various calculation types. Each calculation
 type needs its own class.
 
-All data is stored in a special class derived from the list.
+All data is stored in a special class derived from the list. While parsing,
+the terms are collected in a preallocated columnar EnergyTable.
 """
 
 # ##############################################################################
@@ -25,8 +26,14 @@ All data is stored in a special class derived from the list.
 # ##############################################################################
 
 from math import sqrt
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import chain
 from GMXMMPBSA.exceptions import (OutputError, LengthError, DecompError, InternalError)
+import mmap
 import numpy as np
+import os
+import re
 import sys
 
 idecompString = ['idecomp = 0: No decomposition analysis',
@@ -120,11 +127,283 @@ class EnergyVector(np.ndarray):
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
+class EnergyMoments(object):
+    """
+    Mergeable statistics of an energy term: the number of frames, the mean and
+    the sum of squared deviations from it (M2, as in Welford's algorithm),
+    plus the extreme values. It stands in for an EnergyVector when only the
+    summary of the frames is needed, so the ranks can send these instead of
+    the energies of every frame. The statistics of the frames of a 2-D array
+    (frames x residues, as in the decomp outputs) are arrays over its columns
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, low=np.inf, high=-np.inf):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def from_vector(cls, vector):
+        """ Statistics of the frames in vector """
+        vector = np.asarray(vector, dtype=float)
+        if not len(vector):
+            return cls()
+        mean = vector.mean(axis=0)
+        return cls(len(vector), mean, ((vector - mean) ** 2).sum(axis=0), vector.min(axis=0), vector.max(axis=0))
+
+    def merge(self, other):
+        """ Statistics of the frames of both (Chan et al. parallel update) """
+        if not other.count:
+            return self
+        if not self.count:
+            return other
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return EnergyMoments(count, self.mean + delta * other.count / count,
+                             self.m2 + other.m2 + delta * delta * self.count * other.count / count,
+                             np.minimum(self.low, other.low), np.maximum(self.high, other.high))
+
+    def __len__(self):
+        return self.count
+
+    def avg(self):
+        return self.mean if self.count else np.nan
+
+    def stdev(self):
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def sums(self):
+        """ The sum and the sum of squares of the frames """
+        return self.count * self.mean, self.m2 + self.count * self.mean ** 2
+
+    def __eq__(self, other):
+        """ Whether every frame is equal to the number other """
+        return bool(np.all(self.low == other) and np.all(self.high == other))
+
+    def abs_gt(self, val):
+        """ If any element's absolute value is greater than a # """
+        return bool(np.max(np.maximum(abs(self.low), abs(self.high))) > val) if self.count else False
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
+class EnergyTable(object):
+    """
+    Columnar energy storage used while parsing output files. Every term is a
+    column of one preallocated 2-D buffer that doubles its number of rows when
+    full, so filling N frames is amortized O(N) instead of the O(N^2) of
+    repeated EnergyVector.append calls. Each column keeps its own frame count,
+    since some terms (e.g. ESURF) are read from a different file.
+    """
+
+    def __init__(self, keys, capacity=1024):
+        self.keys = list(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.buffer = np.zeros((max(capacity, 1), len(self.keys)))
+        self.counts = np.zeros(len(self.keys), dtype=int)
+
+    def __len__(self):
+        """ Number of frames, i.e. the length of the longest column """
+        return int(self.counts.max()) if self.keys else 0
+
+    def _reserve(self, size):
+        """ Grows the buffer (doubling) so it holds at least size rows """
+        capacity = self.buffer.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        buffer = np.zeros((capacity, len(self.keys)))
+        buffer[:self.buffer.shape[0]] = self.buffer
+        self.buffer = buffer
+
+    def append(self, key, value):
+        """ Adds one frame to the column of key """
+        col = self.index[key]
+        row = self.counts[col]
+        if row == self.buffer.shape[0]:
+            self._reserve(row + 1)
+        self.buffer[row, col] = value
+        self.counts[col] = row + 1
+
+    def extend(self, key, values):
+        """ Adds a sequence of frames to the column of key """
+        values = np.asarray(values, dtype=float).ravel()
+        col = self.index[key]
+        row = self.counts[col]
+        self._reserve(row + len(values))
+        self.buffer[row:row + len(values), col] = values
+        self.counts[col] = row + len(values)
+
+    def frames(self, key):
+        """ Frame index of the column of key """
+        return np.arange(self.counts[self.index[key]])
+
+    def column(self, key):
+        """ Returns a copy of the column of key as an EnergyVector """
+        col = self.index[key]
+        return EnergyVector(self.buffer[:self.counts[col], col].copy())
+
+    def vectors(self):
+        """ Returns a dict with an EnergyVector per column """
+        return {key: self.column(key) for key in self.keys}
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
+# One line of an energy block. terms is a tuple of (key, word) pairs, where word
+# is the index of the value in line.split() or None for "the value after the
+# first '='". chamber lines are only printed for chamber topologies, and if the
+# first word of the line is unless, every term of the line is 0.
+EnergyLine = namedtuple('EnergyLine', 'terms chamber unless')
+EnergyLine.__new__.__defaults__ = (False, None)
+
+# A block of EnergyLines. marker is a (bytes) regular expression that matches
+# the start of the first line of the block
+EnergyBlock = namedtuple('EnergyBlock', 'marker lines')
+
+def _parse_energy_blocks(buffer, blocks, table, chamber=False, zero_terms=(), fname=None):
+    """
+    Scans the output file contents (bytes) once and fills table with every term
+    of every block found. Terms in zero_terms (and the chamber terms of
+    non-chamber topologies) are set to 0. A line of a block without its terms
+    (e.g. of a crashed calculation) raises an OutputError naming fname
+    """
+    markers = b'|'.join(b'(?P<b%d>%s)' % (i, block.marker) for i, block in enumerate(blocks))
+    # Matching the newline before the marker is much faster than ^ with re.M.
+    # Only the first line is not preceded by one
+    pattern = re.compile(b'\\n(?:%s)' % markers)
+    first = re.compile(markers).match(buffer)
+    starts = [(0, first.lastgroup)] if first else []
+    # Everything that does not depend on the contents is resolved only once.
+    # Values are collected in one list per term and stored in table at the end,
+    # each with a single slice assignment into its (doubling) buffer. Setting
+    # the items of the buffer one at a time, even a row per block, makes the
+    # parsing 1.5 times slower, since list.append is much cheaper than NumPy
+    # item assignment
+    columns = {}
+    layouts = []
+    for block in blocks:
+        lines, zeros = [], []
+        for line in block.lines:
+            if line.chamber and not chamber:
+                zeros.extend(columns.setdefault(key, []) for key, word in line.terms)
+                continue
+            terms = tuple((columns.setdefault(key, []).append, word) for key, word in line.terms
+                          if key not in zero_terms)
+            zeros.extend(columns.setdefault(key, []) for key, word in line.terms if key in zero_terms)
+            lines.append((terms, line.unless))
+        layouts.append((lines, zeros))
+
+    end = 0
+    for pos, group in chain(starts, ((match.start() + 1, match.lastgroup) for match in pattern.finditer(buffer))):
+        if pos < end:
+            # Inside the block we just parsed
+            continue
+        lines, zeros = layouts[int(group[1:])]
+        for terms, unless in lines:
+            end = buffer.find(b'\n', pos)
+            if end == -1:
+                end = len(buffer)
+            words = buffer[pos:end].split()
+            start, pos = pos, end + 1
+            try:
+                if unless is not None and words[0] == unless:
+                    for append, word in terms:
+                        append(0.0)
+                    continue
+                for append, word in terms:
+                    if word is None:
+                        word = 1 if words[0].endswith(b'=') else 2
+                    append(float(words[word]))
+            except (IndexError, ValueError):
+                line = buffer[start:end].decode(errors='replace').strip()
+                raise OutputError('%s, line %d: incomplete energy terms (%r). The calculation may have failed, or '
+                                  'the file is still being written' % (fname, buffer[:start].count(b'\n') + 1, line)
+                                  ) from None
+        for column in zeros:
+            column.append(0.0)
+
+    for key, column in columns.items():
+        table.extend(key, column)
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
+@contextmanager
+def _mapped(fname):
+    """ Memory-maps fname for reading (an empty file cannot be mapped) """
+    with open(fname, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b''
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        buffer.close()
+
+def _join_files(output, pool=None):
+    """
+    Parses every per-rank file of output, with pool.map if given, and joins
+    their arrays in rank order. Files that were not parsed here (the files of
+    the other ranks in a RankPool) are None and are skipped
+    """
+    mapper = map if pool is None else pool.map
+    pieces = [piece for piece in mapper(output._read_file, range(output.num_files)) if piece is not None]
+    if not pieces:
+        return
+    for key in output.data_keys:
+        output.data[key] = EnergyVector(np.concatenate([piece[key] for piece in pieces]))
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
+class RankPool(object):
+    """
+    Parses the per-rank output files with the MPI ranks. Every rank parses its
+    own files, and the master gathers the arrays of all of them. Without
+    gather, every rank keeps only the arrays of its own files. This must be
+    used by every rank, in the same order
+    """
+
+    def __init__(self, comm, gather=True):
+        self.comm = comm
+        self.gather = gather
+
+    def map(self, func, items):
+        """ Like map, but the results that stay in other ranks are None """
+        items = list(items)
+        rank, size = self.comm.Get_rank(), self.comm.Get_size()
+        results = {}
+        for i in range(rank, len(items), size):
+            try:
+                results[i] = func(items[i])
+            except Exception as e:
+                results[i] = e
+        errors = {i: result for i, result in results.items() if isinstance(result, Exception)}
+        gathered = self.comm.gather(results if self.gather else errors)
+        error = None
+        if rank == 0:
+            for part in gathered:
+                if self.gather:
+                    results.update(part)
+                errors.update((i, result) for i, result in part.items() if isinstance(result, Exception))
+            error = errors[min(errors)] if errors else None
+        # A failure in any rank stops all of them
+        error = self.comm.bcast(error)
+        if error is not None:
+            raise error
+        if self.gather and rank != 0:
+            return [None] * len(items)
+        return [results.get(i) for i in range(len(items))]
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
 class AmberOutput(object):
     """
     Base Amber output class. It takes a basename as a file name and parses
     through all of the thread-specific output files (assumed to have the suffix
-    .# where # spans from 0 to num_files - 1
+    .# where # spans from 0 to num_files - 1. With a pool (a process pool or a
+    RankPool), the files are parsed concurrently
     """
     # Ordered list of keys in the data dictionary
     data_keys = ['BOND', 'ANGLE', 'DIHED', 'UB', 'IMP', 'CMAP', 'VDWAALS', 'EEL',
@@ -245,26 +524,47 @@ class AmberOutput(object):
 
     #==================================================
 
-    def _read(self):
+    def _read(self, pool=None):
         """
         Internal reading function. This should be called at the end of __init__.
-        It loops through all of the output files to populate the arrays
+        It parses all of the output files (with pool, if given) to populate the
+        arrays
         """
         if self.is_read: return None # don't read through them twice
 
-        for fileno in range(self.num_files):
-            output_file = open('%s.%d' % (self.basename, fileno), 'r')
-            self._get_energies(output_file)
-            output_file.close()
-            # If we have to get energies elsewhere (e.g., with GB and ESURF), do
-            # that here. This is an empty function when unnecessary
-            self._extra_reading(fileno)
+        _join_files(self, pool)
 
         self.is_read = True
 
     #==================================================
 
-    def _extra_reading(self, fileno):
+    def _read_file(self, fileno):
+        """ Parses the output file of one rank and returns an array per term """
+        # The parsers fill the columns of this table in place
+        table = EnergyTable(self.data_keys)
+        fname = '%s.%d' % (self.basename, fileno)
+        with _mapped(fname) as buffer:
+            self._get_energies(buffer, table, fname)
+        # If we have to get energies elsewhere (e.g., with GB and ESURF), do
+        # that here. This is an empty function when unnecessary
+        self._extra_reading(fileno, table)
+        return table.vectors()
+
+    #==================================================
+
+    def _get_energies(self, buffer, table, fname):
+        """ Parses the energy terms described by energy_blocks """
+        _parse_energy_blocks(buffer, self.energy_blocks, table, self.chamber, self._zero_terms(), fname)
+
+    #==================================================
+
+    def _zero_terms(self):
+        """ Terms that are not printed in the output files and are set to 0 """
+        return ()
+
+    #==================================================
+
+    def _extra_reading(self, fileno, table):
         pass
 
     #==================================================
@@ -498,10 +798,13 @@ class NMODEout(object):
     composite_keys = []
     data_key_owner = {}
     print_levels = {'Translational':1,'Rotational':1,'Vibrational':1,'Total':1}
+    # Layout of the entropy terms in the output files
+    energy_blocks = [EnergyBlock(rb'Total:', [EnergyLine((('Total', 3),)), EnergyLine((('Translational', 3),)),
+                                              EnergyLine((('Rotational', 3),)), EnergyLine((('Vibrational', 3),))])]
 
     #==================================================
 
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
         import warnings
         self.basename = basename
 
@@ -515,7 +818,7 @@ class NMODEout(object):
         self.num_files = num_files
         self.is_read = False
 
-        self._read()
+        self._read(pool)
 
     #==================================================
 
@@ -560,45 +863,28 @@ class NMODEout(object):
 
     #==================================================
 
-    def _read(self):
+    def _read(self, pool=None):
         """ Internal reading function to populate the data arrays """
 
         if self.is_read: return None # don't read through again
 
-        # Loop through all filenames
-        for fileno in range(self.num_files):
-            output_file = open('%s.%d' % (self.basename, fileno), 'r')
-            self._get_energies(output_file)
-            output_file.close()
+        # Parse all files (with pool, if given)
+        _join_files(self, pool)
 
         self.is_read = True
 
     #==================================================
 
-    def _get_energies(self, outfile):
-        """ Parses the energy terms from the output file. This will parse 1 line
-            at a time in order to minimize the memory requirements (we should only
-            have to store a single line at a time in addition to the arrays of
-            data)
-        """
-
-        rawline = outfile.readline()
-
-        while rawline:
-            if rawline[0:35] == '   |---- Entropy not Calculated---|':
+    def _read_file(self, fileno):
+        """ Parses the output file of one rank and returns an array per term """
+        table = EnergyTable(self.data_keys)
+        fname = '%s.%d' % (self.basename, fileno)
+        with _mapped(fname) as buffer:
+            if buffer.find(b'   |---- Entropy not Calculated---|') != -1:
                 sys.stderr.write('Not all frames minimized within tolerance')
-
-            if rawline[0:6] == 'Total:':
-                self.data['Total'] = self.data['Total'].append(float(rawline.split()[3]) *
-                                          self.temp / 1000)
-                self.data['Translational'] = self.data['Translational'].append(
-                    float(outfile.readline().split()[3]) * self.temp / 1000)
-                self.data['Rotational'] = self.data['Rotational'].append(
-                    float(outfile.readline().split()[3]) * self.temp / 1000)
-                self.data['Vibrational'] = self.data['Vibrational'].append(
-                    float(outfile.readline().split()[3]) * self.temp / 1000)
-
-            rawline = outfile.readline()
+            _parse_energy_blocks(buffer, self.energy_blocks, table, fname=fname)
+        # The entropies are printed in cal/mol/K
+        return {key: vector * self.temp / 1000 for key, vector in table.vectors().items()}
 
     #==================================================
 
@@ -608,6 +894,16 @@ class NMODEout(object):
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
+# Layout of the energy blocks printed by sander (imin=5)
+_BOND_LINE = EnergyLine((('BOND', 2), ('ANGLE', 5), ('DIHED', 8)))
+_CHAMBER_LINE = EnergyLine((('UB', 2), ('IMP', 5), ('CMAP', 8)), chamber=True)
+_14_LINE = EnergyLine((('1-4 VDW', 3), ('1-4 EEL', 7)))
+_RISM_EPOT = EnergyBlock(rb'(?:solute_epot|solutePotentialEnergy)',
+                         [EnergyLine((('VDWAALS', 2), ('EEL', 3), ('BOND', 4), ('ANGLE', 5), ('DIHED', 6),
+                                      ('1-4 VDW', 7), ('1-4 EEL', 8)))])
+
+#-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
+
 class GBout(AmberOutput):
     """ Amber output class for normal generalized Born simulations """
     # Ordered list of keys in the data dictionary
@@ -626,61 +922,26 @@ class GBout(AmberOutput):
     print_levels = {'BOND':2, 'ANGLE':2, 'DIHED':2, 'UB':2, 'IMP':2, 'CMAP':2,
                     'VDWAALS':1, 'EEL':1, '1-4 VDW':2, '1-4 EEL':2, 'EGB':1,
                     'ESURF':1}
-    # Ordered list of keys in the data dictionary
+    # Layout of the energy terms in the output files
+    energy_blocks = [EnergyBlock(rb' BOND', [_BOND_LINE, _CHAMBER_LINE,
+                                             EnergyLine((('VDWAALS', 2), ('EEL', 5), ('EGB', 8))), _14_LINE])]
 
     #==================================================
 
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
         AmberOutput.__init__(self, basename, INPUT, num_files, chamber)
         self.surften = INPUT['surften']
         self.surfoff = INPUT['surfoff']
-        AmberOutput._read(self)
-
-    #==================================================
-
-    def _get_energies(self, outfile):
-        """ Parses the mdout files for the GB potential terms """
-        rawline = outfile.readline()
-
-        while rawline:
-
-            if rawline[0:5] == ' BOND':
-                words = rawline.split()
-                self.data['BOND'] = self.data['BOND'].append(float(words[2]))
-                self.data['ANGLE'] = self.data['ANGLE'].append(float(words[5]))
-                self.data['DIHED'] = self.data['DIHED'].append(float(words[8]))
-                words = outfile.readline().split()
-
-                if self.chamber:
-                    self.data['UB'] = self.data['UB'].append(float(words[2]))
-                    self.data['IMP'] = self.data['IMP'].append(float(words[5]))
-                    self.data['CMAP'] = self.data['CMAP'].append(float(words[8]))
-                    words = outfile.readline().split()
-                else:
-                    self.data['UB'] = self.data['UB'].append(0.0)
-                    self.data['IMP'] = self.data['IMP'].append(0.0)
-                    self.data['CMAP'] = self.data['CMAP'].append(0.0)
-
-                self.data['VDWAALS'] = self.data['VDWAALS'].append(float(words[2]))
-                self.data['EEL'] = self.data['EEL'].append(float(words[5]))
-                self.data['EGB'] = self.data['EGB'].append(float(words[8]))
-                words = outfile.readline().split()
-                self.data['1-4 VDW'] = self.data['1-4 VDW'].append(float(words[3]))
-                self.data['1-4 EEL'] = self.data['1-4 EEL'].append(float(words[7]))
-            # end if rawline[0:5] == 'BOND'
-
-            rawline = outfile.readline()
-
-        # end while rawline
+        AmberOutput._read(self, pool)
 
     #==================================================
 
-    def _extra_reading(self, fileno):
+    def _extra_reading(self, fileno, table):
         # Load the ESURF data from the cpptraj output
         fname = '%s.%d' % (self.basename, fileno)
         fname = fname.replace('gb.mdout','gb_surf.dat')
         surf_data = _get_cpptraj_surf(fname)
-        self.data['ESURF'] = self.data['ESURF'].append((surf_data * self.surften) + self.surfoff)
+        table.extend('ESURF', (surf_data * self.surften) + self.surfoff)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
@@ -702,61 +963,27 @@ class PBout(AmberOutput):
     print_levels = {'BOND':2, 'ANGLE':2, 'DIHED':2, 'VDWAALS':1, 'EEL':1,
                     '1-4 VDW':2, '1-4 EEL':2, 'EPB':1, 'ENPOLAR':1, 'UB':2,
                     'IMP':2,'CMAP':2, 'EDISPER':1}
+    # Layout of the energy terms in the output files
+    energy_blocks = [EnergyBlock(rb' BOND', [_BOND_LINE, _CHAMBER_LINE,
+                                             EnergyLine((('VDWAALS', 2), ('EEL', 5), ('EPB', 8))), _14_LINE,
+                                             EnergyLine((('ENPOLAR', 2), ('EDISPER', 5)))])]
 
     #==================================================
 
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
         AmberOutput.__init__(self, basename, INPUT, num_files, chamber)
         self.apbs = INPUT['sander_apbs']
-        AmberOutput._read(self)
+        AmberOutput._read(self, pool)
         if self.apbs: self.print_levels['EDISPER'] = 3 # never print this for APBS
 
     #==================================================
 
-    def _get_energies(self, outfile):
-        """ Parses the energy values from the output files """
-
-        rawline = outfile.readline()
-
-        while rawline:
-
-            if rawline[0:5] == ' BOND':
-                words = rawline.split()
-                self.data['BOND'] = self.data['BOND'].append(float(words[2]))
-                self.data['ANGLE'] = self.data['ANGLE'].append(float(words[5]))
-                self.data['DIHED'] = self.data['DIHED'].append(float(words[8]))
-                words = outfile.readline().split()
-
-                if self.chamber:
-                    self.data['UB'] = self.data['UB'].append(float(words[2]))
-                    self.data['IMP'] = self.data['IMP'].append(float(words[5]))
-                    self.data['CMAP'] = self.data['CMAP'].append(float(words[8]))
-                    words = outfile.readline().split()
-                else:
-                    self.data['UB'] = self.data['UB'].append(0.0)
-                    self.data['IMP'] = self.data['IMP'].append(0.0)
-                    self.data['CMAP'] = self.data['CMAP'].append(0.0)
-
-                self.data['VDWAALS'] = self.data['VDWAALS'].append(float(words[2]))
-                self.data['EEL'] = self.data['EEL'].append(float(words[5]))
-                self.data['EPB'] = self.data['EPB'].append(float(words[8]))
-                words = outfile.readline().split()
-                self.data['1-4 VDW'] = self.data['1-4 VDW'].append(float(words[3]))
-                self.data['1-4 EEL'] = self.data['1-4 EEL'].append(float(words[7]))
-                words = outfile.readline().split()
-                self.data['ENPOLAR'] = self.data['ENPOLAR'].append(float(words[2]))
-                if not self.apbs:
-                    self.data['EDISPER'] = self.data['EDISPER'].append(float(words[5]))
-                else:
-                    self.data['EDISPER'] = self.data['EDISPER'].append(0.0)
-            # end if rawline == ' BOND'
-
-            rawline = outfile.readline()
-
-        # end while rawline
+    def _zero_terms(self):
+        """ APBS does not print EDISPER """
+        return ('EDISPER',) if self.apbs else ()
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
-import re
+
 class RISMout(AmberOutput):
     # Ordered list of keys in the data dictionary
     data_keys = ['BOND', 'ANGLE', 'DIHED', 'VDWAALS', 'EEL', '1-4 VDW',
@@ -771,64 +998,34 @@ class RISMout(AmberOutput):
     # Which of those keys belong to the gas phase energy contributions
     print_levels = {'BOND':2, 'ANGLE':2, 'DIHED':2, 'VDWAALS':1, 'EEL':1,
                     '1-4 VDW':2, '1-4 EEL':2, 'ERISM':1}
+    # Layout of the solvation terms in the output files for the standard
+    # (solvtype=0) and GF (solvtype=1) free energies
+    solvtype_blocks = ([EnergyBlock(rb'(?:rism_exchem|rism_excessChemicalPotential)\s',
+                                    [EnergyLine((('ERISM', 1),))])],
+                       [EnergyBlock(rb'(?:rism_exchGF|rism_excessChemicalPotentialGF)\s',
+                                    [EnergyLine((('ERISM', 1),))])])
 
     #==================================================
 
-    def __init__(self, basename, INPUT, num_files=1, chamber=False, solvtype=0):
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, solvtype=0, pool=None):
         AmberOutput.__init__(self, basename, INPUT, num_files, chamber)
         self.solvtype = solvtype
-        AmberOutput._read(self)
-
-    #==================================================
-
-    def _get_energies(self, outfile):
-        """ Parses the RISM output file for energy terms """
-
-        # Getting the RISM solvation energies requires some decision-making.
-        # There are 2 possibilities (right now):
-        #
-        # 1. Standard free energy (solvtype==0)
-        # 2. GF free energy (solvtype==1)
-
-        rawline = outfile.readline()
-
-        while rawline:
-
-            if re.match(r'(solute_epot|solutePotentialEnergy)',
-                        rawline):
-                words = rawline.split()
-                self.data['VDWAALS'] = self.data['VDWAALS'].append(float(words[2]))
-                self.data['EEL'] = self.data['EEL'].append(float(words[3]))
-                self.data['BOND'] = self.data['BOND'].append(float(words[4]))
-                self.data['ANGLE'] = self.data['ANGLE'].append(float(words[5]))
-                self.data['DIHED'] = self.data['DIHED'].append(float(words[6]))
-                self.data['1-4 VDW'] = self.data['1-4 VDW'].append(float(words[7]))
-                self.data['1-4 EEL'] = self.data['1-4 EEL'].append(float(words[8]))
-
-            elif self.solvtype == 0 and re.match(
-                    r'(rism_exchem|rism_excessChemicalPotential)\s',rawline):
-                self.data['ERISM'] = self.data['ERISM'].append(float(rawline.split()[1]))
-            elif self.solvtype == 1 and re.match(
-                    r'(rism_exchGF|rism_excessChemicalPotentialGF)\s',rawline):
-                self.data['ERISM'] = self.data['ERISM'].append(float(rawline.split()[1]))
-
-            rawline = outfile.readline()
-
-    #==================================================
+        self.energy_blocks = [_RISM_EPOT] + self.solvtype_blocks[solvtype]
+        AmberOutput._read(self, pool)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
 class RISM_std_Out(RISMout):
     """ No polar decomp RISM output file for standard free energy """
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
-        RISMout.__init__(self, basename, INPUT, num_files, chamber, 0)
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
+        RISMout.__init__(self, basename, INPUT, num_files, chamber, 0, pool)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
 class RISM_gf_Out(RISMout):
     """ No polar decomp RISM output file for Gaussian Fluctuation free energy """
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
-        RISMout.__init__(self, basename, INPUT, num_files, chamber, 1)
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
+        RISMout.__init__(self, basename, INPUT, num_files, chamber, 1, pool)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
@@ -848,61 +1045,30 @@ class PolarRISMout(RISMout):
     # Which of those keys belong to the gas phase energy contributions
     print_levels = {'BOND':2, 'ANGLE':2, 'DIHED':2, 'VDWAALS':1, 'EEL':1,
                     '1-4 VDW':2, '1-4 EEL':2, 'POLAR SOLV':1, 'APOLAR SOLV':1}
-
-    #==================================================
-
-    def _get_energies(self, outfile):
-        """ Parses the RISM output file for energy terms """
-
-        # Getting the RISM solvation energies requires some decision-making.
-        # There are 2 possibilities (right now):
-        #
-        # 1. Standard free energy (solvtype==0)
-        # 2. GF free energy (solvtype==1)
-
-        rawline = outfile.readline()
-
-        while rawline:
-
-            if re.match(r'(solute_epot|solutePotentialEnergy)',
-                        rawline):
-                words = rawline.split()
-                self.data['VDWAALS'] = self.data['VDWAALS'].append(float(words[2]))
-                self.data['EEL'] = self.data['EEL'].append(float(words[3]))
-                self.data['BOND'] = self.data['BOND'].append(float(words[4]))
-                self.data['ANGLE'] = self.data['ANGLE'].append(float(words[5]))
-                self.data['DIHED'] = self.data['DIHED'].append(float(words[6]))
-                self.data['1-4 VDW'] = self.data['1-4 VDW'].append(float(words[8]))
-                self.data['1-4 EEL'] = self.data['1-4 EEL'].append(float(words[8]))
-
-            elif self.solvtype == 0 and re.match(
-                    r'(rism_polar|rism_polarExcessChemicalPotential)\s',rawline):
-                self.data['POLAR SOLV'] = self.data['POLAR SOLV'].append(float(rawline.split()[1]))
-            elif self.solvtype == 0 and re.match(
-                    r'(rism_apolar|rism_apolarExcessChemicalPotential)\s',rawline):
-                self.data['APOLAR SOLV'] = self.data['APOLAR SOLV'].append(float(rawline.split()[1]))
-            elif self.solvtype == 1 and re.match(
-                    r'(rism_polGF|rism_polarExcessChemicalPotentialGF)\s',rawline):
-                self.data['POLAR SOLV'] = self.data['POLAR SOLV'].append(float(rawline.split()[1]))
-            elif self.solvtype == 1 and re.match(
-                    r'(rism_apolGF|rism_apolarExcessChemicalPotentialGF)\s',rawline):
-                self.data['APOLAR SOLV'] = self.data['APOLAR SOLV'].append(float(rawline.split()[1]))
-
-            rawline = outfile.readline()
+    # Layout of the solvation terms in the output files for the standard
+    # (solvtype=0) and GF (solvtype=1) free energies
+    solvtype_blocks = ([EnergyBlock(rb'(?:rism_polar|rism_polarExcessChemicalPotential)\s',
+                                    [EnergyLine((('POLAR SOLV', 1),))]),
+                        EnergyBlock(rb'(?:rism_apolar|rism_apolarExcessChemicalPotential)\s',
+                                    [EnergyLine((('APOLAR SOLV', 1),))])],
+                       [EnergyBlock(rb'(?:rism_polGF|rism_polarExcessChemicalPotentialGF)\s',
+                                    [EnergyLine((('POLAR SOLV', 1),))]),
+                        EnergyBlock(rb'(?:rism_apolGF|rism_apolarExcessChemicalPotentialGF)\s',
+                                    [EnergyLine((('APOLAR SOLV', 1),))])])
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 class PolarRISM_std_Out(PolarRISMout):
     """ Polar decomp RISM output file for standard free energy """
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
-        RISMout.__init__(self, basename, INPUT, num_files, chamber, 0)
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
+        RISMout.__init__(self, basename, INPUT, num_files, chamber, 0, pool)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
 class PolarRISM_gf_Out(PolarRISMout):
     """ Polar decomp RISM output file for Gaussian Fluctuation free energy """
-    def __init__(self, basename, INPUT, num_files=1, chamber=False):
-        RISMout.__init__(self, basename, INPUT, num_files, chamber, 1)
+    def __init__(self, basename, INPUT, num_files=1, chamber=False, pool=None):
+        RISMout.__init__(self, basename, INPUT, num_files, chamber, 1, pool)
 
 #-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-
 
@@ -925,60 +1091,12 @@ class QMMMout(GBout):
     print_levels = {'BOND':2, 'ANGLE':2, 'DIHED':2, 'VDWAALS':1, 'EEL':1,
                     '1-4 VDW':2, '1-4 EEL':2, 'EGB':1, 'ESURF':1, 'ESCF':1,
                     'UB':2, 'IMP':2, 'CMAP':2}
-
-    #==================================================
-
-    def _get_energies(self, outfile):
-        """ Parses the energies from a QM/MM output file. NOTE, however, that a
-            QMMMout *could* just be a GBout with ESCF==0 if the QM region lies
-            entirely outside this system
-        """
-
-        rawline = outfile.readline()
-
-        while rawline:
-
-            if rawline[0:5] == ' BOND':
-                words = rawline.split()
-                self.data['BOND'] = self.data['BOND'].append(float(words[2]))
-                self.data['ANGLE'] = self.data['ANGLE'].append(float(words[5]))
-                self.data['DIHED'] = self.data['DIHED'].append(float(words[8]))
-                words = outfile.readline().split()
-
-                if self.chamber:
-                    self.data['UB'] = self.data['UB'].append(float(words[2]))
-                    self.data['IMP'] = self.data['IMP'].append(float(words[5]))
-                    self.data['CMAP'] = self.data['CMAP'].append(float(words[8]))
-                    words = outfile.readline().split()
-                else:
-                    self.data['UB'] = self.data['UB'].append(0.0)
-                    self.data['IMP'] = self.data['IMP'].append(0.0)
-                    self.data['CMAP'] = self.data['CMAP'].append(0.0)
-
-                self.data['VDWAALS'] = self.data['VDWAALS'].append(float(words[2]))
-                self.data['EEL'] = self.data['EEL'].append(float(words[5]))
-                self.data['EGB'] = self.data['EGB'].append(float(words[8]))
-                words = outfile.readline().split()
-                self.data['1-4 VDW'] = self.data['1-4 VDW'].append(float(words[3]))
-                self.data['1-4 EEL'] = self.data['1-4 EEL'].append(float(words[7]))
-                words = outfile.readline().split()
-                # This is where ESCF will be. Since ESCF can differ based on which
-                # qmtheory was chosen, we just check to see if it's != ESURF:
-                if words[0] != 'minimization':
-                    # It's possible that there is no space between ***ESCF and the =.
-                    # If not, the ESCF variable will be the second, not the 3rd word
-                    if words[0].endswith('='):
-                        self.data['ESCF'] = self.data['ESCF'].append(float(words[1]))
-                    else:
-                        self.data['ESCF'] = self.data['ESCF'].append(float(words[2]))
-                else:
-                    self.data['ESCF'] = self.data['ESCF'].append(0.0)
-
-            rawline = outfile.readline()
-
-            # end if rawline[0:5] == ' BOND':
-
-        # end while rawline
+    # Layout of the energy terms in the output files. The line after 1-4 VDW
+    # holds ESCF, whose name depends on qmtheory. If the QM region lies entirely
+    # outside this system, that line is the minimization summary and ESCF is 0
+    energy_blocks = [EnergyBlock(rb' BOND', [_BOND_LINE, _CHAMBER_LINE,
+                                             EnergyLine((('VDWAALS', 2), ('EEL', 5), ('EGB', 8))), _14_LINE,
+                                             EnergyLine((('ESCF', None),), unless=b'minimization')])]
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
@@ -1024,6 +1142,30 @@ class BindingStatistics(object):
 
     #==================================================
 
+    def delta_stats(self):
+        """
+        Sets the [average, standard deviation] of every difference from the
+        statistics of the complex, receptor and ligand terms. Composite terms
+        must be filled already, so it works on EnergyMoments as well (see
+        main._reduce_statistics)
+        """
+        for key in self.com.data_keys:
+            self.data[key] = [self.com.data[key].avg() - self.rec.data[key].avg() -
+                              self.lig.data[key].avg(),
+                              sqrt(self.com.data[key].stdev() ** 2 +
+                                   self.rec.data[key].stdev() ** 2 +
+                                   self.lig.data[key].stdev() ** 2) ]
+
+        for key in self.com.composite_keys:
+            self.data['DELTA ' + key] = \
+                [self.com.data[key].avg() - self.rec.data[key].avg() -
+                 self.lig.data[key].avg(),
+                 sqrt(self.com.data[key].stdev() ** 2 +
+                      self.rec.data[key].stdev() ** 2 +
+                      self.lig.data[key].stdev() ** 2) ]
+
+    #==================================================
+
     def print_vectors(self, csvwriter):
         """ Output all of the energy terms including the differences if we're
             doing a single trajectory simulation and there are no missing terms
@@ -1237,21 +1379,7 @@ class SingleTrajBinding(BindingStatistics):
         self.com.fill_composite_terms()
         self.rec.fill_composite_terms()
         self.lig.fill_composite_terms()
-
-        for key in self.com.data_keys:
-            self.data[key] = [self.com.data[key].avg() - self.rec.data[key].avg() -
-                              self.lig.data[key].avg(),
-                              sqrt(self.com.data[key].stdev() ** 2 +
-                                   self.rec.data[key].stdev() ** 2 +
-                                   self.lig.data[key].stdev() ** 2) ]
-
-        for key in self.com.composite_keys:
-            self.data['DELTA ' + key] = \
-                [self.com.data[key].avg() - self.rec.data[key].avg() -
-                 self.lig.data[key].avg(),
-                 sqrt(self.com.data[key].stdev() ** 2 +
-                      self.rec.data[key].stdev() ** 2 +
-                      self.lig.data[key].stdev() ** 2) ]
+        self.delta_stats()
 
     #==================================================
 
@@ -1408,6 +1536,18 @@ class MultiTrajBinding(BindingStatistics):
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+def _merge_moments(parts):
+    """ Merges the {token: {term: EnergyMoments}} of every rank """
+    merged = {}
+    for part in parts:
+        for token, terms in part.items():
+            merged_terms = merged.setdefault(token, {})
+            for term, moments in terms.items():
+                merged_terms[term] = merged_terms.get(term, EnergyMoments()).merge(moments)
+    return merged
+
+#+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
 class DecompOut(object):
     " Class for decomposition output file to collect statistics and output them "
 
@@ -1415,16 +1555,20 @@ class DecompOut(object):
     descriptions = { 'TDC' : 'Total Energy Decomposition:',
                      'SDC' : 'Sidechain Energy Decomposition:',
                      'BDC' : 'Backbone Energy Decomposition:' }
+    terms = ('int', 'vdw', 'eel', 'pol', 'sas', 'tot')
+    # Fixed-width columns of a TDC/SDC/BDC row: residue number(s), then the
+    # internal, vdw, eel, pol and sas energies
+    res_fields = ((4, 10),)
+    energy_fields = ((11, 20), (21, 30), (31, 40), (41, 50), (51, 60))
 
     #==================================================
 
     def __init__(self, basename, prmtop, surften, csvwriter, num_files=1,
-                 verbose=1):
+                 verbose=1, pool=None):
         from csv import writer
         self.basename = basename # base name of output files
         self.prmtop = prmtop # AmberParm prmtop object
         self.num_files = num_files # how many MPI files we created
-        self.termnum = 0 # which term number we are on
         self.surften = surften # surface tension to multiply SAS by
         self.verbose = verbose
         # Set the term-extractor based on whether we want to dump the values to
@@ -1449,22 +1593,12 @@ class DecompOut(object):
         else:
             self.csvwriter = None
 
-        self.current_file = 0 # File counter
-        try:
-            self.num_terms = int(self.get_num_terms())
-        except TypeError:
+        self.num_terms = int(self.get_num_terms())
+        if not self.num_terms:
             raise OutputError('DecompOut: Not a decomp output file')
-        self.data = {}
-        for token in self.allowed_tokens:
-            self.data[token] = {'int': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)],
-                                'vdw': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)],
-                                'eel': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)],
-                                'pol': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)],
-                                'sas': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)],
-                                'tot': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)] }
-            self.resnums               = [[0 for i in range(self.num_terms)],
-                                          [0 for i in range(self.num_terms)]]
-        self.decfile = open(basename + '.0', 'r')
+        self.row = 0 # next row handed out by get_next_term
+        self.moments = None # merged statistics of all ranks (see merge_moments)
+        self._parse(pool)
 
     #==================================================
 
@@ -1489,68 +1623,140 @@ class DecompOut(object):
         return num_terms
 
     #==================================================
+
+    def _parse(self, pool=None):
+        """
+        Reads the rows of every decomp block in all of the files into one
+        (frames x terms x 6) array per token, and the sums and sums of squares
+        over the frames into self.data. With a RankPool that does not gather,
+        only the files of this rank are read
+        """
+        mapper = map if pool is None else pool.map
+        pieces = [piece for piece in mapper(self._read_file, range(self.num_files)) if piece is not None]
+        if pieces:
+            resnums, energies = zip(*pieces)
+            resnums = np.concatenate(resnums)
+            energies = np.concatenate(energies)
+        else:
+            energies = np.zeros((0, len(self.allowed_tokens), self.num_terms, len(self.terms)))
+        self.numframes = len(energies)
+        self.resnums = [[0] * self.num_terms, [0] * self.num_terms]
+        if self.numframes:
+            for i in range(len(self.res_fields)):
+                self.resnums[i] = resnums[0, :, i].tolist()
+        self.energies = {}
+        self.data = {}
+        for i, token in enumerate(self.allowed_tokens):
+            self.energies[token] = energies[:, i]
+            self.data[token] = {term: [EnergyVector(self.energies[token][:, :, j].sum(axis=0)),
+                                       EnergyVector((self.energies[token][:, :, j] ** 2).sum(axis=0))]
+                                for j, term in enumerate(self.terms)}
+
+    #==================================================
+
+    def get_moments(self):
+        """ Returns {token: {term: EnergyMoments}} of the frames parsed here """
+        return {token: {term: EnergyMoments.from_vector(self.energies[token][:, :, j])
+                        for j, term in enumerate(self.terms)}
+                for token in self.allowed_tokens}
+
+    #==================================================
+
+    def merge_moments(self, parts):
+        """
+        Takes the statistics of all frames from the get_moments of every rank,
+        in place of the frames parsed here. The summaries are written from
+        them, but there are no frames left for get_next_term or get_data
+        """
+        self.moments = _merge_moments(parts)
+        self.numframes = self.moments[self.allowed_tokens[0]]['tot'].count
+        self.energies = None
+        for token in self.allowed_tokens:
+            self.data[token] = {term: [EnergyVector(value) for value in self.moments[token][term].sums()]
+                                for term in self.terms}
+
+    #==================================================
+
+    def _read_file(self, fileno):
+        """
+        Slices the fixed-width columns of the TDC/SDC/BDC rows of one file.
+        Returns the residue numbers and the energies, shaped (frames x tokens x
+        terms x columns)
+        """
+        row_re = re.compile(br'\n((?:%s) [^\n]*)' % b'|'.join(tok.encode() for tok in self.allowed_tokens))
+        with _mapped('%s.%d' % (self.basename, fileno)) as buffer:
+            start = buffer.find(self.indicator.encode())
+            rows = row_re.findall(buffer, start) if start != -1 else []
+        width = self.energy_fields[-1][1]
+        chars = np.array(rows, dtype='S%d' % width).view(np.uint8).reshape(len(rows), width)
+        del rows
+
+        def column(start, end, dtype=float):
+            return np.ascontiguousarray(chars[:, start:end]).view('S%d' % (end - start)).ravel().astype(dtype)
+
+        # The blocks must come in the order of allowed_tokens in every frame
+        block = len(self.allowed_tokens) * self.num_terms
+        tokens = column(0, 3, 'U3')
+        expected = np.tile(np.repeat(self.allowed_tokens, self.num_terms), len(chars) // block + 1)[:len(chars)]
+        wrong = np.flatnonzero(tokens != expected)
+        if wrong.size:
+            raise OutputError(('Expecting %s type, but got %s type. Re-run ' +
+                               'gmx_MMPBSA with the correct dec_verbose') % (expected[wrong[0]], tokens[wrong[0]]))
+        numframes = len(chars) // block
+        chars = chars[:numframes * block]
+        # The rows are padded with NULs, so a row cut short ends with one
+        short = np.flatnonzero(chars[:, -1] == 0)
+        if short.size:
+            fname = '%s.%d' % (self.basename, fileno)
+            with _mapped(fname) as buffer:
+                for i, match in enumerate(row_re.finditer(buffer, start)):
+                    if i == short[0]:
+                        break
+                line = buffer[:match.start(1)].count(b'\n') + 1
+                row = match.group(1).decode(errors='replace')
+            raise OutputError('%s, line %d: decomp row shorter than %d characters (%r). The calculation may have '
+                              'failed' % (fname, line, width, row))
+
+        resnums = np.empty((len(chars), len(self.res_fields)), dtype=int)
+        for i, (start, end) in enumerate(self.res_fields):
+            resnums[:, i] = column(start, end, int)
+        energies = np.empty((len(chars), len(self.terms)))
+        for i, (start, end) in enumerate(self.energy_fields):
+            energies[:, i] = column(start, end)
+        energies[:, 4] *= self.surften
+        energies[:, 5] = energies[:, 0] + energies[:, 1] + energies[:, 2] + energies[:, 3] + energies[:, 4]
+        return (resnums.reshape(numframes * len(self.allowed_tokens), self.num_terms, len(self.res_fields)),
+                energies.reshape(numframes, len(self.allowed_tokens), self.num_terms, len(self.terms)))
+
+    #==================================================
+
     def get_data(self, nframes, reslist=None):
+        """ Returns {token: {residue: {term: EnergyVector}}} for the first nframes """
         array_data = {key: {} for key in self.allowed_tokens}
-        for i in range(nframes):
-            for key in self.allowed_tokens:
-                for _ in range(self.num_terms):
-                    rnum, internal, vdw, eel, pol, sas, tot = self.get_next_term(key)
-                    if reslist:
-                        rnum = reslist[rnum - 1].string
-                    if rnum not in array_data[key]:
-                        array_data[key][rnum] = {}
-                        for k in ('int', 'vdw', 'eel', 'pol', 'sas', 'tot'):
-                            array_data[key][rnum][k] = EnergyVector(nframes)
-                    array_data[key][rnum]['int'][i] = internal
-                    array_data[key][rnum]['vdw'][i] = vdw
-                    array_data[key][rnum]['eel'][i] = eel
-                    array_data[key][rnum]['pol'][i] = pol
-                    array_data[key][rnum]['sas'][i] = sas
-                    array_data[key][rnum]['tot'][i] = tot
+        for key in self.allowed_tokens:
+            energies = self.energies[key][:nframes]
+            for i, rnum in enumerate(self.resnums[0]):
+                if reslist:
+                    rnum = reslist[rnum - 1].string
+                array_data[key][rnum] = {term: EnergyVector(energies[:, i, j]) for j, term in enumerate(self.terms)}
         return array_data
 
     def _get_next_term(self, expected_type, framenum=1):
-        """ Gets the next energy term from the output file(s) """
-        line = self.decfile.readline()
+        """ Gets the next energy term from the parsed output file(s) """
         if expected_type and expected_type not in self.allowed_tokens:
             raise OutputError('BUGBUG: expected_type must be in %s' % self.allowed_tokens)
-        while line[0:3] not in self.allowed_tokens:
-            # We only get in here if we've gone off the end of a block, so our
-            # current term number is 0 now.
-            self.termnum = 0
-            line = self.decfile.readline()
-            if not line:
-                self.decfile.close()
-                if self.current_file == self.num_files - 1: return []
-                self.current_file += 1
-                self.decfile = open('%s.%d' % (self.basename,self.current_file),'r')
-                line = self.decfile.readline()
-        # Return [res #, internal, vdw, eel, pol, sas]
-        if expected_type and expected_type != line[0:3]:
+        frame, term = divmod(self.row, self.num_terms)
+        frame, token = divmod(frame, len(self.allowed_tokens))
+        if frame == self.numframes:
+            return []
+        token = self.allowed_tokens[token]
+        if expected_type and expected_type != token:
             raise OutputError(('Expecting %s type, but got %s type. Re-run ' +
-                               'gmx_MMPBSA with the correct dec_verbose') % (expected_type, line[0:3]))
-        resnum = int(line[4:10])
-        internal = float(line[11:20])
-        vdw = float(line[21:30])
-        eel = float(line[31:40])
-        pol = float(line[41:50])
-        sas = float(line[51:60]) * self.surften
-        tot = internal + vdw + eel + pol + sas
-        self.resnums[0][self.termnum] = resnum
-        self.data[line[0:3]]['int'][0][self.termnum] += internal
-        self.data[line[0:3]]['int'][1][self.termnum] += internal**2
-        self.data[line[0:3]]['vdw'][0][self.termnum] += vdw
-        self.data[line[0:3]]['vdw'][1][self.termnum] += vdw**2
-        self.data[line[0:3]]['eel'][0][self.termnum] += eel
-        self.data[line[0:3]]['eel'][1][self.termnum] += eel**2
-        self.data[line[0:3]]['pol'][0][self.termnum] += pol
-        self.data[line[0:3]]['pol'][1][self.termnum] += pol**2
-        self.data[line[0:3]]['sas'][0][self.termnum] += sas
-        self.data[line[0:3]]['sas'][1][self.termnum] += sas**2
-        self.data[line[0:3]]['tot'][0][self.termnum] += tot
-        self.data[line[0:3]]['tot'][1][self.termnum] += tot**2
-        self.termnum += 1
-        return [resnum, internal, vdw, eel, pol, sas, tot]
+                               'gmx_MMPBSA with the correct dec_verbose') % (expected_type, token))
+        self.row += 1
+        # Return [res #, internal, vdw, eel, pol, sas, tot]
+        return ([self.resnums[i][term] for i in range(len(self.res_fields))] +
+                self.energies[token][frame, term].tolist())
 
     #==================================================
 
@@ -1559,6 +1765,10 @@ class DecompOut(object):
         This is for stability calculations -- just get all of the terms to
         fill up the data arrays.
         """
+        # Every term is already in the data arrays, so only the CSV dump needs
+        # to walk through them
+        if not self.csvwriter:
+            return
         token_counter = 0
         searched_type = self.allowed_tokens[0]
         framenum = 1
@@ -1574,8 +1784,6 @@ class DecompOut(object):
             if token_counter % len(self.allowed_tokens) == 0: framenum += 1
             com_token = self.get_next_term(searched_type, framenum)
 
-        self.numframes = framenum - 1
-
     #==================================================
 
     def _get_next_term_csv(self, expected_type, framenum=1):
@@ -1670,80 +1878,24 @@ class PairDecompOut(DecompOut):
     """ Same as DecompOut, but for Pairwise decomposition """
 
     indicator = "                    PRINT PAIR DECOMP - TOTAL ENERGIES"
+    res_fields = ((4, 11), (13, 20))
+    energy_fields = ((21, 33), (34, 46), (47, 59), (60, 72), (73, 85))
 
     #==================================================
 
     def get_data(self, nframes, reslist=None):
-        array_data = {}
+        """ Returns {token: {residue: {residue 2: {term: EnergyVector}}}} for the first nframes """
+        array_data = {key: {} for key in self.allowed_tokens}
         for key in self.allowed_tokens:
-            array_data[key] = {}
-        for i in range(nframes):
-            for key in self.allowed_tokens:
-                for _ in range(self.num_terms):
-                    rnum, rnum2, internal, vdw, eel, pol, sas, tot = self.get_next_term(key)
-                    if reslist:
-                        rnum = reslist[rnum - 1].string
-                        rnum2 = reslist[rnum2 - 1].string
-                    if rnum not in array_data[key]:
-                        array_data[key][rnum] = {}
-                    if rnum2 not in array_data[key][rnum]:
-                        array_data[key][rnum][rnum2] = {}
-                        for k in ('int', 'vdw', 'eel', 'pol', 'sas', 'tot'):
-                            array_data[key][rnum][rnum2][k] = EnergyVector(nframes)
-                    array_data[key][rnum][rnum2]['int'][i] = internal
-                    array_data[key][rnum][rnum2]['vdw'][i] = vdw
-                    array_data[key][rnum][rnum2]['eel'][i] = eel
-                    array_data[key][rnum][rnum2]['pol'][i] = pol
-                    array_data[key][rnum][rnum2]['sas'][i] = sas
-                    array_data[key][rnum][rnum2]['tot'][i] = tot
+            energies = self.energies[key][:nframes]
+            for i, (rnum, rnum2) in enumerate(zip(*self.resnums)):
+                if reslist:
+                    rnum = reslist[rnum - 1].string
+                    rnum2 = reslist[rnum2 - 1].string
+                array_data[key].setdefault(rnum, {})[rnum2] = {term: EnergyVector(energies[:, i, j])
+                                                               for j, term in enumerate(self.terms)}
         return array_data
 
-    def _get_next_term(self, expected_type=None, framenum=1):
-        """ Gets the next energy term from the output file(s) """
-        line = self.decfile.readline()
-        if expected_type and not expected_type in self.allowed_tokens:
-            raise OutputError('BUGBUG: expected_type must be in %s' %
-                              self.allowed_tokens)
-        while not line[0:3] in self.allowed_tokens:
-            # We only get in here if we've gone off the end of a block, so our
-            # current term number is 0 now.
-            self.termnum = 0
-            line = self.decfile.readline()
-            if not line:
-                self.decfile.close()
-                if self.current_file == self.num_files - 1: return []
-                self.current_file += 1
-                self.decfile = open('%s.%d' % (self.basename,self.current_file),'r')
-                line = self.decfile.readline()
-        # Return [res #, internal, vdw, eel, pol, sas]
-        if expected_type and expected_type != line[0:3]:
-            raise OutputError(('Expecting %s type, but got %s type. Re-run ' +
-                               'gmx_MMPBSA with the correct dec_verbose') % (expected_type, line[0:3]))
-        resnum = int(line[4:11])
-        resnum2 = int(line[13:20])
-        internal = float(line[21:33])
-        vdw = float(line[34:46])
-        eel = float(line[47:59])
-        pol = float(line[60:72])
-        sas = float(line[73:85]) * self.surften
-        tot = internal + vdw + eel + pol + sas
-        self.data[line[0:3]]['int'][0][self.termnum] += internal
-        self.data[line[0:3]]['int'][1][self.termnum] += internal * internal
-        self.data[line[0:3]]['vdw'][0][self.termnum] += vdw
-        self.data[line[0:3]]['vdw'][1][self.termnum] += vdw * vdw
-        self.data[line[0:3]]['eel'][0][self.termnum] += eel
-        self.data[line[0:3]]['eel'][1][self.termnum] += eel * eel
-        self.data[line[0:3]]['pol'][0][self.termnum] += pol
-        self.data[line[0:3]]['pol'][1][self.termnum] += pol * pol
-        self.data[line[0:3]]['sas'][0][self.termnum] += sas
-        self.data[line[0:3]]['sas'][1][self.termnum] += sas * sas
-        self.data[line[0:3]]['tot'][0][self.termnum] += tot
-        self.data[line[0:3]]['tot'][1][self.termnum] += tot * tot
-        self.resnums[0][self.termnum] = resnum
-        self.resnums[1][self.termnum] = resnum2
-        self.termnum += 1
-        return [resnum, resnum2, internal, vdw, eel, pol, sas, tot]
-
     #==================================================
 
     def write_summary(self, numframes, output_file):
@@ -1900,6 +2052,7 @@ class DecompBinding(object):
                                       'tot': [EnergyVector(self.num_terms), EnergyVector(self.num_terms)] }
             self.resnums               = [[0 for i in range(self.num_terms)],
                                           [0 for i in range(self.num_terms)]]
+        self.moments = None # merged statistics of the DELTAs (see merge_moments)
 
     #==================================================
 
@@ -1911,6 +2064,76 @@ class DecompBinding(object):
 
     #==================================================
 
+    def _pairing(self):
+        """
+        Returns which complex terms are paired with the next receptor term and
+        which with the next ligand term, as _parse_all_begin pairs them
+        """
+        res_list = self.prmtop_system.res_list
+        in_rec = np.array([bool(res_list[resnum-1].receptor_number) for resnum in self.com.resnums[0]])
+        return in_rec, ~in_rec
+
+    #==================================================
+
+    def _fill_resnums(self):
+        """ Labels every term with its residue and its location """
+        parm_data = self.prmtop_system.complex_prmtop.parm_data
+        for i, resnum in enumerate(self.com.resnums[0]):
+            resnam = parm_data['RESIDUE_LABEL'][resnum-1]
+            self.resnums[0][i] = '%3s%4d' % (resnam, resnum)
+            if self.prmtop_system.res_list[resnum-1].receptor_number:
+                self.resnums[1][i] = 'R %3s%4d' % (resnam, self.prmtop_system.res_list[resnum-1].receptor_number)
+            else:
+                self.resnums[1][i] = 'L %3s%4d' % (resnam, self.prmtop_system.res_list[resnum-1].ligand_number)
+
+    #==================================================
+
+    def get_moments(self):
+        """
+        Returns {token: {term: EnergyMoments}} of the DELTAs of the frames
+        parsed here by com, rec and lig
+        """
+        if not self.com.numframes:
+            return {token: {term: EnergyMoments() for term in DecompOut.terms} for token in self.allowed_tokens}
+        if self.com.numframes != self.rec.numframes or self.com.numframes != self.lig.numframes:
+            raise DecompError('Mismatch in number of decomp frames!')
+        in_rec, in_lig = self._pairing()
+        if in_rec.sum() != self.rec.num_terms or in_lig.sum() != self.lig.num_terms:
+            raise DecompError('Mismatch in number of decomp terms!')
+        moments = {}
+        for token in self.allowed_tokens:
+            deltas = self.com.energies[token].copy()
+            deltas[:, in_rec] -= self.rec.energies[token]
+            deltas[:, in_lig] -= self.lig.energies[token]
+            moments[token] = {term: EnergyMoments.from_vector(deltas[:, :, j])
+                              for j, term in enumerate(DecompOut.terms)}
+        return moments
+
+    #==================================================
+
+    def merge_moments(self, parts):
+        """
+        Takes the statistics of the DELTAs of all frames from the get_moments of
+        every rank. com, rec and lig must hold their merged statistics too
+        """
+        self.moments = _merge_moments(parts)
+
+    #==================================================
+
+    def _parse_moments(self):
+        """ Fills the DELTAs from the merged statistics instead of the frames """
+        self._fill_resnums()
+        for token in self.allowed_tokens:
+            for term in DecompOut.terms:
+                self.data[token][term] = [EnergyVector(value) for value in self.moments[token][term].sums()]
+        self.numframes = self.com.numframes
+        self.num_com_frames = self.numframes
+        self.num_rec_frames = self.numframes
+        self.num_lig_frames = self.numframes
+        self._calc_avg_stdev()
+
+    #==================================================
+
     def _parse_all_begin(self):
         """ Parses through all of the terms in all of the frames, but doesn't
             do any printing
@@ -1918,6 +2141,8 @@ class DecompBinding(object):
         # For per-residue decomp, we need terms to match up
         if self.com.num_terms != (self.rec.num_terms + self.lig.num_terms):
             raise DecompError('Mismatch in number of decomp terms!')
+        if self.moments is not None:
+            return self._parse_moments()
         # Get the first complex term, then parse through the rest of them
         token_counter = 0
         searched_token = self.allowed_tokens[0]
@@ -2168,10 +2393,35 @@ class PairDecompBinding(DecompBinding):
 
     #==================================================
 
+    def _pairing(self):
+        """
+        Returns which complex pairs are paired with the next receptor pair and
+        which with the next ligand pair. The others are only in the complex
+        """
+        res_list = self.prmtop_system.res_list
+        in_rec = np.array([bool(res_list[resnum-1].receptor_number and res_list[resnum2-1].receptor_number)
+                           for resnum, resnum2 in zip(*self.com.resnums)])
+        in_lig = np.array([bool(not res_list[resnum-1].receptor_number and res_list[resnum2-1].ligand_number)
+                           for resnum, resnum2 in zip(*self.com.resnums)])
+        return in_rec, in_lig
+
+    #==================================================
+
+    def _fill_resnums(self):
+        """ Labels every term with its pair of residues """
+        parm_data = self.prmtop_system.complex_prmtop.parm_data
+        for i, (resnum, resnum2) in enumerate(zip(*self.com.resnums)):
+            self.resnums[0][i] = '%3s%4d' % (parm_data['RESIDUE_LABEL'][resnum-1], resnum)
+            self.resnums[1][i] = '%3s%4d' % (parm_data['RESIDUE_LABEL'][resnum2-1], resnum2)
+
+    #==================================================
+
     def _parse_all_begin(self):
         """ Parses through all of the terms in all of the frames, but doesn't
             do any printing
         """
+        if self.moments is not None:
+            return self._parse_moments()
         # Get the first complex term, then parse through the rest of them
         token_counter = 0
         searched_token = self.allowed_tokens[0]
@@ -2394,55 +2644,35 @@ class MultiTrajDecompBinding(DecompBinding):
 
     #==================================================
 
-    def _parse_all_begin(self):
-        """ Parses all of the files """
-        self.num_com_frames = 0
-        self.num_rec_frames = 0
-        self.num_lig_frames = 0
+    def _count_frames(self, output):
+        """ Walks through all of the terms of output (for the CSV dump) and
+            returns its number of frames
+        """
+        # The merged statistics (see DecompOut.merge_moments) have no terms
+        if output.moments is not None:
+            return output.numframes
         token_counter = 0
         framenum = 1
         searched_token = self.allowed_tokens[0]
-        my_term = self.com.get_next_term(searched_token, framenum)
-        while my_term:
-            for i in range(1, self.com.num_terms):
-                my_term = self.com.get_next_term(searched_token, framenum)
-
-            token_counter += 1
-            searched_token = self.allowed_tokens[token_counter %
-                                                 len(self.allowed_tokens)]
-            if token_counter % len(self.allowed_tokens) == 0: framenum += 1
-            my_term = self.com.get_next_term(searched_token, framenum)
-        self.num_com_frames = framenum - 1
-
-        token_counter = 0
-        searched_token = self.allowed_tokens[0]
-        framenum = 1
-        my_term = self.rec.get_next_term(searched_token, framenum)
+        my_term = output.get_next_term(searched_token, framenum)
         while my_term:
-            for i in range(1, self.rec.num_terms):
-                my_term = self.rec.get_next_term(searched_token, framenum)
+            for i in range(1, output.num_terms):
+                my_term = output.get_next_term(searched_token, framenum)
 
             token_counter += 1
             searched_token = self.allowed_tokens[token_counter %
                                                  len(self.allowed_tokens)]
             if token_counter % len(self.allowed_tokens) == 0: framenum += 1
-            my_term = self.rec.get_next_term(searched_token, framenum)
-        self.num_rec_frames = framenum - 1
+            my_term = output.get_next_term(searched_token, framenum)
+        return framenum - 1
 
-        token_counter = 0
-        searched_token = self.allowed_tokens[0]
-        framenum = 1
-        my_term = self.lig.get_next_term(searched_token, framenum)
-        while my_term:
-            for i in range(1, self.lig.num_terms):
-                my_term = self.lig.get_next_term(searched_token, framenum)
+    #==================================================
 
-            token_counter += 1
-            searched_token = self.allowed_tokens[token_counter %
-                                                 len(self.allowed_tokens)]
-            if token_counter % len(self.allowed_tokens) == 0: framenum += 1
-            my_term = self.lig.get_next_term(searched_token, framenum)
-        self.num_lig_frames = framenum - 1
+    def _parse_all_begin(self):
+        """ Parses all of the files """
+        self.num_com_frames = self._count_frames(self.com)
+        self.num_rec_frames = self._count_frames(self.rec)
+        self.num_lig_frames = self._count_frames(self.lig)
 
         # Fill the self.resnums
         for i in range(self.com.num_terms):
@@ -2558,11 +2788,7 @@ def _get_cpptraj_surf(fname):
     This function will parse out the surface areas printed out by cpptraj in a
     standard data file and return it as an EnergyVector instance.
     """
-    f = open(fname, 'r')
-    vec = EnergyVector()
-    for line in f:
-        if line.startswith('#'):
-            continue
-        vec = vec.append(float(line.split()[1]))
+    with open(fname, 'r') as f:
+        surf = [float(line.split()[1]) for line in f if not line.startswith('#')]
 
-    return vec
+    return EnergyVector(surf)
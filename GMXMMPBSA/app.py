@@ -82,7 +82,7 @@ def gmxmmpbsa():
 
     # If we're not rewriting output do whole shebang, otherwise load info and parms
     # Throw up a barrier before and after running the actual calcs
-    if not app.FILES.rewrite_output:
+    if not (app.FILES.rewrite_output or app.FILES.merge):
         try:
             app.read_input_file()
         except InputError as e:
@@ -94,15 +94,37 @@ def gmxmmpbsa():
         app.check_for_bad_input()
         app.make_prmtops()
         app.loadcheck_prmtops()
-        app.file_setup()
-        app.run_mmpbsa()
+        # Print the task graph and quit
+        if app.FILES.dry_run:
+            app.build_pipeline().write_graph(app.stdout)
+            sys.exit(0)
+        if app.shard:
+            app.setup_shard()
+        if app.INPUT['adaptive_sem'] or app.INPUT['adaptive_time']:
+            app.run_adaptive()
+        elif app.FILES.pipeline:
+            app.run_pipeline()
+        else:
+            app.file_setup()
+            app.run_mmpbsa()
+    # If we are merging shards, load the info of the shards and check prmtops
+    elif app.FILES.merge:
+        app.merge_shards()
+        app.make_prmtops()
+        app.loadcheck_prmtops()
     # If we are rewriting output, load the info and check prmtops
     else:
         info = InfoFile(app)
         info.read_info()
+        # Only the output files of the last pass are left
+        if app.INPUT.get('adaptive_sem') or app.INPUT.get('adaptive_time'):
+            GMXMMPBSA_ERROR('-rewrite-output is not available for adaptive sampling runs', InputError)
         app.make_prmtops()
         app.loadcheck_prmtops()
 
+    # A shard only leaves its outputs for -merge
+    if app.shard:
+        app.finalize()
     # Now we parse the output, print, and finish
     app.parse_output_files()
     app.write_final_outputs()
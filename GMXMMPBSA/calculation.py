@@ -35,8 +35,11 @@ Classes:
 
 from GMXMMPBSA.exceptions import CalcError
 from GMXMMPBSA.exceptions import GMXMMPBSA_ERROR, GMXMMPBSA_WARNING
+from GMXMMPBSA.scheduler import TaskScheduler
+from GMXMMPBSA.costmodel import natoms, calc_kind
 import os
 import sys
+import time
 import numpy as np
 import math
 
@@ -44,12 +47,23 @@ import math
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 class CalculationList(list):
-    """ This contains the list of all calculations that need to be run """
+    """
+    This contains the list of all calculations that need to be run. If a
+    Manifest is given, the calculations that are already done are skipped and
+    the ones that finish are recorded in it. If an EnergyCache is given, the
+    outputs of the cacheable calculations are taken from it when possible. If
+    a CostModel is given, the time each calculation takes is recorded in it
+    """
 
-    def __init__(self, timer, *args):
+    def __init__(self, timer, *args, manifest=None, cache=None, cost_model=None):
         self.timer = timer
         self.timer_keys = []
         self.labels = []
+        self.manifest = manifest
+        self.cache = cache
+        self.cost_model = cost_model
+        # (kind, timer key, number of atoms) of each output for the cost model
+        self.costs = {}
         list.__init__(self)
 
     def append(self, calc, label='', timer_key=None):
@@ -60,14 +74,52 @@ class CalculationList(list):
         self.timer_keys.append(timer_key)
         list.append(self, calc)
         self.labels.append(label)
+        kind = calc_kind(calc, timer_key)
+        if kind is not None and getattr(calc, 'output', None) is not None:
+            self.costs[calc.output] = (kind, timer_key, natoms(calc.prmtop))
+
+    def order_by_cost(self, frames):
+        """
+        Sorts the calculations by their predicted cost, longest first, so that
+        the long ones do not start last when several run at the same time.
+        frames is the number of frames of each unit (rank or chunk) of each
+        timer key. The labels and PrintCalc messages stay with the calculation
+        that follows them, and a CopyCalc (which costs nothing) always ends up
+        after the calculation that writes its source file
+        """
+        if self.cost_model is None:
+            return
+        groups = []
+        pending = []
+        for calc, label, key in zip(self, self.labels, self.timer_keys):
+            pending.append((calc, label, key))
+            if isinstance(calc, PrintCalc):
+                continue
+            kind, key, atoms = self.costs.get(getattr(calc, 'output', None), (None, key, 0))
+            groups.append((self.cost_model.predict(kind, atoms, frames.get(key, 0)), pending))
+            pending = []
+        # sorted is stable, so calculations with the same cost keep their order
+        groups = sorted(groups, key=lambda group: -group[0])
+        if pending:
+            groups.append((0.0, pending))
+        calcs = [item for _, group in groups for item in group]
+        self[:] = [calc for calc, _, _ in calcs]
+        self.labels = [label for _, label, _ in calcs]
+        self.timer_keys = [key for _, _, key in calcs]
 
     def extend(self, calcs, labels, timer_keys):
         """ Add a list/iterable of Calculation instances to the list """
         for i, calc in enumerate(calcs):
             CalculationList.append(self, calc, labels[i], timer_keys[i])
 
-    def run(self, rank, stdout=sys.stdout, stderr=sys.stderr):
-        """ Runs every calculation in the list """
+    def run(self, rank, stdout=sys.stdout, stderr=sys.stderr, nproc=1, scheduler=None):
+        """
+        Runs every calculation in the list. If nproc > 1, independent
+        calculations are dispatched concurrently, and if a ChunkScheduler is
+        given, the trajectory chunks are claimed on demand (see _run_concurrent).
+        A TaskScheduler hands out the units through the MPI master (see
+        _run_tasks)
+        """
         own_handle = False
         try:
             f = open(stdout, 'w')
@@ -75,19 +127,218 @@ class CalculationList(list):
         except TypeError:
             f = stdout
         try:
+            if isinstance(scheduler, TaskScheduler):
+                self._run_tasks(rank, f, stderr, scheduler)
+                return
+            if nproc > 1 or scheduler is not None:
+                self._run_concurrent(rank, f, stderr, nproc, scheduler)
+                return
             for i, calc in enumerate(self):
                 # Start timer, run calculation, then stop the timer
                 if self.timer_keys[i] is not None:
                     self.timer.start_timer(self.timer_keys[i])
                 if self.labels[i]:
                     f.write(self.labels[i] + '\n')
-                calc.setup()
-                calc.run(rank, stdout=stdout, stderr=stderr)
+                self.run_calc(calc, rank, stdout, stderr)
                 if self.timer_keys[i] is not None:
                     self.timer.stop_timer(self.timer_keys[i])
         finally:
             if own_handle: f.close()
 
+    def _run_concurrent(self, rank, stdout, stderr, nproc, scheduler=None):
+        """
+        Runs the calculations using a pool of nproc workers. Every calculation
+        launches its own external program, so threads are enough to keep nproc
+        processes busy. Labels and PrintCalc messages are written in list order
+        when each calculation is dispatched, so the output is deterministic.
+
+        Without a scheduler, each calculation runs once on the files of this
+        rank. With a scheduler, each calculation runs on every trajectory chunk
+        that this process manages to claim, and a new chunk is only claimed once
+        a worker is free. A CopyCalc depends on the unit that writes its source
+        file for that chunk: if that unit runs here, the copy is submitted when
+        it finishes, otherwise the copy waits for its completion marker. Timers
+        measure the wall time between the dispatch of the first and the
+        completion of the last unit that shares the timer key
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from copy import deepcopy
+
+        def _execute(i, calc, chunk, source=None):
+            if source is not None:
+                scheduler.wait(*source)
+            self.run_calc(calc, chunk, stdout, stderr)
+            if scheduler is not None:
+                scheduler.finish(i, chunk)
+
+        # Index of the last calculation of each timer, and units in flight
+        last_index = {}
+        for i, key in enumerate(self.timer_keys):
+            last_index[key] = i
+        active = dict.fromkeys(last_index, 0)
+
+        producers = {}
+        running = {}
+        finished = set()
+        # CopyCalc units waiting for a unit that is running here
+        deferred = {}
+        error = None
+
+        def _submit(i, unit, chunk, source=None):
+            future = executor.submit(_execute, i, unit, chunk, source)
+            running[future] = (i, chunk)
+
+        def _collect(timeout=None):
+            """ Waits for running units and stops the timers that are done """
+            nonlocal error
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, chunk = running.pop(future)
+                key = self.timer_keys[i]
+                active[key] -= 1
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                        for pending in running:
+                            pending.cancel()
+                else:
+                    finished.add((i, chunk))
+                    for args in deferred.pop((i, chunk), ()):
+                        _submit(*args)
+                if key is not None and not active[key] and dispatched > last_index[key]:
+                    self.timer.stop_timer(key)
+
+        dispatched = 0
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            for i, calc in enumerate(self):
+                if error is not None:
+                    break
+                key = self.timer_keys[i]
+                if key is not None:
+                    self.timer.start_timer(key)
+                if self.labels[i]:
+                    stdout.write(self.labels[i] + '\n')
+                if isinstance(calc, PrintCalc):
+                    calc.run(rank, stdout=stdout)
+                    chunks = []
+                elif scheduler is None:
+                    chunks = [rank]
+                else:
+                    chunks = range(scheduler.count(key))
+                for chunk in chunks:
+                    # Only claim new work when a worker is free
+                    while len(running) >= nproc and error is None:
+                        _collect()
+                    if error is not None:
+                        break
+                    if scheduler is not None and not scheduler.claim(i, chunk):
+                        continue
+                    unit = deepcopy(calc)
+                    # sander always writes a restart file, so concurrent
+                    # calculations cannot share the same one. The copy keeps
+                    # the name of the list's calc for later passes
+                    if getattr(unit, 'restrt', None) is not None:
+                        unit.restrt = '%s.%d' % (calc.restrt, i)
+                    source = None
+                    if isinstance(calc, CopyCalc) and calc.orig_name in producers:
+                        source = (producers[calc.orig_name], chunk)
+                        if source in finished:
+                            source = None
+                        elif scheduler is None and source not in running.values():
+                            # It failed, and the error is raised below
+                            break
+                    active[key] += 1
+                    if source is not None and source in running.values():
+                        deferred.setdefault(source, []).append((i, unit, chunk))
+                    else:
+                        _submit(i, unit, chunk, source)
+                if getattr(calc, 'output', None) is not None:
+                    producers[calc.output] = i
+                dispatched = i + 1
+                if key is not None and not active[key] and dispatched > last_index[key]:
+                    self.timer.stop_timer(key)
+            # Collect the results as they finish
+            while running:
+                _collect()
+        if error is not None:
+            raise error
+
+    def _run_tasks(self, rank, stdout, stderr, scheduler):
+        """
+        Runs the (calculation, chunk) units that the master of a TaskScheduler
+        hands out to this rank, one at a time. The master writes the labels and
+        PrintCalc messages of a calculation when its first unit is handed out.
+        The timers only count the time spent running units
+        """
+        from copy import deepcopy
+
+        units = []
+        after = {}
+        messages = {}
+        producers = {}
+        text = ''
+        for i, calc in enumerate(self):
+            if self.labels[i]:
+                text += self.labels[i] + '\n'
+            if isinstance(calc, PrintCalc):
+                text += calc.message + '\n'
+                continue
+            if text:
+                messages[i] = text
+                text = ''
+            for chunk in range(scheduler.count(self.timer_keys[i])):
+                units.append((i, chunk))
+                if isinstance(calc, CopyCalc) and calc.orig_name in producers:
+                    after[(i, chunk)] = (producers[calc.orig_name], chunk)
+            if getattr(calc, 'output', None) is not None:
+                producers[calc.output] = i
+
+        def _work(unit):
+            i, chunk = unit
+            calc = deepcopy(self[i])
+            if getattr(calc, 'restrt', None) is not None:
+                calc.restrt = '%s.%d' % (calc.restrt, i)
+            key = self.timer_keys[i]
+            if key is not None:
+                self.timer.start_timer(key)
+            try:
+                self.run_calc(calc, chunk, stdout, stderr)
+            finally:
+                if key is not None:
+                    self.timer.stop_timer(key)
+
+        scheduler.run(units, after, _work, messages, stdout)
+
+    def run_calc(self, calc, rank, stdout=sys.stdout, stderr=sys.stderr):
+        """
+        Runs one calculation, unless the manifest says it is already done or
+        its output is in the cache
+        """
+        if isinstance(calc, PrintCalc):
+            calc.run(rank, stdout=stdout)
+            return
+        if self.manifest is not None and self.manifest.is_done(calc, rank):
+            return
+        use_cache = self.cache is not None and calc.cacheable
+        if not (use_cache and self.cache.get(calc, rank)):
+            start = time.time()
+            calc.setup()
+            calc.run(rank, stdout=stdout, stderr=stderr)
+            output = getattr(calc, 'output', None)
+            if self.cost_model is not None and output in self.costs:
+                self.cost_model.observe(*self.costs[output], time.time() - start)
+            if use_cache:
+                self.cache.put(calc, rank)
+        if self.manifest is not None:
+            self.manifest.record(calc, rank)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _command(prog):
+    """ Command-line (a list) that runs a program given as a path or a list """
+    return list(prog) if isinstance(prog, (list, tuple)) else [prog]
+
 
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
@@ -96,6 +347,10 @@ class Calculation(object):
         from this class.
     """
 
+    # Whether the output only depends on the inputs, so it can be stored in the
+    # EnergyCache
+    cacheable = False
+
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
     def __init__(self, prog, prmtop, incrd, inptraj, input_file, output):
@@ -108,7 +363,9 @@ class Calculation(object):
 
         self.calc_setup = False  # This means that the setup has run successfully
 
-        self.command_args = [self.program]
+        # The program may also be a command (a list), such as the one that runs
+        # the OpenMP or MPI version of cpptraj
+        self.command_args = list(_command(self.program))
 
     def run(self, rank, stdout=sys.stdout, stderr=sys.stderr):
         """ Runs the program. All command-line arguments must be set before
@@ -157,11 +414,11 @@ class Calculation(object):
             calc_failed = bool(process.wait())
 
             if calc_failed:
-                raise CalcError('%s failed with prmtop %s!' % (self.program,
-                                                               self.prmtop))
+                raise CalcError('%s failed with prmtop %s!' % (' '.join(_command(self.program)),
+                                                                self.prmtop))
         finally:
             if own_handleo: process_stdout.close()
-            if own_handlee: process_stdout.close()
+            if own_handlee: process_stderr.close()
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
@@ -179,6 +436,8 @@ class Calculation(object):
 class EnergyCalculation(Calculation):
     """ Uses mmpbsa_py_energy to evaluate energies """
 
+    cacheable = True
+
     def __init__(self, prog, prmtop, incrd, inptraj, input_file, output, restrt):
         Calculation.__init__(self, prog, prmtop, incrd, inptraj,
                              input_file, output)
@@ -379,14 +638,18 @@ class QuasiHarmCalc(Calculation):
     """ Quasi-harmonic entropy calculation class """
 
     def __init__(self, prog, prmtop, inptraj, input_file, output,
-                 receptor_mask, ligand_mask, fnpre):
-        """ Initializes the Quasi-harmonic calculation class """
+                 receptor_mask, ligand_mask, fnpre, make_average=True):
+        """
+        Initializes the Quasi-harmonic calculation class. If make_average is
+        False, the average PDB was already made with the trajectories
+        """
         Calculation.__init__(self, prog, prmtop, None, inptraj,
                              input_file, output)
         self.stability = not bool(receptor_mask) and not bool(ligand_mask)
         self.receptor_mask, self.ligand_mask = receptor_mask, ligand_mask
         self.calc_setup = False
         self.fnpre = fnpre  # file name prefix
+        self.make_average = make_average
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
@@ -403,12 +666,17 @@ class QuasiHarmCalc(Calculation):
         # Make sure masks are a list, and that there are enough masks
 
         # First thing we need is the average PDB as a reference
+        if not self.make_average:
+            self.command_args.extend((self.prmtop, self.input_file))
+            self.calc_setup = True
+            return
+
         ptraj_str = 'trajin %s\naverage %savgcomplex.pdb pdb chainid " "\ngo' % (self.inptraj,
                                                                                  prefix)
 
         outfile = open(self.fnpre + 'create_average.out', 'w')
 
-        process = Popen([self.program, self.prmtop], stdin=PIPE, stdout=outfile)
+        process = Popen(_command(self.program) + [self.prmtop], stdin=PIPE, stdout=outfile)
         out, err = process.communicate(ptraj_str.encode())
 
         if process.wait():
@@ -436,13 +704,21 @@ class PBEnergyCalculation(EnergyCalculation):
     prints to stdout and redirect them to the user
     """
 
+    # Number of recent lines (and of warnings) kept to report a failure
+    recent_lines = 20
+
     def run(self, rank, stdout=sys.stdout, stderr=sys.stderr):
         """
         Runs the program. All command-line arguments must be set before calling
         this method. Command-line arguments should be set in setup()
-        stdout is ignored here because we need to parse it for errors
+        stdout is ignored here because we need to parse it for errors. It is
+        written to a .stdout file next to the output as it comes, and only the
+        last recent_lines lines and warnings are kept in memory, since PBSA can
+        print a lot on long runs. The calculation is stopped as soon as a PB
+        bomb is printed
         """
         import re
+        from collections import deque
         from subprocess import Popen, PIPE
 
         # If this has not been set up yet
@@ -460,6 +736,12 @@ class PBEnergyCalculation(EnergyCalculation):
         except TypeError:
             process_stderr = stderr
 
+        log = self.output.replace('.mdout', '.stdout')
+        if log == self.output:
+            log += '.stdout'
+        if '%d' in log:
+            log = log % rank
+
         # The setup() method sets the command-line arguments and makes sure that
         # all of the CL arguments are set. Now all we have to do is start the
         # process and monitor it for success.
@@ -476,17 +758,29 @@ class PBEnergyCalculation(EnergyCalculation):
             process = Popen(self.command_args, stdin=None, stdout=PIPE,
                             stderr=process_stderr)
 
-            out, err = process.communicate(b'')
-            calc_failed = bool(process.wait())
-            out = out.decode('utf-8')
+            recent = deque(maxlen=self.recent_lines)
+            error_list = deque(maxlen=self.recent_lines)
+            bomb = False
+            with process.stdout, open(log, 'w') as f:
+                for line in process.stdout:
+                    line = line.decode('utf-8', 'replace')
+                    f.write(line)
+                    line = line.strip()
+                    recent.append(line)
+                    match = errorre.match(line)
+                    if match:
+                        error_list.append(line)
+                        # No point in waiting for the rest of the frames
+                        if match.group(1).lower() == 'pb bomb':
+                            bomb = True
+                            process.kill()
+                            break
+            calc_failed = bool(process.wait()) or bomb
             if calc_failed:
-                error_list = [s.strip() for s in out.split('\n')
-                              if errorre.match(s.strip())]
-
                 GMXMMPBSA_ERROR('%s failed with prmtop %s!\n\t' % (self.program, self.prmtop) +
-                                '\n\t'.join(error_list) + '\n' +
-                                'If you are using sander and PB calculation, check the *.mdout files to get the sander '
-                                'error\n',
+                                '\n\t'.join(error_list or recent) + '\n' +
+                                'The output of %s is in %s. If you are using sander and PB calculation, check the '
+                                '*.mdout files to get the sander error\n' % (self.program, log),
                                 CalcError)
         finally:
             if own_handle: process_stderr.close()
@@ -501,6 +795,8 @@ class SurfCalc(Calculation):
     necessary cpptraj input
     """
 
+    cacheable = True
+
     def __init__(self, prog, prmtop, inptraj, output, probe=1.4, offset=0.0):
         self.prmtop = str(prmtop)
         self.inptraj = inptraj
@@ -524,7 +820,7 @@ class SurfCalc(Calculation):
             # Make sure the inptraj and output are rank-substituted
         instring = self._get_instring(rank)
 
-        process = Popen([self.program, self.prmtop], stdin=PIPE, stdout=PIPE,
+        process = Popen(_command(self.program) + [self.prmtop], stdin=PIPE, stdout=PIPE,
                         stderr=PIPE)
 
         out, err = process.communicate(instring.encode())
@@ -532,8 +828,8 @@ class SurfCalc(Calculation):
         calc_failed = bool(process.wait())
 
         if calc_failed:
-            raise CalcError('%s failed with prmtop %s!' % (self.program,
-                                                           self.prmtop))
+            raise CalcError('%s failed with prmtop %s!' % (' '.join(_command(self.program)),
+                                                            self.prmtop))
 
 
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
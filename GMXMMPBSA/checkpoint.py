@@ -0,0 +1,180 @@
+"""
+This module keeps track of the calculations that have already finished, so an
+interrupted run can be resumed (-resume) without repeating them.
+
+Methods:
+   file_hash(fname) : SHA1 of the contents of a file
+   cached_file_hash(fname) : file_hash, computed once for each version of a file
+   input_hash(calc, rank) : Hash of everything a calculation depends on
+   output_name(calc, rank) : Name of the output file of a calculation
+
+Classes:
+   Manifest: Record of the finished calculations of one process
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+# Attributes of a calculation that are not part of its inputs
+_NOT_INPUTS = ('command_args', 'calc_setup', 'output', 'final_name', 'restrt')
+
+
+def file_hash(fname):
+    """
+    Returns the SHA1 of the contents of a file. The %VERSION line of a topology
+    file only holds the date it was written, so it is skipped
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        line = f.readline()
+        if not line.startswith(b'%VERSION'):
+            sha.update(line)
+        for block in iter(lambda: f.read(1048576), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+_hashes = {}
+
+
+def cached_file_hash(fname):
+    """ file_hash, computed only once for each version (inode, size and mtime) of the file """
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        _hashes[key] = file_hash(fname)
+    return _hashes[key]
+
+
+def input_hash(calc, rank, hasher=file_hash):
+    """
+    Returns a hash of the options of a calculation and of the contents of the
+    files it reads (with the rank substituted into the file names), so it does
+    not depend on the names of those files
+    """
+    sha = hashlib.sha1(type(calc).__name__.encode())
+    for key, value in sorted(vars(calc).items()):
+        if key in _NOT_INPUTS:
+            continue
+        value = _input_value(key, value, rank, hasher)
+        if value is not None:
+            sha.update(('%s=%s\n' % (key, value)).encode())
+    return sha.hexdigest()
+
+
+def _input_value(key, value, rank, hasher):
+    """
+    Text hashed for one attribute of a calculation: the hash of the contents
+    for the names of existing files, the value for the other options, and the
+    same for each item of a list. None for attributes that are not options
+    """
+    if isinstance(value, (list, tuple)):
+        if key == 'program':
+            # The program may be a command that runs it (see _command)
+            value = value[-1] if value else ''
+        else:
+            return '[%s]' % ', '.join('%s' % _input_value(key, item, rank, hasher) for item in value)
+    if isinstance(value, str):
+        if '%d' in value:
+            try:
+                value = value % rank
+            except (TypeError, ValueError):
+                pass
+        if key == 'program':
+            return os.path.basename(value)
+        if os.path.isfile(value):
+            return hasher(value)
+        return value
+    if isinstance(value, (int, float, bool, type(None))):
+        return str(value)
+    return None
+
+
+def output_name(calc, rank):
+    """ Name of the output file of calc for this rank """
+    output = getattr(calc, 'final_name', None) or calc.output
+    if '%d' in output:
+        output = output % rank
+    return output
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class Manifest(object):
+    """
+    Record of the calculations (one entry per rank or chunk) that finished
+    successfully. Each entry holds a hash of the inputs of the calculation
+    (its options and the contents of its topology, coordinate, trajectory and
+    input files) and the size and hash of the output file. A calculation is
+    done only if its inputs did not change and its output is complete.
+
+    Every process writes its own manifest file, but reads those of all the
+    processes, since a chunk may be run by a different process on resume
+    """
+
+    def __init__(self, prefix, rank=0):
+        self.filename = '%smanifest.%d.json' % (prefix, rank)
+        self.entries = {}
+        self.own_entries = {}
+        self._lock = threading.Lock()
+        for fname in sorted(glob.glob('%smanifest.*.json' % prefix)):
+            try:
+                with open(fname) as f:
+                    entries = json.load(f)
+            except ValueError:
+                # Died while writing it. Those calculations will be repeated
+                continue
+            self.entries.update(entries)
+            if fname == self.filename:
+                self.own_entries.update(entries)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def is_done(self, calc, rank):
+        """ Whether calc already finished for this rank (or chunk) """
+        output = output_name(calc, rank)
+        entry = self.entries.get(output)
+        if entry is None or not os.path.isfile(output):
+            return False
+        # Truncated or modified output files are not complete
+        if os.path.getsize(output) != entry['size'] or file_hash(output) != entry['output']:
+            return False
+        return entry['inputs'] == input_hash(calc, rank, cached_file_hash)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def record(self, calc, rank):
+        """ Adds a finished calculation and rewrites the manifest file """
+        output = output_name(calc, rank)
+        entry = {'inputs': input_hash(calc, rank, cached_file_hash), 'size': os.path.getsize(output),
+                 'output': file_hash(output)}
+        with self._lock:
+            self.entries[output] = self.own_entries[output] = entry
+            # Write a new file and replace the old one, so the manifest is never
+            # left half-written
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.own_entries, f, indent=1)
+            os.replace(self.filename + '.tmp', self.filename)
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
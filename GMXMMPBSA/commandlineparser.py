@@ -126,6 +126,50 @@ group.add_argument('-O', '--overwrite', default=False, action='store_true',
 group.add_argument('-prefix', dest='prefix', default='_GMXMMPBSA_',
                    metavar='<file prefix>',
                    help='Prefix for intermediate files.')
+group.add_argument('-nproc', dest='nproc', default=1, type=int, metavar='N',
+                   help='''Number of calculations to run concurrently in serial
+                  (non-MPI) runs. The complex, receptor and ligand calculations
+                  are independent, so they can share the available cores.
+                  The output files of the chunks are also parsed by N
+                  processes.''')
+group.add_argument('-cpptraj-jobs', dest='cpptraj_jobs', default=3, type=int, metavar='N',
+                   help='''Maximum number of cpptraj processes run at the same
+                  time to prepare the trajectories. The trajectories given for
+                  the complex, receptor and ligand (and their nmode
+                  trajectories) are prepared independently of each other. Use
+                  1 to prepare them one after the other.''')
+group.add_argument('-pipeline', dest='pipeline', default=False, action='store_true',
+                   help='''Run the trajectory preparation, the calculations and
+                  the parsing of their outputs as a task graph, so every step
+                  starts as soon as the files it needs exist (e.g. the complex
+                  calculations start while the receptor and ligand are still
+                  being stripped). Most useful with -nproc or MPI.''')
+group.add_argument('-live-stats', dest='live_stats', default=0, type=float, nargs='?', const=30.0,
+                   metavar='SECONDS',
+                   help='''Follow the GB and PB output files while they are being
+                  written and print, every SECONDS seconds (30 if omitted), the
+                  frames done and the frames per second of each model, a
+                  running delta G with its standard error of the mean (without
+                  ESURF for GB) and an estimate of the time left.''')
+group.add_argument('--cache-dir', dest='cache_dir', default=None, metavar='DIR',
+                   help='''Directory of a persistent cache of energy and surface
+                  area outputs, shared by all the runs that use it. A
+                  calculation whose program, topology, trajectory and input
+                  file are the same as in a previous run is not repeated.
+                  The prepared trajectories are kept there too, so they are
+                  not made again while the trajectories, topologies, masks
+                  and frames are the same (e.g. going from GB to PB).''')
+group.add_argument('--cache-size', dest='cache_size', default=10.0, type=float, metavar='GB',
+                   help='''Maximum size of the cache. The least recently used
+                  outputs (and trajectories) are removed when it is
+                  exceeded.''')
+group.add_argument('--timings', dest='timings', metavar='FILE',
+                   default=os.path.join(os.path.expanduser('~'), '.gmx_MMPBSA', 'timings.json'),
+                   help='''File with the time taken by the calculations of the
+                  earlier runs. It is used to predict the cost of each
+                  calculation, so the longest ones are started first with
+                  -nproc, chunk_size or -pipeline, and the timings of every run
+                  are added to it. An empty string disables it.''')
 group = parser.add_argument_group('Input and Output Files', '''These options specify the input files and optional 
 output files.''')
 group.add_argument('-i', dest='input_file', metavar='FILE', help='MM/PBSA input file.')
@@ -228,8 +272,28 @@ group.add_argument('-rewrite-output', dest='rewrite_output', default=False,
                    action='store_true', help='''Do not re-run any calculations,
                   just parse the output files from the previous calculation and
                   rewrite the output files.''')
+group.add_argument('-resume', dest='resume', default=False, action='store_true',
+                   help='''Resume an interrupted run. The intermediate files are
+                  kept, and only the calculations that did not finish (or whose
+                  inputs or outputs changed) are run again.''')
 group.add_argument('--clean', dest='clean', action='store_true', default=False,
                    help='''Clean temporary files and quit.''')
+group.add_argument('-dry-run', dest='dry_run', default=False, action='store_true',
+                   help='''Print the task graph used by -pipeline (the tasks
+                  and the tasks each of them waits for) and quit. The
+                  topologies are still built (the calculations depend on them),
+                  but no intermediate file is removed and nothing is run.''')
+group.add_argument('-shard', dest='shard', default=None, metavar='I/N',
+                   help='''Run only the I-th of N contiguous blocks of the
+                  analyzed frames (e.g. 3/16), for job arrays. The intermediate
+                  files, topologies and outputs of the shard are written to
+                  the shard_I directory, and no final output is written. The
+                  shards do not communicate, and are joined with -merge.''')
+group.add_argument('-merge', dest='merge', default=None, nargs='+', metavar='DIR',
+                   help='''Do not run any calculations, join the outputs of the
+                  shard directories written by -shard (e.g. shard_*) in the
+                  order of their frames and write the final output files. It
+                  must be run in the directory where the shards were run.''')
 
 # GUI parser
 description = 'This program is part of gmx_MMPBSA and will show a workspace to analyze the gmx_MMPBSA results'
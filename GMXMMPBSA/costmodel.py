@@ -0,0 +1,180 @@
+"""
+This module estimates how long each calculation will take, so the longest
+ones can be dispatched first when several calculations (or trajectory chunks)
+run at the same time. Otherwise, a long PB calculation on the complex that
+happens to be last in the list keeps one worker busy while the others are
+idle.
+
+The cost of a calculation is modelled as coef * natoms ** exponent seconds per
+frame, with the exponent fixed for each kind of calculation (e.g. GB scales
+with the square of the number of atoms). The coefficient starts from a rough
+default and is fitted to the timings of the earlier runs, which are stored in
+a history file (--timings).
+
+Methods:
+   natoms(prmtop) : Number of atoms in a topology file
+   calc_kind(calc, timer_key) : Kind of calculation used by the cost model
+
+Classes:
+   CostModel: Predicts the cost of the calculations and records their timings
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import json
+import os
+import threading
+
+# Default coefficient and exponent of the number of atoms of each kind of
+# calculation (seconds per frame = coef * natoms ** exponent)
+_DEFAULTS = {'gb': (1.0e-8, 2.0),
+             'pb': (5.0e-4, 1.0),
+             'rism': (6.0e-3, 1.0),
+             'nmode': (1.0e-9, 3.0),
+             'qh': (1.0e-6, 1.0),
+             'surf': (1.0e-5, 1.0)}
+
+# Timings kept for each kind of calculation
+_HISTORY_SIZE = 100
+
+_natoms = {}
+
+
+def natoms(prmtop):
+    """ Returns the number of atoms of an Amber topology file (0 if it cannot be read) """
+    if prmtop not in _natoms:
+        _natoms[prmtop] = 0
+        try:
+            with open(prmtop) as f:
+                for line in f:
+                    if line.startswith('%FLAG POINTERS'):
+                        line = f.readline()
+                        if line.startswith('%FORMAT'):
+                            line = f.readline()
+                        _natoms[prmtop] = int(line[:8])
+                        break
+        except (OSError, ValueError):
+            pass
+    return _natoms[prmtop]
+
+
+def calc_kind(calc, timer_key):
+    """
+    Returns the kind of a calculation (e.g. 'pb:sander'), or None for the
+    calculations that take no time (messages and copies)
+    """
+    program = getattr(calc, 'program', None)
+    if program is None or timer_key is None:
+        return None
+    model = 'surf' if hasattr(calc, '_get_instring') else timer_key
+    return '%s:%s' % (model, os.path.basename(program))
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class CostModel(object):
+    """
+    Cost model fitted to the history file. Each entry of the history is a list
+    of the last (natoms, frames, seconds) timings of one kind of calculation.
+    The timings of the current run are collected in observations and only
+    added to the history by save()
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.history = self._load()
+        self.observations = []
+        self._lock = threading.Lock()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def predict(self, kind, natoms, frames):
+        """ Predicted number of seconds of a calculation """
+        if kind is None:
+            return 0.0
+        coef, exponent = self._coefficient(kind)
+        return coef * max(natoms, 1) ** exponent * max(frames, 1)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def observe(self, kind, timer_key, natoms, seconds):
+        """
+        Records the time a calculation (or one chunk of it) took. The number
+        of frames is added by the caller before save, once it is known
+        """
+        if kind is None:
+            return
+        with self._lock:
+            self.observations.append((kind, timer_key, natoms, seconds))
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def save(self, timings):
+        """
+        Adds a list of (kind, natoms, frames, seconds) timings to the history
+        file. The file is read again first, since other runs may have updated
+        it in the meantime
+        """
+        if not self.filename or not timings:
+            return
+        history = self._load()
+        for kind, natoms, frames, seconds in timings:
+            if natoms and frames:
+                history.setdefault(kind, []).append([natoms, frames, seconds])
+        for kind in history:
+            history[kind] = history[kind][-_HISTORY_SIZE:]
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(history, f, indent=1)
+            os.replace(tmp, self.filename)
+        except OSError:
+            # The timings only make the scheduling better, so a read-only
+            # location is not an error
+            return
+        self.history = history
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _coefficient(self, kind):
+        """ Fitted coefficient and exponent of a kind of calculation """
+        coef, exponent = _DEFAULTS.get(kind.split(':')[0], (1.0e-6, 1.0))
+        timings = self.history.get(kind)
+        if timings:
+            size = sum(frames * natoms ** exponent for natoms, frames, _ in timings)
+            if size > 0:
+                coef = sum(seconds for _, _, seconds in timings) / size
+        return coef, exponent
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _load(self):
+        """ Reads the history file """
+        if not self.filename:
+            return {}
+        try:
+            with open(self.filename) as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return history if isinstance(history, dict) else {}
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
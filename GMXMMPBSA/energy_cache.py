@@ -0,0 +1,278 @@
+"""
+This module contains a persistent cache of energy and surface area output
+files, shared by every run that uses the same cache directory (--cache-dir).
+The outputs are stored under a hash of everything the calculation depends on
+(the program, the contents of the topology, coordinate, trajectory and input
+files and its options), so the same system is not computed twice when only
+the output options or an unrelated variable of the input file changed.
+The prepared trajectories (cleaned by trjconv, or stripped and split by
+cpptraj) are kept in the same directory, so a rerun that only changes the
+calculations (e.g. GB to PB) does not prepare them again.
+
+Classes:
+   EnergyCache: On-disk cache of calculation outputs with LRU eviction
+   TrajectoryCache: On-disk cache of prepared trajectories
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from GMXMMPBSA.checkpoint import cached_file_hash, input_hash, output_name
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class EnergyCache(object):
+    """
+    Directory with the output files of the finished calculations, one file per
+    input hash (in a subdirectory named after its first two characters). The
+    modification time of an entry is updated every time it is used, and the
+    least recently used entries are removed when the total size of the cache
+    exceeds max_size (in bytes). Several runs (or processes) can share the
+    same directory, since the entries are written to a temporary file first.
+    The cache directory is only walked to evict entries when the running total
+    of the stored sizes (counted once per run) exceeds max_size
+    """
+
+    def __init__(self, directory, max_size=10 * 1024 ** 3):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def get(self, calc, rank):
+        """
+        Copies the cached output of calc for this rank (or chunk) to its output
+        file. Returns False if it is not in the cache
+        """
+        entry = self._entry(calc, rank)
+        try:
+            shutil.copyfile(entry, output_name(calc, rank))
+            os.utime(entry)
+        except FileNotFoundError:
+            # Not in the cache, or evicted by another run in the meantime
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def put(self, calc, rank):
+        """ Stores the output of calc for this rank (or chunk) """
+        entry = self._entry(calc, rank)
+        tmp = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            shutil.copyfile(output_name(calc, rank), tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            # The cache is full or read-only. The cache only saves time, so
+            # this is not an error
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._added(size)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_size """
+        entries = []
+        total = 0
+        for dirpath, _, fnames in os.walk(self.directory):
+            for fname in fnames:
+                # Entries still being written
+                if fname.endswith('.tmp') or dirpath.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            with self._lock:
+                self._size = total
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+        with self._lock:
+            self._size = total
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _added(self, size):
+        """ Counts an entry of size bytes, and evicts if the cache is over max_size """
+        with self._lock:
+            if self._size is not None and self._size + size <= self.max_size:
+                self._size += size
+                return
+        self.evict()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _entry(self, calc, rank):
+        """ Path of the cache entry of calc for this rank """
+        key = input_hash(calc, rank, cached_file_hash)
+        return os.path.join(self.directory, key[:2], key)
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class TrajectoryCache(EnergyCache):
+    """
+    Prepared trajectories (and the other files made with them), stored in the
+    traj subdirectory of the cache directory, one directory per key. The key
+    is a hash of the contents of the files the trajectories were made from and
+    of the options used. Each entry has the files (named without the prefix of
+    the run, so they can be restored with another prefix) and a state.json file
+    with the list of files and the data the run needs (e.g. number of frames).
+    The restored files get the modification time of the stored ones, so the
+    frame counts and hashes of the earlier runs are still valid for them. The
+    contents of the input files are hashed only once for each version (inode,
+    size and mtime) of the file, and the hashes are kept in hashes.json
+    """
+
+    def __init__(self, directory, max_size=10 * 1024 ** 3):
+        EnergyCache.__init__(self, directory, max_size)
+        self._hashes_file = os.path.join(self.directory, 'hashes.json')
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def key(self, kind, files, options):
+        """
+        Key of the trajectories of this kind made from files (None for the
+        files that are not used) with options (a dict)
+        """
+        hashes = self._load_hashes()
+        sha = hashlib.sha1(kind.encode())
+        for fname in files:
+            if fname is None:
+                sha.update(b'None\n')
+                continue
+            stat = os.stat(fname)
+            memo = '%s:%d:%d:%d' % (os.path.abspath(fname), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if memo not in hashes:
+                hashes[memo] = cached_file_hash(fname)
+            sha.update(('%s\n' % hashes[memo]).encode())
+        for name, value in sorted(options.items()):
+            sha.update(('%s=%s\n' % (name, value)).encode())
+        self._save_hashes(hashes)
+        return sha.hexdigest()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def get(self, key, prefix=''):
+        """
+        Copies the files of the entry to prefix + name and returns its state,
+        or None if it is not in the cache (or part of it was evicted)
+        """
+        entry = self._traj_entry(key)
+        try:
+            with open(os.path.join(entry, 'state.json')) as f:
+                state = json.load(f)
+            for name in state['files']:
+                os.utime(os.path.join(entry, name))
+            for name, mtime in zip(state['files'], state['mtimes']):
+                shutil.copyfile(os.path.join(entry, name), prefix + name)
+                os.utime(prefix + name, ns=(mtime, mtime))
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        os.utime(os.path.join(entry, 'state.json'))
+        with self._lock:
+            self.hits += 1
+        return state
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def put(self, key, fnames, state, prefix=''):
+        """ Stores the files fnames (which start with prefix) and state """
+        entry = self._traj_entry(key)
+        tmp = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        os.makedirs(tmp)
+        try:
+            state = dict(state, files=[fname[len(prefix):] for fname in fnames],
+                         mtimes=[os.stat(fname).st_mtime_ns for fname in fnames])
+            for fname, name in zip(fnames, state['files']):
+                shutil.copyfile(fname, os.path.join(tmp, name))
+            with open(os.path.join(tmp, 'state.json'), 'w') as f:
+                json.dump(state, f)
+            size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+        except OSError:
+            # Another run stored the same entry in the meantime, or the
+            # cache is full. The cache only saves time, so this is not an error
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self._added(size)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _traj_entry(self, key):
+        """ Path of the entry of key """
+        return os.path.join(self.directory, 'traj', key[:2], key)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _load_hashes(self):
+        """ Reads the hashes of the input files """
+        try:
+            with open(self._hashes_file) as f:
+                hashes = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return hashes if isinstance(hashes, dict) else {}
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _save_hashes(self, hashes):
+        """ Writes the hashes of the input files, with the ones other runs added """
+        hashes = dict(self._load_hashes(), **hashes)
+        tmp = '%s.%d.tmp' % (self._hashes_file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(hashes, f)
+            os.replace(tmp, self._hashes_file)
+        except OSError:
+            pass
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
@@ -50,6 +50,12 @@ class MPI(object):
 
         #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
+        def gather(self, inp, root=0):
+            """ Mimics an MPI_Gather """
+            return [inp]
+
+        #-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
         def Barrier(self):
             """ Mimics an MPI_Barrier """
             pass
@@ -5,6 +5,8 @@ desired calculations in the gmx_MMPBSA calculation.
 Methods:
          find_progs(INPUT): Determines which programs are needed and sees if
                             they can be found. Returns dictionary of programs
+         parallel_cpptraj(INPUT, cpptraj): Returns the command that runs the
+                            OpenMP or MPI version of cpptraj, if requested
          which(program): Internal; searches AMBERHOME/bin and optionally
                          PATH to see if a program can be found
 
@@ -29,7 +31,7 @@ Classes: ExternProg: External program class
 #  for more details.                                                           #
 # ##############################################################################
 
-from GMXMMPBSA.exceptions import GMXMMPBSA_ERROR
+from GMXMMPBSA.exceptions import GMXMMPBSA_ERROR, GMXMMPBSA_WARNING
 import logging
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
@@ -103,11 +105,45 @@ def find_progs(INPUT, mpi_size=0):
 
     if 'make_ndx' not in my_progs or 'editconf' not in my_progs or 'trjconv' not in my_progs:
         GMXMMPBSA_ERROR('Could not find necessary program [ GROMACS ]')
+
+    my_progs['cpptraj_parallel'] = parallel_cpptraj(INPUT, my_progs['cpptraj'], mpi_size)
     logging.info('Checking external programs...Done.\n')
     return my_progs
 
 #+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+def parallel_cpptraj(INPUT, cpptraj, mpi_size=0):
+    """
+    Returns the command (a list) that runs cpptraj for the trajectory
+    preparation, surface area and quasi-harmonic work. cpptraj.MPI is run
+    through mpirun with cpptraj_ranks ranks, and cpptraj.OMP with
+    cpptraj_threads OpenMP threads. Falls back to the serial cpptraj if the
+    parallel version can not be found
+    """
+    ranks, threads = INPUT['cpptraj_ranks'], INPUT['cpptraj_threads']
+    if ranks > 1 and mpi_size > 1:
+        # mpirun can not be started from the ranks of gmx_MMPBSA itself
+        GMXMMPBSA_WARNING('cpptraj_ranks is ignored when running gmx_MMPBSA with MPI')
+        ranks = 1
+    if ranks > 1:
+        mpi_exe = ExternProg('cpptraj.MPI', True, True).full_path
+        mpirun = ExternProg('mpirun', True, True).full_path
+        if mpi_exe and mpirun:
+            logging.info('cpptraj.MPI found! Using %s with %d ranks' % (mpi_exe, ranks))
+            return [mpirun, '-np', str(ranks), mpi_exe]
+        GMXMMPBSA_WARNING('Could not find cpptraj.MPI or mpirun. Using %s instead' %
+                          ('cpptraj.OMP' if threads > 1 else cpptraj))
+    if threads > 1:
+        omp_exe = ExternProg('cpptraj.OMP', True, True).full_path
+        if omp_exe:
+            logging.info('cpptraj.OMP found! Using %s with %d threads' % (omp_exe, threads))
+            # Only cpptraj gets the threads, not the other programs
+            return ['env', 'OMP_NUM_THREADS=%d' % threads, omp_exe]
+        GMXMMPBSA_WARNING('Could not find cpptraj.OMP. Using %s instead' % cpptraj)
+    return [cpptraj]
+
+#+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
 def which(program, search_path=False, force_path=None):
     """ Searches for a program in $AMBERHOME first, then PATH if we allow
         PATH searching.
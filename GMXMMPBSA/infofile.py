@@ -54,7 +54,7 @@ class InfoFile(object):
         outfile = open(name, 'w')
         # The data we have to write: INPUT, FILES, and the following attributes:
         # numframes, numframes_nmode, mpi_size (also recognize size),
-        # input_file_text, mut_str
+        # num_chunks, num_chunks_nmode, input_file_text, mut_str
 
         # Start with INPUT (and the editable vars). Allow this to recognize INFO
         # files from the last version of gmx_MMPBSA
@@ -89,6 +89,8 @@ class InfoFile(object):
         outfile.write('size = %d\n' % self.app.mpi_size)
         outfile.write('numframes = %d\n' % self.app.numframes)
         outfile.write('numframes_nmode = %d\n' % self.app.numframes_nmode)
+        outfile.write('num_chunks = %d\n' % self.app.num_chunks)
+        outfile.write('num_chunks_nmode = %d\n' % self.app.num_chunks_nmode)
         outfile.write("mut_str = '%s'\n" % self.app.mut_str)
         outfile.write('using_chamber = %s\n' % self.app.using_chamber)
         outfile.write(self.app.input_file_text)
@@ -136,6 +138,10 @@ class InfoFile(object):
                 else:
                     setattr(self.app, var, val)
                 continue
+        # Info files written before the trajectories could be split in chunks
+        # have one output file per rank
+        if not hasattr(self.app, 'num_chunks'):
+            self.app.num_chunks = self.app.num_chunks_nmode = self.app.mpi_size
         # Determine stability here:
         self.app.stability = self.app.FILES.stability
         # Set app.pre as prefix
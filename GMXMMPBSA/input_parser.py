@@ -488,6 +488,14 @@ strip_mask = ':WAT,Cl*,CIO,Cs+,IB,K*,Li+,MG*,Na+,Rb+,CS,RB,NA,F,CL'
 
 input_file.addNamelist('general', 'general',
                        [
+                           ['adaptive_min_frames', int, 30, 'Frames needed (in two passes at least) before '
+                                                            'adaptive_sem can stop adaptive sampling'],
+                           ['adaptive_sem', float, 0.0, 'Stop adding frames once the SEM of adaptive_term is below '
+                                                        'this value (0 = use all the frames)'],
+                           ['adaptive_stride', int, 64, 'Stride of the first adaptive sampling pass'],
+                           ['adaptive_term', str, 'TOTAL', 'Energy term whose SEM is checked by adaptive sampling'],
+                           ['adaptive_time', float, 0.0, 'Wall-time budget of adaptive sampling, in minutes '
+                                                         '(0 = no limit)'],
                            ['assign_chainID', int, 0, 'Assign chains ID'],
                            ['debug_printlevel', int, 0, 'Increase debugging info printed'],
                            ['endframe', int, 9999999, 'Last frame to analyze'],
@@ -496,6 +504,11 @@ input_file.addNamelist('general', 'general',
                            ['ie_segment', int, 25, 'Trajectory segment to calculate interaction entropy'],
                            ['c2_entropy', int, 0, 'Do C2 Entropy calculation'],
                            ['c2_segment', int, 25, 'Trajectory segment to calculate c2 entropy'],
+                           ['chunk_size', int, 0, 'Number of frames in each work chunk (0 = one chunk per '
+                                                  'processor)'],
+                           ['cpptraj_ranks', int, 1, 'Number of MPI ranks of cpptraj.MPI (1 = serial cpptraj)'],
+                           ['cpptraj_threads', int, 1, 'Number of OpenMP threads of cpptraj.OMP (1 = serial '
+                                                       'cpptraj)'],
                            ['exp_ki', float, 0, 'Experimental Ki in nM'],
                            ['full_traj', int, 0, 'Print a full traj. AND the thread trajectories'],
                            ['gmx_path', str, '', 'Force to use this path to get GROMACS executable'],
@@ -504,6 +517,8 @@ input_file.addNamelist('general', 'general',
                            ['keep_files', int, 2, 'How many files to keep after successful completion'],
                            ['forcefields', list, 'oldff/leaprc.ff99SB, leaprc.gaff', 'Define the force field to build '
                                                                                    'the Amber topology'],
+                           ['native_io', int, 0, 'Make the intermediate trajectories in-process instead of with '
+                                                 'cpptraj'],
                            ['netcdf', int, 0, 'Use NetCDF intermediate trajectories'],
                            ['overwrite_data', int, 0, 'Defines whether the gmxMMPBSA data will be overwritten'],
                            ['PBRadii', int, 3, 'Define PBRadii to build amber topology from GROMACS files'],
@@ -625,6 +640,8 @@ input_file.addNamelist('ala', 'alanine_scanning',
                            ['mutant_only', int, 0, 'Only compute mutant energies'],
                            ['mutant', str, 'ALA', 'Defines if Alanine or Glycine scanning will be performed'],
                            ['mutant_res', str, '', 'Which residue will be mutated'],
+                           ['mutant_scan', int, 0, 'Mutate each of the residues selected in mutant_res, one at a '
+                                                   'time'],
                            ['cas_intdiel', int, 0, 'Change the intdiel value based on which aa is mutated'],
                            ['intdiel_nonpolar', int, 1, 'intdiel for nonpolar residues'],
                            ['intdiel_polar', int, 3, 'intdiel for polar residues'],
@@ -24,27 +24,41 @@
 # ##############################################################################
 
 import os
+import re
 import signal
 import sys
+import time
 import logging
+from math import sqrt
 # Import gmx_MMPBSA modules
 from GMXMMPBSA import utils
 from GMXMMPBSA.amber_outputs import (QHout, NMODEout, QMMMout, GBout, PBout, PolarRISM_std_Out, RISM_std_Out,
-                                     PolarRISM_gf_Out, RISM_gf_Out, SingleTrajBinding, MultiTrajBinding, IEout, C2out)
+                                     PolarRISM_gf_Out, RISM_gf_Out, SingleTrajBinding, MultiTrajBinding, IEout, C2out,
+                                     RankPool, EnergyMoments, BindingStatistics)
+from GMXMMPBSA.checkpoint import Manifest
+from GMXMMPBSA.energy_cache import EnergyCache, TrajectoryCache
 from GMXMMPBSA.calculation import (CalculationList, EnergyCalculation, PBEnergyCalculation, RISMCalculation,
                                    NmodeCalc, QuasiHarmCalc, CopyCalc, PrintCalc, LcpoCalc, MolsurfCalc,
                                    InteractionEntropyCalc, C2EntropyCalc)
 from GMXMMPBSA.commandlineparser import parser
+from GMXMMPBSA.costmodel import CostModel
 from GMXMMPBSA.createinput import create_inputs
-from GMXMMPBSA.exceptions import (MMPBSA_Error, InternalError, InputError, GMXMMPBSA_ERROR, GMXMMPBSA_WARNING)
+from GMXMMPBSA.exceptions import (MMPBSA_Error, InternalError, InputError, CommandlineError, GMXMMPBSA_ERROR,
+                                  GMXMMPBSA_WARNING)
 from GMXMMPBSA.findprogs import find_progs
 from GMXMMPBSA.infofile import InfoFile
 from GMXMMPBSA.fake_mpi import MPI as FakeMPI
 from GMXMMPBSA.input_parser import input_file as _input_file
-from GMXMMPBSA.make_trajs import make_trajectories, make_mutant_trajectories
+from GMXMMPBSA.monitor import LiveStats
+from GMXMMPBSA.make_trajs import (make_trajectories, make_mutant_trajectories, plan_trajectories,
+                                  make_nmode_trajectory, make_dummy_files, make_trajectory_slices,
+                                  make_nmode_trajectories, make_native_slices, Trajectory, frame_cache)
+from GMXMMPBSA.trajio import supported
 from GMXMMPBSA.output_file import (write_stability_output, write_binding_output, write_decomp_stability_output,
                                    write_decomp_binding_output, Data2h5)
 from GMXMMPBSA.parm_setup import MMPBSA_System
+from GMXMMPBSA.pipeline import TaskGraph
+from GMXMMPBSA.scheduler import ChunkScheduler, TaskScheduler, split_frames, adaptive_passes, shard_range
 from GMXMMPBSA.make_top import CheckMakeTop
 from GMXMMPBSA.timer import Timer
 
@@ -80,6 +94,9 @@ class MMPBSA_App(object):
         _MPI = self.MPI = MPI
         self.pre = '_GMXMMPBSA_'
         self.INPUT = {}
+        # Label and complex, receptor and ligand topologies of the other
+        # residues of a mutant scan (see CheckMakeTop.buildScanTopologies)
+        self.scan_mutants = []
         if stdout is None:
             _stdout = self.stdout = _unbuf_stdout
         else:
@@ -108,6 +125,10 @@ class MMPBSA_App(object):
         if size is not None and self.mpi_size == 1:
             self.mpi_size = size
 
+        # Files of the normal system ('surf' for the surface areas, 'average'
+        # for the average structure) made while preparing the trajectories
+        self.pass_outputs = set()
+
     def file_setup(self):
         """ Sets up the trajectories and input files """
         # If we are rewriting the output file only, bail out here
@@ -140,18 +161,55 @@ class MMPBSA_App(object):
         self.timer.add_timer('cpptraj', 'Creating trajectories with cpptraj:')
         self.timer.start_timer('cpptraj')
 
+        # With MPI (or -nproc and chunk_size), every rank (or worker) makes its
+        # own slice of the trajectories, and the master only the dummy files
+        workers = self.mpi_size if self.mpi_size > 1 else (self.nproc if INPUT['chunk_size'] else 1)
         if master:
             self.stdout.write('Preparing trajectories for simulation...\n')
-            self.numframes, rec_frames, lig_frames, self.numframes_nmode = make_trajectories(INPUT, FILES,
-                                                                                             self.mpi_size,
-                                                                     self.external_progs['cpptraj'], self.pre)
-            if self.traj_protocol == 'MTP' and not self.numframes == rec_frames == lig_frames:
-                GMXMMPBSA_ERROR('The complex, receptor, and ligand trajectories must be the same length. Since v1.5.0 '
-                                'we have simplified a few things to make the code easier to maintain. Please check the '
-                                'documentation')
+        native = False
+        if INPUT['native_io']:
+            trajs = FILES.complex_trajs + (FILES.receptor_trajs or []) + (FILES.ligand_trajs or [])
+            native = all(supported(traj) for traj in trajs)
+            if master and not native:
+                GMXMMPBSA_WARNING('The trajectories can not be read in-process (XTC files need mdtraj or '
+                                  'MDAnalysis, and NetCDF files must be NetCDF-3). Using cpptraj instead')
+        # cpptraj computes the surface areas while it makes the trajectories
+        self.pass_outputs = {'average'} if native else {'surf', 'average'}
+        # The trajectories prepared by an earlier run with the same trajectories,
+        # topologies, masks and frames are in the cache
+        traj_cache = key = state = None
+        if master and FILES.cache_dir:
+            traj_cache = TrajectoryCache(FILES.cache_dir, int(FILES.cache_size * 1024 ** 3))
+            key = self._trajectory_key(traj_cache)
+            state = traj_cache.get(key, self.pre)
+        state = self.MPI.COMM_WORLD.bcast(state)
+        if state is not None:
+            self._restore_trajectories(state)
+        else:
+            prefix_files = set(self._prefix_files()) if traj_cache else None
+            if workers > 1 or native:
+                self.make_trajectory_slices(workers, native)
+            elif master:
+                self.numframes, rec_frames, lig_frames, self.numframes_nmode = make_trajectories(
+                    INPUT, FILES, self.mpi_size, self.external_progs['cpptraj_parallel'], self.pre, self.cpptraj_jobs)
+                self._check_traj_lengths(self.numframes, rec_frames, lig_frames)
 
         self.MPI.COMM_WORLD.Barrier()
 
+        if traj_cache is not None and state is None:
+            self._store_trajectories(traj_cache, key, [fname for fname in self._prefix_files()
+                                                       if fname not in prefix_files])
+
+        # Number of thread-specific (or chunk-specific) trajectories. Only the
+        # master knows how many frames we have
+        if master:
+            chunks = (len(split_frames(self.numframes, self.mpi_size, INPUT['chunk_size'])),
+                      len(split_frames(self.numframes_nmode, self.mpi_size, INPUT['chunk_size']))
+                      if INPUT['nmoderun'] else 0)
+        else:
+            chunks = None
+        self.num_chunks, self.num_chunks_nmode = self.MPI.COMM_WORLD.bcast(chunks)
+
         self.timer.stop_timer('cpptraj')
 
         self.timer.add_timer('muttraj', 'Mutating trajectories:')
@@ -159,8 +217,17 @@ class MMPBSA_App(object):
 
         if INPUT['alarun']:
             self.stdout.write('Mutating trajectories...\n')
-        _, mutant_residue = make_mutant_trajectories(INPUT, FILES, self.mpi_rank, self.external_progs['cpptraj'],
-                                                     self.normal_system, self.mutant_system, self.pre)
+        # Every rank mutates its share of the chunks. Mutating is cheap, so a
+        # static split is fine here
+        _, mutant_residue = make_mutant_trajectories(INPUT, FILES, self.mpi_rank,
+                                                     self.external_progs['cpptraj_parallel'], self.normal_system, self.mutant_system, self.pre,
+                                                     range(self.mpi_rank, self.num_chunks, self.mpi_size),
+                                                     range(self.mpi_rank, self.num_chunks_nmode, self.mpi_size))
+        for _, prefix, system, prmtops in self.scan_systems:
+            make_mutant_trajectories(INPUT, FILES, self.mpi_rank, self.external_progs['cpptraj_parallel'],
+                                     self.normal_system, system, self.pre,
+                                     range(self.mpi_rank, self.num_chunks, self.mpi_size),
+                                     range(self.mpi_rank, self.num_chunks_nmode, self.mpi_size), prefix, prmtops)
 
         self.MPI.COMM_WORLD.Barrier()
 
@@ -173,7 +240,119 @@ class MMPBSA_App(object):
 
         self.timer.stop_timer('muttraj')
 
-        # Add all of the calculation timers
+        self.save_frame_counts()
+
+        self._add_calc_timers()
+
+        self.sync_mpi()
+
+    def _trajectory_key(self, traj_cache):
+        """
+        Cache key of the prepared trajectories. The calculations do not change
+        them, so e.g. a GB and a PB run of the same system share them
+        """
+        FILES, INPUT = self.FILES, self.INPUT
+        files = ([FILES.complex_prmtop, FILES.receptor_prmtop, FILES.ligand_prmtop] + FILES.complex_trajs +
+                 (FILES.receptor_trajs or []) + (FILES.ligand_trajs or []))
+        options = {var: INPUT[var] for var in ('startframe', 'endframe', 'interval', 'nmoderun', 'nmstartframe',
+                                               'nmendframe', 'nminterval', 'strip_mask', 'receptor_mask',
+                                               'ligand_mask', 'netcdf', 'full_traj', 'qh_entropy', 'chunk_size')}
+        options.update(size=self.mpi_size, stability=FILES.stability, complex_trajs=len(FILES.complex_trajs),
+                       receptor_trajs=len(FILES.receptor_trajs or []), ligand_trajs=len(FILES.ligand_trajs or []))
+        return traj_cache.key('trajectories', files, options)
+
+    def _prefix_files(self):
+        """ Files that start with the prefix """
+        directory = os.path.dirname(self.pre)
+        return [os.path.join(directory, fname) for fname in os.listdir(directory or os.getcwd())
+                if os.path.join(directory, fname).startswith(self.pre)]
+
+    def _surf_options(self):
+        """ Options of the surface areas made with the trajectories """
+        return [self.INPUT['molsurf'], self.INPUT['probe'], self.INPUT['msoffset']]
+
+    def _store_trajectories(self, traj_cache, key, fnames):
+        """ Adds the files made while preparing the trajectories to the cache """
+        frames = {}
+        for fname in fnames:
+            count = frame_cache.get(fname)
+            if count is not None:
+                frames[fname[len(self.pre):]] = count
+        surf = 'surf' in self.pass_outputs and self.INPUT['gbrun']
+        traj_cache.put(key, fnames, {'numframes': self.numframes, 'numframes_nmode': self.numframes_nmode,
+                                     'pass_outputs': sorted(self.pass_outputs if surf else
+                                                            self.pass_outputs - {'surf'}),
+                                     'surf': self._surf_options(), 'frames': frames}, self.pre)
+
+    def _restore_trajectories(self, state):
+        """
+        Uses the trajectories restored from the cache (see _store_trajectories).
+        The surface areas are only used if they were made with the same options
+        """
+        self.numframes, self.numframes_nmode = state['numframes'], state['numframes_nmode']
+        self.pass_outputs = set(state['pass_outputs'])
+        if state['surf'] != self._surf_options():
+            self.pass_outputs.discard('surf')
+        if self.master:
+            for name, count in state['frames'].items():
+                frame_cache.set(self.pre + name, count)
+            self.stdout.write('Using the prepared trajectories of the cache...\n')
+
+    def make_trajectory_slices(self, workers, native=False):
+        """
+        Makes the thread-specific (or chunk-specific) trajectories in parallel.
+        The chunks are divided in workers blocks of consecutive chunks, and each
+        block is made by its own cpptraj run (one per rank with MPI, or a pool
+        of nproc threads otherwise), which only reads the frames of the block.
+        With native, the blocks are made in-process instead of by cpptraj
+        """
+        INPUT, FILES, cpptraj = self.INPUT, self.FILES, self.external_progs['cpptraj_parallel']
+        frames = None
+        if self.master:
+            frames = make_dummy_files(INPUT, FILES, self.mpi_size, cpptraj, self.pre, self.cpptraj_jobs)
+            self._check_traj_lengths(*frames)
+        frames = self.MPI.COMM_WORLD.bcast(frames)
+        self.numframes = frames[0]
+        frame_counts = {system: split_frames(count, self.mpi_size, INPUT['chunk_size'])
+                        for system, count in zip(('complex', 'receptor', 'ligand'), frames)}
+        num_chunks = len(frame_counts['complex'])
+        blocks = []
+        first = 0
+        for count in split_frames(num_chunks, workers):
+            if count:
+                blocks.append(range(first, first + count))
+            first += count
+
+        def _slice(chunks):
+            if native:
+                make_native_slices(INPUT, FILES, self.pre, frame_counts, chunks)
+            else:
+                make_trajectory_slices(INPUT, FILES, cpptraj, self.pre, frame_counts, chunks)
+
+        if self.mpi_size > 1:
+            for chunks in blocks[self.mpi_rank:self.mpi_rank + 1]:
+                _slice(chunks)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(_slice, chunks) for chunks in blocks]:
+                    future.result()
+        # The nmode trajectories are made from all the slices
+        self.MPI.COMM_WORLD.Barrier()
+        if self.master:
+            self.numframes_nmode = make_nmode_trajectories(INPUT, FILES, self.mpi_size, cpptraj, self.pre,
+                                                           self.numframes, self.cpptraj_jobs)
+
+    def _check_traj_lengths(self, com_frames, rec_frames, lig_frames):
+        """ With multiple trajectories, all the systems must have the same number of frames """
+        if self.traj_protocol == 'MTP' and not com_frames == rec_frames == lig_frames:
+            GMXMMPBSA_ERROR('The complex, receptor, and ligand trajectories must be the same length. Since v1.5.0 '
+                            'we have simplified a few things to make the code easier to maintain. Please check the '
+                            'documentation')
+
+    def _add_calc_timers(self):
+        """ Adds all of the calculation timers """
+        INPUT = self.INPUT
         self.timer.add_timer('calc', 'Total calculation time:')
         if INPUT['gbrun']:
             self.timer.add_timer('gb', 'Total GB calculation time:')
@@ -186,8 +365,6 @@ class MMPBSA_App(object):
         if INPUT['qh_entropy']:
             self.timer.add_timer('qh', 'Total quasi-harmonic calculation time:')
 
-        self.sync_mpi()
-
     def run_mmpbsa(self, rank=None):
         """
         Runs the MM/PBSA analysis. This assumes FILES and INPUT are already set.
@@ -210,9 +387,22 @@ class MMPBSA_App(object):
 
         self.stdout.write('\n')
 
-        self.calc_list.run(rank, self.stdout)
+        # With chunk_size, the chunks are handed out on demand. With MPI, the
+        # master hands them out
+        scheduler = None
+        if INPUT['chunk_size'] and self.MPI.COMM_WORLD.Get_size() > 1:
+            scheduler = TaskScheduler(self.MPI, self.num_chunks, self.num_chunks_nmode)
+        elif INPUT['chunk_size']:
+            scheduler = ChunkScheduler(self.pre, self.num_chunks, self.num_chunks_nmode)
+
+        self.start_live_stats()
+        try:
+            self.calc_list.run(rank, self.stdout, nproc=self.nproc, scheduler=scheduler)
+        finally:
+            self.stop_live_stats()
 
         self.sync_mpi()
+        self.save_timings()
 
         if master:
             self.timer.stop_timer('calc')
@@ -220,13 +410,395 @@ class MMPBSA_App(object):
             info = InfoFile(self)
             info.write_info(self.pre + 'info')
 
+    def run_adaptive(self):
+        """
+        Adaptive sampling. Runs file_setup, run_mmpbsa and parse_output_files on
+        the frames of each pass given by adaptive_passes (coarse-to-fine), adding
+        the energies of every pass to those of the previous ones (see _output).
+        It stops when the SEM of adaptive_term is below adaptive_sem for every
+        model (after two passes and adaptive_min_frames frames at least, since
+        the SEM of a few coarse frames is unreliable), when the next pass is not expected to fit in the adaptive_time
+        budget, or when all the frames are used
+        """
+        INPUT, master = self.INPUT, self.master
+        start_time = time.time()
+        startframe, interval = INPUT['startframe'], INPUT['interval']
+        if master:
+            total_frames = Trajectory(self.FILES.complex_prmtop, self.FILES.complex_trajs,
+                                      self.external_progs['cpptraj']).total_frames
+            endframe = min(INPUT['endframe'], total_frames)
+            passes = adaptive_passes(startframe, endframe, interval, INPUT['adaptive_stride'])
+        else:
+            passes = None
+        passes = self.MPI.COMM_WORLD.bcast(passes)
+        self._adaptive = {'previous': {}, 'current': {}}
+        frames = 0
+        for i, (first, step) in enumerate(passes):
+            if i:
+                # The work units of the previous pass are done
+                self.remove(-2)
+                self.sync_mpi()
+            INPUT['startframe'], INPUT['interval'] = first, step
+            pass_start = time.time()
+            if master:
+                self.stdout.write('\nAdaptive sampling pass %d: every %d frames starting from frame %d\n' %
+                                  (i + 1, step, first))
+            self.file_setup()
+            self.run_mmpbsa()
+            self.parse_output_files()
+            reason = None
+            if master:
+                frames += self.numframes
+                sem = self._adaptive_sem()
+                self.stdout.write('%d frames used so far. Largest SEM of %s: %.4f\n' %
+                                  (frames, INPUT['adaptive_term'], sem))
+                if INPUT['adaptive_sem'] and sem < INPUT['adaptive_sem'] and i and \
+                        frames >= INPUT['adaptive_min_frames']:
+                    reason = 'the SEM of %s (%.4f) is below adaptive_sem (%.4f)' % (INPUT['adaptive_term'], sem,
+                                                                                  INPUT['adaptive_sem'])
+                elif i + 1 == len(passes):
+                    reason = 'all the frames were used'
+                elif INPUT['adaptive_time']:
+                    # Assume the time per frame of this pass
+                    next_frames = len(range(passes[i + 1][0], endframe + 1, passes[i + 1][1]))
+                    expected = time.time() - start_time + (time.time() - pass_start) / self.numframes * next_frames
+                    if expected > INPUT['adaptive_time'] * 60:
+                        reason = 'the next pass would exceed adaptive_time (%s min)' % INPUT['adaptive_time']
+                if reason is None:
+                    self._adaptive = {'previous': self._adaptive['current'], 'current': {}}
+                # The final outputs are parsed again afterwards
+                del self.calc_types
+            reason = self.MPI.COMM_WORLD.bcast(reason)
+            if reason is not None:
+                break
+        INPUT['startframe'], INPUT['interval'] = startframe, interval
+        if master:
+            self.numframes = frames
+            self.adaptive_report = ('Adaptive sampling used %d of %d frames (%d passes). It stopped because %s.' %
+                                    (frames, len(range(startframe, endframe + 1, interval)), i + 1, reason))
+            self.stdout.write(self.adaptive_report + '\n')
+            self._adaptive['current'] = {}
+
+    def _adaptive_sem(self):
+        """ Largest SEM of adaptive_term among the models of the normal and mutant systems """
+        term = self.INPUT['adaptive_term']
+        sems = []
+        for calc_types in (self.calc_types, self.calc_types.mutant):
+            for key in ('gb', 'pb', 'rism std', 'rism gf'):
+                if key not in calc_types:
+                    continue
+                data = calc_types[key]['complex' if self.stability else 'delta'].data
+                values = data.get('DELTA ' + term, data.get(term))
+                if values is None:
+                    GMXMMPBSA_ERROR('%s is not an energy term of the %s output (adaptive_term)' % (term, key),
+                                    InputError)
+                sems.append(float(values.stdev()) / sqrt(len(values)))
+        return max(sems)
+
+    def setup_shard(self):
+        """
+        Restricts the analyzed frames to the block of this shard (-shard). The
+        nmode frames are counted among the analyzed ones, so they are moved to
+        the frames of the block (and nmode is skipped if none of them is in it)
+        """
+        INPUT = self.INPUT
+        shard, num_shards = self.shard
+        if self.master:
+            total_frames = Trajectory(self.FILES.complex_prmtop, self.FILES.complex_trajs,
+                                      self.external_progs['cpptraj']).total_frames
+            endframe = min(INPUT['endframe'], total_frames)
+            nframes = len(range(INPUT['startframe'], endframe + 1, INPUT['interval']))
+            block = shard_range(nframes, shard, num_shards)
+        else:
+            nframes = block = None
+        nframes, block = self.MPI.COMM_WORLD.bcast((nframes, block))
+        if block is None:
+            GMXMMPBSA_ERROR('There are more shards (%d) than frames (%d)!' % (num_shards, nframes), InputError)
+        first, last = block
+        startframe = INPUT['startframe']
+        INPUT['startframe'] = startframe + (first - 1) * INPUT['interval']
+        INPUT['endframe'] = startframe + (last - 1) * INPUT['interval']
+        if self.master:
+            self.stdout.write('Shard %d of %d: frames %d to %d of the trajectory\n' %
+                              (shard, num_shards, INPUT['startframe'], INPUT['endframe']))
+        if INPUT['nmoderun']:
+            nmstart, nminterval = INPUT['nmstartframe'], INPUT['nminterval']
+            nmfirst = nmstart + max(-(-(first - nmstart) // nminterval), 0) * nminterval
+            nmlast = min(INPUT['nmendframe'], last)
+            if nmfirst > nmlast:
+                INPUT['nmoderun'] = 0
+                if self.master:
+                    self.stdout.write('None of the nmode frames is in this shard\n')
+            else:
+                INPUT['nmstartframe'], INPUT['nmendframe'] = nmfirst - first + 1, nmlast - first + 1
+
+    def merge_shards(self):
+        """
+        Loads the info files of the shard directories given to -merge. The first
+        shard describes the run, and parse_output_files joins the outputs of
+        all of them in the order of their frames (see _output)
+        """
+        from types import SimpleNamespace
+        FILES = self.FILES
+        prefix, directories, gui = FILES.prefix, FILES.merge, FILES.gui
+        shards = []
+        for directory in directories:
+            info = os.path.join(directory, prefix + 'info')
+            if not os.path.isfile(info):
+                GMXMMPBSA_ERROR('%s is not the directory of a -shard run (%s not found)' % (directory, info),
+                                InputError)
+            shard = SimpleNamespace(INPUT={}, info=info)
+            InfoFile(shard).read_info(info)
+            match = re.match(r'(\d+)/(\d+)$', str(getattr(shard.FILES, 'shard', None)))
+            if not match:
+                GMXMMPBSA_ERROR('%s was not written by a -shard run' % info, InputError)
+            shard.index, shard.num_shards = int(match.group(1)), int(match.group(2))
+            # The directory may have been moved since the shard ran
+            shard.pre = os.path.join(directory, os.path.basename(shard.FILES.prefix))
+            shards.append(shard)
+        shards.sort(key=lambda shard: shard.index)
+        num_shards = shards[0].num_shards
+        indices = [shard.index for shard in shards]
+        if any(shard.num_shards != num_shards for shard in shards) or len(set(indices)) != len(indices):
+            GMXMMPBSA_ERROR('The shard directories given to -merge do not belong to the same run', InputError)
+        missing = sorted(set(range(1, num_shards + 1)) - set(indices))
+        if missing:
+            GMXMMPBSA_ERROR('Shards %s of %d are missing' % (', '.join(str(i) for i in missing), num_shards),
+                            InputError)
+        if any(shard.input_file_text != shards[0].input_file_text for shard in shards):
+            GMXMMPBSA_ERROR('The shards were not run with the same input file', InputError)
+
+        InfoFile(self).read_info(shards[0].info)
+        # The topologies and the outputs of the merge are written here
+        self.FILES.prefix = self.pre = prefix
+        self.FILES.merge, self.FILES.shard = directories, None
+        self.INPUT['startframe'] = shards[0].INPUT['startframe']
+        self.INPUT['endframe'] = shards[-1].INPUT['endframe']
+        self.INPUT['nmoderun'] = int(any(shard.INPUT['nmoderun'] for shard in shards))
+        self.numframes = sum(shard.numframes for shard in shards)
+        self.numframes_nmode = sum(shard.numframes_nmode for shard in shards if shard.INPUT['nmoderun'])
+        self._shards = [(shard.pre, shard.num_chunks, shard.num_chunks_nmode if shard.INPUT['nmoderun'] else 0)
+                        for shard in shards]
+        # The info file of a shard only describes its own frames
+        if gui:
+            GMXMMPBSA_WARNING('gmx_MMPBSA_ana is not opened after -merge')
+        self.FILES.gui = False
+        self.stdout.write('Merging %d shards (%d frames)\n' % (num_shards, self.numframes))
+
+    def start_live_stats(self):
+        """
+        Starts following the GB and PB output files on the master, if
+        -live-stats was given
+        """
+        INPUT = self.INPUT
+        self.live_stats = None
+        if not self.master or not self.FILES.live_stats:
+            return
+        models = []
+        for trigger, key, outclass, basename, num_files in self._output_classes():
+            if key not in ('gb', 'pb') or not INPUT[trigger]:
+                continue
+            if not INPUT['mutant_only']:
+                models.append((key.upper(), self.pre + basename, outclass.data_keys))
+            if INPUT['alarun']:
+                models.append((key.upper() + ' (mutant)', self.pre + 'mutant_' + basename, outclass.data_keys))
+        if not models:
+            return
+        self.live_stats = LiveStats(models, self.num_chunks, self.numframes, self.stability, self.FILES.live_stats,
+                                    self.stdout)
+        self.live_stats.start()
+
+    def stop_live_stats(self):
+        """ Stops following the output files """
+        if self.live_stats is not None:
+            self.live_stats.stop()
+            self.live_stats = None
+
+    def run_pipeline(self):
+        """
+        Does the work of file_setup, run_mmpbsa and parse_output_files as a
+        single task graph (see build_pipeline), so every step starts as soon as
+        the files it needs exist instead of waiting for the whole stage
+        """
+        FILES, INPUT, master = self.FILES, self.INPUT, self.master
+        self.timer.start_timer('setup')
+        if master and not FILES.use_mdins:
+            create_inputs(INPUT, self.normal_system, self.pre)
+        self.timer.stop_timer('setup')
+        # Bail out if we only wanted to generate mdin files
+        if FILES.make_mdins:
+            self.stdout.write('Created mdin files. Quitting.\n')
+            sys.exit(0)
+        self.sync_mpi()
+
+        self.timer.add_timer('cpptraj', 'Creating trajectories with cpptraj:')
+        self.timer.add_timer('muttraj', 'Mutating trajectories:')
+        self._add_calc_timers()
+
+        graph = self.build_pipeline()
+        self.timer.start_timer('calc')
+        self.start_live_stats()
+        try:
+            graph.run(self.nproc, self.stdout)
+        finally:
+            self.stop_live_stats()
+        self.sync_mpi()
+        self.save_timings()
+        self.save_frame_counts()
+        self.timer.stop_timer('calc')
+
+        if master:
+            self.stdout.write(('\n%d frames were processed by cpptraj for use in '
+                               'calculation.\n') % self.numframes)
+            if INPUT['nmoderun']:
+                self.stdout.write(('%d frames were processed by cpptraj for '
+                                   'nmode calculations.\n') % self.numframes_nmode)
+            # Write out the info file now
+            info = InfoFile(self)
+            info.write_info(self.pre + 'info')
+
+    def build_pipeline(self):
+        """
+        Builds the TaskGraph with the trajectory preparation, the calculations
+        and the parsing of their output files. Each processor gets one piece
+        of every trajectory, as in the default (chunk_size = 0) split
+        """
+        from copy import deepcopy
+
+        INPUT, FILES, pre = self.INPUT, self.FILES, self.pre
+        if INPUT['chunk_size']:
+            if self.master:
+                GMXMMPBSA_WARNING('chunk_size is ignored with -pipeline')
+            INPUT['chunk_size'] = 0
+        self.num_chunks = self.mpi_size
+        self.num_chunks_nmode = self.mpi_size if INPUT['nmoderun'] else 0
+        self.numframes = self.numframes_nmode = 0
+        self.pass_outputs = set()
+        self._parsed = {}
+        cpptraj = self.external_progs['cpptraj_parallel']
+        trj_sfx = 'nc' if INPUT['netcdf'] else 'mdcrd'
+        systems = ['complex'] if self.stability else ['complex', 'receptor', 'ligand']
+        graph = TaskGraph(pre, self.mpi_rank, self.mpi_size, self.timer)
+
+        def _system_files(prefix, system):
+            """ Files made by cpptraj for a system """
+            files = ['%s%s.%s.%%d' % (prefix, system, trj_sfx), '%s%s.pdb' % (prefix, system),
+                     '%sdummy%s.inpcrd' % (prefix, system)]
+            if INPUT['full_traj'] or INPUT['qh_entropy']:
+                files.append('%s%s.%s' % (prefix, system, trj_sfx))
+            return files
+
+        # Trajectories. Only the master runs cpptraj, but every system gets its
+        # own cpptraj job, so the calculations on the complex can start while
+        # the receptor and ligand are still being stripped
+        jobs = {}
+
+        def _plan(rank):
+            frames, trajs = plan_trajectories(INPUT, FILES, self.mpi_size, cpptraj, pre, split_systems=True)
+            if self.traj_protocol == 'MTP' and not frames[0] == frames[1] == frames[2]:
+                GMXMMPBSA_ERROR('The complex, receptor, and ligand trajectories must be the same length. Since '
+                                'v1.5.0 we have simplified a few things to make the code easier to maintain. Please '
+                                'check the documentation')
+            self.numframes = frames[0]
+            if self.live_stats is not None:
+                self.live_stats.numframes = self.numframes
+            for job_systems, traj, output in trajs:
+                jobs[job_systems[0]] = (traj, output)
+
+        graph.add('set up trajectories', _plan, master_only=True, timer_key='cpptraj',
+                  message='Preparing trajectories for simulation...')
+        for system in systems:
+            graph.add('%s trajectory' % system, lambda rank, s=system: jobs[s][0].Run(jobs[s][1]),
+                      outputs=_system_files(pre, system), after=['set up trajectories'], master_only=True,
+                      timer_key='cpptraj')
+        if INPUT['nmoderun']:
+            for system in systems:
+                def _nmode(rank, s=system):
+                    frames = make_nmode_trajectory(INPUT, FILES, self.mpi_size, cpptraj, pre, s, self.num_chunks)
+                    if s == 'complex':
+                        self.numframes_nmode = frames
+                graph.add('%s nmode trajectory' % system, _nmode, inputs=['%s%s.%s.%%d' % (pre, system, trj_sfx)],
+                          outputs=['%s%s_nm.%s.%%d' % (pre, system, trj_sfx)], master_only=True,
+                          timer_key='cpptraj')
+
+        # Every rank mutates its own trajectories
+        if INPUT['alarun']:
+            suffixes = ['.%s.%%d' % trj_sfx]
+            if INPUT['nmoderun']:
+                suffixes.append('_nm.%s.%%d' % trj_sfx)
+            inputs = [pre + system + sfx for system in systems for sfx in suffixes]
+            outputs = [pre + 'mutant_' + system + sfx for system in systems for sfx in suffixes]
+            for system in systems:
+                outputs += _system_files(pre + 'mutant_', system)
+            if INPUT['full_traj'] or INPUT['qh_entropy']:
+                inputs.append('%scomplex.%s' % (pre, trj_sfx))
+            graph.add('mutate trajectories',
+                      lambda rank: make_mutant_trajectories(INPUT, FILES, rank, cpptraj, self.normal_system,
+                                                            self.mutant_system, pre),
+                      inputs=inputs, outputs=outputs, timer_key='muttraj', message='Mutating trajectories...')
+
+        # Calculations. They read their trajectory and coordinate files and
+        # write their output (or copy it from the normal system)
+        self.load_calc_list()
+        for i, calc in enumerate(self.calc_list):
+            if isinstance(calc, PrintCalc):
+                continue
+            output = calc.final_name if isinstance(calc, CopyCalc) else calc.output
+            inputs = [f for f in (getattr(calc, 'incrd', None), getattr(calc, 'inptraj', None),
+                                  getattr(calc, 'orig_name', None)) if f]
+            # sander always writes a restart file, so calculations that may run
+            # at the same time cannot share it. The list keeps its own names
+            if getattr(calc, 'restrt', None) is not None:
+                calc = deepcopy(calc)
+                calc.restrt = '%s.%d' % (calc.restrt, i)
+            name = output[len(pre):].replace('.%d', '')
+            graph.add(name, self._calc_task(calc), inputs, [output], master_only='%d' not in output,
+                      timer_key=self.calc_list.timer_keys[i], message='  running %s...' % name)
+
+        # Parsing of the output files of each system
+        prefixes = []
+        if not INPUT['mutant_only']:
+            prefixes.append('')
+        if INPUT['alarun']:
+            prefixes.append('mutant_')
+        for trigger, key, outclass, basename, num_files in self._output_classes():
+            if not INPUT[trigger]:
+                continue
+            for prefix in prefixes:
+                for system in systems:
+                    fname = pre + prefix + basename % system
+                    inputs = [fname + '.%d']
+                    if key == 'gb':
+                        inputs.append(fname.replace('gb.mdout', 'gb_surf.dat') + '.%d')
+
+                    def _parse(rank, cls=outclass, fname=fname, num_files=num_files):
+                        self._parsed[(cls, fname)] = cls(fname, INPUT, num_files, self.using_chamber)
+                    graph.add('parse %s (%s)' % (prefix + basename % system, key), _parse, inputs,
+                              master_only=True)
+        return graph
+
+    def _calc_task(self, calc):
+        """ Returns the function that runs a calculation in a TaskGraph """
+        def _run(rank):
+            self.calc_list.run_calc(calc, rank, self.stdout)
+        return _run
+
     def load_calc_list(self):
         """
         Sets up all of the calculations to be run. When adding a new
         calculation type, add a class to calculation.py, import it at the top of
         the file here, then append it to the calc list appropriately
         """
-        self.calc_list = CalculationList(self.timer)
+        # Every finished calculation is recorded, so the run can be resumed
+        cache = None
+        if self.FILES.cache_dir:
+            cache = EnergyCache(self.FILES.cache_dir, int(self.FILES.cache_size * 1024 ** 3))
+        # Every rank must order the calculations in the same way, so the master
+        # reads the timings of the earlier runs
+        cost_model = CostModel(self.FILES.timings if self.master else None)
+        cost_model.history = self.MPI.COMM_WORLD.bcast(cost_model.history)
+        self.calc_list = CalculationList(self.timer, manifest=Manifest(self.pre, self.mpi_rank), cache=cache,
+                                         cost_model=cost_model)
 
         if not self.INPUT['mutant_only']:
             self.calc_list.append(
@@ -237,18 +809,68 @@ class MMPBSA_App(object):
             self.calc_list.append(
                 PrintCalc('\nRunning calculations on mutant system...'), timer_key=None)
             self._load_calc_list(self.pre + 'mutant_', True, self.mutant_system)
+        # The other mutants of the scan go in the same list, so all of them are
+        # scheduled together
+        for label, prefix, system, prmtops in self.scan_systems:
+            self.calc_list.append(
+                PrintCalc('\nRunning calculations on mutant %s...' % label), timer_key=None)
+            self._load_calc_list(prefix, True, system, prmtops)
+        # The order only matters when several calculations run at the same time
+        if self.nproc > 1 or self.INPUT['chunk_size'] or self.FILES.pipeline:
+            self.calc_list.order_by_cost(self.MPI.COMM_WORLD.bcast(self._unit_frames()))
+
+    def _unit_frames(self):
+        """ Number of frames of each unit (rank or chunk) of every timer key """
+        numframes, numframes_nmode = getattr(self, 'numframes', 0), getattr(self, 'numframes_nmode', 0)
+        frames = numframes / max(getattr(self, 'num_chunks', 1), 1)
+        return {'gb': frames, 'pb': frames, 'rism': frames, 'qh': numframes,
+                'nmode': numframes_nmode / max(getattr(self, 'num_chunks_nmode', 1), 1)}
+
+    def save_timings(self):
+        """
+        Logs the predicted and the actual time of each kind of calculation, and
+        adds the timings of this run to the history of the cost model
+        """
+        cost_model = self.calc_list.cost_model
+        observations = self.MPI.COMM_WORLD.gather(cost_model.observations)
+        if not self.master:
+            return
+        frames = self._unit_frames()
+        totals = {}
+        timings = []
+        for kind, key, natoms, seconds in (obs for rank_obs in observations for obs in rank_obs):
+            total = totals.setdefault(kind, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += cost_model.predict(kind, natoms, frames.get(key, 0))
+            total[2] += seconds
+            timings.append((kind, natoms, frames.get(key, 0), seconds))
+        for kind in sorted(totals):
+            count, predicted, actual = totals[kind]
+            logging.info('Cost model: %d %s calculation(s) took %.1f s (predicted %.1f s)' %
+                         (count, kind, actual, predicted))
+        cost_model.save(timings)
+
+    def save_frame_counts(self):
+        """ Adds the frames counted or written by every rank to the frame count cache """
+        counts = self.MPI.COMM_WORLD.gather(frame_cache.counts)
+        if self.master:
+            for rank_counts in counts[1:]:
+                frame_cache.update(rank_counts)
+            frame_cache.save()
 
-    def _load_calc_list(self, prefix, mutant, parm_system):
+    def _load_calc_list(self, prefix, mutant, parm_system, mut_prmtops=None):
         """
         Internal routine to handle building calculation list. Called separately
-        for mutant and normal systems
+        for mutant and normal systems. mut_prmtops are the complex, receptor and
+        ligand topologies of the mutant (the mutant topologies in FILES by
+        default)
         """
         # Set up a dictionary of external programs to use based one external progs
         progs = {'gb': self.external_progs['mmpbsa_py_energy'],
-                 'sa': self.external_progs['cpptraj'],
+                 'sa': self.external_progs['cpptraj_parallel'],
                  'pb': self.external_progs['mmpbsa_py_energy'],
                  'rism': self.external_progs['rism3d.snglpnt'],
-                 'qh': self.external_progs['cpptraj'],
+                 'qh': self.external_progs['cpptraj_parallel'],
                  'nmode': self.external_progs['mmpbsa_py_nabnmode']
                  }
         if self.INPUT['use_sander'] or self.INPUT['decomprun']:
@@ -264,10 +886,13 @@ class MMPBSA_App(object):
         # Determine if we just copy the receptor files. This only happens if we
         # are doing mutant calculations, we're not only doing the mutant, and the
         # receptor/mutant receptor topologies are equal. Same for the ligand
+        if mut_prmtops is None:
+            mut_prmtops = (self.FILES.mutant_complex_prmtop, self.FILES.mutant_receptor_prmtop,
+                           self.FILES.mutant_ligand_prmtop)
         copy_receptor = (mutant and not self.INPUT['mutant_only'] and
-                         self.FILES.receptor_prmtop == self.FILES.mutant_receptor_prmtop)
+                         self.FILES.receptor_prmtop == mut_prmtops[1])
         copy_ligand = (mutant and not self.INPUT['mutant_only'] and
-                       self.FILES.ligand_prmtop == self.FILES.mutant_ligand_prmtop)
+                       self.FILES.ligand_prmtop == mut_prmtops[2])
 
         # First load the GB calculations
         if self.INPUT['gbrun']:
@@ -277,6 +902,10 @@ class MMPBSA_App(object):
             else:
                 incrd = '%sdummy%%s.inpcrd' % prefix
 
+            # The surface areas of the normal system are made while preparing
+            # the trajectories (see plan_trajectories)
+            fused_surf = 'surf' in self.pass_outputs and not mutant
+
             # See whether we are doing molsurf or LCPO. Reduce # of arguments
             # needed to 3, filling in the others here
             if self.INPUT['molsurf']:
@@ -309,10 +938,11 @@ class MMPBSA_App(object):
                                   self.pre + 'restrt.%d')
             self.calc_list.append(c, '  calculating complex contribution...',
                                   timer_key='gb')
-            c = SAClass(parm_system.complex_prmtop,
-                        '%scomplex.%s.%%d' % (prefix, trj_sfx),
-                        '%scomplex_gb_surf.dat.%%d' % prefix)
-            self.calc_list.append(c, '', timer_key='gb')
+            if not fused_surf:
+                c = SAClass(parm_system.complex_prmtop,
+                            '%scomplex.%s.%%d' % (prefix, trj_sfx),
+                            '%scomplex_gb_surf.dat.%%d' % prefix)
+                self.calc_list.append(c, '', timer_key='gb')
 
             if not self.stability:
                 try:
@@ -338,10 +968,11 @@ class MMPBSA_App(object):
                                           self.pre + 'restrt.%d')
                     self.calc_list.append(c, '  calculating receptor contribution...',
                                           timer_key='gb')
-                c = SAClass(parm_system.receptor_prmtop,
-                            '%sreceptor.%s.%%d' % (prefix, trj_sfx),
-                            '%sreceptor_gb_surf.dat.%%d' % prefix)
-                self.calc_list.append(c, '', timer_key='gb')
+                if not fused_surf:
+                    c = SAClass(parm_system.receptor_prmtop,
+                                '%sreceptor.%s.%%d' % (prefix, trj_sfx),
+                                '%sreceptor_gb_surf.dat.%%d' % prefix)
+                    self.calc_list.append(c, '', timer_key='gb')
 
                 try:
                     mdin = mdin_template % 'lig'
@@ -366,10 +997,11 @@ class MMPBSA_App(object):
                                           self.pre + 'restrt.%d')
                     self.calc_list.append(c, '  calculating ligand contribution...',
                                           timer_key='gb')
-                c = SAClass(parm_system.ligand_prmtop,
-                            '%sligand.%s.%%d' % (prefix, trj_sfx),
-                            '%sligand_gb_surf.dat.%%d' % prefix)
-                self.calc_list.append(c, '', timer_key='gb')
+                if not fused_surf:
+                    c = SAClass(parm_system.ligand_prmtop,
+                                '%sligand.%s.%%d' % (prefix, trj_sfx),
+                                '%sligand_gb_surf.dat.%%d' % prefix)
+                    self.calc_list.append(c, '', timer_key='gb')
 
         # end if self.INPUT['gbrun']
 
@@ -466,7 +1098,7 @@ class MMPBSA_App(object):
                     c = CopyCalc('%sreceptor_rism.mdout.%%d' % self.pre,
                                  '%sreceptor_rism.mdout.%%d' % prefix)
                     self.calc_list.append(c, '  no mutation found in receptor; '
-                                             'using unmutated files', timer_key='pb')
+                                             'using unmutated files', timer_key='rism')
                 else:
                     c = RISMCalculation(progs['rism'], parm_system.receptor_prmtop,
                                         '%sreceptor.pdb' % prefix,
@@ -480,7 +1112,7 @@ class MMPBSA_App(object):
                     c = CopyCalc('%sligand_rism.mdout.%%d' % self.pre,
                                  '%sligand_rism.mdout.%%d' % prefix)
                     self.calc_list.append(c, '  no mutation found in ligand; '
-                                             'using unmutated files', timer_key='pb')
+                                             'using unmutated files', timer_key='rism')
                 else:
                     c = RISMCalculation(progs['rism'], parm_system.ligand_prmtop,
                                         '%sligand.pdb' % prefix,
@@ -509,27 +1141,27 @@ class MMPBSA_App(object):
                     c = CopyCalc('%sreceptor_nm.out.%%d' % self.pre,
                                  '%sreceptor_nm.out.%%d' % prefix)
                     self.calc_list.append(c, '  no mutation found in receptor; '
-                                             'using unmutated files', timer_key='pb')
+                                             'using unmutated files', timer_key='nmode')
                 else:
                     c = NmodeCalc(progs['nmode'], parm_system.receptor_prmtop,
                                   '%sreceptor.pdb' % prefix,
                                   '%sreceptor_nm.%s.%%d' % (prefix, trj_sfx),
                                   '%sreceptor_nm.out.%%d' % prefix, self.INPUT)
                     self.calc_list.append(c, '  calculating receptor contribution...',
-                                          timer_key='rism')
+                                          timer_key='nmode')
 
                 if copy_ligand:
                     c = CopyCalc('%sligand_nm.out.%%d' % self.pre,
                                  '%sligand_nm.out.%%d' % prefix)
                     self.calc_list.append(c, '  no mutation found in ligand; '
-                                             'using unmutated files', timer_key='pb')
+                                             'using unmutated files', timer_key='nmode')
                 else:
                     c = NmodeCalc(progs['nmode'], parm_system.ligand_prmtop,
                                   '%sligand.pdb' % prefix,
                                   '%sligand_nm.%s.%%d' % (prefix, trj_sfx),
                                   '%sligand_nm.out.%%d' % prefix, self.INPUT)
                     self.calc_list.append(c, '  calculating ligand contribution...',
-                                          timer_key='rism')
+                                          timer_key='nmode')
 
         # end if self.INPUT['nmoderun']
 
@@ -537,24 +1169,28 @@ class MMPBSA_App(object):
         if self.INPUT['qh_entropy']:
             self.calc_list.append(
                 PrintCalc('\nBeginning quasi-harmonic calculations with %s' %
-                          progs['qh']), timer_key='qh')
+                          ' '.join(progs['qh'])), timer_key='qh')
 
             c = QuasiHarmCalc(progs['qh'], parm_system.complex_prmtop,
                               '%scomplex.%s' % (prefix, trj_sfx),
                               '%scpptrajentropy.in' % prefix,
                               '%scpptraj_entropy.out' % prefix,
                               self.INPUT['receptor_mask'],
-                              self.INPUT['ligand_mask'], self.pre)
+                              self.INPUT['ligand_mask'], self.pre,
+                              make_average=mutant or 'average' not in self.pass_outputs)
             self.calc_list.append(c, '', timer_key='qh')
 
 
     def make_prmtops(self):
         self.timer.add_timer('setup_gmx', 'Total GROMACS setup time:')
         self.timer.start_timer('setup_gmx')
-        # Now we're getting ready, remove existing intermediate files
+        # Now we're getting ready, remove existing intermediate files. A dry
+        # run only builds the topologies, so it keeps them
         if self.master and self.FILES.use_mdins:
             self.remove(-1)
-        elif self.master and not self.FILES.rewrite_output:
+        elif self.master and self.FILES.resume:
+            self.remove(-2)
+        elif self.master and not (self.FILES.rewrite_output or self.FILES.merge or self.FILES.dry_run):
             self.remove(0)
 
         # Find external programs IFF we are doing a calc
@@ -575,8 +1211,10 @@ class MMPBSA_App(object):
             logging.info('Building AMBER Topologies from GROMACS files...Done.\n')
             self.INPUT['receptor_mask'], self.INPUT['ligand_mask'], self.resl = maketop.get_masks()
             self.mut_str = maketop.mut_label
+            self.scan_mutants = maketop.scan_mutants
             self.FILES.complex_fixed = self.FILES.prefix + 'COM_FIXED.pdb'
         self.FILES = self.MPI.COMM_WORLD.bcast(self.FILES, root=0)
+        self.scan_mutants = self.MPI.COMM_WORLD.bcast(self.scan_mutants, root=0)
         self.INPUT = self.MPI.COMM_WORLD.bcast(self.INPUT, root=0)
         self.sync_mpi()
         self.timer.stop_timer('setup_gmx')
@@ -606,6 +1244,12 @@ class MMPBSA_App(object):
                 FILES.mutant_ligand_prmtop = FILES.ligand_prmtop
             self.mutant_system = MMPBSA_System(FILES.mutant_complex_prmtop, FILES.mutant_receptor_prmtop,
                                                FILES.mutant_ligand_prmtop)
+        # (label, prefix, system, topologies) of the other mutants of the scan.
+        # The part that is not mutated uses the normal topology
+        self.scan_systems = []
+        for n, (label, com_prmtop, rec_prmtop, lig_prmtop) in enumerate(self.scan_mutants, start=2):
+            prmtops = (com_prmtop, rec_prmtop or FILES.receptor_prmtop, lig_prmtop or FILES.ligand_prmtop)
+            self.scan_systems.append((label, self.pre + 'mutant%d_' % n, MMPBSA_System(*prmtops), prmtops))
         # If we have a chamber prmtop, force using sander
         if self.using_chamber:
             INPUT['use_sander'] = True
@@ -620,6 +1264,9 @@ class MMPBSA_App(object):
         if INPUT['alarun']:
             self.mutant_system.Map(INPUT['receptor_mask'], INPUT['ligand_mask'])
             self.mutant_system.CheckConsistency()
+        for _, _, system, _ in self.scan_systems:
+            system.Map(INPUT['receptor_mask'], INPUT['ligand_mask'])
+            system.CheckConsistency()
         if (INPUT['ligand_mask'] is None or INPUT['receptor_mask'] is None):
             com_mask, INPUT['receptor_mask'], INPUT['ligand_mask'] = \
                 self.normal_system.Mask('all', in_complex=True)
@@ -645,12 +1292,16 @@ class MMPBSA_App(object):
         else:
             write_binding_output(self)
         if self.INPUT['decomprun']:
+            # The statistics merged from the MPI ranks, if only those are needed
+            decomp = getattr(self, '_decomp', None)
             if self.stability:
-                write_decomp_stability_output(self.FILES, self.INPUT, self.mpi_size,
-                                              self.normal_system, self.mutant_system, self.mut_str, self.pre)
+                write_decomp_stability_output(self.FILES, self.INPUT, self.num_chunks,
+                                              self.normal_system, self.mutant_system, self.mut_str, self.pre,
+                                              decomp)
             else:
-                write_decomp_binding_output(self.FILES, self.INPUT, self.mpi_size,
-                                            self.normal_system, self.mutant_system, self.mut_str, self.pre)
+                write_decomp_binding_output(self.FILES, self.INPUT, self.num_chunks,
+                                            self.normal_system, self.mutant_system, self.mut_str, self.pre,
+                                            decomp)
         if self.INPUT['save_mode']:
             # Store the calc_types data in a h5 file
             Data2h5(self)
@@ -666,12 +1317,16 @@ class MMPBSA_App(object):
         self.timer.print_('setup_gmx', self.stdout)
         self.timer.print_('setup', self.stdout)
 
-        if not self.FILES.rewrite_output:
+        if not (self.FILES.rewrite_output or self.FILES.merge):
             self._finalize_timers()
         self.timer.print_('output', self.stdout)
         self.timer.print_('global', self.stdout)
 
-        self.remove(self.INPUT['keep_files'])
+        # A shard always keeps the outputs that -merge reads
+        if self.shard and not self.INPUT['keep_files']:
+            self.remove(-3)
+        else:
+            self.remove(self.INPUT['keep_files'])
 
         logging.info('\n\nThank you for using gmx_MMPBSA. Please cite us if you publish this work with this '
                      'reference:\n    Mario S. Valdés Tresanco, Mario E. Valdes-Tresanco, Pedro A. Valiente, & '
@@ -683,7 +1338,7 @@ class MMPBSA_App(object):
         self.MPI.Finalize()
 
         end = 0
-        if self.FILES.gui:
+        if self.FILES.gui and not self.shard:
             import subprocess
             logging.info('Opening gmx_MMPBSA_ana to analyze results...\n')
             g = subprocess.Popen(['gmx_MMPBSA_ana', '-f', self.FILES.prefix + 'info'])
@@ -733,6 +1388,28 @@ class MMPBSA_App(object):
             self.FILES = object()
         # Broadcast the FILES
         self.FILES = self.MPI.COMM_WORLD.bcast(self.FILES)
+        # A shard keeps all of its files in its own directory, so the shards of
+        # a job array can run in the same working directory
+        self.shard = None
+        if self.FILES.shard:
+            match = re.match(r'(\d+)/(\d+)$', self.FILES.shard)
+            if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+                GMXMMPBSA_ERROR('-shard must be I/N with 1 <= I <= N (e.g. 3/16)', CommandlineError)
+            if self.FILES.merge:
+                GMXMMPBSA_ERROR('-shard and -merge can not be used together', CommandlineError)
+            self.shard = int(match.group(1)), int(match.group(2))
+            directory = 'shard_%d' % self.shard[0]
+            self.FILES.prefix = os.path.join(directory, self.FILES.prefix)
+            if self.master:
+                os.makedirs(directory, exist_ok=True)
+                root = logging.getLogger()
+                for handler in root.handlers[:]:
+                    if isinstance(handler, logging.FileHandler):
+                        root.removeHandler(handler)
+                        handler.close()
+                        log = logging.FileHandler(os.path.join(directory, 'gmx_MMPBSA.log'), 'w')
+                        log.setFormatter(handler.formatter)
+                        root.addHandler(log)
         # Hand over the file prefix to the App instance
         self.pre = self.FILES.prefix
         if self.FILES.receptor_trajs or self.FILES.ligand_trajs:
@@ -741,6 +1418,18 @@ class MMPBSA_App(object):
             self.traj_protocol = 'STP'  # single traj protocol
         # change by explicit argument
         self.stability = self.FILES.stability
+        # Concurrent calculations are only used in serial runs. With MPI, every
+        # rank already runs its own calculations
+        self.nproc = self.FILES.nproc
+        if self.nproc < 1:
+            GMXMMPBSA_ERROR('-nproc must be a positive integer!', CommandlineError)
+        if self.mpi_size > 1 and self.nproc > 1:
+            if self.master:
+                GMXMMPBSA_WARNING('-nproc is ignored when running with MPI')
+            self.nproc = 1
+        self.cpptraj_jobs = self.FILES.cpptraj_jobs
+        if self.cpptraj_jobs < 1:
+            GMXMMPBSA_ERROR('-cpptraj-jobs must be a positive integer!', CommandlineError)
 
     def read_input_file(self, infile=None):
         """ Reads the input file, pull it from FILES if not provided here """
@@ -850,8 +1539,6 @@ class MMPBSA_App(object):
             GMXMMPBSA_ERROR('IDECOMP cannot be used with sander.APBS!', InputError)
         if not INPUT['sander_apbs'] in [0, 1]:
             GMXMMPBSA_ERROR('SANDER_APBS must be 0 or 1!', InputError)
-        if INPUT['alarun'] and INPUT['netcdf'] != '':
-            GMXMMPBSA_ERROR('Alanine scanning is incompatible with NETCDF != 0!', InputError)
         if INPUT['decomprun'] and INPUT['idecomp'] == 0:
             GMXMMPBSA_ERROR('IDECOMP cannot be 0 for Decomposition analysis!', InputError)
         if INPUT['ions_parameters'] not in range(1,13):
@@ -916,6 +1603,18 @@ class MMPBSA_App(object):
         # check mutant definition
         if not self.INPUT['mutant'].upper() in ['ALA', 'A', 'GLY', 'G']:
             GMXMMPBSA_ERROR('The mutant most be ALA (or A) or GLY (or G)', InputError)
+        if not INPUT['mutant_scan'] in [0, 1]:
+            GMXMMPBSA_ERROR('MUTANT_SCAN must be set to 0 or 1!', InputError)
+        if INPUT['mutant_scan']:
+            if (INPUT['cas_intdiel'] or INPUT['mutant_only'] or INPUT['decomprun'] or INPUT['nmoderun'] or
+                    INPUT['qh_entropy']):
+                GMXMMPBSA_ERROR('MUTANT_SCAN can not be combined with cas_intdiel, mutant_only, decomposition, '
+                                'normal mode or quasi-harmonic calculations!', InputError)
+            if INPUT['adaptive_sem'] or INPUT['adaptive_time'] or self.FILES.shard:
+                GMXMMPBSA_ERROR('MUTANT_SCAN can not be combined with adaptive sampling or -shard!', InputError)
+            if self.FILES.pipeline:
+                GMXMMPBSA_WARNING('-pipeline is ignored with MUTANT_SCAN')
+                self.FILES.pipeline = False
 
         # fixed the error when try to open gmx_MMPBSA_ana in the issue
         # https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA/issues/33
@@ -924,6 +1623,32 @@ class MMPBSA_App(object):
             GMXMMPBSA_WARNING(f"The startframe variable must be >= 1. Changing startframe from"
                               f" {self.INPUT['startframe']} to 1")
             self.INPUT['startframe'] = 1
+        if self.INPUT['chunk_size'] < 0:
+            GMXMMPBSA_ERROR('CHUNK_SIZE must be non-negative!', InputError)
+        if self.INPUT['cpptraj_ranks'] < 1 or self.INPUT['cpptraj_threads'] < 1:
+            GMXMMPBSA_ERROR('CPPTRAJ_RANKS and CPPTRAJ_THREADS must be >= 1!', InputError)
+        if self.INPUT['adaptive_sem'] < 0 or self.INPUT['adaptive_time'] < 0 or self.INPUT['adaptive_min_frames'] < 0:
+            GMXMMPBSA_ERROR('ADAPTIVE_SEM, ADAPTIVE_TIME and ADAPTIVE_MIN_FRAMES must be non-negative!', InputError)
+        if self.INPUT['adaptive_sem'] or self.INPUT['adaptive_time']:
+            stride = self.INPUT['adaptive_stride']
+            if stride < 1 or stride & (stride - 1):
+                GMXMMPBSA_ERROR('ADAPTIVE_STRIDE must be a power of 2!', InputError)
+            if not (self.INPUT['gbrun'] or self.INPUT['pbrun'] or self.INPUT['rismrun']):
+                GMXMMPBSA_ERROR('Adaptive sampling (ADAPTIVE_SEM or ADAPTIVE_TIME) needs a GB, PB or 3D-RISM '
+                                'calculation!', InputError)
+            if (self.INPUT['decomprun'] or self.INPUT['nmoderun'] or self.INPUT['qh_entropy'] or
+                    self.INPUT['interaction_entropy'] or self.INPUT['c2_entropy']):
+                GMXMMPBSA_ERROR('Adaptive sampling (ADAPTIVE_SEM or ADAPTIVE_TIME) can not be combined with '
+                                'decomposition, normal mode or entropy calculations!', InputError)
+            if self.FILES.pipeline:
+                GMXMMPBSA_WARNING('-pipeline is ignored with adaptive sampling')
+                self.FILES.pipeline = False
+        if self.FILES.shard:
+            if self.INPUT['qh_entropy'] or self.INPUT['decomprun']:
+                GMXMMPBSA_ERROR('-shard can not be combined with quasi-harmonic or decomposition calculations, '
+                                'since they need all the frames at once!', InputError)
+            if self.INPUT['adaptive_sem'] or self.INPUT['adaptive_time']:
+                GMXMMPBSA_ERROR('-shard can not be combined with adaptive sampling!', InputError)
         if self.INPUT['nmstartframe'] < 1:
             GMXMMPBSA_WARNING(f"The nmstartframe variable must be >= 1. Changing nmstartframe from"
                               f" {self.INPUT['nmstartframe']} to 1")
@@ -943,17 +1668,252 @@ class MMPBSA_App(object):
         """ Throws up a barrier """
         self.MPI.COMM_WORLD.Barrier()
 
+    def _output_classes(self):
+        """
+        Returns a list with the INPUT trigger, the key in the calc_types dict,
+        the output class and the base name of the output files without the
+        prefix (with %s-substitution for complex, receptor, or ligand) of each
+        calculation type, and the number of files of each output
+        """
+        # Determine if our GB is QM/MM or not
+        GBClass = QMMMout if self.INPUT['ifqnt'] else GBout
+        # Determine which kind of RISM output class we are based on std/gf and
+        # polardecomp
+        if self.INPUT['polardecomp']:
+            RISM_GF = PolarRISM_gf_Out
+            RISM_Std = PolarRISM_std_Out
+        else:
+            RISM_GF = RISM_gf_Out
+            RISM_Std = RISM_std_Out
+        # nmode trajectories are split on their own
+        return [('nmoderun', 'nmode', NMODEout, '%s_nm.out', self.num_chunks_nmode),
+                ('gbrun', 'gb', GBClass, '%s_gb.mdout', self.num_chunks),
+                ('pbrun', 'pb', PBout, '%s_pb.mdout', self.num_chunks),
+                ('rismrun_std', 'rism std', RISM_Std, '%s_rism.mdout', self.num_chunks),
+                ('rismrun_gf', 'rism gf', RISM_GF, '%s_rism.mdout', self.num_chunks)]
+
+    def _output(self, outclass, fname, num_files):
+        """
+        Reads an output, unless the pipeline has already done it. With adaptive
+        sampling, the energies of the previous passes are added in front
+        """
+        parsed = getattr(self, '_parsed', {})
+        if (outclass, fname) in parsed:
+            output = parsed.pop((outclass, fname))
+        elif getattr(self, '_shards', None):
+            # -merge: the same output of every shard, one after the other
+            output = None
+            for pre, num_chunks, num_chunks_nmode in self._shards:
+                num_files = num_chunks_nmode if outclass is NMODEout else num_chunks
+                if not num_files:
+                    continue
+                shard_output = outclass(pre + fname[len(self.pre):], self.INPUT, num_files, self.using_chamber)
+                if output is None:
+                    output = shard_output
+                    continue
+                for key in output.data_keys:
+                    output.data[key] = output.data[key].append(shard_output.data[key])
+        else:
+            output = outclass(fname, self.INPUT, num_files, self.using_chamber)
+        adaptive = getattr(self, '_adaptive', None)
+        if adaptive is not None:
+            previous = adaptive['previous'].get(fname)
+            if previous is not None:
+                for key in output.data_keys:
+                    output.data[key] = previous.data[key].append(output.data[key])
+            adaptive['current'][fname] = output
+        return output
+
+    def _summary_only(self):
+        """
+        Whether the MPI ranks can send the statistics of their frames instead
+        of the energies of every frame. Those are only needed for the per-frame
+        outputs (-eo, -deo and the HDF5 file of save_mode) and to combine the
+        frames of different outputs (entropies, alanine scanning and adaptive
+        sampling)
+        """
+        INPUT, FILES = self.INPUT, self.FILES
+        return self.mpi_size > 1 and not (FILES.energyout or FILES.dec_energies or INPUT['save_mode'] or
+                                          INPUT['interaction_entropy'] or INPUT['c2_entropy'] or
+                                          INPUT['nmoderun'] or INPUT['alarun'] or
+                                          getattr(self, '_adaptive', None) is not None)
+
+    def _parse_rank_outputs(self):
+        """
+        Parses the per-rank output files concurrently. With MPI, every rank
+        parses its own files and the master gathers the arrays (RankPool);
+        otherwise, with -nproc, a pool of processes parses them. The outputs
+        are left in self._parsed for _output. If only the summary is needed,
+        every rank keeps the energies of its own frames, and True is returned
+        (see _reduce_statistics)
+        """
+        # The pipeline has already parsed them, and -merge joins the shards
+        if self.FILES.pipeline or getattr(self, '_shards', None):
+            return False
+        summary = self._summary_only()
+        if self.mpi_size > 1:
+            pool = RankPool(self.MPI.COMM_WORLD, gather=not summary)
+        elif self.nproc > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=self.nproc)
+        else:
+            return False
+        INPUT = self.INPUT
+        prefixes = []
+        if not INPUT['mutant_only']:
+            prefixes.append(self.pre)
+        if INPUT['alarun']:
+            prefixes.append(self.pre + 'mutant_')
+        prefixes.extend(prefix for _, prefix, _, _ in self.scan_systems)
+        systems = ['complex'] if self.stability else ['complex', 'receptor', 'ligand']
+        self._parsed = {}
+        try:
+            for trigger, key, outclass, basename, num_files in self._output_classes():
+                if not INPUT[trigger] or (num_files < 2 and not summary):
+                    continue
+                for prefix in prefixes:
+                    for system in systems:
+                        fname = prefix + basename % system
+                        output = outclass(fname, INPUT, num_files, self.using_chamber, pool=pool)
+                        if self.master or summary:
+                            self._parsed[(outclass, fname)] = output
+        finally:
+            if not isinstance(pool, RankPool):
+                pool.shutdown()
+        return summary
+
+    def _reduce_statistics(self):
+        """
+        Every rank has built calc_types from its own frames. The ranks agree on
+        the consistency checks of the binding statistics, and then send the
+        mergeable moments of every energy term, which the master combines into
+        EnergyMoments in place of the EnergyVectors. The decomposition is
+        reduced the same way (see _reduce_decomp)
+        """
+        comm = self.MPI.COMM_WORLD
+        if self.INPUT['decomprun']:
+            self._reduce_decomp()
+        outputs, bindings = [], []
+        for key in self.calc_types:
+            if not isinstance(self.calc_types[key], dict):
+                continue
+            for name, output in self.calc_types[key].items():
+                (bindings if isinstance(output, BindingStatistics) else outputs).append(output)
+        # An inconsistency or a missing frame in any rank applies to all frames
+        flags = comm.gather([(binding.inconsistent, binding.missing_terms) for binding in bindings])
+        if self.master:
+            flags = [tuple(map(any, zip(*terms))) for terms in zip(*flags)]
+        flags = comm.bcast(flags)
+        for binding, (inconsistent, missing_terms) in zip(bindings, flags):
+            if missing_terms and not binding.missing_terms:
+                # As in delta2, but the master takes the differences once the
+                # statistics are merged
+                binding.missing_terms = True
+                for output in (binding.com, binding.rec, binding.lig):
+                    output.verbose = 2
+                    output.fill_composite_terms()
+            elif inconsistent and not binding.inconsistent:
+                # The composite terms must include the internal terms
+                binding.inconsistent = True
+                binding.com.verbose = binding.rec.verbose = binding.lig.verbose = 2
+                binding.delta()
+        # Differences of unpaired frames (missing terms, multiple trajectories)
+        # are summarized by their averages and deviations, which come from the
+        # merged statistics of the complex, receptor and ligand
+        paired = [binding for binding in bindings
+                  if not binding.missing_terms and not isinstance(binding, MultiTrajBinding)]
+        vectors = [(output.data, key) for output in outputs for key in output.data]
+        vectors += [(binding.data, key) for binding in paired for key in binding.data]
+        moments = comm.gather([EnergyMoments.from_vector(data[key]) for data, key in vectors])
+        if not self.master:
+            return
+        for (data, key), parts in zip(vectors, zip(*moments)):
+            merged = EnergyMoments()
+            for part in parts:
+                merged = merged.merge(part)
+            data[key] = merged
+        for binding in bindings:
+            if binding not in paired:
+                binding.delta_stats()
+
+    def _reduce_decomp(self):
+        """
+        Every rank reads its own decomposition files, and sends the
+        EnergyMoments of every residue (or pair) in its frames, and of their
+        DELTAs in single trajectory binding calculations. The master merges
+        them into the DecompOut (and DELTAs) that the decomp output is written
+        from, left in self._decomp keyed like write_decomp_binding_output
+        expects. The mutants are not here, since alanine scanning needs every
+        frame (see _summary_only)
+        """
+        from GMXMMPBSA.amber_outputs import (DecompOut, PairDecompOut, DecompBinding,
+                                             PairDecompBinding)
+        INPUT, FILES = self.INPUT, self.FILES
+        if INPUT['mutant_only']:
+            return
+        comm = self.MPI.COMM_WORLD
+        pool = RankPool(comm, gather=False)
+        if INPUT['idecomp'] in [1, 2]:
+            SingleClass, BindingClass = DecompOut, DecompBinding
+        else:
+            SingleClass, BindingClass = PairDecompOut, PairDecompBinding
+        # Only single trajectory DELTAs are taken frame by frame
+        multitraj = bool(FILES.receptor_trajs or FILES.ligand_trajs)
+        system = self.normal_system
+        systems = [('complex', system.complex_prmtop)]
+        if not self.stability:
+            systems += [('receptor', system.receptor_prmtop), ('ligand', system.ligand_prmtop)]
+        outputs, bindings = [], []
+        for solvent, trigger in (('gb', 'gbrun'), ('pb', 'pbrun')):
+            if not INPUT[trigger]:
+                continue
+            # The same surface tensions that the decomp output uses
+            surften = INPUT['cavity_surften'] if solvent == 'pb' and not self.stability else INPUT['surften']
+            decomps = [SingleClass(self.pre + '%s_%s.mdout' % (name, solvent), prmtop, surften, '',
+                                   self.num_chunks, INPUT['dec_verbose'], pool=pool)
+                       for name, prmtop in systems]
+            outputs.extend(decomps)
+            if not self.stability and not multitraj:
+                bindings.append((self.pre + solvent + '_bind',
+                                 BindingClass(*decomps, system, INPUT['idecomp'],
+                                              INPUT['dec_verbose'], None, '', '')))
+        try:
+            moments = ([output.get_moments() for output in outputs] +
+                       [binding.get_moments() for _, binding in bindings])
+        except Exception as e:
+            moments = e
+        moments = comm.gather(moments)
+        # A failure in any rank stops all of them (like RankPool)
+        error = None
+        if self.master:
+            error = next((part for part in moments if isinstance(part, Exception)), None)
+        error = comm.bcast(error)
+        if error is not None:
+            raise error
+        if not self.master:
+            return
+        moments = list(zip(*moments))
+        self._decomp = {}
+        for output, parts in zip(outputs, moments):
+            output.merge_moments(parts)
+            self._decomp[output.basename] = output
+        for (key, binding), parts in zip(bindings, moments[len(outputs):]):
+            binding.merge_moments(parts)
+            self._decomp[key] = binding.moments
+
     def parse_output_files(self):
         """
         This parses the output files and loads them into dicts for easy access
         """
-        # Only the master does this
-        if not self.master:
+        # Every rank helps to read the per-rank output files
+        summary = self._parse_rank_outputs()
+        # Only the master does the rest, unless every rank summarizes its frames
+        if not self.master and not summary:
             return
         self.calc_types = type('calc_types', (dict,), {'mutant': {}})()
         INPUT, FILES = self.INPUT, self.FILES
         # Quasi-harmonic analysis is a special-case, so handle that separately
-        if INPUT['qh_entropy']:
+        if INPUT['qh_entropy'] and self.master:
             if not INPUT['mutant_only']:
                 self.calc_types['qh'] = QHout(self.pre + 'cpptraj_entropy.out', INPUT['temp'])
             if INPUT['alarun']:
@@ -964,24 +1924,6 @@ class MMPBSA_App(object):
             BindClass = SingleTrajBinding
         else:
             BindClass = MultiTrajBinding
-        # Determine if our GB is QM/MM or not
-        GBClass = QMMMout if INPUT['ifqnt'] else GBout
-        # Determine which kind of RISM output class we are based on std/gf and
-        # polardecomp
-        if INPUT['polardecomp']:
-            RISM_GF = PolarRISM_gf_Out
-            RISM_Std = PolarRISM_std_Out
-        else:
-            RISM_GF = RISM_gf_Out
-            RISM_Std = RISM_std_Out
-        # Now we make a list of the other calculation types, their INPUT triggers,
-        # their key in the calc_types dict, the base name of their output files
-        # without the prefix (with %s-substitution for complex, receptor, or
-        # ligand), and the class for their output
-        triggers = ('nmoderun', 'gbrun', 'pbrun', 'rismrun_std', 'rismrun_gf')
-        outclass = (NMODEout, GBClass, PBout, RISM_Std, RISM_GF)
-        outkey = ('nmode', 'gb', 'pb', 'rism std', 'rism gf')
-        basename = ('%s_nm.out', '%s_gb.mdout', '%s_pb.mdout', '%s_rism.mdout', '%s_rism.mdout')
 
         if self.INPUT['interaction_entropy']:
             if not INPUT['mutant_only']:
@@ -994,20 +1936,18 @@ class MMPBSA_App(object):
             if INPUT['alarun']:
                 self.calc_types.mutant['c2'] = C2out()
 
-        for i, key in enumerate(outkey):
-            if not INPUT[triggers[i]]:
+        for trigger, key, outclass, basename, num_files in self._output_classes():
+            if not INPUT[trigger]:
                 continue
             # Non-mutant
             if not INPUT['mutant_only']:
-                self.calc_types[key] = {'complex': outclass[i](self.pre + basename[i] % 'complex', self.INPUT,
-                                                               self.mpi_size, self.using_chamber)}
+                self.calc_types[key] = {'complex': self._output(outclass, self.pre + basename % 'complex',
+                                                                num_files)}
                 if not self.stability:
-                    self.calc_types[key]['receptor'] = outclass[i](self.pre +
-                                                                   basename[i] % 'receptor', self.INPUT, self.mpi_size,
-                                                                   self.using_chamber)
-                    self.calc_types[key]['ligand'] = outclass[i](self.pre +
-                                                                 basename[i] % 'ligand', self.INPUT, self.mpi_size,
-                                                                 self.using_chamber)
+                    self.calc_types[key]['receptor'] = self._output(outclass, self.pre + basename % 'receptor',
+                                                                    num_files)
+                    self.calc_types[key]['ligand'] = self._output(outclass, self.pre + basename % 'ligand',
+                                                                  num_files)
                     self.calc_types[key]['delta'] = BindClass(
                         self.calc_types[key]['complex'],
                         self.calc_types[key]['receptor'],
@@ -1031,16 +1971,13 @@ class MMPBSA_App(object):
                     self.calc_types[key]['complex'].fill_composite_terms()
             # Time for mutant
             if INPUT['alarun']:
-                self.calc_types.mutant[key] = {'complex':
-                                                      outclass[i](self.pre + 'mutant_' + basename[i] % 'complex',
-                                                                  self.INPUT, self.mpi_size, self.using_chamber)}
+                self.calc_types.mutant[key] = {'complex': self._output(
+                    outclass, self.pre + 'mutant_' + basename % 'complex', num_files)}
                 if not self.stability:
-                    self.calc_types.mutant[key]['receptor'] = outclass[i](
-                        self.pre + 'mutant_' + basename[i] % 'receptor',
-                        self.INPUT, self.mpi_size, self.using_chamber)
-                    self.calc_types.mutant[key]['ligand'] = outclass[i](
-                        self.pre + 'mutant_' + basename[i] % 'ligand',
-                        self.INPUT, self.mpi_size, self.using_chamber)
+                    self.calc_types.mutant[key]['receptor'] = self._output(
+                        outclass, self.pre + 'mutant_' + basename % 'receptor', num_files)
+                    self.calc_types.mutant[key]['ligand'] = self._output(
+                        outclass, self.pre + 'mutant_' + basename % 'ligand', num_files)
                     self.calc_types.mutant[key]['delta'] = BindClass(
                         self.calc_types.mutant[key]['complex'],
                         self.calc_types.mutant[key]['receptor'],
@@ -1062,7 +1999,32 @@ class MMPBSA_App(object):
                 else:
                     self.calc_types.mutant[key]['complex'].fill_composite_terms()
 
-        if INPUT['decomprun']:
+        # The other mutants of the scan. Only their binding (or complex) free
+        # energies are kept, for the DELTA DELTA G table
+        self.calc_types.scan = []
+        for label, prefix, _, _ in self.scan_systems:
+            mutant = {}
+            for trigger, key, outclass, basename, num_files in self._output_classes():
+                if not INPUT[trigger]:
+                    continue
+                mutant[key] = self._output(outclass, prefix + basename % 'complex', num_files)
+                if self.stability:
+                    mutant[key].fill_composite_terms()
+                else:
+                    mutant[key] = BindClass(mutant[key],
+                                            self._output(outclass, prefix + basename % 'receptor', num_files),
+                                            self._output(outclass, prefix + basename % 'ligand', num_files),
+                                            self.INPUT['verbose'], self.using_chamber)
+            self.calc_types.scan.append((label, mutant))
+
+        if summary:
+            self._reduce_statistics()
+            if not self.master:
+                return
+
+        # The energies of every frame are only stored with save_mode, which
+        # does not summarize
+        if INPUT['decomprun'] and not summary:
             self.calc_types.decomp = self._get_decomp()
 
     def _get_decomp(self):
@@ -1128,31 +2090,31 @@ class MMPBSA_App(object):
             if not self.INPUT['mutant_only']:
                 return_data[key] = {'complex': SingleClass(self.pre + basename[i] % 'complex',
                                  self.FILES.complex_prmtop, INPUT['surften'],
-                                 False, self.mpi_size, INPUT['dec_verbose']).get_data(self.numframes, self.resl['COM'])}
+                                 False, self.num_chunks, INPUT['dec_verbose']).get_data(self.numframes, self.resl['COM'])}
                 if not self.stability:
                     return_data[key]['receptor'] = SingleClass(self.pre + basename[i] % 'receptor',
                                                                self.FILES.receptor_prmtop, INPUT['surften'],
-                                                               False, self.mpi_size, INPUT['dec_verbose']).get_data(
+                                                               False, self.num_chunks, INPUT['dec_verbose']).get_data(
                         self.numframes, self.resl['REC'])
                     return_data[key]['ligand'] = SingleClass(self.pre + basename[i] % 'ligand',
                                                                self.FILES.ligand_prmtop, INPUT['surften'],
-                                                               False, self.mpi_size, INPUT['dec_verbose']).get_data(
+                                                               False, self.num_chunks, INPUT['dec_verbose']).get_data(
                         self.numframes, self.resl['LIG'])
 
             if INPUT['alarun']:
                 # Do mutant
                 return_data.mutant[key] = {'complex': SingleClass(self.pre + 'mutant_' + basename[i] % 'complex',
                                                            self.FILES.complex_prmtop, INPUT['surften'],
-                                                           False, self.mpi_size, INPUT['dec_verbose']).get_data(
+                                                           False, self.num_chunks, INPUT['dec_verbose']).get_data(
                     self.numframes, self.resl['MUT_COM'])}
                 if not self.stability:
                     return_data.mutant[key]['receptor'] = SingleClass(self.pre + 'mutant_' + basename[i] % 'receptor',
                                                                self.FILES.receptor_prmtop, INPUT['surften'],
-                                                               False, self.mpi_size, INPUT['dec_verbose']).get_data(
+                                                               False, self.num_chunks, INPUT['dec_verbose']).get_data(
                         self.numframes, self.resl['MUT_REC'])
                     return_data.mutant[key]['ligand'] = SingleClass(self.pre + 'mutant_' + basename[i] % 'ligand',
                                                              self.FILES.ligand_prmtop, INPUT['surften'],
-                                                             False, self.mpi_size, INPUT['dec_verbose']).get_data(
+                                                             False, self.num_chunks, INPUT['dec_verbose']).get_data(
                         self.numframes, self.resl['MUT_LIG'])
         return return_data
 # Local methods
@@ -25,6 +25,7 @@ import parmed
 from GMXMMPBSA.exceptions import *
 from GMXMMPBSA.utils import checkff, selector, get_dist, list2range, res2map
 from GMXMMPBSA.alamdcrd import _scaledistance
+from GMXMMPBSA.energy_cache import TrajectoryCache
 import subprocess
 from pathlib import Path
 import logging
@@ -66,6 +67,9 @@ class CheckMakeTop:
         self.log = open('gmx_MMPBSA.log', 'a')
 
         self.mut_label = ''
+        # Other residues of the mutant scan (see buildScanTopologies)
+        self.scan_residues = []
+        self.scan_mutants = []
 
         # Define Gromacs executable
         self.make_ndx = self.external_progs['make_ndx']
@@ -80,14 +84,16 @@ class CheckMakeTop:
         self.rec_str_ions = False
         self.lig_str_ions = False
 
-        # create the * prmtop variables for compatibility with the original code
-        self.complex_pmrtop = 'COM.prmtop'
-        self.receptor_pmrtop = 'REC.prmtop'
-        self.ligand_pmrtop = 'LIG.prmtop'
+        # create the * prmtop variables for compatibility with the original code.
+        # They go to the directory of the prefix (e.g. the bundle of a -shard run)
+        directory = os.path.dirname(self.FILES.prefix)
+        self.complex_pmrtop = os.path.join(directory, 'COM.prmtop')
+        self.receptor_pmrtop = os.path.join(directory, 'REC.prmtop')
+        self.ligand_pmrtop = os.path.join(directory, 'LIG.prmtop')
 
-        self.mutant_complex_pmrtop = 'MUT_COM.prmtop'
-        self.mutant_receptor_pmrtop = 'MUT_REC.prmtop'
-        self.mutant_ligand_pmrtop = 'MUT_LIG.prmtop'
+        self.mutant_complex_pmrtop = os.path.join(directory, 'MUT_COM.prmtop')
+        self.mutant_receptor_pmrtop = os.path.join(directory, 'MUT_REC.prmtop')
+        self.mutant_ligand_pmrtop = os.path.join(directory, 'MUT_LIG.prmtop')
 
         self.complex_temp_top = self.FILES.prefix + 'COM.top'
         self.receptor_temp_top = self.FILES.prefix + 'COM.top'
@@ -124,6 +130,8 @@ class CheckMakeTop:
         if self.INPUT['qm_residues']:
             self.INPUT['qm_residues'] = ','.join(str(x) for x in self.get_selected_residues(self.INPUT['qm_residues']))
 
+        self.scan_mutants = self.buildScanTopologies() if self.INPUT['alarun'] and self.INPUT['mutant_scan'] else []
+
         self.cleanup_trajs()
         return tops
 
@@ -719,9 +727,21 @@ class CheckMakeTop:
             GMXMMPBSA_ERROR("No residue for mutation was defined")
         # dict = { resind: [chain, resnum, icode]
         sele_res_dict = self.get_selected_residues(self.INPUT['mutant_res'])
-        if not len(sele_res_dict) == 1:
+        if self.INPUT['mutant_scan']:
+            # The first residue is mutated as usual, the rest in buildScanTopologies
+            sele_res_dict = [r for r in sele_res_dict if self._can_mutate(r)]
+            if not sele_res_dict:
+                GMXMMPBSA_ERROR('None of the residues selected in mutant_res can be mutated')
+            self.scan_residues = sele_res_dict[1:]
+        elif not len(sele_res_dict) == 1:
             GMXMMPBSA_ERROR('Only ONE mutant residue is allowed.')
-        r = sele_res_dict[0]
+        return self._mutation_info(sele_res_dict[0])
+
+    def _mutation_info(self, r):
+        """
+        Mutation index in the complex, part (REC or LIG), index in the part and
+        label of the residue r (from amber selection format)
+        """
         res = self.complex_str.residues[r - 1]
         icode = ':' + res.insertion_code if res.insertion_code else ''
         if not parmed.residue.AminoAcidResidue.has(res.name):
@@ -748,6 +768,52 @@ class CheckMakeTop:
         # return r - 1 since r is the complex mutant index from amber selection format. Needed for top mutation only
         return r - 1, part_mut, part_index, label
 
+    def _can_mutate(self, r):
+        """ Whether the residue r (from amber selection format) can be scanned """
+        res = self.complex_str.residues[r - 1]
+        mutant = 'GLY' if self.INPUT['mutant'].upper() in ['GLY', 'G'] else 'ALA'
+        if not parmed.residue.AminoAcidResidue.has(res.name) or res.name in ['GLY', mutant]:
+            GMXMMPBSA_WARNING(f"Residue {res.chain}:{res.name}:{res.number} can't be mutated to {mutant} and "
+                              f"will be skipped by the scan...")
+            return False
+        return True
+
+    def buildScanTopologies(self):
+        """
+        Builds the mutant topologies of the other residues of the scan from the
+        normal topologies. The part (receptor or ligand) that is not mutated
+        keeps the normal topology (None)
+
+        :return: list with the label and the complex, receptor and ligand
+        topologies of each mutant
+        """
+        com_parm = parmed.load_file(self.complex_pmrtop)
+        rec_parm = lig_parm = None
+        if not self.FILES.stability:
+            rec_parm = parmed.load_file(self.receptor_pmrtop)
+            lig_parm = parmed.load_file(self.ligand_pmrtop)
+        directory = os.path.dirname(self.FILES.prefix)
+        scan_mutants = []
+        for n, r in enumerate(self.scan_residues, start=2):
+            mut_index, part_mut, part_index, label = self._mutation_info(r)
+            logging.info(f'Building Mutant Topologies for {label}...')
+            mut_tops = [os.path.join(directory, f'MUT{n}_COM.prmtop'), None, None]
+            parms = [(com_parm, mut_index, 0)]
+            if part_mut == 'REC' and rec_parm:
+                mut_tops[1] = os.path.join(directory, f'MUT{n}_REC.prmtop')
+                parms.append((rec_parm, part_index, 1))
+            elif part_mut == 'LIG' and lig_parm:
+                mut_tops[2] = os.path.join(directory, f'MUT{n}_LIG.prmtop')
+                parms.append((lig_parm, part_index, 2))
+            for parm, index, i in parms:
+                mtop = self.makeMutTop(parm, index)
+                mut_parm = type(parm).from_structure(mtop)
+                # change de PBRadii
+                action = ChRad(mut_parm, PBRadii[self.INPUT['PBRadii']])
+                mut_parm.write_parm(mut_tops[i])
+            scan_mutants.append([label] + mut_tops)
+        return scan_mutants
+
     def makeMutTop(self, wt_top, mut_index, pdb=False):
         """
 
@@ -906,6 +972,28 @@ class CheckMakeTop:
         # clear trajectory
         if not self.INPUT['solvated_trajectory']:
             return
+        # The cleaned trajectories of an earlier run with the same files are in the cache
+        cache = key = None
+        if self.FILES.cache_dir:
+            cache = TrajectoryCache(self.FILES.cache_dir, int(self.FILES.cache_size * 1024 ** 3))
+            files = [self.FILES.complex_tpr, self.FILES.complex_index] + self.FILES.complex_trajs
+            options = {'complex_trajs': len(self.FILES.complex_trajs)}
+            if self.FILES.receptor_tpr:
+                files += [self.FILES.receptor_tpr, self.FILES.receptor_index] + self.FILES.receptor_trajs
+                options.update(receptor_trajs=len(self.FILES.receptor_trajs), receptor_group=self.FILES.receptor_group)
+            if self.FILES.ligand_tpr:
+                files += [self.FILES.ligand_tpr, self.FILES.ligand_index] + self.FILES.ligand_trajs
+                options.update(ligand_trajs=len(self.FILES.ligand_trajs), ligand_group=self.FILES.ligand_group)
+            key = cache.key('cleanup', files, options)
+            state = cache.get(key)
+            if state is not None:
+                logging.info('Using the cleaned trajectories of the cache...')
+                self.FILES.complex_trajs = state['complex_trajs']
+                if self.FILES.receptor_tpr:
+                    self.FILES.receptor_trajs = state['receptor_trajs']
+                if self.FILES.ligand_tpr:
+                    self.FILES.ligand_trajs = state['ligand_trajs']
+                return
         logging.info('Cleaning normal complex trajectories...')
         new_trajs = []
         for i in range(len(self.FILES.complex_trajs)):
@@ -963,6 +1051,14 @@ class CheckMakeTop:
                 new_trajs.append('LIG_traj_{}.xtc'.format(i))
             self.FILES.ligand_trajs = new_trajs
 
+        if cache is not None:
+            state = {'complex_trajs': self.FILES.complex_trajs}
+            if self.FILES.receptor_tpr:
+                state['receptor_trajs'] = self.FILES.receptor_trajs
+            if self.FILES.ligand_tpr:
+                state['ligand_trajs'] = self.FILES.ligand_trajs
+            cache.put(key, [traj for trajs in state.values() for traj in trajs], state)
+
     def fix_chains_IDs(self, com_str, rec_str=None, lig_str=None, ref_str=None):
         if ref_str:
             if len(ref_str.residues) != len(com_str.residues):
@@ -9,10 +9,30 @@ Methods:
             trajectories needed for the calculation, as well as all dummy
             files (i.e. restarts and PDBs)
 
+         plan_trajectories(INPUT, FILES, size): Sets up the cpptraj jobs that
+            make_trajectories runs, without running them
+
+         make_dummy_files(INPUT, FILES, size): Makes the dummy files and the
+            reference frame used by make_trajectory_slices
+
+         make_trajectory_slices(INPUT, FILES, frame_counts, chunks): Makes the
+            trajectories of some of the chunks, so every processor can make
+            its own
+
+         make_native_slices(INPUT, FILES, frame_counts, chunks): Same as
+            make_trajectory_slices, without cpptraj
+
+         make_nmode_trajectory(INPUT, FILES, size, system): Makes the nmode
+            trajectories of one system
+
+         run_cpptraj_jobs(streams, max_jobs): Runs independent streams of
+            cpptraj jobs at the same time
+
          make_mutant_trajectories(INPUT, FILES, rank): Mutates the trajectories
 
 Classes:
          Trajectory: Class for manipulating Amber trajectories through cpptraj
+         FrameCounts: Cache of the number of frames of the trajectory files
 """
 
 # ##############################################################################
@@ -33,20 +53,242 @@ Classes:
 #  for more details.                                                           #
 # ##############################################################################
 
+import json
+import os
+import threading
 from warnings import warn
 from GMXMMPBSA.exceptions import (TrajError, MMPBSA_Error, InternalError,
                                   MutantResError)
+from GMXMMPBSA.scheduler import split_frames
 
 
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
-def make_trajectories(INPUT, FILES, size, cpptraj, pre):
+def make_trajectories(INPUT, FILES, size, cpptraj, pre, max_jobs=1):
     """
     This function creates the necessary trajectory files, and creates thread-
-    specific trajectories for parallel calculations
+    specific trajectories for parallel calculations. If chunk_size is set, the
+    trajectories are cut into chunks that are handed out on demand instead.
+    Every trajectory given by the user is read by a single cpptraj job, which
+    also makes the nmode trajectories, the surface areas and the average
+    structure (see plan_trajectories). These jobs are independent of each
+    other, so up to max_jobs of them run at the same time
+    """
+    frames, jobs = plan_trajectories(INPUT, FILES, size, cpptraj, pre, single_pass=True)
+    run_cpptraj_jobs([[(output, lambda traj=traj, output=output: traj.Run(output))]
+                      for systems, traj, output in jobs], max_jobs)
+
+    return frames + ((len(_nmode_frames(INPUT, frames[0])) if INPUT['nmoderun'] else 0),)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def make_dummy_files(INPUT, FILES, size, cpptraj, pre, max_jobs=1):
+    """
+    Creates the files that do not depend on how the frames are split among the
+    processors: the dummy PDB and restart files of each system, the full
+    trajectories (if needed) and the reference frame that every slice made by
+    make_trajectory_slices is fitted to. Only the first frame is processed
+    unless the full trajectories are needed. Up to max_jobs trajectories are
+    processed at the same time. Returns the number of frames of the complex,
+    receptor and ligand trajectories
+    """
+    trj_suffix = 'nc' if INPUT['netcdf'] else 'mdcrd'
+    full_traj = INPUT['full_traj'] or INPUT['qh_entropy']
+    frames = {'complex': 0, 'receptor': 0, 'ligand': 0}
+    streams = []
+    for prmtop, trajs, source, systems in _trajectory_sources(FILES):
+        traj = Trajectory(prmtop, trajs, cpptraj)
+        traj.Setup(INPUT['startframe'], INPUT['endframe'], INPUT['interval'])
+        frames[source] = int(traj.processed_frames)
+        if traj.processed_frames < size and not INPUT['chunk_size']:
+            raise MMPBSA_Error('Must have at least as many %s frames as processors! Set chunk_size to use more '
+                               'processors than frames' % source)
+        if not full_traj:
+            traj.Setup(INPUT['startframe'], INPUT['startframe'], 1)
+        traj.rms('!(%s)' % INPUT['strip_mask'])
+        if source == 'complex' and INPUT['qh_entropy']:
+            traj.Average(pre + 'avgcomplex.pdb')
+        traj.Outtraj(pre + '%s_reference.rst7' % source, frames='1', filetype='restart')
+        for system in systems:
+            if system != source:
+                traj.Strip(_system_mask(INPUT, system))
+            if full_traj:
+                traj.Outtraj(pre + '%s.%s' % (system, trj_suffix), filetype=INPUT['netcdf'])
+            traj.Outtraj(pre + '%s.pdb' % system, frames='1', filetype='pdb')
+            traj.Outtraj(pre + 'dummy%s.inpcrd' % system, frames='1', filetype='restart')
+            if system != source:
+                traj.Unstrip(restrip_solvent=True)
+                traj.rms('!(%s)' % INPUT['strip_mask'])
+        output = pre + '%s_dummy_cpptraj.out' % source
+        streams.append([(output, lambda traj=traj, output=output: traj.Run(output))])
+    run_cpptraj_jobs(streams, max_jobs)
+    return frames['complex'], frames['receptor'], frames['ligand']
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def make_trajectory_slices(INPUT, FILES, cpptraj, pre, frame_counts, chunks):
+    """
+    Creates the thread-specific (or chunk-specific) trajectories of chunks (a
+    range of consecutive chunk numbers) of every system with one cpptraj run
+    per source trajectory that only reads the frames of those chunks.
+    frame_counts has the number of frames of every chunk of the complex,
+    receptor and ligand. The frames are fitted to the reference frame made by
+    make_dummy_files, so the result is the same as that of make_trajectories
+    """
+    trj_suffix = 'nc' if INPUT['netcdf'] else 'mdcrd'
+    for prmtop, trajs, source, systems in _trajectory_sources(FILES):
+        frame_count = frame_counts[source]
+        first = sum(frame_count[:chunks[0]])
+        count = sum(frame_count[chunk] for chunk in chunks)
+        if not count:
+            continue
+        traj = Trajectory(prmtop, trajs, cpptraj)
+        traj.Setup(INPUT['startframe'] + first * INPUT['interval'],
+                   INPUT['startframe'] + (first + count - 1) * INPUT['interval'], INPUT['interval'])
+        traj.Reference(pre + '%s_reference.rst7' % source)
+        traj.rms('!(%s)' % INPUT['strip_mask'], reference=True)
+        for system in systems:
+            if system != source:
+                traj.Strip(_system_mask(INPUT, system))
+            _outtraj_split(traj, pre + '%s.%s.%%d' % (system, trj_suffix), [frame_count[chunk] for chunk in chunks],
+                           INPUT['netcdf'], chunks[0])
+            _plan_surf(traj, INPUT, pre, system, [frame_count[chunk] for chunk in chunks], chunks[0])
+            if system != source:
+                traj.Unstrip(restrip_solvent=True)
+                traj.rms('!(%s)' % INPUT['strip_mask'], reference=True)
+        traj.Run(pre + '%s_traj_cpptraj.%d.out' % (source, chunks[0]))
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def make_native_slices(INPUT, FILES, pre, frame_counts, chunks):
+    """
+    Same as make_trajectory_slices, but the trajectories are read, fitted and
+    written in-process (see trajio) instead of by cpptraj. The frames are
+    fitted to the first analyzed frame, as make_trajectories does
+    """
+    from GMXMMPBSA.trajio import write_slices
+    trj_suffix = 'nc' if INPUT['netcdf'] else 'mdcrd'
+    for prmtop, trajs, source, systems in _trajectory_sources(FILES):
+        frame_count = frame_counts[source]
+        first = sum(frame_count[:chunks[0]])
+        counts = [frame_count[chunk] for chunk in chunks]
+        if not sum(counts):
+            continue
+        start = INPUT['startframe'] - 1
+        frames = [start + (first + i) * INPUT['interval'] for i in range(sum(counts))]
+        outputs = [(pre + '%s.%s.%%d' % (system, trj_suffix), None if system == source else _system_mask(INPUT, system))
+                   for system in systems]
+        written = write_slices(prmtop, trajs, frames, start, '!(%s)' % INPUT['strip_mask'], outputs, counts,
+                               chunks[0], INPUT['netcdf'])
+        for fname, count in written.items():
+            frame_cache.set(fname, count)
+
+
+def make_nmode_trajectories(INPUT, FILES, size, cpptraj, pre, numframes, max_jobs=1):
+    """
+    Makes the nmode trajectories of every system from the numframes frames of
+    the thread-specific (or chunk-specific) trajectories, up to max_jobs
+    systems at the same time. Returns the number of nmode frames
+    """
+    if not INPUT['nmoderun']:
+        return 0
+    num_chunks = len(split_frames(numframes, size, INPUT['chunk_size']))
+    systems = ['complex'] if FILES.stability else ['complex', 'receptor', 'ligand']
+    streams = [[job] for job in _nmode_jobs(INPUT, FILES, size, cpptraj, pre, systems, num_chunks)]
+    return run_cpptraj_jobs(streams, max_jobs)[0][0]
+
+
+def _nmode_jobs(INPUT, FILES, size, cpptraj, pre, systems, num_chunks):
+    """ (log file, function) jobs that make the nmode trajectories of systems """
+    return [(pre + '%s_nm_traj_cpptraj.out' % system[:3],
+             lambda system=system: make_nmode_trajectory(INPUT, FILES, size, cpptraj, pre, system, num_chunks))
+            for system in systems]
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def run_cpptraj_jobs(streams, max_jobs=1):
+    """
+    Runs streams of cpptraj jobs. Every stream is a list of (log file,
+    function) jobs that run one after the other, and the streams are
+    independent of each other, so up to max_jobs of them run at the same time
+    (each job is an external cpptraj process, so threads are enough). A failed
+    stream does not stop the others: the errors of all of them are raised
+    together once every stream is done. Returns the results of the functions
+    of each stream
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _run(stream):
+        results = []
+        for log, function in stream:
+            try:
+                results.append(function())
+            except MMPBSA_Error as e:
+                raise TrajError('%s (see %s)' % (e, log))
+        return results
+
+    results = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_jobs, len(streams)))) as executor:
+        for future in [executor.submit(_run, stream) for stream in streams]:
+            try:
+                results.append(future.result())
+            except TrajError as e:
+                errors.append(str(e))
+                results.append(None)
+    if len(errors) == 1:
+        raise TrajError(errors[0])
+    elif errors:
+        raise TrajError('%d cpptraj jobs failed:\n  %s' % (len(errors), '\n  '.join(errors)))
+    return results
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _trajectory_sources(FILES):
+    """
+    Returns the (topology, trajectory files, system, systems written from it)
+    of each trajectory given by the user. The receptor and ligand are stripped
+    from the complex trajectory unless they have their own
+    """
+    sources = [(FILES.complex_prmtop, FILES.complex_trajs, 'complex', ['complex'])]
+    if not FILES.stability:
+        for system, prmtop, trajs in (('receptor', FILES.receptor_prmtop, FILES.receptor_trajs),
+                                      ('ligand', FILES.ligand_prmtop, FILES.ligand_trajs)):
+            if trajs:
+                sources.append((prmtop, trajs, system, [system]))
+            else:
+                sources[0][3].append(system)
+    return sources
+
+
+def _system_mask(INPUT, system):
+    """ Mask stripped from the complex to get the receptor or the ligand """
+    return INPUT['ligand_mask'] if system == 'receptor' else INPUT['receptor_mask']
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def plan_trajectories(INPUT, FILES, size, cpptraj, pre, split_systems=False, single_pass=False):
+    """
+    Sets up (but does not run) the cpptraj jobs that create the non-mutant
+    trajectories and dummy files. Returns the number of frames of the complex,
+    receptor and ligand trajectories, and a list of (systems, Trajectory, output
+    file) jobs. The receptor and ligand of a single trajectory are normally
+    stripped in the same cpptraj pass as the complex; with split_systems each
+    of them gets its own job so that they can run at the same time. With
+    single_pass, the surface areas of the GB calculations, the average
+    structure of the quasi-harmonic analysis and the nmode trajectories are
+    made by the same jobs, so nothing has to read the trajectories again
     """
+    from copy import deepcopy
 
     stability = FILES.stability
+    chunk_size = INPUT['chunk_size']
 
     # File suffix is dependent on file type
     if INPUT['netcdf']:
@@ -69,73 +311,47 @@ def make_trajectories(INPUT, FILES, size, cpptraj, pre):
     traj.Setup(INPUT['startframe'], INPUT['endframe'], INPUT['interval'])
     # RMS fit
     traj.rms('!(%s)' % INPUT['strip_mask'])
+    if single_pass and INPUT['qh_entropy']:
+        traj.Average(pre + 'avgcomplex.pdb')
 
     com_frames = int(traj.processed_frames)
     rec_frames = 0
     lig_frames = 0
-    num_frames_nmode = 0
 
     # Sanity check
-    if traj.processed_frames < size:
-        raise MMPBSA_Error('Must have at least as many frames as processors!')
+    if traj.processed_frames < size and not chunk_size:
+        raise MMPBSA_Error('Must have at least as many frames as processors! Set chunk_size to use more '
+                           'processors than frames')
 
     # We now know how many frames we have in total, so make a list that lists the
-    # number of frames found for each rank, and assign extra frames incrementally
-    frames_per_rank = traj.processed_frames // size
-    extras = traj.processed_frames - frames_per_rank * size
-    frame_count = [frames_per_rank for i in range(size)]
-    for i in range(size):
-        if i < extras: frame_count[i] += 1
+    # number of frames found for each rank (or chunk)
+    frame_count = split_frames(traj.processed_frames, size, chunk_size)
 
-    # Dump our complex trajectories
-    if INPUT['full_traj'] or INPUT['qh_entropy']:
-        traj.Outtraj(pre + 'complex.%s' % trj_suffix, filetype=INPUT['netcdf'])
-    traj.Outtraj(pre + 'complex.pdb', frames='1', filetype='pdb')
-    traj.Outtraj(pre + 'dummycomplex.inpcrd', frames='1', filetype='restart')
+    # Receptor/ligand jobs start from the same fitted trajectory
+    if split_systems:
+        base = deepcopy(traj)
 
-    # Now dump thread-specific trajectories
-    last_frame = 1
-    for i in range(size):
-        frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-        traj.Outtraj(pre + 'complex.%s.%d' % (trj_suffix, i),
-                     frames=frame_string, filetype=INPUT['netcdf'])
-        last_frame += frame_count[i]
+    # Dump our complex trajectories
+    _outtraj_system(traj, INPUT, pre, 'complex', trj_suffix, frame_count, single_pass, size)
+    jobs = [(['complex'], traj, pre + 'normal_traj_cpptraj.out')]
 
     # Now create the receptor/ligand trajectories if we're taking them from
     # the complex trajectory
-
-    if not stability and not FILES.receptor_trajs:
-        traj.Strip(INPUT['ligand_mask'])
-        if INPUT['full_traj'] or INPUT['qh_entropy']:
-            traj.Outtraj(pre + 'receptor.%s' % trj_suffix, filetype=INPUT['netcdf'])
-        traj.Outtraj(pre + 'receptor.pdb', frames='1', filetype='pdb')
-        traj.Outtraj(pre + 'dummyreceptor.inpcrd', frames='1', filetype='restart')
-        last_frame = 1
-        for i in range(size):
-            frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-            traj.Outtraj(pre + 'receptor.%s.%d' % (trj_suffix, i),
-                         frames=frame_string, filetype=INPUT['netcdf'])
-            last_frame += frame_count[i]
-        traj.Unstrip(restrip_solvent=True)
-        traj.rms('!(%s)' % INPUT['strip_mask'])
-
-    if not stability and not FILES.ligand_trajs:
-        traj.Strip(INPUT['receptor_mask'])
-        if INPUT['full_traj'] or INPUT['qh_entropy']:
-            traj.Outtraj(pre + 'ligand.%s' % trj_suffix, filetype=INPUT['netcdf'])
-        traj.Outtraj(pre + 'ligand.pdb', frames='1', filetype='pdb')
-        traj.Outtraj(pre + 'dummyligand.inpcrd', frames='1', filetype='restart')
-        last_frame = 1
-        for i in range(size):
-            frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-            traj.Outtraj(pre + 'ligand.%s.%d' % (trj_suffix, i),
-                         frames=frame_string, filetype=INPUT['netcdf'])
-            last_frame += frame_count[i]
-        traj.Unstrip(restrip_solvent=True)
-        traj.rms('!(%s)' % INPUT['strip_mask'])
-
-    # Run cpptraj to get the trajectory
-    traj.Run(pre + 'normal_traj_cpptraj.out')
+    for system, mask, own_trajs in (('receptor', INPUT['ligand_mask'], FILES.receptor_trajs),
+                                       ('ligand', INPUT['receptor_mask'], FILES.ligand_trajs)):
+        if stability or own_trajs:
+            continue
+        if split_systems:
+            systraj = deepcopy(base)
+            systraj.Strip(mask)
+            _outtraj_system(systraj, INPUT, pre, system, trj_suffix, frame_count)
+            jobs.append(([system], systraj, pre + '%s_traj_cpptraj.out' % system))
+        else:
+            traj.Strip(mask)
+            _outtraj_system(traj, INPUT, pre, system, trj_suffix, frame_count, single_pass, size)
+            traj.Unstrip(restrip_solvent=True)
+            traj.rms('!(%s)' % INPUT['strip_mask'])
+            jobs[0][0].append(system)
 
     # Go back and do the receptor and ligand if we used a multiple
     # trajectory approach
@@ -151,30 +367,15 @@ def make_trajectories(INPUT, FILES, size, cpptraj, pre):
         rectraj.Setup(INPUT['startframe'], INPUT['endframe'], INPUT['interval'])
         rec_frames = int(rectraj.processed_frames)
         rectraj.rms('!(%s)' % INPUT['strip_mask'])
-        if INPUT['full_traj'] or INPUT['qh_entropy']:
-            rectraj.Outtraj(pre + 'receptor.%s' % trj_suffix,
-                            filetype=INPUT['netcdf'])
-        rectraj.Outtraj(pre + 'receptor.pdb', frames='1', filetype='pdb')
-        rectraj.Outtraj(pre + 'dummyreceptor.inpcrd', frames='1',
-                        filetype='restart')
 
         # Now do the same split-up of workload as we did for complex, but don't
         # assume the same number of frames as we had for the complex
-        if rectraj.processed_frames < size:
+        if rectraj.processed_frames < size and not chunk_size:
             raise MMPBSA_Error('Too many procs for receptor snapshots')
-        frames_per_rank = rectraj.processed_frames // size
-        extras = rectraj.processed_frames - frames_per_rank * size
-        frame_count = [frames_per_rank for i in range(size)]
-        for i in range(size):
-            if i < extras: frame_count[i] += 1
-        last_frame = 1
-        for i in range(size):
-            frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-            rectraj.Outtraj(pre + 'receptor.%s.%d' % (trj_suffix, i),
-                            frames=frame_string, filetype=INPUT['netcdf'])
-            last_frame += frame_count[i]
-
-        rectraj.Run(pre + 'receptor_traj_cpptraj.out')
+        frame_count = split_frames(rectraj.processed_frames, size, chunk_size)
+        _outtraj_system(rectraj, INPUT, pre, 'receptor', trj_suffix, frame_count, single_pass, size)
+
+        jobs.append((['receptor'], rectraj, pre + 'receptor_traj_cpptraj.out'))
 
     # end if not stability and FILES.receptor_trajs
 
@@ -190,227 +391,412 @@ def make_trajectories(INPUT, FILES, size, cpptraj, pre):
         ligtraj.Setup(INPUT['startframe'], INPUT['endframe'], INPUT['interval'])
         lig_frames = int(ligtraj.processed_frames)
         ligtraj.rms('!(%s)' % INPUT['strip_mask'])
-        ligtraj.Outtraj(pre + 'ligand.%s' % trj_suffix, filetype=INPUT['netcdf'])
-        ligtraj.Outtraj(pre + 'ligand.pdb', frames='1', filetype='pdb')
-        ligtraj.Outtraj(pre + 'dummyligand.inpcrd', frames='1',
-                        filetype='restart')
 
         # Now do the same split-up of workload as we did for complex, but don't
         # assume the same number of frames as we had for the complex
-        if ligtraj.processed_frames < size:
+        if ligtraj.processed_frames < size and not chunk_size:
             raise MMPBSA_Error('Too many procs for ligand snapshots')
-        frames_per_rank = ligtraj.processed_frames // size
-        extras = ligtraj.processed_frames - frames_per_rank * size
-        frame_count = [frames_per_rank for i in range(size)]
-        for i in range(size):
-            if i < extras: frame_count[i] += 1
-        last_frame = 1
-        for i in range(size):
-            frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-            ligtraj.Outtraj(pre + 'ligand.%s.%d' % (trj_suffix, i),
-                            frames=frame_string, filetype=INPUT['netcdf'])
-            last_frame += frame_count[i]
-
-        ligtraj.Run(pre + 'ligand_traj_cpptraj.out')
+        frame_count = split_frames(ligtraj.processed_frames, size, chunk_size)
+        _outtraj_system(ligtraj, INPUT, pre, 'ligand', trj_suffix, frame_count, single_pass, size)
+
+        jobs.append((['ligand'], ligtraj, pre + 'ligand_traj_cpptraj.out'))
 
     # end if not stability and FILES.ligand_trajs
 
-    # Now make the nmode trajectories
-    if INPUT['nmoderun']:
-        nmtraj = Trajectory(FILES.complex_prmtop, [pre + 'complex.%s.%d' %
-                                                   (trj_suffix, i) for i in range(size)], cpptraj)
-        nmtraj.Setup(INPUT['nmstartframe'], INPUT['nmendframe'], INPUT['nminterval'])
-
-        num_frames_nmode = int(nmtraj.processed_frames)
-
-        # Now split up the complex trajectory by thread
-        if nmtraj.processed_frames < size:
-            raise MMPBSA_Error('More processors than complex nmode frames!')
-
-        frames_per_rank = nmtraj.processed_frames // size
-        extras = nmtraj.processed_frames - frames_per_rank * size
-        frame_count = [frames_per_rank for i in range(size)]
-        for i in range(size):
-            if i < extras: frame_count[i] += 1
-        last_frame = 1
-        for i in range(size):
-            frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-            nmtraj.Outtraj(pre + 'complex_nm.%s.%d' % (trj_suffix, i),
-                           frames=frame_string, filetype=INPUT['netcdf'])
-            last_frame += frame_count[i]
-
-        nmtraj.Run(pre + 'com_nm_traj_cpptraj.out')
+    return (com_frames, rec_frames, lig_frames), jobs
 
-        if not stability:
-            nmtraj = Trajectory(FILES.receptor_prmtop, [pre + 'receptor.%s.%d' %
-                                                        (trj_suffix, i) for i in range(size)], cpptraj)
-            nmtraj.Setup(INPUT['nmstartframe'], INPUT['nmendframe'], INPUT['nminterval'])
-            # Now split up the complex trajectory by thread
-            if nmtraj.processed_frames < size:
-                raise MMPBSA_Error('More processors than receptor nmode frames!')
-
-            frames_per_rank = nmtraj.processed_frames // size
-            extras = nmtraj.processed_frames - frames_per_rank * size
-            frame_count = [frames_per_rank for i in range(size)]
-            for i in range(size):
-                if i < extras: frame_count[i] += 1
-            last_frame = 1
-            for i in range(size):
-                frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-                nmtraj.Outtraj(pre + 'receptor_nm.%s.%d' % (trj_suffix, i),
-                               frames=frame_string, filetype=INPUT['netcdf'])
-                last_frame += frame_count[i]
-
-            nmtraj.Run(pre + 'rec_nm_traj_cpptraj.out')
-
-            nmtraj = Trajectory(FILES.ligand_prmtop, [pre + 'ligand.%s.%d' %
-                                                      (trj_suffix, i) for i in range(size)], cpptraj)
-            nmtraj.Setup(INPUT['nmstartframe'], INPUT['nmendframe'], INPUT['nminterval'])
-            # Now split up the complex trajectory by thread
-            if nmtraj.processed_frames < size:
-                raise MMPBSA_Error('More processors than ligand nmode frames!')
-
-            frames_per_rank = nmtraj.processed_frames // size
-            extras = nmtraj.processed_frames - frames_per_rank * size
-            frame_count = [frames_per_rank for i in range(size)]
-            for i in range(size):
-                if i < extras: frame_count[i] += 1
-            last_frame = 1
-            for i in range(size):
-                frame_string = '%d-%d' % (last_frame, last_frame + frame_count[i] - 1)
-                nmtraj.Outtraj(pre + 'ligand_nm.%s.%d' % (trj_suffix, i),
-                               frames=frame_string, filetype=INPUT['netcdf'])
-                last_frame += frame_count[i]
-
-            nmtraj.Run(pre + 'lig_nm_traj_cpptraj.out')
-
-        # end if not stability
-
-    # end if INPUT['nmoderun']
-    return com_frames, rec_frames, lig_frames, num_frames_nmode
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def make_nmode_trajectory(INPUT, FILES, size, cpptraj, pre, system, num_chunks):
+    """
+    Makes the thread-specific (or chunk-specific) nmode trajectories of system
+    (complex, receptor or ligand) from its num_chunks trajectories. Returns the
+    number of nmode frames
+    """
+    trj_suffix = 'nc' if INPUT['netcdf'] else 'mdcrd'
+    prmtop = {'complex': FILES.complex_prmtop, 'receptor': FILES.receptor_prmtop,
+              'ligand': FILES.ligand_prmtop}[system]
+    nmtraj = Trajectory(prmtop, [pre + '%s.%s.%d' % (system, trj_suffix, i) for i in range(num_chunks)], cpptraj)
+    nmtraj.Setup(INPUT['nmstartframe'], INPUT['nmendframe'], INPUT['nminterval'])
+
+    # Now split up the trajectory by thread
+    if nmtraj.processed_frames < size and not INPUT['chunk_size']:
+        raise MMPBSA_Error('More processors than %s nmode frames!' % system)
+
+    frame_count = split_frames(nmtraj.processed_frames, size, INPUT['chunk_size'])
+    _outtraj_split(nmtraj, pre + '%s_nm.%s.%%d' % (system, trj_suffix), frame_count, INPUT['netcdf'])
+
+    nmtraj.Run(pre + '%s_nm_traj_cpptraj.out' % system[:3])
+
+    return int(nmtraj.processed_frames)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _outtraj_system(traj, INPUT, pre, system, trj_suffix, frame_count, single_pass=False, size=1):
+    """
+    Adds the outtraj actions for one system: the full trajectory (if needed),
+    the dummy PDB and restart files and the thread-specific trajectories. With
+    single_pass, the surface areas and the nmode trajectories of the system are
+    made in the same pass
+    """
+    if INPUT['full_traj'] or INPUT['qh_entropy']:
+        traj.Outtraj(pre + '%s.%s' % (system, trj_suffix), filetype=INPUT['netcdf'])
+    traj.Outtraj(pre + '%s.pdb' % system, frames='1', filetype='pdb')
+    traj.Outtraj(pre + 'dummy%s.inpcrd' % system, frames='1', filetype='restart')
+    _outtraj_split(traj, pre + '%s.%s.%%d' % (system, trj_suffix), frame_count, INPUT['netcdf'])
+    if single_pass:
+        _plan_surf(traj, INPUT, pre, system, frame_count)
+        _plan_nmode(traj, INPUT, pre, system, trj_suffix, sum(frame_count), size)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _outtraj_split(traj, basename, frame_count, filetype, first_chunk=0):
+    """
+    Adds the outtraj actions that dump the thread-specific (or chunk-specific)
+    trajectories, numbered from first_chunk. basename must have a %d for the
+    thread/chunk number
+    """
+    last_frame = 1
+    for i, count in enumerate(frame_count, first_chunk):
+        frame_string = '%d-%d' % (last_frame, last_frame + count - 1)
+        traj.Outtraj(basename % i, frames=frame_string, filetype=filetype)
+        traj.written[basename % i] = count
+        last_frame += count
+
+
+def _split_data_file(data_file, basename, frame_count, first_chunk=0):
+    """
+    Splits a cpptraj data file with one line per frame into the thread-specific
+    (or chunk-specific) files of the frame_count frames of each chunk, numbered
+    from first_chunk, and removes it. The frames of every file are numbered
+    from 1, as if cpptraj had been run on the chunk alone
+    """
+    with open(data_file) as f:
+        lines = f.readlines()
+    header = [line for line in lines if line.startswith('#')]
+    frames = [line.split(None, 1)[1] for line in lines if not line.startswith('#') and line.strip()]
+    if len(frames) != sum(frame_count):
+        raise TrajError('%s has %d frames, but %d were expected' % (data_file, len(frames), sum(frame_count)))
+    start = 0
+    for i, count in enumerate(frame_count, first_chunk):
+        with open(basename % i, 'w') as f:
+            f.writelines(header)
+            for frame, line in enumerate(frames[start:start + count], 1):
+                f.write('%8d %s' % (frame, line))
+        start += count
+    os.remove(data_file)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _plan_surf(traj, INPUT, pre, system, frame_count, first_chunk=0):
+    """
+    Adds the surface area calculation of the GB calculations of system to the
+    pass, so LcpoCalc (or MolsurfCalc) does not have to read the trajectories
+    again. Run splits the result into the thread-specific (or chunk-specific)
+    files, numbered from first_chunk
+    """
+    if not INPUT['gbrun'] or INPUT['mutant_only']:
+        return
+    data_file = pre + '%s_gb_surf.%d.dat' % (system, first_chunk)
+    traj.Surf(data_file, INPUT['molsurf'], INPUT['probe'], INPUT['msoffset'])
+    traj.data_splits.append((data_file, pre + '%s_gb_surf.dat.%%d' % system, frame_count, first_chunk))
+
+
+def _nmode_frames(INPUT, numframes):
+    """ Positions (starting from 1) of the nmode frames among the numframes analyzed frames """
+    if INPUT['nmstartframe'] > numframes:
+        raise TrajError('nmode start frame (%d) > total frames (%d)' % (INPUT['nmstartframe'], numframes))
+    return list(range(INPUT['nmstartframe'], min(INPUT['nmendframe'], numframes) + 1, INPUT['nminterval']))
+
+
+def _plan_nmode(traj, INPUT, pre, system, trj_suffix, numframes, size):
+    """
+    Adds the thread-specific (or chunk-specific) nmode trajectories of system
+    to the pass, picking the nmode frames among its numframes frames like
+    make_nmode_trajectory does with the thread-specific trajectories
+    """
+    if not INPUT['nmoderun']:
+        return
+    frames = _nmode_frames(INPUT, numframes)
+    if len(frames) < size and not INPUT['chunk_size']:
+        raise MMPBSA_Error('More processors than %s nmode frames!' % system)
+    start = 0
+    for i, count in enumerate(split_frames(len(frames), size, INPUT['chunk_size'])):
+        fname = pre + '%s_nm.%s.%d' % (system, trj_suffix, i)
+        traj.Outtraj(fname, frames=_frame_ranges(frames[start:start + count]), filetype=INPUT['netcdf'])
+        traj.written[fname] = count
+        start += count
+
+
+def _frame_ranges(frames):
+    """ cpptraj range of a list of frames (e.g. 1-5,7,9) """
+    ranges = []
+    for frame in frames:
+        if ranges and ranges[-1][1] == frame - 1:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+    return ','.join('%d' % a if a == b else '%d-%d' % (a, b) for a, b in ranges)
 
 
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 def make_mutant_trajectories(INPUT, FILES, rank, cpptraj,
-                             norm_sys, mut_sys, pre):
-    """ Mutates given trajectories and outputs dummy files for mutants """
+                             norm_sys, mut_sys, pre, chunks=None, chunks_nmode=None,
+                             mut_pre=None, mut_prmtops=None):
+    """
+    Mutates given trajectories and outputs dummy files for mutants. By default
+    each rank mutates its own thread-specific trajectories. When the
+    trajectories are split in chunks, chunks and chunks_nmode are the chunks
+    this rank has to mutate. The files of the mutant start with mut_pre
+    (pre + 'mutant_' by default), and mut_prmtops are the complex, receptor and
+    ligand topologies of the mutant (the mutant topologies in FILES by default)
+    """
     from GMXMMPBSA.alamdcrd import MutantMdcrd, GlyMutantMdcrd
     import shutil
     if not INPUT['alarun']: return None, None
 
     stability = FILES.stability
 
-    if INPUT['netcdf']:
-        trj_suffix = 'nc'
-        raise TypeError('Alanine/Glycine scanning requires ASCII trajectories '
-                        '(netcdf=0)')
-    else:
-        trj_suffix = 'mdcrd'
+    trj_suffix = 'nc' if INPUT['netcdf'] else 'mdcrd'
+
+    if mut_pre is None:
+        mut_pre = pre + 'mutant_'
+    if mut_prmtops is None:
+        mut_prmtops = (FILES.mutant_complex_prmtop, FILES.mutant_receptor_prmtop, FILES.mutant_ligand_prmtop)
+    mut_com_prmtop, mut_rec_prmtop, mut_lig_prmtop = mut_prmtops
 
-    if not stability and not ((FILES.ligand_prmtop == FILES.mutant_ligand_prmtop
-                               and FILES.receptor_prmtop != FILES.mutant_receptor_prmtop) or (
-                                      FILES.ligand_prmtop != FILES.mutant_ligand_prmtop and
-                                      FILES.receptor_prmtop == FILES.mutant_receptor_prmtop)):
+    if not stability and not ((FILES.ligand_prmtop == mut_lig_prmtop
+                               and FILES.receptor_prmtop != mut_rec_prmtop) or (
+                                      FILES.ligand_prmtop != mut_lig_prmtop and
+                                      FILES.receptor_prmtop == mut_rec_prmtop)):
         raise MMPBSA_Error('Alanine/Glycine scanning requires either a mutated '
                            'ligand or receptor topology file with only 1 mutant residue, but not '
                            'both')
 
     master = rank == 0
 
-    # Have each rank mutate our rank's normal complex trajectory
-    try:
-        com_mut = MutantMdcrd(pre + 'complex.%s.%d' % (trj_suffix, rank),
-                              norm_sys.complex_prmtop, mut_sys.complex_prmtop)
-    except MutantResError:
-        com_mut = GlyMutantMdcrd(pre + 'complex.%s.%d' % (trj_suffix, rank),
-                                 norm_sys.complex_prmtop, mut_sys.complex_prmtop)
-    com_mut.MutateTraj(pre + 'mutant_complex.%s.%d' % (trj_suffix, rank))
-
-    # Have each rank mutate our rank's normal receptor or ligand trajectory
-    # and copy the normal one to the mutant if the mutated residue is *not*
-    # present in there
-    if not stability:
-        if FILES.receptor_prmtop != FILES.mutant_receptor_prmtop:
-            try:
-                rec_mut = MutantMdcrd(pre + 'receptor.%s.%d' % (trj_suffix, rank),
-                                      norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
-            except MutantResError:
-                rec_mut = GlyMutantMdcrd(pre + 'receptor.%s.%d' % (trj_suffix, rank),
-                                         norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
-            rec_mut.MutateTraj(pre + 'mutant_receptor.%s.%d' % (trj_suffix, rank))
-            shutil.copyfile(pre + 'ligand.%s.%d' % (trj_suffix, rank),
-                            pre + 'mutant_ligand.%s.%d' % (trj_suffix, rank))
-
-        elif FILES.ligand_prmtop != FILES.mutant_ligand_prmtop:
-            try:
-                lig_mut = MutantMdcrd(pre + 'ligand.%s.%d' % (trj_suffix, rank),
-                                      norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
-            except MutantResError:
-                lig_mut = GlyMutantMdcrd(pre + 'ligand.%s.%d' % (trj_suffix, rank),
-                                         norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
-            lig_mut.MutateTraj(pre + 'mutant_ligand.%s.%d' % (trj_suffix, rank))
-            shutil.copyfile(pre + 'receptor.%s.%d' % (trj_suffix, rank),
-                            pre + 'mutant_receptor.%s.%d' % (trj_suffix, rank))
+    if chunks is None:
+        chunks = [rank]
+    if chunks_nmode is None:
+        chunks_nmode = [rank]
+
+    com_mut = None
+    for chunk in chunks:
+        # Have each rank mutate this chunk's normal complex trajectory
+        try:
+            com_mut = MutantMdcrd(pre + 'complex.%s.%d' % (trj_suffix, chunk),
+                                  norm_sys.complex_prmtop, mut_sys.complex_prmtop)
+        except MutantResError:
+            com_mut = GlyMutantMdcrd(pre + 'complex.%s.%d' % (trj_suffix, chunk),
+                                     norm_sys.complex_prmtop, mut_sys.complex_prmtop)
+        com_mut.MutateTraj(mut_pre + 'complex.%s.%d' % (trj_suffix, chunk))
+        # The mutants have the same frames, so the dummy files below need no query
+        frame_cache.copy(com_mut.traj, mut_pre + 'complex.%s.%d' % (trj_suffix, chunk))
+
+        # Have each rank mutate this chunk's normal receptor or ligand trajectory
+        # and copy the normal one to the mutant if the mutated residue is *not*
+        # present in there
+        if not stability:
+            if FILES.receptor_prmtop != mut_rec_prmtop:
+                try:
+                    rec_mut = MutantMdcrd(pre + 'receptor.%s.%d' % (trj_suffix, chunk),
+                                          norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
+                except MutantResError:
+                    rec_mut = GlyMutantMdcrd(pre + 'receptor.%s.%d' % (trj_suffix, chunk),
+                                             norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
+                rec_mut.MutateTraj(mut_pre + 'receptor.%s.%d' % (trj_suffix, chunk))
+                frame_cache.copy(rec_mut.traj, mut_pre + 'receptor.%s.%d' % (trj_suffix, chunk))
+                shutil.copyfile(pre + 'ligand.%s.%d' % (trj_suffix, chunk),
+                                mut_pre + 'ligand.%s.%d' % (trj_suffix, chunk))
+                frame_cache.copy(pre + 'ligand.%s.%d' % (trj_suffix, chunk),
+                                 mut_pre + 'ligand.%s.%d' % (trj_suffix, chunk))
+
+            elif FILES.ligand_prmtop != mut_lig_prmtop:
+                try:
+                    lig_mut = MutantMdcrd(pre + 'ligand.%s.%d' % (trj_suffix, chunk),
+                                          norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
+                except MutantResError:
+                    lig_mut = GlyMutantMdcrd(pre + 'ligand.%s.%d' % (trj_suffix, chunk),
+                                             norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
+                lig_mut.MutateTraj(mut_pre + 'ligand.%s.%d' % (trj_suffix, chunk))
+                frame_cache.copy(lig_mut.traj, mut_pre + 'ligand.%s.%d' % (trj_suffix, chunk))
+                shutil.copyfile(pre + 'receptor.%s.%d' % (trj_suffix, chunk),
+                                mut_pre + 'receptor.%s.%d' % (trj_suffix, chunk))
+                frame_cache.copy(pre + 'receptor.%s.%d' % (trj_suffix, chunk),
+                                 mut_pre + 'receptor.%s.%d' % (trj_suffix, chunk))
 
     # Have our master dump out dummy files
     if master:
-        com_traj = Trajectory(FILES.mutant_complex_prmtop,
-                              pre + 'mutant_complex.%s.0' % trj_suffix, cpptraj)
+        com_traj = Trajectory(mut_com_prmtop,
+                              mut_pre + 'complex.%s.0' % trj_suffix, cpptraj)
         com_traj.Setup(1, 1, 1)
-        com_traj.Outtraj(pre + 'mutant_complex.pdb', frames='1', filetype='pdb')
-        com_traj.Outtraj(pre + 'mutant_dummycomplex.inpcrd', frames='1',
+        com_traj.Outtraj(mut_pre + 'complex.pdb', frames='1', filetype='pdb')
+        com_traj.Outtraj(mut_pre + 'dummycomplex.inpcrd', frames='1',
                          filetype='restart')
-        com_traj.Run(pre + 'mutant_complex_cpptraj.out')
+        com_traj.Run(mut_pre + 'complex_cpptraj.out')
         if not stability:
-            rec_traj = Trajectory(FILES.mutant_receptor_prmtop,
-                                  pre + 'mutant_receptor.%s.0' % trj_suffix, cpptraj)
+            rec_traj = Trajectory(mut_rec_prmtop,
+                                  mut_pre + 'receptor.%s.0' % trj_suffix, cpptraj)
             rec_traj.Setup(1, 1, 1)
-            rec_traj.Outtraj(pre + 'mutant_receptor.pdb', frames='1',
+            rec_traj.Outtraj(mut_pre + 'receptor.pdb', frames='1',
                              filetype='pdb')
-            rec_traj.Outtraj(pre + 'mutant_dummyreceptor.inpcrd', frames='1',
+            rec_traj.Outtraj(mut_pre + 'dummyreceptor.inpcrd', frames='1',
                              filetype='restart')
-            rec_traj.Run(pre + 'mutant_receptor_cpptraj.out')
+            rec_traj.Run(mut_pre + 'receptor_cpptraj.out')
 
-            lig_traj = Trajectory(FILES.mutant_ligand_prmtop,
-                                  pre + 'mutant_ligand.%s.0' % trj_suffix, cpptraj)
+            lig_traj = Trajectory(mut_lig_prmtop,
+                                  mut_pre + 'ligand.%s.0' % trj_suffix, cpptraj)
             lig_traj.Setup(1, 1, 1)
-            lig_traj.Outtraj(pre + 'mutant_ligand.pdb', frames='1',
+            lig_traj.Outtraj(mut_pre + 'ligand.pdb', frames='1',
                              filetype='pdb')
-            lig_traj.Outtraj(pre + 'mutant_dummyligand.inpcrd', frames='1',
+            lig_traj.Outtraj(mut_pre + 'dummyligand.inpcrd', frames='1',
                              filetype='restart')
-            lig_traj.Run(pre + 'mutant_ligand_cpptraj.out')
+            lig_traj.Run(mut_pre + 'ligand_cpptraj.out')
 
     # Mutate our nmode trajectories if need be
     if INPUT['nmoderun']:
-        com_mut = MutantMdcrd(pre + 'complex_nm.%s.%d' % (trj_suffix, rank),
-                              norm_sys.complex_prmtop, mut_sys.complex_prmtop)
-        com_mut.MutateTraj(pre + 'mutant_complex_nm.%s.%d' % (trj_suffix, rank))
-        if not stability and FILES.receptor_prmtop != FILES.mutant_receptor_prmtop:
-            rec_mut = MutantMdcrd(pre + 'receptor_nm.%s.%d' % (trj_suffix, rank),
-                                  norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
-            rec_mut.MutateTraj(pre + 'mutant_receptor_nm.%s.%d' %
-                               (trj_suffix, rank))
-            shutil.copyfile(pre + 'ligand_nm.%s.%d' % (trj_suffix, rank),
-                            pre + 'mutant_ligand_nm.%s.%d' % (trj_suffix, rank))
-
-        if not stability and FILES.ligand_prmtop != FILES.mutant_ligand_prmtop:
-            lig_mut = MutantMdcrd(pre + 'ligand_nm.%s.%d' % (trj_suffix, rank),
-                                  norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
-            lig_mut.MutateTraj(pre + 'mutant_ligand_nm.%s.%d' %
-                               (trj_suffix, rank))
-            shutil.copyfile(pre + 'ligand_nm.%s.%d' % (trj_suffix, rank),
-                            pre + 'mutant_ligand_nm.%s.%d' % (trj_suffix, rank))
+        for chunk in chunks_nmode:
+            com_mut = MutantMdcrd(pre + 'complex_nm.%s.%d' % (trj_suffix, chunk),
+                                  norm_sys.complex_prmtop, mut_sys.complex_prmtop)
+            com_mut.MutateTraj(mut_pre + 'complex_nm.%s.%d' % (trj_suffix, chunk))
+            if not stability and FILES.receptor_prmtop != mut_rec_prmtop:
+                rec_mut = MutantMdcrd(pre + 'receptor_nm.%s.%d' % (trj_suffix, chunk),
+                                      norm_sys.receptor_prmtop, mut_sys.receptor_prmtop)
+                rec_mut.MutateTraj(mut_pre + 'receptor_nm.%s.%d' %
+                                   (trj_suffix, chunk))
+                shutil.copyfile(pre + 'ligand_nm.%s.%d' % (trj_suffix, chunk),
+                                mut_pre + 'ligand_nm.%s.%d' % (trj_suffix, chunk))
+
+            if not stability and FILES.ligand_prmtop != mut_lig_prmtop:
+                lig_mut = MutantMdcrd(pre + 'ligand_nm.%s.%d' % (trj_suffix, chunk),
+                                      norm_sys.ligand_prmtop, mut_sys.ligand_prmtop)
+                lig_mut.MutateTraj(mut_pre + 'ligand_nm.%s.%d' %
+                                   (trj_suffix, chunk))
+                shutil.copyfile(pre + 'ligand_nm.%s.%d' % (trj_suffix, chunk),
+                                mut_pre + 'ligand_nm.%s.%d' % (trj_suffix, chunk))
 
     # If we're doing a quasi-harmonic approximation we need the full com traj
     if (INPUT['full_traj'] or INPUT['qh_entropy']) and master:
         com_mut = MutantMdcrd(pre + 'complex.%s' % trj_suffix,
                               norm_sys.complex_prmtop, mut_sys.complex_prmtop)
-        com_mut.MutateTraj(pre + 'mutant_complex.%s' % trj_suffix)
+        com_mut.MutateTraj(mut_pre + 'complex.%s' % trj_suffix)
 
+    if com_mut is None:
+        return None, None
     return str(com_mut), com_mut.mutres
 
 
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class FrameCounts(object):
+    """
+    Cache of the number of frames of the trajectory files, so cpptraj is not
+    run again to count them. Each file is stored by its absolute path together
+    with its size and modification time, and an entry is only used while they
+    are the same. The cache is kept in filename (in the working directory) so
+    the next runs find it too
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.counts = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def get(self, traj):
+        """ Number of frames of traj, or None if it is not known """
+        with self._lock:
+            if not self._loaded:
+                self.counts.update(self._load())
+                self._loaded = True
+            entry = self.counts.get(os.path.abspath(traj))
+        if entry is not None and entry[:2] == self._stat(traj):
+            return entry[2]
+        return None
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def set(self, traj, frames):
+        """ Stores the number of frames of traj, as it is now """
+        stat = self._stat(traj)
+        if stat is not None:
+            with self._lock:
+                self.counts[os.path.abspath(traj)] = list(stat) + [frames]
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def copy(self, source, copy):
+        """ copy has as many frames as source (e.g. it was mutated from it) """
+        frames = self.get(source)
+        if frames is not None:
+            self.set(copy, frames)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def update(self, counts):
+        """ Adds the counts of another process """
+        with self._lock:
+            self.counts.update(counts)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def save(self):
+        """
+        Writes the cache. The file is read again first, since other runs may
+        have updated it, and the entries of the files that changed or no longer
+        exist are left out
+        """
+        if not self.filename:
+            return
+        counts = self._load()
+        with self._lock:
+            counts.update(self.counts)
+        counts = {traj: entry for traj, entry in counts.items() if entry[:2] == self._stat(traj)}
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(counts, f)
+            os.replace(tmp, self.filename)
+        except OSError:
+            # The cache only saves time, so a read-only directory is not an error
+            pass
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _load(self):
+        """ Reads the cache file """
+        if not self.filename:
+            return {}
+        try:
+            with open(self.filename) as f:
+                counts = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return counts if isinstance(counts, dict) else {}
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    @staticmethod
+    def _stat(traj):
+        """ [size, modification time] of a file, or None if it does not exist """
+        try:
+            stat = os.stat(traj)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+
+# Number of frames of every trajectory file queried or written by this run
+frame_cache = FrameCounts('gmx_MMPBSA_frames.json')
+
+
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 class Trajectory(object):
@@ -445,6 +831,10 @@ class Trajectory(object):
         trajsystem.Run('_MMPBSA_create_trajectories.out')
     """
 
+    # Maximum number of cpptraj processes counting frames at the same time.
+    # Counting mostly reads the files, so it is not limited by the cores
+    query_jobs = 8
+
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
     def __init__(self, prmtop, traj_files, cpptraj='cpptraj'):
@@ -460,11 +850,20 @@ class Trajectory(object):
 
         self.prmtop = prmtop
 
-        # Find cpptraj
-        self.exe = cpptraj
+        # Find cpptraj. It may also be the command (a list) that runs the
+        # OpenMP or MPI version (see findprogs.parallel_cpptraj)
+        self.exe = list(cpptraj) if isinstance(cpptraj, (list, tuple)) else [cpptraj]
 
         self.strip_solvent = False
 
+        # Number of frames of the thread-specific (or chunk-specific)
+        # trajectories written by Run, so they don't have to be queried later
+        self.written = {}
+
+        # (data file, basename, frame counts, first chunk) of the data files
+        # that Run splits into thread-specific (or chunk-specific) files
+        self.data_splits = []
+
         self.Query()
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
@@ -487,6 +886,8 @@ class Trajectory(object):
             pass
 
         self.actions = []
+        self.written = {}
+        self.data_splits = []
 
         # Catch stupid choices
         if startframe > endframe:
@@ -582,42 +983,56 @@ class Trajectory(object):
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
     def Query(self):
-        """ Finds out how many frames are in the given traj files """
-        from subprocess import Popen, PIPE
-        import re
+        """
+        Finds out how many frames are in the given traj files. The files that
+        are not in frame_cache are queried at the same time
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-        framere = re.compile(r'Frames: (\d+)')
+        sizes = {traj: frame_cache.get(traj) for traj in self.traj_files}
+        missing = [traj for traj in sizes if sizes[traj] is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), self.query_jobs)) as executor:
+                for traj, num_frames in zip(missing, executor.map(self._query_file, missing)):
+                    sizes[traj] = num_frames
+                    frame_cache.set(traj, num_frames)
 
-        self.traj_sizes = []
+        self.traj_sizes = [sizes[traj] for traj in self.traj_files]
 
-        # Determine how many frames are in each trajectory of the list
+        self.total_frames = sum(self.traj_sizes)
 
-        for traj in self.traj_files:
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
-            process = Popen([self.exe, '-p', str(self.prmtop), '-y', traj, '-tl'],
-                            stdin=PIPE, stdout=PIPE)
+    def _query_file(self, traj):
+        """ Runs cpptraj to count the frames of one traj file """
+        from subprocess import Popen, PIPE
+        import re
 
-            (output, error) = process.communicate(b'')
+        framere = re.compile(r'Frames: (\d+)')
 
-            if process.wait():  # if it quits with return code != 0
-                raise TrajError('%s failed when querying %s' % (self.exe, traj))
+        # Counting frames is quick and several files are queried at the same
+        # time, so the program itself is run without mpirun or extra threads
+        exe = self.exe[-1]
+        process = Popen([exe, '-p', str(self.prmtop), '-y', traj, '-tl'],
+                        stdin=PIPE, stdout=PIPE)
 
-            output = output.decode()
+        (output, error) = process.communicate(b'')
 
-            # Now parse the output to find out how many frames are there. We are
-            # looking for "Coordinate processing will occur on x frames."
+        if process.wait():  # if it quits with return code != 0
+            raise TrajError('%s failed when querying %s' % (exe, traj))
 
-            num_frames = framere.findall(output)
-            if len(num_frames) < 1:
-                raise TrajError('Could not find number of frames in ' + traj)
-            elif len(num_frames) > 1:
-                raise RuntimeError('Unexpected output from cpptraj. Has format '
-                                   'changed?')
-            self.traj_sizes.append(int(num_frames[0]))
+        output = output.decode()
 
-        # end for traj in self.traj_files
+        # Now parse the output to find out how many frames are there. We are
+        # looking for "Coordinate processing will occur on x frames."
 
-        self.total_frames = sum(self.traj_sizes)
+        num_frames = framere.findall(output)
+        if len(num_frames) < 1:
+            raise TrajError('Could not find number of frames in ' + traj)
+        elif len(num_frames) > 1:
+            raise RuntimeError('Unexpected output from cpptraj. Has format '
+                               'changed?')
+        return int(num_frames[0])
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
@@ -635,9 +1050,38 @@ class Trajectory(object):
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
-    def rms(self, mask):
-        """ Does an RMS fit around a specific mask """
-        self.actions.append('rmsd %s mass first' % mask)
+    def rms(self, mask, reference=False):
+        """
+        Does an RMS fit around a specific mask, to the first frame or to the
+        structure loaded with Reference
+        """
+        self.actions.append('rmsd %s mass %s' % (mask, 'reference' if reference else 'first'))
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def Reference(self, fname):
+        """ Loads the reference structure used by rms(reference=True) """
+        self.actions.append('reference %s' % fname)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def Surf(self, output, molsurf=False, probe=1.4, offset=0.0):
+        """
+        Computes the surface area of the current atoms in every frame with
+        LCPO (or molsurf), like LcpoCalc and MolsurfCalc do
+        """
+        if molsurf:
+            self.actions.append('molsurf :* out %s probe %s offset %s' % (output, probe, offset))
+        else:
+            if 'solvent none' not in self.actions:
+                self.actions.append('solvent none')
+            self.actions.append('surf :* out %s' % output)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def Average(self, fname):
+        """ Writes the average structure of the current atoms to a PDB file """
+        self.actions.append('average %s pdb chainid " "' % fname)
 
     # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
 
@@ -680,15 +1124,20 @@ class Trajectory(object):
             for action in self.actions:
                 input_string += action.strip() + '\n'
 
-            process = Popen([self.exe, self.prmtop], stdout=stdout, stdin=PIPE)
+            process = Popen(self.exe + [self.prmtop], stdout=stdout, stdin=PIPE)
 
             process.communicate(input_string.encode())
 
             if process.wait():
-                raise TrajError('Error running %s' % self.program)
+                raise TrajError('Error running %s' % ' '.join(self.exe))
         finally:
             if own_handle: stdout.close()
 
+        for fname, count in self.written.items():
+            frame_cache.set(fname, count)
+        for data_file, basename, frame_count, first_chunk in self.data_splits:
+            _split_data_file(data_file, basename, frame_count, first_chunk)
+
     # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
     def Outtraj(self, filename, frames=None, filetype='', nobox='nobox'):
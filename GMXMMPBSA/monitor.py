@@ -0,0 +1,237 @@
+"""
+This module follows the GB and PB output files while sander (or
+mmpbsa_py_energy) is still writing them, and periodically prints the number of
+frames done, the speed, a running estimate of the binding free energy with its
+standard error of the mean and the time left for each model (-live-stats).
+
+The estimate only uses the terms printed in the mdout files, so the GB values
+do not include ESURF (computed afterwards by cpptraj) and are labeled as such.
+It is only meant to spot diverging or stalled runs early; the final results
+are always taken from the complete output files.
+
+Classes:
+   MdoutFollower: Reads the energy blocks appended to an mdout file
+   LiveStats: Thread that prints the running statistics
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+import re
+import sys
+import threading
+import time
+from math import sqrt
+from GMXMMPBSA.amber_outputs import EnergyMoments
+
+# 'KEY = value' pairs of an energy block (e.g. ' 1-4 VDW =     12.3456')
+_termre = re.compile(r'(1-4 \w+|[A-Z][\w-]*)\s*=\s*([-+]?\d+\.\d*(?:[eE][-+]?\d+)?)')
+
+
+def _hms(seconds):
+    """ Formats a number of seconds as hh:mm:ss """
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class MdoutFollower(object):
+    """
+    Reads the part of an mdout file written since the last call to update() and
+    collects the sum of the energy terms in data_keys of every complete frame.
+    An energy block starts with the ' BOND' line and ends with the first line
+    without terms, so partially written blocks are left for the next update
+    """
+
+    def __init__(self, fname, data_keys, since=0.0):
+        self.fname = fname
+        self.data_keys = set(data_keys)
+        self.since = since
+        self.totals = []
+        self._offset = 0
+        self._buffer = ''
+        self._block = None
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def update(self):
+        """ Reads the new frames. Returns how many there were """
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            return 0
+        # Left over from a previous run, it will be overwritten
+        if stat.st_mtime < self.since:
+            return 0
+        if stat.st_size < self._offset:
+            # The file was truncated (the program started again)
+            self.totals = []
+            self._offset = 0
+            self._buffer = ''
+            self._block = None
+        if stat.st_size == self._offset:
+            return 0
+        with open(self.fname, 'r') as f:
+            f.seek(self._offset)
+            new = f.read(stat.st_size - self._offset)
+            self._offset = f.tell()
+        lines = (self._buffer + new).split('\n')
+        # The last line is not complete yet
+        self._buffer = lines.pop()
+        nframes = len(self.totals)
+        for line in lines:
+            if line[0:5] == ' BOND':
+                self._end_block()
+                self._block = 0.0
+            if self._block is None:
+                continue
+            terms = _termre.findall(line)
+            if not terms:
+                self._end_block()
+                continue
+            self._block += sum(float(value) for key, value in terms if key in self.data_keys)
+        return len(self.totals) - nframes
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _end_block(self):
+        if self._block is not None:
+            self.totals.append(self._block)
+            self._block = None
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class LiveStats(threading.Thread):
+    """
+    Prints, every interval seconds, the progress of each model (e.g. GB and PB)
+    of the normal and mutant systems. models is a list of (label, base name,
+    data keys) tuples, where the base name has a %s for complex, receptor or
+    ligand (e.g. _GMXMMPBSA_%s_gb.mdout). The frames of the thread-specific
+    files are matched by position, so the running delta G only uses the frames
+    that every system has already finished. numframes (the number of frames of
+    each system) may be set once the trajectories are made
+    """
+
+    def __init__(self, models, num_files, numframes=0, stability=False, interval=30.0, stdout=sys.stdout):
+        threading.Thread.__init__(self, name='LiveStats', daemon=True)
+        self.num_files = num_files
+        self.numframes = numframes
+        self.interval = interval
+        self.stdout = stdout
+        self.systems = ['complex'] if stability else ['complex', 'receptor', 'ligand']
+        self.start_time = time.time()
+        self.models = []
+        for label, basename, data_keys in models:
+            followers = [[MdoutFollower('%s.%d' % (basename % system, i), data_keys, self.start_time)
+                          for system in self.systems] for i in range(num_files)]
+            # Running statistics of delta G, frames already added for each
+            # file, time of the first frame and time of the last new frame.
+            # ESURF is not in the mdout files, but in the _surf.dat ones
+            dg_label = 'DELTA G (no ESURF)' if 'ESURF' in data_keys else 'DELTA G'
+            self.models.append({'label': label, 'files': followers, 'paired': [0] * num_files,
+                                'stats': EnergyMoments(), 'dg_label': dg_label, 'first': None, 'last': None})
+        self._finished = threading.Event()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            # Nothing to report once every model that started is done
+            new = self.update()
+            expected = self.numframes * len(self.systems)
+            if new or any(model['first'] is not None and self._done(model) < expected for model in self.models):
+                self.write()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def stop(self):
+        """ Stops the thread """
+        self._finished.set()
+        if self.is_alive():
+            self.join()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def update(self):
+        """ Reads the new frames of every model. Returns how many there were """
+        now = time.time()
+        total = 0
+        for model in self.models:
+            new = 0
+            for i, followers in enumerate(model['files']):
+                for follower in followers:
+                    new += follower.update()
+                # Frames that are done for every system
+                paired = min(len(follower.totals) for follower in followers)
+                dgs = [followers[0].totals[j] - sum(follower.totals[j] for follower in followers[1:])
+                       for j in range(model['paired'][i], paired)]
+                model['stats'] = model['stats'].merge(EnergyMoments.from_vector(dgs))
+                # A rewritten file is not counted twice
+                model['paired'][i] = max(paired, model['paired'][i])
+            if new:
+                if model['first'] is None:
+                    model['first'] = now
+                model['last'] = now
+            total += new
+        return total
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def write(self):
+        """ Prints the statistics of every model """
+        now = time.time()
+        lines = ['Live statistics (%s elapsed):' % _hms(now - self.start_time)]
+        expected = self.numframes * len(self.systems)
+        for model in self.models:
+            done = self._done(model)
+            if model['first'] is None:
+                lines.append('  %-14s waiting' % model['label'])
+                continue
+            line = '  %-14s %7d' % (model['label'], done)
+            if expected:
+                line += '/%d' % expected
+            line += ' frames'
+            elapsed = now - model['first']
+            if elapsed > 0 and done:
+                rate = done / elapsed
+                line += ' %8.2f frames/s' % rate
+            else:
+                rate = 0.0
+            stats = model['stats']
+            if len(stats):
+                line += '   %s = %10.4f +/- %.4f' % (model['dg_label'], stats.avg(), stats.stdev() / sqrt(len(stats)))
+            if expected and done >= expected:
+                line += '   done'
+            elif now - model['last'] > 3 * self.interval:
+                line += '   no new frames for %s' % _hms(now - model['last'])
+            elif expected and rate:
+                line += '   ETA %s' % _hms((expected - done) / rate)
+            lines.append(line)
+        self.stdout.write('\n'.join(lines) + '\n')
+        self.stdout.flush()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    @staticmethod
+    def _done(model):
+        """ Number of frames read for all the systems of a model """
+        return sum(len(follower.totals) for followers in model['files'] for follower in followers)
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
@@ -23,7 +23,7 @@ statistics printing.
 
 import io
 import numpy as np
-from GMXMMPBSA.amber_outputs import EnergyVector
+from GMXMMPBSA.amber_outputs import EnergyVector, EnergyMoments
 from GMXMMPBSA.exceptions import LengthError, GMXMMPBSA_WARNING
 from GMXMMPBSA import utils
 from math import sqrt, ceil
@@ -159,6 +159,8 @@ def write_stability_output(app):
     final_output.add_comment('')
     final_output.add_comment('Calculations performed using %s complex frames.' %
                              app.numframes)
+    if getattr(app, 'adaptive_report', None):
+        final_output.add_comment(app.adaptive_report)
     if INPUT['nmoderun']:
         final_output.add_comment('NMODE calculations performed using %s frames.' %
                                  app.numframes_nmode)
@@ -342,6 +344,9 @@ def write_stability_output(app):
 
     # end for solv in ['gbrun', 'pbrun', ...]
 
+    if getattr(app.calc_types, 'scan', None):
+        _write_scan_table(app, final_output)
+
     if FILES.energyout: ene_csv.close()
 
 
@@ -375,6 +380,8 @@ def write_binding_output(app):
                                  prmtop_system.ligand_prmtop.parm_data['RESIDUE_LABEL'][0])
     final_output.add_comment('')
     final_output.add_comment('Calculations performed using %s complex frames.' % app.numframes)
+    if getattr(app, 'adaptive_report', None):
+        final_output.add_comment(app.adaptive_report)
     if INPUT['nmoderun']:
         final_output.add_comment('NMODE calculations performed using %s frames.' % app.numframes_nmode)
     if INPUT['interaction_entropy']:
@@ -546,7 +553,7 @@ def write_binding_output(app):
 
             # Combine with the entropy(ies)
             if INPUT['qh_entropy']:
-                if isinstance(sys_norm.data['DELTA TOTAL'], EnergyVector):
+                if isinstance(sys_norm.data['DELTA TOTAL'], (EnergyVector, EnergyMoments)):
                     final_output.add_section('Using Quasi-harmonic Entropy Approximation:\n'
                                              'DELTA G binding = %9.4f\n' %
                                              (sys_norm.data['DELTA TOTAL'].avg() - qhnorm.total_avg()))
@@ -581,7 +588,7 @@ def write_binding_output(app):
 
             # Combine with the entropy(ies)
             if INPUT['qh_entropy']:
-                if isinstance(sys_mut.data['DELTA TOTAL'], EnergyVector):
+                if isinstance(sys_mut.data['DELTA TOTAL'], (EnergyVector, EnergyMoments)):
                     final_output.add_section('Using Quasi-harmonic Entropy Approximation:\n'
                                              'DELTA G binding = %9.4f\n' %
                                              (qhmutant.total_avg() - sys_mut.data['DELTA TOTAL'].avg()))
@@ -630,15 +637,68 @@ def write_binding_output(app):
 
     # end for solv in ['gbrun', 'pbrun', ...]
 
+    if getattr(app.calc_types, 'scan', None):
+        _write_scan_table(app, final_output)
+
     if FILES.energyout:
         ene_csv.close()
 
 
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
+def _write_scan_table(app, final_output):
+    """
+    Writes the DELTA DELTA G of every mutant of a mutant scan (mutant_scan = 1),
+    one row per mutated residue and one column per solvation model
+    """
+    INPUT = app.INPUT
+    triggers = ('gbrun', 'pbrun', 'rismrun_std', 'rismrun_gf')
+    outkeys = ('gb', 'pb', 'rism std', 'rism gf')
+    headers = ('GB', 'PB', '3D-RISM', '3D-RISM (GF)')
+    keys = [key for trigger, key in zip(triggers, outkeys) if INPUT[trigger]]
+    # The first mutant is the one of the detailed results
+    if app.stability:
+        mutants = [(app.mut_str, {key: app.calc_types.mutant[key]['complex'] for key in keys})]
+        title = 'DELTA G'
+    else:
+        mutants = [(app.mut_str, {key: app.calc_types.mutant[key]['delta'] for key in keys})]
+        title = 'DELTA DELTA G binding'
+    mutants += app.calc_types.scan
+
+    final_output.write('\nRESULTS OF THE MUTANT SCAN (%s):\n\n' % title)
+    final_output.writeline('%-30s' % 'Mutant' + ''.join('%24s' % headers[outkeys.index(key)] for key in keys))
+    for label, data in mutants:
+        line = '%-30s' % label
+        for key in keys:
+            if app.stability:
+                diff_array = app.calc_types[key]['complex'].data['TOTAL'] - data[key].data['TOTAL']
+                davg, dstdev = diff_array.avg(), diff_array.stdev()
+            else:
+                davg, dstdev = data[key].diff(app.calc_types[key]['delta'], 'DELTA TOTAL', 'DELTA TOTAL')
+            line += '%11.4f +/- %8.4f' % (davg, dstdev)
+        final_output.writeline(line)
+    final_output.separate()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _decomp_output(decomp, DecompClass, basename, *args):
+    """
+    The DecompOut of basename with the merged statistics of the MPI ranks if
+    decomp has it (see main._reduce_decomp), or else one parsed from its files
+    """
+    if decomp and basename in decomp:
+        return decomp[basename]
+    return DecompClass(basename, *args)
+
+
 def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
-                                  mutant_system, mutstr, pre):
-    """ Write output file for stability decomposition calculations """
+                                  mutant_system, mutstr, pre, decomp=None):
+    """
+    Write output file for stability decomposition calculations. decomp has the
+    merged DecompOut of the MPI ranks by file name, if there is no need to
+    parse the files here
+    """
     from csv import writer
     from datetime import datetime
     from GMXMMPBSA.amber_outputs import DecompOut, PairDecompOut, idecompString
@@ -677,9 +737,9 @@ def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
 
         # See if we do normal system
         if not INPUT['mutant_only']:
-            gb_com = DecompClass(pre + 'complex_gb.mdout',
-                                 prmtop_system.complex_prmtop, INPUT['surften'], csv_prefix,
-                                 size, INPUT['dec_verbose'])
+            gb_com = _decomp_output(decomp, DecompClass, pre + 'complex_gb.mdout',
+                                    prmtop_system.complex_prmtop, INPUT['surften'], csv_prefix,
+                                    size, INPUT['dec_verbose'])
             gb_com.fill_all_terms()
             if INPUT['csv_format']:
                 decompout.writerow(['Energy Decomposition Analysis (All units ' +
@@ -704,9 +764,9 @@ def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
                 dec_energies.write(ls)
 
         if INPUT['alarun']:
-            gb_com = DecompClass(pre + 'mutant_complex_gb.mdout',
-                                 mutant_system.complex_prmtop, INPUT['surften'], csv_prefix,
-                                 size, INPUT['dec_verbose'])
+            gb_com = _decomp_output(decomp, DecompClass, pre + 'mutant_complex_gb.mdout',
+                                    mutant_system.complex_prmtop, INPUT['surften'], csv_prefix,
+                                    size, INPUT['dec_verbose'])
             gb_com.fill_all_terms()
             if INPUT['csv_format']:
                 decompout.writerow(['Energy Decomposition Analysis (All units ' +
@@ -739,9 +799,9 @@ def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
 
         # See if we do normal system
         if not INPUT['mutant_only']:
-            pb_com = DecompClass(pre + 'complex_pb.mdout',
-                                 prmtop_system.complex_prmtop, INPUT['surften'], csv_prefix,
-                                 size, INPUT['dec_verbose'])
+            pb_com = _decomp_output(decomp, DecompClass, pre + 'complex_pb.mdout',
+                                    prmtop_system.complex_prmtop, INPUT['surften'], csv_prefix,
+                                    size, INPUT['dec_verbose'])
             pb_com.fill_all_terms()
             if INPUT['csv_format']:
                 decompout.writerow(['Energy Decomposition Analysis (All units ' +
@@ -764,9 +824,9 @@ def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
                     utils.concatenate(dec_energies, csv_prefix + '.' + token + '.csv')
                 dec_energies.write(ls)
         if INPUT['alarun']:
-            pb_com = DecompClass(pre + 'mutant_complex_pb.mdout',
-                                 mutant_system.complex_prmtop, INPUT['surften'], csv_prefix,
-                                 size, INPUT['dec_verbose'])
+            pb_com = _decomp_output(decomp, DecompClass, pre + 'mutant_complex_pb.mdout',
+                                    mutant_system.complex_prmtop, INPUT['surften'], csv_prefix,
+                                    size, INPUT['dec_verbose'])
             pb_com.fill_all_terms()
             if INPUT['csv_format']:
                 decompout.writerow(['Energy Decomposition Analysis (All units ' +
@@ -796,8 +856,13 @@ def write_decomp_stability_output(FILES, INPUT, size, prmtop_system,
 # +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 
 def write_decomp_binding_output(FILES, INPUT, size, prmtop_system,
-                                mutant_system, mutstr, pre):
-    """ Write output file for binding free energy decomposition calculations """
+                                mutant_system, mutstr, pre, decomp=None):
+    """
+    Write output file for binding free energy decomposition calculations.
+    decomp has the merged DecompOut of the MPI ranks by file name, and the
+    merged statistics of the DELTAs by the prefix of their CSV file (e.g.
+    pre + 'gb_bind'), if there is no need to parse the files here
+    """
     from csv import writer
     from datetime import datetime
     from GMXMMPBSA.amber_outputs import (DecompOut, PairDecompOut, DecompBinding,
@@ -854,22 +919,25 @@ def write_decomp_binding_output(FILES, INPUT, size, prmtop_system,
         # Normal system
         if not INPUT['mutant_only']:
             if csv_prefix: csv_pre = csv_prefix % 'com'
-            gb_com = SingleClass(pre + 'complex_gb.mdout',
-                                 prmtop_system.complex_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_com = _decomp_output(decomp, SingleClass, pre + 'complex_gb.mdout',
+                                    prmtop_system.complex_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'rec'
-            gb_rec = SingleClass(pre + 'receptor_gb.mdout',
-                                 prmtop_system.receptor_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_rec = _decomp_output(decomp, SingleClass, pre + 'receptor_gb.mdout',
+                                    prmtop_system.receptor_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'lig'
-            gb_lig = SingleClass(pre + 'ligand_gb.mdout',
-                                 prmtop_system.ligand_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_lig = _decomp_output(decomp, SingleClass, pre + 'ligand_gb.mdout',
+                                    prmtop_system.ligand_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = pre + 'gb_bind'
             gb_bind = BindingClass(gb_com, gb_rec, gb_lig, prmtop_system,
                                    INPUT['idecomp'], INPUT['dec_verbose'], decompout,
                                    csv_pre, 'Energy Decomposition Analysis ' +
                                    '(All units kcal/mol): Generalized Born solvent')
+            # The DELTAs of the frames of all MPI ranks, if they were merged
+            if decomp and pre + 'gb_bind' in decomp:
+                gb_bind.moments = decomp[pre + 'gb_bind']
             # Write the data to the output file
             gb_bind.parse_all()
             # Now it's time to dump everything to the CSV file
@@ -895,23 +963,26 @@ def write_decomp_binding_output(FILES, INPUT, size, prmtop_system,
         # Mutant system
         if INPUT['alarun']:
             if csv_prefix: csv_pre = csv_prefix % 'com'
-            gb_com = SingleClass(pre + 'mutant_complex_gb.mdout',
-                                 mutant_system.complex_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_com = _decomp_output(decomp, SingleClass, pre + 'mutant_complex_gb.mdout',
+                                    mutant_system.complex_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'rec'
-            gb_rec = SingleClass(pre + 'mutant_receptor_gb.mdout',
-                                 mutant_system.receptor_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_rec = _decomp_output(decomp, SingleClass, pre + 'mutant_receptor_gb.mdout',
+                                    mutant_system.receptor_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'lig'
-            gb_lig = SingleClass(pre + 'mutant_ligand_gb.mdout',
-                                 mutant_system.ligand_prmtop, INPUT['surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            gb_lig = _decomp_output(decomp, SingleClass, pre + 'mutant_ligand_gb.mdout',
+                                    mutant_system.ligand_prmtop, INPUT['surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = pre + 'gb_bind'
             gb_bind = BindingClass(gb_com, gb_rec, gb_lig, mutant_system,
                                    INPUT['idecomp'], INPUT['dec_verbose'], decompout,
                                    csv_pre, 'Energy Decomposition Analysis ' +
                                    '(All units kcal/mol): Generalized Born solvent (%s)' %
                                    mutstr)
+            # The DELTAs of the frames of all MPI ranks, if they were merged
+            if decomp and pre + 'mutant_gb_bind' in decomp:
+                gb_bind.moments = decomp[pre + 'mutant_gb_bind']
             # Write the data to the output file
             gb_bind.parse_all()
             # Now it's time to dump everything to the CSV file
@@ -945,22 +1016,25 @@ def write_decomp_binding_output(FILES, INPUT, size, prmtop_system,
         # Normal system
         if not INPUT['mutant_only']:
             if csv_prefix: csv_pre = csv_prefix % 'com'
-            pb_com = SingleClass(pre + 'complex_pb.mdout',
-                                 prmtop_system.complex_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_com = _decomp_output(decomp, SingleClass, pre + 'complex_pb.mdout',
+                                    prmtop_system.complex_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'rec'
-            pb_rec = SingleClass(pre + 'receptor_pb.mdout',
-                                 prmtop_system.receptor_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_rec = _decomp_output(decomp, SingleClass, pre + 'receptor_pb.mdout',
+                                    prmtop_system.receptor_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'lig'
-            pb_lig = SingleClass(pre + 'ligand_pb.mdout',
-                                 prmtop_system.ligand_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_lig = _decomp_output(decomp, SingleClass, pre + 'ligand_pb.mdout',
+                                    prmtop_system.ligand_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = pre + 'pb_bind'
             pb_bind = BindingClass(pb_com, pb_rec, pb_lig, prmtop_system,
                                    INPUT['idecomp'], INPUT['dec_verbose'], decompout,
                                    csv_pre, 'Energy Decomposition Analysis ' +
                                    '(All units kcal/mol): Poisson Boltzmann solvent')
+            # The DELTAs of the frames of all MPI ranks, if they were merged
+            if decomp and pre + 'pb_bind' in decomp:
+                pb_bind.moments = decomp[pre + 'pb_bind']
             # Write the data to the output file
             pb_bind.parse_all()
             # Now it's time to dump everything to the CSV file
@@ -986,23 +1060,26 @@ def write_decomp_binding_output(FILES, INPUT, size, prmtop_system,
         # Mutant system
         if INPUT['alarun']:
             if csv_prefix: csv_pre = csv_prefix % 'com'
-            pb_com = SingleClass(pre + 'mutant_complex_pb.mdout',
-                                 mutant_system.complex_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_com = _decomp_output(decomp, SingleClass, pre + 'mutant_complex_pb.mdout',
+                                    mutant_system.complex_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'rec'
-            pb_rec = SingleClass(pre + 'mutant_receptor_pb.mdout',
-                                 mutant_system.receptor_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_rec = _decomp_output(decomp, SingleClass, pre + 'mutant_receptor_pb.mdout',
+                                    mutant_system.receptor_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = csv_prefix % 'lig'
-            pb_lig = SingleClass(pre + 'mutant_ligand_pb.mdout',
-                                 mutant_system.ligand_prmtop, INPUT['cavity_surften'],
-                                 csv_pre, size, INPUT['dec_verbose'])
+            pb_lig = _decomp_output(decomp, SingleClass, pre + 'mutant_ligand_pb.mdout',
+                                    mutant_system.ligand_prmtop, INPUT['cavity_surften'],
+                                    csv_pre, size, INPUT['dec_verbose'])
             if csv_prefix: csv_pre = pre + 'pb_bind'
             pb_bind = BindingClass(pb_com, pb_rec, pb_lig, mutant_system,
                                    INPUT['idecomp'], INPUT['dec_verbose'], decompout,
                                    csv_pre, 'Energy Decomposition Analysis ' +
                                    '(All units kcal/mol): Poisson Boltzmann solvent (%s)' %
                                    mutstr)
+            # The DELTAs of the frames of all MPI ranks, if they were merged
+            if decomp and pre + 'mutant_pb_bind' in decomp:
+                pb_bind.moments = decomp[pre + 'mutant_pb_bind']
             # Write the data to the output file
             pb_bind.parse_all()
             if FILES.dec_energies:
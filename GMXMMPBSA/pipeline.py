@@ -0,0 +1,224 @@
+"""
+This module contains the task graph used to overlap the trajectory
+preparation, the energy and surface calculations and the parsing of their
+output files. Each task declares the files it reads and writes, and a task
+starts as soon as the tasks that write its input files are finished, instead
+of waiting for a whole stage to end.
+
+Classes:
+   Task: A unit of work of the graph
+   TaskGraph: Resolves the dependencies between tasks and runs them
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+import sys
+from GMXMMPBSA.exceptions import CalcError, InternalError
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class Task(object):
+    """
+    A unit of work. func is called with the rank of the process that runs it.
+    inputs and outputs are file names, where %d stands for the thread-specific
+    files. A task runs on every rank unless master_only is set. after is a list
+    of names of tasks that must finish before this one (for dependencies that
+    are not expressed through files)
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), master_only=False, timer_key=None,
+                 message=''):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.master_only = master_only
+        self.timer_key = timer_key
+        self.message = message
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class TaskGraph(list):
+    """
+    List of tasks, in the order in which they are preferred to run. A task can
+    only depend on tasks added before it, so the graph can never have cycles.
+
+    The dependency on the task that writes an input file is resolved by rank:
+      - thread-specific files (%d) of a task that runs on every rank are taken
+        from the same rank, or from every rank if the reader is master_only
+      - any other file written by a task that runs on every rank is written by
+        the master (as the dummy files are)
+      - files of a master_only task come from the master
+    A task that writes a file also waits for the previous task writing it.
+    Every finished task leaves a marker file, so the processes do not need to
+    talk to each other, they just need to share the working directory
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, prefix, rank=0, size=1, timer=None):
+        list.__init__(self)
+        self.prefix = prefix
+        self.rank = rank
+        self.size = size
+        self.timer = timer
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def add(self, name, func, inputs=(), outputs=(), after=(), master_only=False, timer_key=None, message=''):
+        """ Adds a new Task to the graph and returns it """
+        task = Task(name, func, inputs, outputs, after, master_only, timer_key, message)
+        self.append(task)
+        return task
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def dependencies(self):
+        """
+        Returns, for each task, a list of (task index, scope) tuples, where
+        scope is 'local' (the same rank), 'master' or 'all' (every rank)
+        """
+        producers = {}
+        names = {}
+        deps = []
+        for i, task in enumerate(self):
+            mydeps = {}
+            for fname in task.inputs:
+                if fname in producers:
+                    j = producers[fname]
+                    mydeps[j] = self._scope(self[j], task, '%d' in fname)
+            # Two tasks that write the same file must not run at the same time
+            for fname in task.outputs:
+                if fname in producers:
+                    j = producers[fname]
+                    mydeps[j] = self._scope(self[j], task, '%d' in fname)
+            for name in task.after:
+                if name not in names:
+                    raise InternalError('Task %s must be added after %s' % (task.name, name))
+                j = names[name]
+                mydeps[j] = self._scope(self[j], task, True)
+            deps.append(sorted(mydeps.items()))
+            for fname in task.outputs:
+                producers[fname] = i
+            names[task.name] = i
+        return deps
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    @staticmethod
+    def _scope(producer, consumer, per_rank):
+        """ From which ranks the consumer needs the producer to be finished """
+        if producer.master_only or not per_rank:
+            return 'master'
+        if consumer.master_only:
+            return 'all'
+        return 'local'
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def write_graph(self, stdout=sys.stdout):
+        """ Writes the list of tasks and their dependencies (dry run) """
+        stdout.write('Task graph (%d tasks). Tasks run on every processor unless they are marked [master]\n\n' %
+                     len(self))
+        for i, (task, deps) in enumerate(zip(self, self.dependencies())):
+            stdout.write('%4d. %s%s\n' % (i + 1, task.name, ' [master]' if task.master_only else ''))
+            if deps:
+                stdout.write('        after: %s\n' % ', '.join(
+                    '%d' % (j + 1) if scope == 'local' else '%d (%s)' % (j + 1, scope) for j, scope in deps))
+        stdout.write('\n')
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def run(self, nproc=1, stdout=sys.stdout):
+        """
+        Runs the tasks of this rank with a pool of nproc workers. A task is
+        started as soon as all the tasks it depends on are done (on whatever
+        rank they run), giving priority to the tasks added first. Timers run
+        from the start of the first to the end of the last task of their key
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        import time
+
+        deps = self.dependencies()
+        ranks = {'local': [self.rank], 'master': [0], 'all': range(self.size)}
+        pending = [i for i, task in enumerate(self) if self.rank == 0 or not task.master_only]
+        remaining = {}
+        for i in pending:
+            remaining[self[i].timer_key] = remaining.get(self[i].timer_key, 0) + 1
+        done = set()
+        running = {}
+
+        def _ready(i):
+            for j, scope in deps[i]:
+                for r in ranks[scope]:
+                    if (j, r) not in done:
+                        if not os.path.exists(self._marker(j, r)):
+                            return False
+                        done.add((j, r))
+            return True
+
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            try:
+                while pending or running:
+                    if os.path.exists(self._marker('failed')):
+                        raise CalcError('A task failed on another processor. Check its output for the error')
+                    for i in list(pending):
+                        if len(running) >= nproc:
+                            break
+                        if not _ready(i):
+                            continue
+                        pending.remove(i)
+                        task = self[i]
+                        if task.timer_key is not None and self.timer is not None:
+                            self.timer.start_timer(task.timer_key)
+                        if task.message:
+                            stdout.write(task.message + '\n')
+                        running[executor.submit(task.func, self.rank)] = i
+                    if not running:
+                        time.sleep(self.poll_interval)
+                        continue
+                    finished, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = running.pop(future)
+                        # Raises the exception of the task, if any
+                        future.result()
+                        open(self._marker(i, self.rank), 'w').close()
+                        done.add((i, self.rank))
+                        key = self[i].timer_key
+                        remaining[key] -= 1
+                        if key is not None and self.timer is not None and not remaining[key]:
+                            self.timer.stop_timer(key)
+            except BaseException:
+                # Let the other processors know, and do not start anything else
+                open(self._marker('failed'), 'w').close()
+                for future in running:
+                    future.cancel()
+                raise
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _marker(self, index, rank=None):
+        if rank is None:
+            return '%stask.%s' % (self.prefix, index)
+        return '%stask.%d.%d.done' % (self.prefix, index, rank)
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
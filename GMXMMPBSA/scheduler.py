@@ -0,0 +1,325 @@
+"""
+This module contains the classes used to distribute the work among the
+processors on demand instead of assigning a fixed slice of the trajectory to
+each of them.
+
+Methods:
+   split_frames(nframes, size, chunk_size) : Returns the number of frames in
+        each thread- or chunk-specific trajectory
+   adaptive_passes(startframe, endframe, interval, stride) : Returns the frames
+        of each pass of adaptive sampling
+   shard_range(nframes, shard, num_shards) : Returns the frames of one shard
+        of a -shard run
+
+Classes:
+   ChunkScheduler: Hands out (calculation, chunk) work units to the processes
+                   that ask for them
+   TaskScheduler: Master/worker distribution of the work units over MPI, with
+                  the master working too
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+import threading
+from GMXMMPBSA.exceptions import CalcError
+
+
+def split_frames(nframes, size, chunk_size=0):
+    """
+    Returns a list with the number of frames in each thread-specific trajectory.
+    If chunk_size is 0, the frames are divided evenly among the size processors
+    (the extra frames are assigned incrementally). Otherwise the trajectory is
+    cut into as many chunks as needed to hold chunk_size frames at most, and the
+    frames are divided evenly among them
+    """
+    nframes = int(nframes)
+    if chunk_size > 0:
+        nchunks = max(1, -(-nframes // chunk_size))
+    else:
+        nchunks = size
+    frames_per_chunk = nframes // nchunks
+    extras = nframes - frames_per_chunk * nchunks
+    return [frames_per_chunk + 1 if i < extras else frames_per_chunk for i in range(nchunks)]
+
+
+def adaptive_passes(startframe, endframe, interval, stride):
+    """
+    Returns the (startframe, interval) of each pass of adaptive sampling. The
+    first pass takes every stride-th frame of the analyzed ones, and every
+    following pass takes the frames halfway between those taken so far, so the
+    frames are evaluated coarse-to-fine and each of them only once. stride must
+    be a power of 2. Passes that would start after endframe are left out
+    """
+    passes = [(startframe, interval * stride)]
+    step = stride
+    while step > 1:
+        first = startframe + step // 2 * interval
+        if first <= endframe:
+            passes.append((first, step * interval))
+        step //= 2
+    return passes
+
+
+def shard_range(nframes, shard, num_shards):
+    """
+    Returns the first and last position (starting from 1) among the nframes
+    analyzed frames of shard (also starting from 1), when they are divided in
+    num_shards contiguous blocks as evenly as split_frames does. Returns None
+    if the shard has no frames
+    """
+    counts = split_frames(nframes, num_shards)
+    if not counts[shard - 1]:
+        return None
+    first = sum(counts[:shard - 1]) + 1
+    return first, first + counts[shard - 1] - 1
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class ChunkScheduler(object):
+    """
+    Hands out the work units (calculation index, trajectory chunk) on demand.
+    Every process walks the calculation list in the same order and claims the
+    chunks that nobody took yet, so fast processors simply end up doing more
+    chunks than slow ones. A unit is claimed by atomically creating a claim file
+    in the working directory, which works the same for threads and MPI ranks as
+    long as they share the working directory (they already share all of the
+    intermediate files)
+    """
+
+    # Seconds between the checks of the completion marker of a unit that
+    # another process runs
+    poll = 5
+
+    def __init__(self, prefix, num_chunks, num_chunks_nmode=None):
+        self.prefix = prefix
+        self.num_chunks = num_chunks
+        if num_chunks_nmode is None:
+            num_chunks_nmode = num_chunks
+        # nmode trajectories are split on their own, and quasi-harmonic analysis
+        # is done only once over the full trajectory
+        self.chunks = {'nmode': num_chunks_nmode, 'qh': 1}
+        # Wakes up the threads of this process that wait for a unit
+        self._finished = threading.Condition()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def count(self, timer_key):
+        """ Number of chunks of the calculations with that timer key """
+        return self.chunks.get(timer_key, self.num_chunks)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def claim(self, index, chunk):
+        """ Tries to take a unit. Returns True if nobody took it before """
+        try:
+            fd = os.open(self._name(index, chunk, 'claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def finish(self, index, chunk):
+        """ Marks a unit as done """
+        open(self._name(index, chunk, 'done'), 'w').close()
+        with self._finished:
+            self._finished.notify_all()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def is_done(self, index, chunk):
+        """ Whether a unit (run by any process) is done """
+        return os.path.exists(self._name(index, chunk, 'done'))
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def wait(self, index, chunk):
+        """
+        Blocks until a unit is done. finish() wakes up the threads of this
+        process right away. A unit run by another process can only be seen
+        through its completion marker, which is checked every poll seconds
+        """
+        with self._finished:
+            while not self.is_done(index, chunk):
+                self._finished.wait(self.poll)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _name(self, index, chunk, suffix):
+        return '%scalc.%d.chunk.%d.%s' % (self.prefix, index, chunk, suffix)
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class TaskScheduler(ChunkScheduler):
+    """
+    Master/worker distribution of the (calculation, chunk) work units over MPI.
+    The master keeps the queue of units, in the order of the calculation list,
+    and every rank asks it for the next unit when it is free, reporting the one
+    it just finished. A unit that depends on another one (a CopyCalc copies
+    the output of another calculation) is only handed out once that one is
+    done, so a rank never sits waiting while there is other work left. This
+    way the expensive complex units are taken first and the cheaper receptor
+    and ligand units fill the gaps, and there can be more ranks than frames.
+
+    The master works on units like everybody else. It runs its own unit in a
+    thread (which mostly waits for the external program) and keeps answering
+    the requests, polling them with Iprobe, so only the main thread makes MPI
+    calls and no thread support is needed from MPI
+    """
+
+    # Tags of the messages to and from the master
+    REQUEST, REPLY = 7101, 7102
+    # Reply that stops a rank because a unit failed on another one
+    FAILED = 'failed'
+    # Seconds between the checks for requests while the master has nothing to do
+    poll = 0.01
+
+    def __init__(self, MPI, num_chunks, num_chunks_nmode=None):
+        ChunkScheduler.__init__(self, '', num_chunks, num_chunks_nmode)
+        self.MPI = MPI
+        self.comm = MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def run(self, units, after, work, messages=None, stdout=None):
+        """
+        Runs the units handed out to this rank with work(unit). units is the
+        list of units, after maps a unit to the unit it depends on, and messages
+        maps a calculation index to the text written when its first unit is
+        handed out (only the master uses them). If work fails on any rank, no
+        more units are handed out, the error is raised on that rank and a
+        CalcError on every other one
+        """
+        if self.rank == 0:
+            self._serve(units, after, messages or {}, stdout, work)
+            return
+        unit = self.next()
+        while unit is not None:
+            try:
+                work(unit)
+            except BaseException:
+                self.next(failed=True)
+                raise
+            unit = self.next(unit)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def next(self, finished=None, failed=False):
+        """
+        Reports the finished unit (if any) to the master and returns the next
+        one for this rank, or None when there is nothing left. If failed is
+        set, the master stops handing out units. Raises a CalcError if a unit
+        failed on another rank
+        """
+        self.comm.send(('failed' if failed else 'next', finished), dest=0, tag=self.REQUEST)
+        unit = self.comm.recv(source=0, tag=self.REPLY)
+        if unit == self.FAILED and not failed:
+            raise CalcError('A calculation failed on another MPI rank')
+        return unit
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _serve(self, units, after, messages, stdout, work):
+        """
+        Answers the requests of the other ranks until all of them are told to
+        stop, and runs units with work in a thread of the master meanwhile
+        """
+        queue = list(units)
+        done = set()
+        waiting = []
+        failed = False
+        workers = self.size - 1
+        status = self.MPI.Status()
+        errors = []
+        own = None
+        own_done = threading.Event()
+
+        def _take():
+            """ Next unit whose dependency is done, or None """
+            if failed:
+                return None
+            for unit in queue:
+                if after.get(unit) is None or after[unit] in done:
+                    queue.remove(unit)
+                    if stdout is not None and unit[0] in messages:
+                        stdout.write(messages.pop(unit[0]))
+                    return unit
+            return None
+
+        def _work(unit):
+            try:
+                work(unit)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                own_done.set()
+
+        while True:
+            busy = False
+            # The unit of the master
+            if own is not None and own_done.is_set():
+                own[1].join()
+                own_done.clear()
+                if errors:
+                    failed = True
+                    queue = []
+                else:
+                    done.add(own[0])
+                own = None
+            if own is None:
+                unit = _take()
+                if unit is not None:
+                    own = (unit, threading.Thread(target=_work, args=(unit,), name='TaskScheduler'))
+                    own[1].start()
+            # The requests of the other ranks
+            if workers and self.comm.Iprobe(source=self.MPI.ANY_SOURCE, tag=self.REQUEST, status=status):
+                busy = True
+                source = status.Get_source()
+                kind, finished = self.comm.recv(source=source, tag=self.REQUEST)
+                if finished is not None:
+                    done.add(tuple(finished))
+                if kind == 'failed':
+                    failed = True
+                    queue = []
+                waiting.append(source)
+            # Hand out a unit to every rank that is waiting for one, if possible
+            for source in list(waiting):
+                unit = _take()
+                if unit is None and queue and not failed:
+                    # Everything left depends on units that are running
+                    continue
+                waiting.remove(source)
+                self.comm.send(self.FAILED if unit is None and failed else unit, dest=source, tag=self.REPLY)
+                if unit is None:
+                    workers -= 1
+            if not workers and own is None and not queue:
+                break
+            if not busy:
+                own_done.wait(self.poll)
+        if errors:
+            raise errors[0]
+        if failed:
+            raise CalcError('A calculation failed on another MPI rank')
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
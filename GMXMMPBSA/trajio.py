@@ -0,0 +1,505 @@
+"""
+This module reads and writes trajectories in-process, so the thread-specific
+(or chunk-specific) trajectories can be cut from the trajectories given by the
+user without running cpptraj (native_io = 1). The frames are read in blocks of
+NumPy arrays: TRR and NetCDF files are memory-mapped, and XTC files are read
+through mdtraj or MDAnalysis, if one of them is installed. The frames are
+fitted to a reference frame like cpptraj's rmsd action does, the atoms of the
+receptor and ligand are picked by index, and every chunk is written directly
+as an Amber NetCDF or ASCII trajectory.
+
+Methods:
+   supported(fname) : Whether a trajectory file can be read in-process
+   write_slices(prmtop, trajs, frames, reference, fit_mask, outputs, counts,
+        first_chunk, netcdf) : Writes the thread-specific trajectories of a
+        range of chunks
+
+Classes:
+   TRRFile, NetCDFFile, MdcrdFile, XTCFile : Readers of each trajectory format
+   TrajectoryFiles : Several trajectory files read as a single trajectory
+   NetCDFWriter, MdcrdWriter : Writers of Amber trajectories
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+import struct
+import numpy as np
+from GMXMMPBSA.exceptions import TrajError
+
+# Number of frames read and written at a time
+BLOCK_FRAMES = 256
+
+
+def _xtc_backend():
+    """ Returns the name of the library used to read XTC files, or None """
+    for name in ('mdtraj', 'MDAnalysis'):
+        try:
+            __import__(name)
+        except ImportError:
+            continue
+        return name
+    return None
+
+
+def supported(fname):
+    """ Whether a trajectory file can be read in-process """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.xtc':
+        return _xtc_backend() is not None
+    if ext == '.trr':
+        return True
+    if ext in ('.nc', '.ncdf', '.netcdf'):
+        # Only NetCDF-3 files can be memory-mapped (not the HDF5-based NetCDF-4)
+        try:
+            with open(fname, 'rb') as f:
+                return f.read(3) == b'CDF'
+        except OSError:
+            return False
+    return False
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class TRRFile(object):
+    """
+    GROMACS TRR trajectory. The file is memory-mapped, and the headers are
+    scanned once to find where the coordinates of every frame are
+    """
+
+    MAGIC = 1993
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._data = np.memmap(fname, dtype=np.uint8, mode='r')
+        self._offsets = []
+        self.natoms = None
+        self._dtype = None
+        offset = 0
+        while offset < len(self._data):
+            offset = self._scan_frame(offset)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _scan_frame(self, offset):
+        """ Reads the header of the frame at offset. Returns the offset of the next frame """
+        data = self._data
+        magic, = struct.unpack_from('>i', data, offset)
+        if magic != self.MAGIC:
+            raise TrajError('%s is not a valid TRR file (bad magic number at byte %d)' % (self.fname, offset))
+        # Version string: its size, then an XDR string (length and padded bytes)
+        length, = struct.unpack_from('>i', data, offset + 8)
+        pos = offset + 12 + (length + 3) // 4 * 4
+        (ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size, x_size, v_size, f_size,
+         natoms, step, nre) = struct.unpack_from('>13i', data, pos)
+        pos += 13 * 4
+        if box_size:
+            real = box_size // 9
+        elif x_size:
+            real = x_size // (natoms * 3)
+        elif v_size:
+            real = v_size // (natoms * 3)
+        else:
+            real = f_size // (natoms * 3)
+        # Time and lambda
+        pos += 2 * real
+        if x_size:
+            if self.natoms is None:
+                self.natoms, self._dtype = natoms, '>f%d' % real
+            elif natoms != self.natoms:
+                raise TrajError('%s has frames with different numbers of atoms' % self.fname)
+            self._offsets.append(pos + ir_size + e_size + box_size + vir_size + pres_size + top_size + sym_size)
+        return pos + ir_size + e_size + box_size + vir_size + pres_size + top_size + sym_size + x_size + v_size + \
+            f_size
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def read(self, indices):
+        """ Coordinates (in Angstroms) of the frames with the given (0-based) indices """
+        coords = np.empty((len(indices), self.natoms, 3), dtype=np.float32)
+        for i, index in enumerate(indices):
+            coords[i] = np.frombuffer(self._data, dtype=self._dtype, count=self.natoms * 3,
+                                      offset=self._offsets[index]).reshape(self.natoms, 3)
+        coords *= 10.0
+        return coords
+
+    def close(self):
+        self._data = None
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class NetCDFFile(object):
+    """ Amber NetCDF trajectory, memory-mapped through scipy """
+
+    def __init__(self, fname):
+        from scipy.io import netcdf_file
+        self.fname = fname
+        try:
+            self._file = netcdf_file(fname, 'r', mmap=True)
+            self._coords = self._file.variables['coordinates']
+        except (TypeError, ValueError, KeyError) as e:
+            raise TrajError('Could not read %s as an Amber NetCDF trajectory: %s' % (fname, e))
+        self.natoms = self._coords.shape[1]
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def __len__(self):
+        return self._coords.shape[0]
+
+    def read(self, indices):
+        """ Coordinates (in Angstroms) of the frames with the given (0-based) indices """
+        return np.array(self._coords[list(indices)], dtype=np.float32)
+
+    def close(self):
+        self._coords = None
+        self._file.close()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class MdcrdFile(object):
+    """
+    Amber ASCII trajectory (mdcrd) written with 10 coordinates of 8 characters
+    per line, like cpptraj and MdcrdWriter do. Every frame then takes the same
+    number of bytes, so the file is memory-mapped as a (frames, bytes) array
+    and the coordinates are parsed by column, without splitting lines. If box
+    is None, whether the frames have a box line is found from the file size
+    """
+
+    def __init__(self, fname, natoms, box=None):
+        self.fname = fname
+        self.natoms = natoms
+        with open(fname, 'rb') as f:
+            self.title = f.readline().decode(errors='replace').rstrip('\n')
+            offset = f.tell()
+        size = os.path.getsize(fname) - offset
+        full, rest = divmod(natoms * 3, 10)
+        coord_bytes = full * 81 + (rest * 8 + 1 if rest else 0)
+        if box is None:
+            # A box line takes 25 bytes. Prefer no box if both sizes fit
+            box = bool(size % coord_bytes) and not size % (coord_bytes + 25)
+        self.hasbox = box
+        frame_bytes = coord_bytes + 25 if box else coord_bytes
+        if size % frame_bytes:
+            raise TrajError('%s is not a mdcrd trajectory of %d atoms with 10 coordinates per line%s' %
+                            (fname, natoms, ' and a box' if box else ''))
+        self._data = np.memmap(fname, dtype=np.uint8, mode='r', offset=offset,
+                               shape=(size // frame_bytes, frame_bytes))
+        # Columns of the end of the lines, which are dropped before parsing
+        newlines = np.concatenate((np.arange(80, full * 81, 81), [coord_bytes - 1] if rest else [],
+                                   [frame_bytes - 1] if box else [])).astype(int)
+        if len(self._data) and np.any(self._data[0, newlines] != ord('\n')):
+            raise TrajError('%s is not a mdcrd trajectory with 10 coordinates per line' % fname)
+        self._columns = np.delete(np.arange(frame_bytes), newlines)
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def __len__(self):
+        return len(self._data)
+
+    def _fields(self, indices):
+        """ Coordinates and box (if any) of the frames, one row per frame """
+        text = np.ascontiguousarray(self._data[list(indices)][:, self._columns])
+        try:
+            return text.view('S8').astype(np.float64)
+        except ValueError as e:
+            raise TrajError('Could not read the coordinates of %s: %s' % (self.fname, e))
+
+    def read(self, indices):
+        """
+        Coordinates (in Angstroms) of the frames with the given (0-based)
+        indices. They are kept in double precision, so the same values are
+        written back when the frames are copied to another mdcrd
+        """
+        fields = self._fields(indices)
+        return fields[:, :self.natoms * 3].reshape(-1, self.natoms, 3)
+
+    def read_box(self, indices):
+        """ Box lengths of the frames with the given (0-based) indices, or None """
+        if not self.hasbox:
+            return None
+        return self._fields(indices)[:, self.natoms * 3:]
+
+    def close(self):
+        self._data = None
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class XTCFile(object):
+    """
+    GROMACS XTC trajectory. XTC frames are compressed, so they are decoded by
+    mdtraj or MDAnalysis (whichever is installed)
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.backend = _xtc_backend()
+        if self.backend == 'mdtraj':
+            from mdtraj.formats import XTCTrajectoryFile
+            self._file = XTCTrajectoryFile(fname, 'r')
+        elif self.backend == 'MDAnalysis':
+            from MDAnalysis.lib.formats.libmdaxdr import XTCFile as _XTCFile
+            self._file = _XTCFile(fname)
+        else:
+            raise TrajError('Reading XTC files in-process requires mdtraj or MDAnalysis')
+        self._nframes = len(self._file)
+        self.natoms = self._read_frame(0).shape[0] if self._nframes else 0
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def _read_frame(self, index):
+        """ Coordinates (in nm) of one frame """
+        self._file.seek(index)
+        if self.backend == 'mdtraj':
+            return self._file.read(n_frames=1)[0][0]
+        return self._file.read().x
+
+    def __len__(self):
+        return self._nframes
+
+    def read(self, indices):
+        """ Coordinates (in Angstroms) of the frames with the given (0-based) indices """
+        coords = np.empty((len(indices), self.natoms, 3), dtype=np.float32)
+        indices = list(indices)
+        if self.backend == 'mdtraj' and indices and indices[-1] - indices[0] == len(indices) - 1:
+            # Consecutive frames are decoded in one call
+            self._file.seek(indices[0])
+            coords[:] = self._file.read(n_frames=len(indices))[0]
+        else:
+            for i, index in enumerate(indices):
+                coords[i] = self._read_frame(index)
+        coords *= 10.0
+        return coords
+
+    def close(self):
+        self._file.close()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class TrajectoryFiles(object):
+    """ Several trajectory files read as a single trajectory, in order """
+
+    READERS = {'.trr': TRRFile, '.xtc': XTCFile, '.nc': NetCDFFile, '.ncdf': NetCDFFile, '.netcdf': NetCDFFile}
+
+    def __init__(self, trajs):
+        self.files = []
+        for traj in trajs:
+            reader = self.READERS.get(os.path.splitext(traj)[1].lower())
+            if reader is None:
+                raise TrajError('%s can not be read in-process' % traj)
+            self.files.append(reader(traj))
+        natoms = set(f.natoms for f in self.files)
+        if len(natoms) > 1:
+            raise TrajError('The trajectories %s do not have the same number of atoms' % ', '.join(trajs))
+        self.natoms = natoms.pop()
+        self.starts = np.cumsum([0] + [len(f) for f in self.files])
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def read(self, indices):
+        """ Coordinates of the frames with the given (0-based) indices of the joined trajectory """
+        indices = np.asarray(indices)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise TrajError('Frame %d is out of range (%d frames)' % (indices.max() + 1, len(self)))
+        coords = np.empty((len(indices), self.natoms, 3), dtype=np.float32)
+        owner = np.searchsorted(self.starts, indices, side='right') - 1
+        for i, f in enumerate(self.files):
+            mine = np.nonzero(owner == i)[0]
+            if len(mine):
+                coords[mine] = f.read(indices[mine] - self.starts[i])
+        return coords
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class NetCDFWriter(object):
+    """
+    Writes an Amber NetCDF trajectory (NetCDF-3, 64-bit offset) without box.
+    The frames are appended to the file as they come, and the number of frames
+    in the header is set when the file is closed
+    """
+
+    def __init__(self, fname, natoms):
+        self.natoms = natoms
+        self.nframes = 0
+        self._file = open(fname, 'wb')
+        self._file.write(self._header())
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    @staticmethod
+    def _name(name):
+        name = name.encode()
+        return struct.pack('>i', len(name)) + name + b'\0' * (-len(name) % 4)
+
+    @classmethod
+    def _text_attribute(cls, name, value):
+        value = value.encode()
+        return cls._name(name) + struct.pack('>ii', 2, len(value)) + value + b'\0' * (-len(value) % 4)
+
+    def _header(self):
+        """ Header of the file. The data of the non-record variable (spatial) follows it """
+        NC_DIMENSION, NC_VARIABLE, NC_ATTRIBUTE = 10, 11, 12
+        NC_CHAR, NC_FLOAT = 2, 5
+        dims = struct.pack('>ii', NC_DIMENSION, 3)
+        dims += self._name('frame') + struct.pack('>i', 0)
+        dims += self._name('spatial') + struct.pack('>i', 3)
+        dims += self._name('atom') + struct.pack('>i', self.natoms)
+        attrs = struct.pack('>ii', NC_ATTRIBUTE, 5)
+        for name, value in (('title', 'gmx_MMPBSA'), ('application', 'AMBER'), ('program', 'gmx_MMPBSA'),
+                            ('Conventions', 'AMBER'), ('ConventionVersion', '1.0')):
+            attrs += self._text_attribute(name, value)
+
+        def variable(name, dimids, units, nc_type, vsize, begin):
+            var = self._name(name) + struct.pack('>i', len(dimids)) + struct.pack('>%di' % len(dimids), *dimids)
+            if units:
+                var += struct.pack('>ii', NC_ATTRIBUTE, 1) + self._text_attribute('units', units)
+            else:
+                var += struct.pack('>ii', 0, 0)
+            return var + struct.pack('>iiq', nc_type, vsize, begin)
+
+        # The variables are written twice: first to know the size of the
+        # header, and then with the offsets of their data
+        self.record_size = 4 + self.natoms * 12
+        header = b''
+        for _ in range(2):
+            begin = len(header)
+            variables = struct.pack('>ii', NC_VARIABLE, 3)
+            variables += variable('spatial', [1], '', NC_CHAR, 4, begin)
+            variables += variable('time', [0], 'picosecond', NC_FLOAT, 4, begin + 4)
+            variables += variable('coordinates', [0, 2, 1], 'angstrom', NC_FLOAT, self.natoms * 12, begin + 8)
+            header = b'CDF\x02' + struct.pack('>i', 0) + dims + attrs + variables
+        return header + b'xyz\0'
+
+    # -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+    def write(self, coords):
+        """ Appends a block of frames (nframes, natoms, 3) """
+        records = np.empty((len(coords), self.record_size // 4), dtype='>f4')
+        records[:, 0] = np.arange(self.nframes, self.nframes + len(coords), dtype=np.float32)
+        records[:, 1:] = coords.reshape(len(coords), -1)
+        self._file.write(records.tobytes())
+        self.nframes += len(coords)
+
+    def close(self):
+        self._file.seek(4)
+        self._file.write(struct.pack('>i', self.nframes))
+        self._file.close()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class MdcrdWriter(object):
+    """ Writes an Amber ASCII trajectory (mdcrd), with a box line if box is set """
+
+    def __init__(self, fname, natoms, title='gmx_MMPBSA trajectory', box=False):
+        self.natoms = natoms
+        self._file = open(fname, 'w')
+        self._file.write(title + '\n')
+        full, rest = divmod(natoms * 3, 10)
+        self._format = ('%8.3f' * 10 + '\n') * full + ('%8.3f' * rest + '\n' if rest else '')
+        if box:
+            self._format += '%8.3f' * 3 + '\n'
+
+    def write(self, coords, box=None):
+        """ Appends a block of frames (nframes, natoms, 3), and their box lengths (nframes, 3) """
+        coords = coords.reshape(len(coords), -1)
+        if box is not None:
+            coords = np.hstack((coords, box))
+        for frame in coords.tolist():
+            self._file.write(self._format % tuple(frame))
+
+    def close(self):
+        self._file.close()
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def _fit(coords, reference, weights):
+    """
+    Mass-weighted RMS fit of every frame to the reference, like cpptraj's rmsd
+    action: the fit atoms (weights > 0) are superposed on those of the
+    reference, and the whole frame is moved with them
+    """
+    fit = np.nonzero(weights)[0]
+    w = weights[fit] / weights[fit].sum()
+    ref = reference[fit].astype(np.float64)
+    ref_center = w @ ref
+    ref -= ref_center
+    mobile = coords[:, fit].astype(np.float64)
+    centers = np.einsum('a,fai->fi', w, mobile)
+    mobile -= centers[:, None]
+    # Optimal rotations (Kabsch) of all the frames at once
+    u, _, vt = np.linalg.svd(np.einsum('fai,a,aj->fij', mobile, w, ref))
+    d = np.sign(np.linalg.det(u @ vt))
+    u[:, :, 2] *= d[:, None]
+    rotations = u @ vt
+    return ((coords - centers[:, None]) @ rotations + ref_center).astype(np.float32)
+
+
+def write_slices(prmtop, trajs, frames, reference, fit_mask, outputs, counts, first_chunk, netcdf):
+    """
+    Writes the thread-specific (or chunk-specific) trajectories of the frames
+    (0-based indices of the joined trajs) of len(counts) chunks, numbered from
+    first_chunk, with counts[i] frames each. Every frame is fitted to the frame
+    reference on the atoms of fit_mask. outputs is a list of (file name with a
+    %d for the chunk number, mask of the atoms stripped from prmtop or None).
+    Returns the number of frames written to each file
+    """
+    from parmed.amber import LoadParm, AmberMask
+
+    parm = LoadParm(prmtop)
+    files = TrajectoryFiles(trajs)
+    try:
+        if files.natoms != parm.ptr('natom'):
+            raise TrajError('%s has %d atoms, but %s has %d' % (trajs[0], files.natoms, prmtop, parm.ptr('natom')))
+        weights = np.array(parm.parm_data['MASS']) * np.array(AmberMask(parm, fit_mask).Selection())
+        atoms = [None if mask is None else np.nonzero(np.logical_not(AmberMask(parm, mask).Selection()))[0]
+                 for _, mask in outputs]
+        ref = files.read([reference])[0]
+        Writer = NetCDFWriter if netcdf else MdcrdWriter
+        written = {}
+        start = 0
+        for chunk, count in enumerate(counts, first_chunk):
+            writers = [Writer(basename % chunk, files.natoms if keep is None else len(keep))
+                       for (basename, _), keep in zip(outputs, atoms)]
+            for block in range(start, start + count, BLOCK_FRAMES):
+                coords = _fit(files.read(frames[block:min(block + BLOCK_FRAMES, start + count)]), ref, weights)
+                for writer, keep in zip(writers, atoms):
+                    writer.write(coords if keep is None else coords[:, keep])
+            for writer, (basename, _) in zip(writers, outputs):
+                writer.close()
+                written[basename % chunk] = count
+            start += count
+    finally:
+        files.close()
+    return written
@@ -340,25 +340,41 @@ def remove(flag, mpi_size=0, fnpre='_GMXMMPBSA_'):
                     fnpre + 'mutant_receptor_gb_surf.dat',
                     fnpre + 'mutant_ligand_gb_surf.dat', fnpre + 'info']
 
-    # Collect all of the temporary files (those starting with _MMPBSA_)
-    allfiles = os.listdir(os.getcwd())
+    # Collect all of the temporary files (those starting with _MMPBSA_). The
+    # prefix may include a directory (e.g. the bundle of a -shard run)
+    directory = os.path.dirname(fnpre)
+    allfiles = os.listdir(directory or os.getcwd())
     tempfiles = []
     for fil in allfiles:
+        fil = os.path.join(directory, fil)
         if fil.startswith(fnpre): tempfiles.append(fil)
 
     if flag == -1:  # internal -- keep all mdin files
         for fil in tempfiles:
             if not fil in input_files: os.remove(fil)
+    elif flag == -2:  # internal -- resume; only remove the progress markers
+        for fil in tempfiles:
+            if fil.startswith((fnpre + 'task.', fnpre + 'calc.')): os.remove(fil)
+    elif flag == -3:  # internal -- shard bundle; keep only the outputs and the info file
+        keep_files = [fil for fil in keep_files_1 if fil.endswith(('.mdout', '.out', '.dat', 'info'))]
+        for fil in tempfiles:
+            base, ext = os.path.splitext(fil)
+            if fil in keep_files or (ext.strip('.').isdigit() and base in keep_files): continue
+            os.remove(fil)
     elif flag == 0:  # remove all temporary files
         for fil in tempfiles: os.remove(fil)
     elif flag == 1:  # keep keep mdcrds, mdouts, and other relevant output files
+        # The files of the other mutants of a scan (mutant2_, mutant3_...) are
+        # kept like the ones of the first mutant
+        scanre = re.compile('^%smutant\\d+_' % re.escape(fnpre))
         for fil in tempfiles:
-            if fil in keep_files_1: continue  # keep this file
+            name = scanre.sub(fnpre + 'mutant_', fil)
+            if name in keep_files_1: continue  # keep this file
             # Now we have to split out this file and analyze the base. If the
             # suffix is just a number (corresponding to a thread-specific output
             # file or trajectory), then we only want to remove it if in the base
             # name is not in keep_files_1
-            base, ext = os.path.splitext(fil)
+            base, ext = os.path.splitext(name)
             if ext.strip('.').isdigit() and base in keep_files_1: continue
             # if we've made it this far, remove the file
             os.remove(fil)
@@ -0,0 +1,208 @@
+"""
+Tests of the parsers of the sander, 3D-RISM and nmode output files
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+
+import pytest
+
+from GMXMMPBSA import amber_outputs
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'mdout')
+
+INPUT = {'verbose': 2, 'surften': 0.0072, 'surfoff': 0.0, 'sander_apbs': 0, 'temp': 298.15}
+
+# The gas phase terms of the first two frames of every sander and RISM sample
+GAS = {'BOND': [479.138, 482.5551], 'ANGLE': [1236.3622, 1227.993], 'DIHED': [1659.0431, 1651.1294],
+       'VDWAALS': [-796.587, -806.0941], 'EEL': [-11084.4004, -11131.8818],
+       '1-4 VDW': [562.1697, 560.3353], '1-4 EEL': [4410.911, 4397.0287]}
+NO_CHAMBER = {'UB': [0.0, 0.0], 'IMP': [0.0, 0.0], 'CMAP': [0.0, 0.0]}
+
+# Terms read by the parsers before the block grammar, for each sample:
+# (class, basename, number of files, chamber, INPUT changes, terms). The only
+# difference is the corrected 1-4 VDW of PolarRISMout (see below)
+CASES = {
+    'gb': (amber_outputs.GBout, '_GMXMMPBSA_complex_gb.mdout', 2, False, {}, {
+        'BOND': [479.138, 482.5551, 469.5015, 474.9068], 'ANGLE': [1236.3622, 1227.993, 1254.1212, 1241.5479],
+        'DIHED': [1659.0431, 1651.1294, 1647.6675, 1662.3708], 'UB': [0.0] * 4, 'IMP': [0.0] * 4,
+        'CMAP': [0.0] * 4, 'VDWAALS': [-796.587, -806.0941, -789.1282, -811.9834],
+        'EEL': [-11084.4004, -11131.8818, -11062.8105, -11097.0361],
+        '1-4 VDW': [562.1697, 560.3353, 563.6919, 559.1022], '1-4 EEL': [4410.911, 4397.0287, 4418.9541, 4404.0044],
+        'EGB': [-2103.6178, -2052.3741, -2134.0925, -2088.5067],
+        'ESURF': [63.080743, 62.999497, 63.201974, 63.040764]}),
+    'gb chamber': (amber_outputs.GBout, 'chamber_gb.mdout', 1, True, {}, dict(
+        GAS, UB=[31.2054, 30.8871], IMP=[64.1183, 66.0952], CMAP=[-151.6622, -149.983],
+        EGB=[-2103.6178, -2052.3741], ESURF=[63.080743, 62.999497])),
+    'qmmm': (amber_outputs.QMMMout, 'qmmm_gb.mdout', 1, False, {}, {
+        'BOND': [479.138, 482.5551, 469.5015], 'ANGLE': [1236.3622, 1227.993, 1254.1212],
+        'DIHED': [1659.0431, 1651.1294, 1647.6675], 'UB': [0.0] * 3, 'IMP': [0.0] * 3, 'CMAP': [0.0] * 3,
+        'VDWAALS': [-796.587, -806.0941, -789.1282], 'EEL': [-11084.4004, -11131.8818, -11062.8105],
+        '1-4 VDW': [562.1697, 560.3353, 563.6919], '1-4 EEL': [4410.911, 4397.0287, 4418.9541],
+        'EGB': [-2103.6178, -2052.3741, -2134.0925], 'ESURF': [63.080743, 62.999497, 63.147226],
+        # PM3ESCF=, DFTBESCF= and AM1ESCF =
+        'ESCF': [-49.2981, -1835.2205, -51.0677]}),
+    'pb': (amber_outputs.PBout, '_GMXMMPBSA_complex_pb.mdout', 1, False, {}, dict(
+        GAS, EPB=[-2352.9163, -2311.5532], ENPOLAR=[48.0781, 47.8811], EDISPER=[-52.345, -52.0049],
+        **NO_CHAMBER)),
+    'pb apbs': (amber_outputs.PBout, 'apbs_pb.mdout', 1, False, {'sander_apbs': 1}, dict(
+        GAS, EPB=[-2352.9163, -2311.5532], ENPOLAR=[48.0781, 47.8811], EDISPER=[0.0, 0.0], **NO_CHAMBER)),
+    'rism std': (amber_outputs.RISM_std_Out, '_GMXMMPBSA_complex_rism.mdout', 1, False, {}, dict(
+        GAS, ERISM=[3489.174, 3510.55888])),
+    'rism gf': (amber_outputs.RISM_gf_Out, '_GMXMMPBSA_complex_rism.mdout', 1, False, {}, dict(
+        GAS, ERISM=[3301.92113, 3320.40725])),
+    'polar rism std': (amber_outputs.PolarRISM_std_Out, 'polar_rism.mdout', 1, False, {}, dict(
+        GAS, **{'POLAR SOLV': [3701.8832, 3725.1103], 'APOLAR SOLV': [-212.7092, -214.55142]})),
+    'polar rism gf': (amber_outputs.PolarRISM_gf_Out, 'polar_rism.mdout', 1, False, {}, dict(
+        GAS, **{'POLAR SOLV': [3522.0071, 3543.8719], 'APOLAR SOLV': [-220.08597, -223.46465]})),
+    'nmode': (amber_outputs.NMODEout, '_GMXMMPBSA_complex_nm.out', 1, False, {}, {
+        'Translational': [12.94448, 12.94448], 'Rotational': [11.039898, 11.041985],
+        'Vibrational': [55.443378, 55.962457], 'Total': [79.427756, 79.948922]}),
+}
+
+# The parsers before the block grammar read the 1-4 VDW of PolarRISMout from
+# the Coulomb-14 column (word 8 instead of 7), so it was always equal to
+# 1-4 EEL. These are the values they gave for polar_rism.mdout
+POLAR_RISM_OLD_14_VDW = [4410.911, 4397.0287]
+
+
+@pytest.fixture(autouse=True)
+def data_dir(monkeypatch):
+    # The GB classes find the surface area files from the (relative) basename
+    monkeypatch.chdir(DATA)
+
+
+def _parse(case):
+    cls, basename, num_files, chamber, changes, _ = CASES[case]
+    return cls(basename, dict(INPUT, **changes), num_files, chamber)
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_parsed_terms(case):
+    output = _parse(case)
+    expected = CASES[case][-1]
+    assert sorted(expected) == sorted(output.data_keys)
+    for key, values in expected.items():
+        assert list(output.data[key]) == pytest.approx(values, abs=1e-6), key
+
+
+@pytest.mark.parametrize('case', ['polar rism std', 'polar rism gf'])
+def test_polar_rism_reads_14_vdw_column(case):
+    output = _parse(case)
+    # Same column as RISMout, and no longer a copy of 1-4 EEL
+    assert list(output.data['1-4 VDW']) == pytest.approx(list(_parse('rism std').data['1-4 VDW']))
+    assert list(output.data['1-4 VDW']) != pytest.approx(POLAR_RISM_OLD_14_VDW)
+    assert list(output.data['1-4 VDW']) == pytest.approx([562.1697, 560.3353])
+
+
+def test_files_joined_in_rank_order():
+    output = _parse('gb')
+    assert len(output.data['EGB']) == len(output.data['ESURF']) == 4
+    single = amber_outputs.GBout('_GMXMMPBSA_complex_gb.mdout', INPUT, 1)
+    assert list(single.data['EGB']) == list(output.data['EGB'][:2])
+
+
+@pytest.mark.parametrize('cut', [b' VDWAALS =     -796.5870  EEL  ', b' 1-4 VDW =      562.1697  1-4 EEL ='])
+def test_truncated_block(tmp_path, cut):
+    """ A block cut short (a crashed or half-written mdout) names the file and line """
+    with open(os.path.join(DATA, '_GMXMMPBSA_complex_gb.mdout.0'), 'rb') as f:
+        text = f.read()
+    basename = str(tmp_path / 'complex_gb.mdout')
+    with open(basename + '.0', 'wb') as f:
+        f.write(text[:text.index(cut) + len(cut)] + b'\n\n')
+    line = text[:text.index(cut)].count(b'\n') + 1
+    with pytest.raises(amber_outputs.OutputError, match=r'complex_gb\.mdout\.0, line %d' % line):
+        amber_outputs.GBout(basename, INPUT, 1)
+
+
+def test_composite_terms():
+    output = _parse('pb apbs')
+    output.fill_composite_terms()
+    gas = sum(GAS[key][0] for key in GAS)
+    assert output.data['G gas'][0] == pytest.approx(gas)
+    assert output.data['G solv'][0] == pytest.approx(-2352.9163 + 48.0781)
+    assert output.data['TOTAL'][0] == pytest.approx(gas - 2352.9163 + 48.0781)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def test_energy_table_grows():
+    table = amber_outputs.EnergyTable(['EGB', 'ESURF'], capacity=2)
+    vector = amber_outputs.EnergyVector()
+    for i in range(11):
+        table.append('EGB', -2000.0 - i)
+        vector = vector.append(-2000.0 - i)
+    # Doubled from 2 rows, without losing the rows already stored
+    assert table.buffer.shape == (16, 2)
+    assert len(table) == 11
+    assert isinstance(table.column('EGB'), amber_outputs.EnergyVector)
+    assert list(table.column('EGB')) == list(vector)
+
+
+def test_energy_table_columns_keep_their_counts():
+    table = amber_outputs.EnergyTable(['EGB', 'ESURF'], capacity=1)
+    table.extend('EGB', [-2103.6178, -2052.3741, -2134.0925])
+    table.extend('ESURF', [63.080743])
+    table.append('ESURF', 62.999497)
+    assert list(table.counts) == [3, 2]
+    # The number of frames is the one of the longest column
+    assert len(table) == 3
+    assert list(table.frames('EGB')) == [0, 1, 2]
+    assert list(table.frames('ESURF')) == [0, 1]
+    vectors = table.vectors()
+    assert sorted(vectors) == ['EGB', 'ESURF']
+    assert list(vectors['EGB']) == [-2103.6178, -2052.3741, -2134.0925]
+    assert list(vectors['ESURF']) == [63.080743, 62.999497]
+
+
+def test_energy_table_extend_after_append():
+    table = amber_outputs.EnergyTable(['EGB'], capacity=4)
+    table.append('EGB', 1.0)
+    table.extend('EGB', [[2.0, 3.0], [4.0, 5.0]])
+    table.extend('EGB', [])
+    assert list(table.column('EGB')) == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert table.buffer.shape[0] == 8
+
+
+def test_energy_table_columns_are_copies():
+    table = amber_outputs.EnergyTable(['EGB'])
+    table.extend('EGB', [1.0, 2.0])
+    column = table.column('EGB')
+    column[0] = 10.0
+    table.append('EGB', 3.0)
+    assert list(table.column('EGB')) == [1.0, 2.0, 3.0]
+    assert list(column) == [10.0, 2.0]
+
+
+def test_energy_table_empty():
+    table = amber_outputs.EnergyTable(['EGB'], capacity=0)
+    assert len(table) == 0
+    assert list(table.column('EGB')) == []
+    assert len(amber_outputs.EnergyTable([])) == 0
+
+
+@pytest.mark.parametrize('case', ['gb', 'qmmm', 'polar rism std', 'nmode'])
+def test_parsing_with_growing_tables(case, monkeypatch):
+    """ The sample outputs give the same terms when every table starts with one row """
+    table = amber_outputs.EnergyTable
+    monkeypatch.setattr(amber_outputs, 'EnergyTable', lambda keys: table(keys, capacity=1))
+    output = _parse(case)
+    for key, values in CASES[case][-1].items():
+        assert list(output.data[key]) == pytest.approx(values, abs=1e-6), key
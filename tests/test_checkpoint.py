@@ -0,0 +1,132 @@
+"""
+Tests of the manifest that decides which calculations -resume skips
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import pytest
+
+from GMXMMPBSA.calculation import EnergyCalculation, NmodeCalc
+from GMXMMPBSA.checkpoint import Manifest, input_hash
+
+RANK = 1
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+@pytest.fixture
+def energy(tmp_path):
+    """ A finished GB calculation of chunk RANK, recorded in the manifest """
+    _write(tmp_path / 'complex.prmtop', '%VERSION  VERSION_STAMP = V0001.000  DATE = 01/01/21\nATOMS 10\n')
+    _write(tmp_path / 'complex.inpcrd', 'coordinates 0\n')
+    _write(tmp_path / 'gb.mdin', '&cntrl igb=5, saltcon=0.150 /\n')
+    for chunk in range(2):
+        _write(tmp_path / ('complex.mdcrd.%d' % chunk), 'frames of chunk %d\n' % chunk)
+    calc = EnergyCalculation('/opt/amber/bin/sander', tmp_path / 'complex.prmtop', str(tmp_path / 'complex.inpcrd'),
+                             str(tmp_path / 'complex.mdcrd.%d'), str(tmp_path / 'gb.mdin'),
+                             str(tmp_path / 'complex_gb.mdout.%d'), str(tmp_path / 'restrt'))
+    _write(tmp_path / ('complex_gb.mdout.%d' % RANK), 'BOND = 1.0 ANGLE = 2.0\n' * 50)
+    Manifest(str(tmp_path / '_'), RANK).record(calc, RANK)
+    return calc
+
+
+def _is_done(tmp_path, calc):
+    """ Whether a new run (with a new Manifest) would skip calc """
+    return Manifest(str(tmp_path / '_'), 0).is_done(calc, RANK)
+
+
+def test_unchanged_is_done(tmp_path, energy):
+    assert _is_done(tmp_path, energy)
+
+
+@pytest.mark.parametrize('fname, text', [
+    ('gb.mdin', '&cntrl igb=5, saltcon=0.100 /\n'),
+    ('complex.prmtop', '%VERSION  VERSION_STAMP = V0001.000  DATE = 01/01/21\nATOMS 11\n'),
+    ('complex.inpcrd', 'coordinates 1\n'),
+    ('complex.mdcrd.%d' % RANK, 'frames of chunk 9\n'),
+])
+def test_changed_input_file(tmp_path, energy, fname, text):
+    """ The new contents have the same size, so only the contents tell them apart """
+    assert len(text) == len(open(tmp_path / fname).read())
+    _write(tmp_path / fname, text)
+    assert not _is_done(tmp_path, energy)
+
+
+def test_other_chunk_trajectory_ignored(tmp_path, energy):
+    _write(tmp_path / 'complex.mdcrd.0', 'frames of chunk 7\n')
+    assert _is_done(tmp_path, energy)
+
+
+def test_topology_version_stamp_ignored(tmp_path, energy):
+    _write(tmp_path / 'complex.prmtop', '%VERSION  VERSION_STAMP = V0001.000  DATE = 12/31/22\nATOMS 10\n')
+    assert _is_done(tmp_path, energy)
+
+
+def test_changed_trajectory_name(tmp_path, energy):
+    _write(tmp_path / ('other.mdcrd.%d' % RANK), 'other frames\n')
+    energy.inptraj = str(tmp_path / 'other.mdcrd.%d')
+    assert not _is_done(tmp_path, energy)
+
+
+def test_changed_option(tmp_path):
+    INPUT = {'nmode_istrng': 0.1, 'nmode_igb': 1, 'dielc': 1.0, 'temp': 298.15, 'drms': 0.001, 'maxcyc': 10000}
+    calc = NmodeCalc('mmpbsa_py_nabnmode', 'com.prmtop', 'com.inpcrd', 'com.nc.%d', 'nmode.out.%d', INPUT)
+    reference = input_hash(calc, RANK)
+    for key, value in (('temp', 310.0), ('drms', 0.01), ('maxcyc', 5000), ('nmode_istrng', 0.0)):
+        changed = NmodeCalc('mmpbsa_py_nabnmode', 'com.prmtop', 'com.inpcrd', 'com.nc.%d', 'nmode.out.%d',
+                            dict(INPUT, **{key: value}))
+        assert input_hash(changed, RANK) != reference, key
+    # Options given as a list are inputs too
+    calc.extra = [1, 2]
+    listed = input_hash(calc, RANK)
+    calc.extra = [1, 3]
+    assert input_hash(calc, RANK) != listed
+
+
+def test_program_path_ignored(tmp_path, energy):
+    energy.program = '/usr/local/amber22/bin/sander'
+    assert _is_done(tmp_path, energy)
+    energy.program = 'pmemd'
+    assert not _is_done(tmp_path, energy)
+
+
+def test_truncated_output(tmp_path, energy):
+    output = tmp_path / ('complex_gb.mdout.%d' % RANK)
+    text = open(output).read()
+    _write(output, text[:len(text) // 2])
+    assert not _is_done(tmp_path, energy)
+
+
+def test_modified_output(tmp_path, energy):
+    output = tmp_path / ('complex_gb.mdout.%d' % RANK)
+    _write(output, open(output).read().replace('1.0', '9.0'))
+    assert not _is_done(tmp_path, energy)
+
+
+def test_missing_output(tmp_path, energy):
+    (tmp_path / ('complex_gb.mdout.%d' % RANK)).unlink()
+    assert not _is_done(tmp_path, energy)
+
+
+def test_half_written_manifest(tmp_path, energy):
+    _write(tmp_path / ('_manifest.%d.json' % RANK), '{"truncated": ')
+    assert not _is_done(tmp_path, energy)
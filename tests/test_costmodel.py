@@ -0,0 +1,106 @@
+"""
+Tests of the cost model used to dispatch the longest calculations first
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import json
+
+import pytest
+
+from GMXMMPBSA import costmodel
+from GMXMMPBSA.costmodel import CostModel
+
+
+def test_defaults_without_history():
+    model = CostModel()
+    assert model.predict(None, 1000, 10) == 0.0
+    # GB scales with the square of the number of atoms and PB linearly
+    assert model.predict('gb:sander', 2000, 1) == pytest.approx(4 * model.predict('gb:sander', 1000, 1))
+    assert model.predict('pb:sander', 2000, 1) == pytest.approx(2 * model.predict('pb:sander', 1000, 1))
+    assert model.predict('gb:sander', 1000, 10) == pytest.approx(10 * model.predict('gb:sander', 1000, 1))
+
+
+def test_fit_to_history(tmp_path):
+    timings = tmp_path / 'timings.json'
+    # 20 s for 10 frames of 1000 atoms and 80 s for 10 frames of 2000 atoms
+    timings.write_text(json.dumps({'gb:sander': [[1000, 10, 20.0], [2000, 10, 80.0]]}))
+    model = CostModel(str(timings))
+    assert model.predict('gb:sander', 1000, 5) == pytest.approx(10.0)
+    assert model.predict('gb:sander', 3000, 1) == pytest.approx(18.0)
+    # Other kinds keep their defaults
+    assert model.predict('pb:sander', 1000, 1) == pytest.approx(CostModel().predict('pb:sander', 1000, 1))
+
+
+def test_save_and_load(tmp_path):
+    timings = str(tmp_path / 'sub' / 'timings.json')
+    model = CostModel(timings)
+    model.observe('gb:sander', 'gb', 1000, 20.0)
+    model.observe(None, None, 1000, 1.0)
+    assert model.observations == [('gb:sander', 'gb', 1000, 20.0)]
+    assert model.history == {}
+
+    # Another run updates the file in the meantime
+    other = CostModel(timings)
+    other.save([('pb:sander', 500, 4, 2.0)])
+    # Timings without atoms or frames are left out
+    model.save([('gb:sander', 1000, 10, 20.0), ('gb:sander', 0, 10, 1.0), ('gb:sander', 1000, 0, 1.0)])
+
+    expected = {'pb:sander': [[500, 4, 2.0]], 'gb:sander': [[1000, 10, 20.0]]}
+    assert model.history == expected
+    reloaded = CostModel(timings)
+    assert reloaded.history == expected
+    assert reloaded.predict('gb:sander', 1000, 10) == pytest.approx(20.0)
+    assert not list((tmp_path / 'sub').glob('*.tmp'))
+
+
+def test_history_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(costmodel, '_HISTORY_SIZE', 3)
+    timings = str(tmp_path / 'timings.json')
+    model = CostModel(timings)
+    model.save([('gb:sander', 1000, 1, float(i)) for i in range(5)])
+    assert [t[2] for t in CostModel(timings).history['gb:sander']] == [2.0, 3.0, 4.0]
+
+
+def test_unusable_history(tmp_path):
+    timings = tmp_path / 'timings.json'
+    timings.write_text('not json')
+    assert CostModel(str(timings)).history == {}
+    timings.write_text('[1, 2]')
+    assert CostModel(str(timings)).history == {}
+
+    # A history file that cannot be written is not an error
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    model = CostModel(str(blocker / 'timings.json'))
+    model.save([('gb:sander', 1000, 10, 20.0)])
+    assert model.history == {}
+
+    # Without a history file nothing is saved
+    model = CostModel()
+    model.save([('gb:sander', 1000, 10, 20.0)])
+    assert model.history == {}
+
+
+def test_natoms(tmp_path):
+    prmtop = tmp_path / 'complex.prmtop'
+    prmtop.write_text('%VERSION  VERSION_STAMP = V0001.000\n%FLAG TITLE\n%FORMAT(20a4)\n\n'
+                      '%FLAG POINTERS\n%FORMAT(10I8)\n    2254      16    2225\n')
+    assert costmodel.natoms(str(prmtop)) == 2254
+    assert costmodel.natoms(str(tmp_path / 'missing.prmtop')) == 0
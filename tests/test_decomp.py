@@ -0,0 +1,160 @@
+"""
+Tests of the parsers of the per-residue and pairwise decomposition outputs
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from GMXMMPBSA.amber_outputs import DecompOut, PairDecompOut
+from GMXMMPBSA.exceptions import OutputError
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'decomp')
+SURFTEN = 0.0072
+
+# The samples are sander outputs of residues 1, 998, 999, 1000 and 1234 (1,
+# 999, 1000 and 1234 for the pairs), with some energies that fill their
+# column (-9999.999 per residue, -9999999.999 per pair):
+#   res_tdc_sdc_bdc  idecomp=1, TDC/SDC/BDC blocks, 2 files of 2 frames
+#   res_tdc          idecomp=2, TDC blocks only, 1 file of 3 frames
+#   pair_tdc_sdc_bdc idecomp=3, TDC/SDC/BDC blocks, 1 file of 2 frames
+#   pair_tdc         idecomp=4, TDC blocks only, 2 files of 2 and 1 frames
+# (class, basename, number of files, dec_verbose, frames asked to get_data)
+CASES = [
+    (DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 1, 4),
+    (DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 3, 3),
+    # Only TDC is read, and the SDC/BDC blocks are skipped
+    (DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 2, 4),
+    (DecompOut, 'res_tdc.mdout', 1, 0, 3),
+    (PairDecompOut, 'pair_tdc_sdc_bdc.mdout', 1, 3, 2),
+    (PairDecompOut, 'pair_tdc_sdc_bdc.mdout', 1, 0, 2),
+    (PairDecompOut, 'pair_tdc.mdout', 2, 2, 3),
+    (PairDecompOut, 'pair_tdc.mdout', 2, 2, 1),
+]
+
+
+@pytest.fixture(scope='module')
+def expected():
+    """ get_data of the parser before the columns were sliced in bulk, keyed by
+        "basename dec_verbose frames"
+    """
+    with open(os.path.join(DATA, 'get_data.json')) as f:
+        return json.load(f)
+
+
+def _decomp(cls, basename, num_files, verbose):
+    return cls(os.path.join(DATA, basename), None, SURFTEN, None, num_files, verbose)
+
+
+def _plain(data):
+    """ get_data with str keys and lists, like the expected values """
+    if isinstance(data, dict):
+        return {str(key): _plain(value) for key, value in data.items()}
+    return [float(value) for value in data]
+
+
+def _compare(data, expected):
+    assert sorted(data) == sorted(expected)
+    for key in expected:
+        if isinstance(expected[key], dict):
+            _compare(data[key], expected[key])
+        else:
+            assert data[key] == pytest.approx(expected[key], abs=1e-6)
+
+
+@pytest.mark.parametrize('cls,basename,num_files,verbose,nframes', CASES)
+def test_get_data(cls, basename, num_files, verbose, nframes, expected):
+    decomp = _decomp(cls, basename, num_files, verbose)
+    _compare(_plain(decomp.get_data(nframes)), expected['%s %d %d' % (basename, verbose, nframes)])
+
+
+@pytest.mark.parametrize('cls,basename,num_files,numframes,resnums', [
+    (DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 4, [[1, 998, 999, 1000, 1234]]),
+    (DecompOut, 'res_tdc.mdout', 1, 3, [[1, 998, 999, 1000, 1234]]),
+    (PairDecompOut, 'pair_tdc_sdc_bdc.mdout', 1, 2, [[1] * 4 + [999] * 4 + [1000] * 4 + [1234] * 4,
+                                                      [1, 999, 1000, 1234] * 4]),
+    (PairDecompOut, 'pair_tdc.mdout', 2, 3, [[1] * 4 + [999] * 4 + [1000] * 4 + [1234] * 4,
+                                             [1, 999, 1000, 1234] * 4]),
+])
+def test_residues_and_frames(cls, basename, num_files, numframes, resnums):
+    decomp = _decomp(cls, basename, num_files, 0)
+    assert decomp.numframes == numframes
+    assert decomp.num_terms == len(resnums[0])
+    assert decomp.resnums[:len(resnums)] == resnums
+
+
+def test_columns_filled_to_the_edge():
+    decomp = _decomp(DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 1)
+    tdc = decomp.get_data(4)['TDC']
+    assert tdc[1000]['eel'][0] == -9999.999
+    assert decomp.get_data(4)['BDC'][999]['vdw'][1] == 9999.999
+    pair = _decomp(PairDecompOut, 'pair_tdc_sdc_bdc.mdout', 1, 1).get_data(2)
+    assert pair['TDC'][1000][999]['vdw'][0] == -9999999.999
+    assert pair['SDC'][1234][1]['eel'][1] == 1234567.891
+
+
+def test_sums(expected):
+    decomp = _decomp(DecompOut, 'res_tdc_sdc_bdc.mdout', 2, 1)
+    for token, residues in expected['res_tdc_sdc_bdc.mdout 1 4'].items():
+        for term in DecompOut.terms:
+            values = np.array([residues[str(res)][term] for res in decomp.resnums[0]])
+            assert list(decomp.data[token][term][0]) == pytest.approx(values.sum(axis=1), abs=1e-5)
+            assert list(decomp.data[token][term][1]) == pytest.approx((values ** 2).sum(axis=1), rel=1e-9, abs=1e-3)
+
+
+def test_next_term_follows_the_files():
+    decomp = _decomp(PairDecompOut, 'pair_tdc.mdout', 2, 0)
+    rows = [decomp.get_next_term('TDC') for _ in range(3 * 16)]
+    assert decomp.get_next_term('TDC') == []
+    # The last frame is the one of the second file
+    assert rows[32][:2] == [1, 1]
+    with open(os.path.join(DATA, 'pair_tdc.mdout.1')) as f:
+        first = next(line for line in f if line.startswith('TDC')).split()
+    assert rows[32][2:6] == [float(word) for word in first[3:7]]
+    assert rows[32][6] == pytest.approx(float(first[7]) * SURFTEN)
+    assert rows[32][7] == pytest.approx(sum(rows[32][2:7]))
+
+
+@pytest.mark.parametrize('cls,basename', [(DecompOut, 'res_tdc.mdout'), (PairDecompOut, 'pair_tdc.mdout')])
+def test_wrong_dec_verbose(cls, basename):
+    """ The files only have TDC blocks, but dec_verbose=1 asks for SDC and BDC too """
+    with pytest.raises(OutputError, match='Expecting SDC type, but got TDC type'):
+        _decomp(cls, basename, 1, 1).get_data(1)
+
+
+@pytest.mark.parametrize('cls,basename', [(DecompOut, 'res_tdc.mdout'), (PairDecompOut, 'pair_tdc.mdout')])
+def test_short_row(tmp_path, cls, basename):
+    """ A row cut short (a crashed calculation) names the file and line """
+    with open(os.path.join(DATA, basename + '.0')) as f:
+        lines = f.read().split('\n')
+    row = [i for i, line in enumerate(lines) if line.startswith('TDC')][5]
+    lines[row] = lines[row][:-4]
+    with open(str(tmp_path / (basename + '.0')), 'w') as f:
+        f.write('\n'.join(lines))
+    with pytest.raises(OutputError, match=r'%s\.0, line %d: decomp row' % (basename, row + 1)):
+        cls(str(tmp_path / basename), None, SURFTEN, None, 1, 0)
+
+
+def test_not_a_decomp_output():
+    with pytest.raises(OutputError):
+        DecompOut(os.path.join(DATA, os.pardir, 'mdout', '_GMXMMPBSA_complex_gb.mdout'), None, SURFTEN, None)
@@ -0,0 +1,264 @@
+"""
+Tests of the cache of calculation outputs shared between runs
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+
+import pytest
+
+from GMXMMPBSA.calculation import EnergyCalculation
+from GMXMMPBSA.energy_cache import EnergyCache, TrajectoryCache
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _size(directory):
+    """ Total size of the finished entries of a cache directory """
+    return sum(os.path.getsize(os.path.join(dirpath, fname))
+               for dirpath, _, fnames in os.walk(directory) if not dirpath.endswith('.tmp')
+               for fname in fnames if not fname.endswith('.tmp'))
+
+
+@pytest.fixture
+def run(tmp_path):
+    """ Inputs of a GB calculation in the directory of a run """
+    rundir = tmp_path / 'run'
+    rundir.mkdir()
+    _write(rundir / 'complex.prmtop', 'ATOMS 10\n')
+    _write(rundir / 'complex.inpcrd', 'coordinates\n')
+    _write(rundir / 'gb.mdin', '&cntrl igb=5 /\n')
+    for chunk in range(2):
+        _write(rundir / ('complex.mdcrd.%d' % chunk), 'frames of chunk %d\n' % chunk)
+    return rundir
+
+
+def _calc(rundir, output='complex_gb.mdout.%d'):
+    return EnergyCalculation('sander', rundir / 'complex.prmtop', str(rundir / 'complex.inpcrd'),
+                             str(rundir / 'complex.mdcrd.%d'), str(rundir / 'gb.mdin'), str(rundir / output), None)
+
+
+def _finish(calc, rank, text):
+    _write(calc.output % rank, text)
+
+
+def test_hit_copies_output(tmp_path, run):
+    cache = EnergyCache(tmp_path / 'cache')
+    calc = _calc(run)
+    _finish(calc, 0, 'energies of chunk 0\n')
+    cache.put(calc, 0)
+    # Another run with another output name and the same inputs
+    other = _calc(run, 'other_gb.mdout.%d')
+    assert cache.get(other, 0)
+    assert open(run / 'other_gb.mdout.0').read() == 'energies of chunk 0\n'
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+@pytest.mark.parametrize('fname, text', [
+    ('gb.mdin', '&cntrl igb=2 /\n'),
+    ('complex.prmtop', 'ATOMS 12\n'),
+    ('complex.inpcrd', 'coordinatez\n'),
+    ('complex.mdcrd.0', 'frames of chunk 5\n'),
+])
+def test_changed_input_misses(tmp_path, run, fname, text):
+    cache = EnergyCache(tmp_path / 'cache')
+    calc = _calc(run)
+    _finish(calc, 0, 'energies\n')
+    cache.put(calc, 0)
+    _write(run / fname, text)
+    assert not cache.get(calc, 0)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_changed_option_misses(tmp_path, run):
+    cache = EnergyCache(tmp_path / 'cache')
+    calc = _calc(run)
+    _finish(calc, 0, 'energies\n')
+    cache.put(calc, 0)
+    calc.program = 'pmemd'
+    assert not cache.get(calc, 0)
+
+
+def test_other_chunk_misses(tmp_path, run):
+    cache = EnergyCache(tmp_path / 'cache')
+    calc = _calc(run)
+    _finish(calc, 0, 'energies\n')
+    cache.put(calc, 0)
+    assert not cache.get(calc, 1)
+    assert not os.path.exists(run / 'complex_gb.mdout.1')
+
+
+def test_evict_least_recently_used(tmp_path, run):
+    cache = EnergyCache(tmp_path / 'cache')
+    calcs = []
+    for i in range(3):
+        _write(run / 'gb.mdin', '&cntrl igb=%d /\n' % i)
+        calc = _calc(run, 'gb%d.mdout.%%d' % i)
+        _finish(calc, 0, str(i) * 100)
+        cache.put(calc, 0)
+        entry = cache._entry(calc, 0)
+        os.utime(entry, (1000 + i, 1000 + i))
+        calcs.append((calc, entry))
+    # An entry that another run is still writing, older and larger than the
+    # others, must survive
+    partial = os.path.join(os.path.dirname(calcs[0][1]), 'ab' * 20 + '.123.456.tmp')
+    _write(partial, 'x' * 1000)
+    os.utime(partial, (1, 1))
+    # Using the first entry makes it the most recent one
+    _write(run / 'gb.mdin', '&cntrl igb=0 /\n')
+    assert cache.get(calcs[0][0], 0)
+    cache.max_size = 250
+    cache.evict()
+    assert os.path.exists(calcs[0][1])
+    assert not os.path.exists(calcs[1][1])
+    assert os.path.exists(calcs[2][1])
+    assert os.path.exists(partial)
+    assert _size(cache.directory) <= cache.max_size
+
+
+def test_put_keeps_cache_under_max_size(tmp_path, run):
+    cache = EnergyCache(tmp_path / 'cache', max_size=250)
+    for i in range(5):
+        _write(run / 'gb.mdin', '&cntrl igb=%d /\n' % i)
+        calc = _calc(run)
+        _finish(calc, 0, str(i) * 100)
+        cache.put(calc, 0)
+        assert _size(cache.directory) <= cache.max_size
+    # The last one is always kept
+    assert cache.get(calc, 0)
+
+
+def test_put_walks_cache_only_when_full(tmp_path, run, monkeypatch):
+    cache = EnergyCache(tmp_path / 'cache', max_size=250)
+    walks = []
+    walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda top: walks.append(top) or walk(top))
+    for i in range(3):
+        _write(run / 'gb.mdin', '&cntrl igb=%d /\n' % i)
+        calc = _calc(run)
+        _finish(calc, 0, str(i) * 100)
+        cache.put(calc, 0)
+    # Once to count the entries of earlier runs, and once when the third
+    # entry goes over max_size
+    assert len(walks) == 2
+    assert _size(cache.directory) <= cache.max_size
+
+
+def test_put_failure_is_not_an_error(tmp_path, run, monkeypatch):
+    cache = EnergyCache(tmp_path / 'cache')
+    calc = _calc(run)
+    _finish(calc, 0, 'energies\n')
+
+    def full(source, target):
+        _write(target, 'energ')
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr('shutil.copyfile', full)
+    cache.put(calc, 0)
+    monkeypatch.undo()
+    assert not cache.get(calc, 0)
+    assert _size(cache.directory) == 0
+    assert not [fname for _, _, fnames in os.walk(cache.directory) for fname in fnames]
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """ Files the trajectories are made from """
+    _write(tmp_path / 'com.tpr', 'topology\n')
+    _write(tmp_path / 'com.xtc', 'frames\n')
+    return [str(tmp_path / 'com.tpr'), str(tmp_path / 'com.xtc'), None]
+
+
+def test_trajectory_key(tmp_path, inputs):
+    cache = TrajectoryCache(tmp_path / 'cache')
+    options = {'startframe': 1, 'endframe': 100, 'interval': 1}
+    key = cache.key('normal', inputs, options)
+    assert cache.key('normal', inputs, dict(reversed(list(options.items())))) == key
+    # Only the contents count, not the names
+    _write(tmp_path / 'copy.xtc', 'frames\n')
+    assert cache.key('normal', [inputs[0], str(tmp_path / 'copy.xtc'), None], options) == key
+    assert cache.key('mutant', inputs, options) != key
+    assert cache.key('normal', inputs, dict(options, interval=2)) != key
+    assert cache.key('normal', inputs[:2] + [inputs[1]], options) != key
+    _write(tmp_path / 'com.xtc', 'frameZ\n')
+    assert cache.key('normal', inputs, options) != key
+    # The hashes are kept for the next runs
+    assert os.path.isfile(os.path.join(cache.directory, 'hashes.json'))
+    _write(tmp_path / 'com.xtc', 'frames\n')
+    assert TrajectoryCache(tmp_path / 'cache').key('normal', inputs, options) == key
+
+
+def test_trajectory_round_trip(tmp_path, inputs):
+    cache = TrajectoryCache(tmp_path / 'cache')
+    key = cache.key('normal', inputs, {})
+    fnames = []
+    for i, name in enumerate(('complex.mdcrd.0', 'complex.pdb')):
+        fname = str(tmp_path / ('_old_' + name))
+        _write(fname, 'contents of %s\n' % name)
+        os.utime(fname, ns=(10 ** 18 + i, 10 ** 18 + i))
+        fnames.append(fname)
+    cache.put(key, fnames, {'numframes': 100}, prefix=str(tmp_path / '_old_'))
+    state = cache.get(key, prefix=str(tmp_path / '_new_'))
+    assert state['numframes'] == 100
+    assert state['files'] == ['complex.mdcrd.0', 'complex.pdb']
+    for i, name in enumerate(state['files']):
+        restored = str(tmp_path / ('_new_' + name))
+        assert open(restored).read() == 'contents of %s\n' % name
+        # So the cached frame counts and hashes stay valid
+        assert os.stat(restored).st_mtime_ns == 10 ** 18 + i
+    assert cache.get(cache.key('other', inputs, {})) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_trajectory_partly_evicted(tmp_path, inputs):
+    cache = TrajectoryCache(tmp_path / 'cache')
+    key = cache.key('normal', inputs, {})
+    _write(tmp_path / '_complex.mdcrd.0', 'x' * 100)
+    _write(tmp_path / '_complex.mdcrd.1', 'y' * 100)
+    cache.put(key, [str(tmp_path / '_complex.mdcrd.0'), str(tmp_path / '_complex.mdcrd.1')], {},
+              prefix=str(tmp_path / '_'))
+    os.remove(os.path.join(cache._traj_entry(key), 'complex.mdcrd.1'))
+    assert cache.get(key, prefix=str(tmp_path / '_new_')) is None
+
+
+def test_trajectory_evict_keeps_entries_being_written(tmp_path, inputs):
+    cache = TrajectoryCache(tmp_path / 'cache')
+    old = cache.key('old', inputs, {})
+    new = cache.key('new', inputs, {})
+    _write(tmp_path / '_traj', 'x' * 200)
+    cache.put(old, [str(tmp_path / '_traj')], {}, prefix=str(tmp_path / '_'))
+    for dirpath, _, fnames in os.walk(cache._traj_entry(old)):
+        for fname in fnames:
+            os.utime(os.path.join(dirpath, fname), (1000, 1000))
+    # Another run is writing this entry
+    writing = cache._traj_entry(new) + '.123.456.tmp'
+    os.makedirs(writing)
+    _write(os.path.join(writing, 'traj'), 'y' * 1000)
+    os.utime(os.path.join(writing, 'traj'), (1, 1))
+    cache.max_size = 100
+    cache.evict()
+    assert cache.get(old) is None
+    assert os.path.getsize(os.path.join(writing, 'traj')) == 1000
+    assert _size(cache.directory) <= cache.max_size
@@ -0,0 +1,99 @@
+"""
+Tests of the live statistics of the GB and PB output files being written
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import io
+
+import numpy as np
+import pytest
+
+from GMXMMPBSA.amber_outputs import GBout, PBout
+from GMXMMPBSA.monitor import MdoutFollower, LiveStats
+
+
+def _block(vdw, eel, egb):
+    """ An energy block of a GB mdout file """
+    return (' BOND    =        0.0000  ANGLE   =        0.0000  DIHED      =        0.0000\n'
+            ' VDWAALS = %13.4f  EEL     = %13.4f  EGB        = %13.4f\n'
+            ' 1-4 VDW =        0.0000  1-4 EEL =        0.0000  RESTRAINT  =      100.0000\n'
+            '\n' % (vdw, eel, egb))
+
+
+def _append(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_follower_reads_complete_blocks(tmp_path):
+    path = tmp_path / 'complex_gb.mdout.0'
+    follower = MdoutFollower(str(path), ['VDWAALS', 'EEL', 'EGB'])
+    assert follower.update() == 0
+    _append(path, 'header\n' + _block(-1, -2, -3))
+    # The end of a block is only known from the line after it
+    partial = _block(-10, -20, -30)
+    _append(path, partial[:len(partial) // 2])
+    assert follower.update() == 1
+    assert follower.totals == [-6.0]
+    _append(path, partial[len(partial) // 2:])
+    assert follower.update() == 1
+    assert follower.totals == [-6.0, -60.0]
+    # The program started again
+    path.write_text(_block(1, 2, 3))
+    assert follower.update() == 1
+    assert follower.totals == [6.0]
+
+
+def test_follower_ignores_files_of_earlier_runs(tmp_path):
+    path = tmp_path / 'complex_gb.mdout.0'
+    path.write_text(_block(-1, -2, -3))
+    assert MdoutFollower(str(path), ['EEL'], since=path.stat().st_mtime + 10).update() == 0
+
+
+@pytest.mark.parametrize('outclass,label', [(GBout, 'DELTA G (no ESURF)'), (PBout, 'DELTA G')])
+def test_live_stats(tmp_path, outclass, label):
+    """ The running delta G only counts the frames every system has """
+    basename = str(tmp_path / '_GMXMMPBSA_%s_gb.mdout')
+    stdout = io.StringIO()
+    stats = LiveStats([('GB', basename, outclass.data_keys)], 2, numframes=3, stdout=stdout)
+    frames = {'complex': [(-10, -20, -30), (-12, -22, -32), (-11, -21, -31)],
+              'receptor': [(-1, -2, -3), (-2, -2, -2), (-1, -1, -1)],
+              'ligand': [(-4, -5, -6), (-5, -5, -5), (-4, -4, -4)]}
+    for system, energies in frames.items():
+        _append(basename % system + '.0', ''.join(_block(*e) for e in energies[:2]))
+    # The ligand of the second file is not done yet
+    _append(basename % 'complex' + '.1', _block(*frames['complex'][2]))
+    _append(basename % 'receptor' + '.1', _block(*frames['receptor'][2]))
+    assert stats.update() == 8
+    # Only the terms of the model are added (EGB is not a PB term)
+    terms = [key in outclass.data_keys for key in ('VDWAALS', 'EEL', 'EGB')]
+    totals = {system: [np.dot(terms, e) for e in energies] for system, energies in frames.items()}
+    dgs = [totals['complex'][i] - totals['receptor'][i] - totals['ligand'][i] for i in range(2)]
+    assert len(stats.models[0]['stats']) == 2
+    assert stats.models[0]['stats'].avg() == pytest.approx(np.mean(dgs))
+    stats.write()
+    line = stdout.getvalue().splitlines()[1]
+    assert ' 8/9 frames' in line
+    assert '%s = %10.4f +/- %.4f' % (label, np.mean(dgs), np.std(dgs) / np.sqrt(2)) in line
+    _append(basename % 'ligand' + '.1', _block(*frames['ligand'][2]))
+    assert stats.update() == 1
+    assert len(stats.models[0]['stats']) == 3
+    stats.write()
+    assert stdout.getvalue().splitlines()[-1].endswith('done')
@@ -0,0 +1,143 @@
+"""
+Tests of the task graph that overlaps the stages of a calculation
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from GMXMMPBSA.exceptions import CalcError, InternalError
+from GMXMMPBSA.pipeline import TaskGraph
+
+
+def _graph(prefix, rank=0, size=1, log=None):
+    """
+    Trajectory preparation on every rank, energies of the thread-specific
+    trajectories, and the parsing of all of them on the master
+    """
+    def _task(name):
+        def func(rank):
+            time.sleep(0.01)
+            log.append((name, rank))
+        return func
+
+    graph = TaskGraph(prefix, rank, size)
+    graph.poll_interval = 0.01
+    graph.add('trajectories', _task('trajectories'), inputs=['traj.xtc'], outputs=['complex.mdcrd.%d'])
+    graph.add('dummy', _task('dummy'), outputs=['dummycomplex.inpcrd'])
+    graph.add('gb', _task('gb'), inputs=['complex.mdcrd.%d', 'dummycomplex.inpcrd'], outputs=['gb.mdout.%d'])
+    graph.add('pb', _task('pb'), inputs=['complex.mdcrd.%d'], outputs=['pb.mdout.%d'])
+    graph.add('parse', _task('parse'), inputs=['gb.mdout.%d', 'pb.mdout.%d'], master_only=True)
+    graph.add('cleanup', _task('cleanup'), after=['parse'], master_only=True)
+    return graph
+
+
+def test_dependencies(tmp_path):
+    graph = _graph(str(tmp_path / 'pre_'))
+    assert graph.dependencies() == [[], [], [(0, 'local'), (1, 'master')], [(0, 'local')],
+                                    [(2, 'all'), (3, 'all')], [(4, 'master')]]
+    out = io.StringIO()
+    graph.write_graph(out)
+    assert '5. parse [master]\n        after: 3 (all), 4 (all)\n' in out.getvalue()
+    assert '3. gb\n        after: 1, 2 (master)\n' in out.getvalue()
+
+    graph.add('late', lambda rank: None, after=['unknown'])
+    with pytest.raises(InternalError, match='late must be added after unknown'):
+        graph.dependencies()
+
+
+def test_writers_of_a_file_are_ordered(tmp_path):
+    graph = TaskGraph(str(tmp_path / 'pre_'))
+    graph.add('first', None, outputs=['a.%d'], master_only=True)
+    graph.add('second', None, outputs=['a.%d'])
+    assert graph.dependencies() == [[], [(0, 'master')]]
+
+
+@pytest.mark.parametrize('size', [1, 3])
+def test_run_respects_dependencies(tmp_path, size):
+    log = []
+    graphs = [_graph(str(tmp_path / 'pre_'), rank, size, log) for rank in range(size)]
+    errors = []
+
+    def _run(graph):
+        try:
+            graph.run(nproc=2, stdout=io.StringIO())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_run, args=(graph,)) for graph in graphs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not errors
+
+    # Every task runs once on every rank, or once on the master
+    expected = {(name, rank) for name in ('trajectories', 'dummy', 'gb', 'pb') for rank in range(size)}
+    expected |= {('parse', 0), ('cleanup', 0)}
+    assert sorted(log) == sorted(expected)
+    position = {entry: i for i, entry in enumerate(log)}
+    for rank in range(size):
+        assert position[('trajectories', rank)] < position[('gb', rank)]
+        assert position[('trajectories', rank)] < position[('pb', rank)]
+        assert position[('dummy', 0)] < position[('gb', rank)]
+        assert position[('gb', rank)] < position[('parse', 0)]
+        assert position[('pb', rank)] < position[('parse', 0)]
+    assert position[('parse', 0)] < position[('cleanup', 0)]
+
+
+def test_independent_tasks_overlap(tmp_path):
+    barrier = threading.Barrier(2, timeout=10)
+    graph = TaskGraph(str(tmp_path / 'pre_'))
+    graph.poll_interval = 0.01
+    # Each task waits for the other, so they only finish if they run at once
+    graph.add('gb', lambda rank: barrier.wait(), outputs=['gb.mdout.%d'])
+    graph.add('pb', lambda rank: barrier.wait(), outputs=['pb.mdout.%d'])
+    graph.run(nproc=2, stdout=io.StringIO())
+
+
+def test_failure_stops_every_rank(tmp_path):
+    prefix = str(tmp_path / 'pre_')
+    log = []
+
+    def fail(rank):
+        raise CalcError('gb failed')
+
+    graph = TaskGraph(prefix)
+    graph.poll_interval = 0.01
+    graph.add('gb', fail, outputs=['gb.mdout.%d'])
+    graph.add('parse', lambda rank: log.append('parse'), inputs=['gb.mdout.%d'], master_only=True)
+    with pytest.raises(CalcError, match='gb failed'):
+        graph.run(stdout=io.StringIO())
+    assert not log
+    assert os.path.exists(prefix + 'task.failed')
+
+    # A rank still waiting for the master gives up as well
+    other = TaskGraph(prefix, rank=1, size=2)
+    other.poll_interval = 0.01
+    other.add('trajectories', lambda rank: None, outputs=['complex.mdcrd.%d'], master_only=True)
+    other.add('gb', lambda rank: log.append('gb'), inputs=['complex.mdcrd.%d'])
+    with pytest.raises(CalcError, match='another processor'):
+        other.run(stdout=io.StringIO())
+    assert not log
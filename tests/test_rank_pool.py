@@ -0,0 +1,403 @@
+"""
+Tests of the parsing of the per-rank output files by the MPI ranks
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import os
+import shutil
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from GMXMMPBSA import amber_outputs
+from GMXMMPBSA.amber_outputs import RankPool, _mapped, EnergyMoments, DecompOut, PairDecompOut, PairDecompBinding
+from GMXMMPBSA.main import MMPBSA_App
+from GMXMMPBSA.output_file import write_decomp_stability_output, write_decomp_binding_output
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'mdout')
+
+INPUT = {'verbose': 2, 'surften': 0.0072, 'surfoff': 0.0, 'sander_apbs': 0, 'temp': 298.15}
+
+# Rank files of each output, made from the samples. None is a 0-byte file
+OUTPUTS = {
+    'gb': (amber_outputs.GBout, '_GMXMMPBSA_complex_gb.mdout',
+           [('_GMXMMPBSA_complex_gb.mdout.0', '_GMXMMPBSA_complex_gb_surf.dat.0'), (None, None),
+            ('_GMXMMPBSA_complex_gb.mdout.1', '_GMXMMPBSA_complex_gb_surf.dat.1')]),
+    'pb': (amber_outputs.PBout, '_GMXMMPBSA_complex_pb.mdout',
+           [('_GMXMMPBSA_complex_pb.mdout.0',), (None,), ('_GMXMMPBSA_complex_pb.mdout.0',)]),
+    'rism': (amber_outputs.PolarRISM_gf_Out, '_GMXMMPBSA_complex_rism.mdout',
+             [('polar_rism.mdout.0',), ('polar_rism.mdout.0',), (None,)]),
+    'nmode': (amber_outputs.NMODEout, '_GMXMMPBSA_complex_nm.out',
+              [(None,), ('_GMXMMPBSA_complex_nm.out.0',), ('_GMXMMPBSA_complex_nm.out.0',)]),
+}
+
+
+class _Comm(object):
+    """ gather and bcast between ranks that are threads of this process """
+
+    def __init__(self, rank, world):
+        self.rank = rank
+        self.world = world
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.world['size']
+
+    def _exchange(self, obj):
+        """ Every rank posts obj, and gets the objects of all of them """
+        self.world['box'][self.rank] = obj
+        self.world['barrier'].wait()
+        objs = list(self.world['box'])
+        self.world['barrier'].wait()
+        return objs
+
+    def gather(self, obj, root=0):
+        objs = self._exchange(obj)
+        return objs if self.rank == root else None
+
+    def bcast(self, obj, root=0):
+        return self._exchange(obj)[root]
+
+
+def _run_ranks(size, func):
+    """ Calls func(comm) in size ranks. Returns their results or errors """
+    world = {'size': size, 'box': [None] * size, 'barrier': threading.Barrier(size, timeout=60)}
+    results = [None] * size
+
+    def _rank(rank):
+        try:
+            results[rank] = func(_Comm(rank, world))
+        except Exception as e:
+            results[rank] = e
+
+    ranks = [threading.Thread(target=_rank, args=(rank,)) for rank in range(size)]
+    for rank in ranks:
+        rank.start()
+    for rank in ranks:
+        rank.join(60)
+    assert not any(rank.is_alive() for rank in ranks)
+    return results
+
+
+@pytest.fixture
+def rundir(tmp_path, monkeypatch):
+    """ The rank files of every output in an empty directory """
+    for _, basename, files in OUTPUTS.values():
+        for fileno, sources in enumerate(files):
+            for suffix, source in zip(('mdout', 'surf.dat'), sources):
+                target = basename.replace('gb.mdout', 'gb_surf.dat') if suffix == 'surf.dat' else basename
+                target = tmp_path / ('%s.%d' % (target, fileno))
+                if source is None:
+                    target.write_bytes(b'')
+                else:
+                    shutil.copy(os.path.join(DATA, source), str(target))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _parse(name, pool=None):
+    cls, basename, files = OUTPUTS[name]
+    return cls(basename, INPUT, len(files), pool=pool).data
+
+
+def _same(data, expected):
+    assert sorted(data) == sorted(expected)
+    for key in expected:
+        assert list(data[key]) == list(expected[key]), key
+
+
+@pytest.mark.parametrize('name', sorted(OUTPUTS))
+@pytest.mark.parametrize('size', [1, 2, 3, 4])
+def test_ranks_parse_like_serial(rundir, name, size):
+    """ With more ranks than files, some ranks have nothing to parse """
+    serial = _parse(name)
+    results = _run_ranks(size, lambda comm: _parse(name, RankPool(comm)))
+    _same(results[0], serial)
+    # The other ranks do not keep any frame
+    for data in results[1:]:
+        assert not any(len(data[key]) for key in serial)
+
+
+def test_empty_rank_file(rundir):
+    # The 0-byte file adds no frames
+    assert len(_parse('pb')['EPB']) == len(_parse('gb')['ESURF']) == 4
+    # Even if it is the first one
+    total = list(_parse('nmode')['Total'])
+    assert len(total) == 4 and total[:2] == total[2:]
+    with _mapped(str(rundir / '_GMXMMPBSA_complex_pb.mdout.1')) as buffer:
+        assert buffer == b''
+
+
+@pytest.mark.parametrize('size', [1, 2, 3])
+def test_missing_rank_file(rundir, size):
+    """ Every rank fails like the serial parse when the file of one is missing """
+    os.remove('_GMXMMPBSA_complex_pb.mdout.1')
+    with pytest.raises(FileNotFoundError):
+        _parse('pb')
+    results = _run_ranks(size, lambda comm: _parse('pb', RankPool(comm)))
+    for error in results:
+        assert isinstance(error, FileNotFoundError)
+        assert '_GMXMMPBSA_complex_pb.mdout.1' in str(error)
+
+
+def test_ranks_without_gather_keep_their_files(rundir):
+    results = _run_ranks(3, lambda comm: _parse('pb', RankPool(comm, gather=False)))
+    serial = _parse('pb')
+    assert list(results[0]['EPB']) == list(serial['EPB'][:2])
+    assert len(results[1]['EPB']) == 0
+    assert list(results[2]['EPB']) == list(serial['EPB'][2:])
+
+
+def test_mapped(rundir):
+    fname = str(rundir / '_GMXMMPBSA_complex_pb.mdout.0')
+    with open(fname, 'rb') as f:
+        contents = f.read()
+    with _mapped(fname) as buffer:
+        assert buffer[:] == contents
+    assert buffer.closed
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+def test_energy_moments_of_columns():
+    energies = np.random.RandomState(1).uniform(-50, 50, (7, 4))
+    merged = EnergyMoments()
+    for part in (energies[:3], energies[3:3], energies[3:]):
+        merged = merged.merge(EnergyMoments.from_vector(part))
+    assert merged.count == 7
+    assert merged.avg() == pytest.approx(energies.mean(axis=0))
+    assert merged.stdev() == pytest.approx(energies.std(axis=0))
+    assert list(merged.low) == list(energies.min(axis=0))
+    assert list(merged.high) == list(energies.max(axis=0))
+    sums, sumsq = merged.sums()
+    assert sums == pytest.approx(energies.sum(axis=0))
+    assert sumsq == pytest.approx((energies ** 2).sum(axis=0))
+    assert merged.abs_gt(40) and not merged.abs_gt(50)
+
+
+# Decomp outputs of a complex of residues 1-5, where 1-3 are the receptor and
+# 4-5 the ligand. The frames of each rank file: 5 in total (so no average is
+# half way between two printed values), and none in one of them
+RECEPTOR, LIGAND = [1, 2, 3], [4, 5]
+DECOMP_FRAMES = (3, 0, 2)
+LABELS = ['ALA', 'GLY', 'SER', 'LYS', 'ASP']
+
+
+def _decomp_system():
+    """ The prmtops and the residue map of the complex (like an MMPBSA_System) """
+    def prmtop(residues):
+        return SimpleNamespace(parm_data={'RESIDUE_LABEL': [LABELS[res - 1] for res in residues]})
+
+    res_list = [SimpleNamespace(receptor_number=RECEPTOR.index(res) + 1 if res in RECEPTOR else None,
+                                ligand_number=LIGAND.index(res) + 1 if res in LIGAND else None)
+                for res in RECEPTOR + LIGAND]
+    return SimpleNamespace(complex_prmtop=prmtop(RECEPTOR + LIGAND), receptor_prmtop=prmtop(RECEPTOR),
+                           ligand_prmtop=prmtop(LIGAND), res_list=res_list)
+
+
+def _write_decomp(basename, pairwise, residues, frames, seed):
+    """ Writes the rank files of a sander decomp output with random energies """
+    random = np.random.RandomState(seed)
+    terms = [(res, res2) for res in residues for res2 in residues] if pairwise else [(res,) for res in residues]
+    cls = PairDecompOut if pairwise else DecompOut
+    for fileno, numframes in enumerate(frames):
+        with open('%s.%d' % (basename, fileno), 'w') as f:
+            for _ in range(numframes):
+                f.write(cls.indicator + '\n\n')
+                for token in ('TDC', 'SDC', 'BDC'):
+                    for term in terms:
+                        energies = random.uniform(-50, 50, 5).round(3)
+                        if pairwise:
+                            f.write('%s %7d->%7d' % ((token,) + term) + ''.join(' %12.3f' % e for e in energies))
+                        else:
+                            f.write('%s %6d' % ((token,) + term) + ''.join(' %9.3f' % e for e in energies))
+                        f.write('\n')
+                f.write('\n')
+
+
+def _decomp_app(comm, idecomp, stability, multitraj):
+    """ What MMPBSA_App._reduce_decomp needs of the application """
+    INPUT = {'idecomp': idecomp, 'dec_verbose': 3, 'gbrun': True, 'pbrun': True, 'surften': 0.0072,
+             'cavity_surften': 0.0378, 'mutant_only': False, 'alarun': False, 'csv_format': False}
+    FILES = SimpleNamespace(receptor_trajs=['rec.xtc'] if multitraj else [], ligand_trajs=[],
+                            decompout='FINAL_DECOMP_MMPBSA.dat', dec_energies=None)
+    return SimpleNamespace(INPUT=INPUT, FILES=FILES, stability=stability, pre='_GMXMMPBSA_',
+                           num_chunks=len(DECOMP_FRAMES), normal_system=_decomp_system(),
+                           master=comm is None or comm.Get_rank() == 0, MPI=SimpleNamespace(COMM_WORLD=comm))
+
+
+def _write_decomp_output(app, decomp):
+    """ Writes the decomp output, and returns it without the date """
+    args = (app.FILES, app.INPUT, app.num_chunks, app.normal_system, None, '', app.pre, decomp)
+    if app.stability:
+        write_decomp_stability_output(*args)
+    else:
+        write_decomp_binding_output(*args)
+    with open(app.FILES.decompout) as f:
+        return [line for line in f if not line.startswith('| Run on')]
+
+
+@pytest.mark.parametrize('stability,multitraj', [(False, False), (False, True), (True, False)])
+@pytest.mark.parametrize('idecomp', [1, 3])
+@pytest.mark.parametrize('size', [2, 4])
+def test_decomp_moments_like_serial(tmp_path, monkeypatch, size, idecomp, stability, multitraj):
+    """ The decomp output written from the merged statistics of the ranks is
+        the one written from all the frames
+    """
+    monkeypatch.chdir(tmp_path)
+    pairwise = idecomp == 3
+    # The receptor and the ligand of other trajectories have other frames
+    rec_frames, lig_frames = ((2, 1, 2), (1, 2, 2)) if multitraj else (DECOMP_FRAMES, DECOMP_FRAMES)
+    for seed, solvent in enumerate(('gb', 'pb')):
+        _write_decomp('_GMXMMPBSA_complex_%s.mdout' % solvent, pairwise, RECEPTOR + LIGAND, DECOMP_FRAMES, seed)
+        _write_decomp('_GMXMMPBSA_receptor_%s.mdout' % solvent, pairwise, range(1, 4), rec_frames, seed + 2)
+        _write_decomp('_GMXMMPBSA_ligand_%s.mdout' % solvent, pairwise, range(1, 3), lig_frames, seed + 4)
+    serial = _write_decomp_output(_decomp_app(None, idecomp, stability, multitraj), None)
+
+    def reduce(comm):
+        app = _decomp_app(comm, idecomp, stability, multitraj)
+        MMPBSA_App._reduce_decomp(app)
+        return app
+
+    apps = _run_ranks(size, reduce)
+    for app in apps:
+        assert not isinstance(app, Exception), app
+    assert not any(hasattr(app, '_decomp') for app in apps[1:])
+    decomp = apps[0]._decomp
+    systems = ['complex'] if stability else ['complex', 'receptor', 'ligand']
+    keys = ['_GMXMMPBSA_%s_%s.mdout' % (system, solvent) for solvent in ('gb', 'pb') for system in systems]
+    if not stability and not multitraj:
+        keys += ['_GMXMMPBSA_gb_bind', '_GMXMMPBSA_pb_bind']
+    assert sorted(decomp) == sorted(keys)
+    assert decomp['_GMXMMPBSA_complex_gb.mdout'].numframes == 5
+    assert decomp['_GMXMMPBSA_complex_gb.mdout'].energies is None
+    # Nothing is parsed again for the output
+    monkeypatch.setattr(DecompOut, '_parse', None)
+    assert _write_decomp_output(apps[0], decomp) == serial
+
+
+def test_decomp_binding_moments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    system = _decomp_system()
+    _write_decomp('com.mdout', True, RECEPTOR + LIGAND, (2,), 0)
+    _write_decomp('rec.mdout', True, RECEPTOR, (2,), 1)
+    _write_decomp('lig.mdout', True, [1, 2], (2,), 2)
+    com, rec, lig = [PairDecompOut(name, None, 0.0072, None, 1, 3) for name in ('com.mdout', 'rec.mdout', 'lig.mdout')]
+    moments = PairDecompBinding(com, rec, lig, system, 3, 3, None, '', '').get_moments()
+    deltas = com.energies['SDC'].copy()
+    # Pairs of receptor residues, then pairs of ligand residues, in the complex
+    in_rec = [i * 5 + j for i in range(3) for j in range(3)]
+    in_lig = [i * 5 + j for i in range(3, 5) for j in range(3, 5)]
+    deltas[:, in_rec] -= rec.energies['SDC']
+    deltas[:, in_lig] -= lig.energies['SDC']
+    assert moments['SDC']['vdw'].avg() == pytest.approx(deltas[:, :, 1].mean(axis=0))
+    # The pairs of a receptor and a ligand residue are only in the complex
+    assert moments['SDC']['tot'].avg()[3] == pytest.approx(com.energies['SDC'][:, 3, 5].mean())
+    # Too few ligand pairs
+    _write_decomp('lig.mdout', True, [1], (2,), 2)
+    lig = PairDecompOut('lig.mdout', None, 0.0072, None, 1, 3)
+    with pytest.raises(amber_outputs.DecompError, match='terms'):
+        PairDecompBinding(com, rec, lig, system, 3, 3, None, '', '').get_moments()
+    # Too few ligand frames
+    _write_decomp('lig.mdout', True, [1, 2], (1,), 2)
+    lig = PairDecompOut('lig.mdout', None, 0.0072, None, 1, 3)
+    with pytest.raises(amber_outputs.DecompError, match='frames'):
+        PairDecompBinding(com, rec, lig, system, 3, 3, None, '', '').get_moments()
+
+
+def test_decomp_moments_failure(tmp_path, monkeypatch):
+    """ Every rank fails if the DELTAs of one cannot be taken """
+    monkeypatch.chdir(tmp_path)
+    for solvent in ('gb', 'pb'):
+        _write_decomp('_GMXMMPBSA_complex_%s.mdout' % solvent, False, RECEPTOR + LIGAND, DECOMP_FRAMES, 0)
+        _write_decomp('_GMXMMPBSA_receptor_%s.mdout' % solvent, False, range(1, 4), DECOMP_FRAMES, 1)
+        _write_decomp('_GMXMMPBSA_ligand_%s.mdout' % solvent, False, range(1, 3), (2, 1, 2), 2)
+    results = _run_ranks(3, lambda comm: MMPBSA_App._reduce_decomp(_decomp_app(comm, 1, False, False)))
+    for error in results:
+        assert isinstance(error, amber_outputs.DecompError)
+
+
+# Frames of the complex, receptor and ligand in each rank of the summary mode
+SUMMARY_FRAMES = (4, 0, 3, 2)
+
+
+def _energies(frames, seed):
+    """ Energy terms of frames frames of an output, as a GB output would have them """
+    random = np.random.RandomState(seed)
+    output = amber_outputs.AmberOutput('summary', INPUT)
+    for key in output.data_keys:
+        output.data[key] = amber_outputs.EnergyVector(random.uniform(-50, 50, frames).round(3))
+    output.is_read = True
+    return output
+
+
+def _split(output, start, stop):
+    """ The output of the frames start:stop """
+    part = amber_outputs.AmberOutput(output.basename, INPUT)
+    part.data = {key: output.data[key][start:stop] for key in output.data_keys}
+    part.data.update({key: amber_outputs.EnergyVector() for key in output.composite_keys})
+    part.is_read = True
+    return part
+
+
+@pytest.mark.parametrize('BindClass,missing', [(amber_outputs.SingleTrajBinding, False),
+                                               (amber_outputs.SingleTrajBinding, True),
+                                               (amber_outputs.MultiTrajBinding, False)])
+def test_summary_statistics(BindClass, missing):
+    """ The summary written from the merged statistics of the ranks is the one
+        written from all the frames. Missing terms in one rank (as in the
+        LengthError fallback) take the differences of every rank from the
+        statistics of all the frames
+    """
+    outputs = [_energies(sum(SUMMARY_FRAMES), seed) for seed in range(3)]
+    serial = amber_outputs.SingleTrajBinding(*[_split(output, 0, sum(SUMMARY_FRAMES)) for output in outputs])
+    if missing or BindClass is amber_outputs.MultiTrajBinding:
+        # The differences of multiple trajectories are printed as averages too
+        serial.missing_terms = True
+        serial.delta2()
+
+    def reduce(comm):
+        rank = comm.Get_rank()
+        start, stop = sum(SUMMARY_FRAMES[:rank]), sum(SUMMARY_FRAMES[:rank + 1])
+        parts = [_split(output, start, stop) for output in outputs]
+        calc_types = {'gb': dict(zip(('complex', 'receptor', 'ligand'), parts))}
+        calc_types['gb']['delta'] = BindClass(*parts)
+        if missing and rank == 2:
+            calc_types['gb']['delta'].missing_terms = True
+            calc_types['gb']['delta'].delta2()
+        app = SimpleNamespace(INPUT={'decomprun': False}, calc_types=calc_types, master=rank == 0,
+                              MPI=SimpleNamespace(COMM_WORLD=comm))
+        MMPBSA_App._reduce_statistics(app)
+        return calc_types
+
+    results = _run_ranks(len(SUMMARY_FRAMES), reduce)
+    for result in results:
+        assert not isinstance(result, Exception), result
+    delta = results[0]['gb']['delta']
+    assert isinstance(delta.com.data['TOTAL'], EnergyMoments)
+    assert delta.missing_terms == missing
+    if BindClass is amber_outputs.SingleTrajBinding:
+        assert delta.print_summary() == serial.print_summary()
+    else:
+        assert delta.print_summary().split('Differences')[1] == serial.print_summary().split('Differences')[1]
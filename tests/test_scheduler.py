@@ -0,0 +1,317 @@
+"""
+Tests of the distribution of the (calculation, chunk) work units
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import io
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from GMXMMPBSA.calculation import Calculation, CalculationList, CopyCalc
+from GMXMMPBSA.exceptions import CalcError
+from GMXMMPBSA.scheduler import ChunkScheduler, TaskScheduler, adaptive_passes, shard_range
+from GMXMMPBSA.timer import Timer
+
+NUM_CHUNKS = 6
+
+
+class WriteCalc(Calculation):
+    """ Writes its output file and logs the unit, like an energy calculation """
+
+    def __init__(self, output, log, delay=0.02):
+        self.output = output
+        self.log = log
+        self.delay = delay
+        self.calc_setup = False
+
+    def run(self, rank, stdout=None, stderr=None):
+        time.sleep(self.delay)
+        with open(self.output % rank, 'w') as f:
+            f.write('%s %d\n' % (self.output, rank))
+        with open(self.log, 'a') as f:
+            f.write('%s %d\n' % (self.output, rank))
+
+
+def _calc_list(tmp_path, delay=0.02):
+    log = str(tmp_path / 'units.log')
+    timer = Timer()
+    timer.add_timer('gb', 'GB calculations:')
+    calcs = CalculationList(timer)
+    calcs.append(WriteCalc(str(tmp_path / 'complex.%d'), log, delay), 'complex', 'gb')
+    calcs.append(WriteCalc(str(tmp_path / 'receptor.%d'), log, delay), 'receptor', 'gb')
+    calcs.append(CopyCalc(str(tmp_path / 'complex.%d'), str(tmp_path / 'mutant_complex.%d')), '', 'gb')
+    return calcs
+
+
+def _check_outputs(tmp_path):
+    runs = Counter(open(tmp_path / 'units.log').read().splitlines())
+    expected = ['%s %d' % (tmp_path / name, chunk) for name in ('complex.%d', 'receptor.%d')
+                for chunk in range(NUM_CHUNKS)]
+    assert sorted(runs) == sorted(expected)
+    assert set(runs.values()) == {1}
+    for chunk in range(NUM_CHUNKS):
+        assert (open(tmp_path / ('mutant_complex.%d' % chunk)).read() ==
+                open(tmp_path / ('complex.%d' % chunk)).read())
+
+
+def test_chunk_scheduler_claims_once(tmp_path):
+    first = ChunkScheduler(str(tmp_path / '_'), NUM_CHUNKS)
+    second = ChunkScheduler(str(tmp_path / '_'), NUM_CHUNKS)
+    assert first.claim(0, 3)
+    assert not second.claim(0, 3)
+    assert not first.claim(0, 3)
+    assert not second.is_done(0, 3)
+    first.finish(0, 3)
+    assert second.is_done(0, 3)
+
+
+def test_two_workers_share_directory(tmp_path):
+    """ Every unit runs exactly once, and each copy sees its source output """
+    errors = []
+
+    def _worker():
+        scheduler = ChunkScheduler(str(tmp_path / '_'), NUM_CHUNKS)
+        # The other worker can only be seen through the completion markers
+        scheduler.poll = 0.01
+        try:
+            _calc_list(tmp_path).run(0, io.StringIO(), nproc=2, scheduler=scheduler)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=_worker) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert not any(worker.is_alive() for worker in workers)
+    assert not errors
+    _check_outputs(tmp_path)
+
+
+def test_copy_waits_for_running_source(tmp_path):
+    """ A copy whose source runs in this process is submitted when it finishes """
+    scheduler = ChunkScheduler(str(tmp_path / '_'), NUM_CHUNKS)
+    # A copy must never depend on polling the marker of a unit of this process
+    scheduler.poll = 3600
+    start = time.time()
+    _calc_list(tmp_path, delay=0.05).run(0, io.StringIO(), nproc=3, scheduler=scheduler)
+    assert time.time() - start < 60
+    _check_outputs(tmp_path)
+
+
+# +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+
+class _World(object):
+    """ Point-to-point messages between ranks that are threads of this process """
+
+    def __init__(self, size):
+        self.size = size
+        self.messages = []
+        self.cond = threading.Condition()
+
+    def mpi(self, rank):
+        """ Stand-in for the mpi4py MPI module, as seen by one rank """
+        world = self
+
+        class Status(object):
+            source = None
+
+            def Get_source(self):
+                return self.source
+
+        class Comm(object):
+            def Get_rank(self):
+                return rank
+
+            def Get_size(self):
+                return world.size
+
+            def send(self, obj, dest, tag):
+                with world.cond:
+                    world.messages.append((rank, dest, tag, obj))
+                    world.cond.notify_all()
+
+            def _find(self, source, tag):
+                for message in world.messages:
+                    if message[1] == rank and message[2] == tag and source in (-1, message[0]):
+                        return message
+                return None
+
+            def Iprobe(self, source, tag, status=None):
+                with world.cond:
+                    message = self._find(source, tag)
+                if message is not None and status is not None:
+                    status.source = message[0]
+                return message is not None
+
+            def recv(self, source, tag, status=None):
+                with world.cond:
+                    while self._find(source, tag) is None:
+                        world.cond.wait(1)
+                    message = self._find(source, tag)
+                    world.messages.remove(message)
+                if status is not None:
+                    status.source = message[0]
+                return message[3]
+
+        return type('MPI', (object,), {'COMM_WORLD': Comm(), 'ANY_SOURCE': -1, 'Status': Status})
+
+
+def _run_ranks(size, units, after, work, messages=None):
+    """ Runs TaskScheduler.run on size ranks. Returns the output and the errors of each rank """
+    world = _World(size)
+    errors = [None] * size
+    stdout = io.StringIO()
+
+    def _rank(rank):
+        scheduler = TaskScheduler(world.mpi(rank), NUM_CHUNKS)
+        try:
+            scheduler.run(units, after, lambda unit: work(rank, unit), messages, stdout)
+        except Exception as e:
+            errors[rank] = e
+
+    ranks = [threading.Thread(target=_rank, args=(rank,)) for rank in range(size)]
+    for rank in ranks:
+        rank.start()
+    for rank in ranks:
+        rank.join(60)
+    assert not any(rank.is_alive() for rank in ranks)
+    assert not world.messages
+    return stdout.getvalue(), errors
+
+
+def _units():
+    """ Units of a complex, a receptor and a copy of the complex outputs """
+    units = [(i, chunk) for i in range(3) for chunk in range(NUM_CHUNKS)]
+    after = {(2, chunk): (0, chunk) for chunk in range(NUM_CHUNKS)}
+    return units, after
+
+
+def test_task_scheduler_runs_every_unit_once():
+    units, after = _units()
+    runs = []
+    lock = threading.Lock()
+
+    def _work(rank, unit):
+        with lock:
+            runs.append(('start', rank, unit))
+        time.sleep(0.02)
+        with lock:
+            runs.append(('end', rank, unit))
+
+    messages = {0: 'complex\n', 1: 'receptor\n', 2: 'copies\n'}
+    output, errors = _run_ranks(3, units, after, _work, dict(messages))
+    assert errors == [None] * 3
+    started = [unit for event, _, unit in runs if event == 'start']
+    assert sorted(started) == sorted(units)
+    # The master works too
+    assert any(rank == 0 for event, rank, _ in runs if event == 'start')
+    # A copy starts after its source ends
+    events = [(event, unit) for event, _, unit in runs]
+    for unit, source in after.items():
+        assert events.index(('start', unit)) > events.index(('end', source))
+    assert output == 'complex\nreceptor\ncopies\n'
+
+
+def test_task_scheduler_two_ranks_both_work():
+    units, after = _units()
+    ranks = Counter()
+
+    def _work(rank, unit):
+        ranks[rank] += 1
+        time.sleep(0.02)
+
+    _, errors = _run_ranks(2, units, after, _work)
+    assert errors == [None, None]
+    assert sum(ranks.values()) == len(units)
+    assert ranks[0] and ranks[1]
+
+
+def test_task_scheduler_single_rank():
+    units, after = _units()
+    runs = []
+    _, errors = _run_ranks(1, units, after, lambda rank, unit: runs.append(unit))
+    assert errors == [None]
+    assert sorted(runs) == sorted(units)
+
+
+@pytest.mark.parametrize('failing_rank', [0, 1])
+def test_task_scheduler_failure_drains_queue(failing_rank):
+    units, after = _units()
+    runs = []
+    lock = threading.Lock()
+
+    def _work(rank, unit):
+        with lock:
+            runs.append(unit)
+        time.sleep(0.02)
+        if rank == failing_rank:
+            raise RuntimeError('unit %s failed' % (unit,))
+
+    _, errors = _run_ranks(3, units, after, _work)
+    assert isinstance(errors[failing_rank], RuntimeError)
+    # Every other rank stops with an error too
+    for rank, error in enumerate(errors):
+        if rank != failing_rank:
+            assert isinstance(error, CalcError)
+    # The failing rank ran one unit, and the others at most the one they had
+    # when the failure was reported
+    assert len(runs) == len(set(runs)) < len(units)
+
+
+def _pass_frames(passes, endframe):
+    return [frame for first, interval in passes for frame in range(first, endframe + 1, interval)]
+
+
+@pytest.mark.parametrize('startframe,endframe,interval,stride', [
+    (1, 100, 1, 8), (5, 97, 3, 4), (1, 10, 1, 16), (1, 1, 1, 4), (10, 40, 2, 2)])
+def test_adaptive_passes_cover_frames_once(startframe, endframe, interval, stride):
+    passes = adaptive_passes(startframe, endframe, interval, stride)
+    assert passes[0] == (startframe, interval * stride)
+    frames = _pass_frames(passes, endframe)
+    assert sorted(frames) == list(range(startframe, endframe + 1, interval))
+    # Coarse to fine
+    assert [i for _, i in passes] == sorted((i for _, i in passes), reverse=True)
+
+
+def test_adaptive_passes_edge_cases():
+    # With stride 1 there is a single pass with every frame
+    assert adaptive_passes(3, 50, 2, 1) == [(3, 2)]
+    # Passes that would start after endframe are left out
+    assert adaptive_passes(1, 2, 1, 8) == [(1, 8), (2, 2)]
+    assert adaptive_passes(1, 1, 1, 8) == [(1, 8)]
+
+
+@pytest.mark.parametrize('nframes,num_shards', [(10, 1), (10, 3), (16, 4), (7, 7), (100, 16)])
+def test_shard_range_covers_frames_once(nframes, num_shards):
+    blocks = [shard_range(nframes, shard, num_shards) for shard in range(1, num_shards + 1)]
+    assert blocks[0][0] == 1 and blocks[-1][1] == nframes
+    # Contiguous blocks whose sizes differ by one frame at most
+    assert all(first == last + 1 for (_, last), (first, _) in zip(blocks, blocks[1:]))
+    sizes = [last - first + 1 for first, last in blocks]
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_shard_range_more_shards_than_frames():
+    assert [shard_range(3, shard, 5) for shard in range(1, 6)] == [(1, 1), (2, 2), (3, 3), None, None]
+    assert shard_range(0, 1, 2) is None
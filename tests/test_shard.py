@@ -0,0 +1,135 @@
+"""
+Tests of the -shard runs and of joining their outputs with -merge
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import io
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from GMXMMPBSA import main
+from GMXMMPBSA.amber_outputs import GBout
+from GMXMMPBSA.exceptions import InputError
+from GMXMMPBSA.infofile import InfoFile
+from GMXMMPBSA.main import MMPBSA_App
+
+DATA = os.path.join(os.path.dirname(__file__), 'data', 'mdout')
+PREFIX = '_GMXMMPBSA_'
+
+# The two chunks of the GB sample have two frames each
+TOTAL_FRAMES = 4
+
+
+def _input(**changes):
+    INPUT = {var: 0 for var in InfoFile.EDITABLE_INFO_VARS}
+    INPUT.update(verbose=2, surften=0.0072, surfoff=0.0, startframe=1, endframe=9999999, interval=1,
+                 nmoderun=0, nmstartframe=1, nmendframe=1000000, nminterval=1, gbrun=1)
+    INPUT.update(changes)
+    return INPUT
+
+
+def _shard_app(shard, num_shards, INPUT):
+    """ What MMPBSA_App.setup_shard needs of the application of a -shard run """
+    FILES = SimpleNamespace(prefix=os.path.join('shard_%d' % shard, PREFIX), shard='%d/%d' % (shard, num_shards),
+                            merge=None, stability=False, receptor_trajs=[], ligand_trajs=[],
+                            complex_prmtop='COM.prmtop', complex_trajs=['traj.xtc'])
+    return SimpleNamespace(INPUT=INPUT, FILES=FILES, pre=FILES.prefix, shard=(shard, num_shards), master=True,
+                           MPI=SimpleNamespace(COMM_WORLD=SimpleNamespace(bcast=lambda obj: obj)),
+                           external_progs={'cpptraj': None}, stdout=io.StringIO())
+
+
+@pytest.fixture
+def trajectory(monkeypatch):
+    monkeypatch.setattr(main, 'Trajectory', lambda prmtop, trajs, cpptraj: SimpleNamespace(total_frames=TOTAL_FRAMES))
+
+
+def test_shard_frames(trajectory):
+    frames = []
+    for shard in (1, 2):
+        app = _shard_app(shard, 3, _input(startframe=2, interval=2, endframe=20))
+        MMPBSA_App.setup_shard(app)
+        frames.append((app.INPUT['startframe'], app.INPUT['endframe']))
+    # Frames 2 and 4 of the trajectory are analyzed, so the third shard has none
+    assert frames == [(2, 2), (4, 4)]
+
+    app = _shard_app(3, 3, _input(startframe=2, interval=2))
+    with pytest.raises(InputError, match='more shards'):
+        MMPBSA_App.setup_shard(app)
+
+
+def test_shard_nmode_frames(trajectory):
+    app = _shard_app(2, 2, _input(nmoderun=1, nmstartframe=2, nmendframe=4, nminterval=2))
+    MMPBSA_App.setup_shard(app)
+    # Frame 4 is the second frame of the shard
+    assert app.INPUT['nmoderun'] and (app.INPUT['nmstartframe'], app.INPUT['nmendframe']) == (2, 2)
+
+    app = _shard_app(2, 2, _input(nmoderun=1, nmstartframe=1, nmendframe=2))
+    MMPBSA_App.setup_shard(app)
+    assert not app.INPUT['nmoderun']
+
+
+def test_shard_merge_round_trip(tmp_path, monkeypatch, trajectory):
+    monkeypatch.chdir(tmp_path)
+    for shard in (1, 2):
+        app = _shard_app(shard, 2, _input())
+        MMPBSA_App.setup_shard(app)
+        assert (app.INPUT['startframe'], app.INPUT['endframe']) == (2 * shard - 1, 2 * shard)
+        # The shard runs its two frames in a single chunk
+        os.makedirs('shard_%d' % shard)
+        for name in ('complex_gb.mdout', 'complex_gb_surf.dat'):
+            shutil.copy(os.path.join(DATA, '%s%s.%d' % (PREFIX, name, shard - 1)), '%s%s.0' % (app.pre, name))
+        app.numframes, app.numframes_nmode, app.num_chunks, app.num_chunks_nmode = 2, 0, 1, 0
+        app.mpi_size, app.mut_str, app.using_chamber = 1, '', False
+        app.input_file_text = '|&general\n|  startframe=1,\n|/\n'
+        InfoFile(app).write_info(app.pre + 'info')
+
+    app = SimpleNamespace(INPUT={}, FILES=SimpleNamespace(prefix=PREFIX, merge=['shard_2', 'shard_1'], gui=False),
+                          stdout=io.StringIO())
+    MMPBSA_App.merge_shards(app)
+    assert app.pre == PREFIX and app.numframes == TOTAL_FRAMES
+    assert (app.INPUT['startframe'], app.INPUT['endframe']) == (1, TOTAL_FRAMES)
+
+    merged = MMPBSA_App._output(app, GBout, app.pre + 'complex_gb.mdout', app.num_chunks)
+    serial = GBout(os.path.join(DATA, PREFIX + 'complex_gb.mdout'), app.INPUT, 2, False)
+    assert list(merged.data_keys) == list(serial.data_keys)
+    for key in serial.data_keys:
+        np.testing.assert_allclose(merged.data[key], serial.data[key])
+
+
+def test_merge_incomplete(tmp_path, monkeypatch, trajectory):
+    monkeypatch.chdir(tmp_path)
+    app = _shard_app(1, 2, _input())
+    MMPBSA_App.setup_shard(app)
+    os.makedirs('shard_1')
+    app.numframes, app.numframes_nmode, app.num_chunks, app.num_chunks_nmode = 2, 0, 1, 0
+    app.mpi_size, app.mut_str, app.using_chamber, app.input_file_text = 1, '', False, ''
+    InfoFile(app).write_info(app.pre + 'info')
+
+    app = SimpleNamespace(INPUT={}, FILES=SimpleNamespace(prefix=PREFIX, merge=['shard_1'], gui=False),
+                          stdout=io.StringIO())
+    with pytest.raises(InputError, match='Shards 2 of 2 are missing'):
+        MMPBSA_App.merge_shards(app)
+    app.FILES.merge = ['shard_1', 'shard_3']
+    with pytest.raises(InputError, match='shard_3 is not the directory of a -shard run'):
+        MMPBSA_App.merge_shards(app)
@@ -0,0 +1,175 @@
+"""
+Tests of the in-process trajectory writers and of the fit to the reference
+"""
+
+# ##############################################################################
+#                           GPLv3 LICENSE INFO                                 #
+#                                                                              #
+#  Copyright (C) 2020  Mario S. Valdes-Tresanco and Mario E. Valdes-Tresanco   #
+#  Copyright (C) 2014  Jason Swails, Bill Miller III, and Dwight McGee         #
+#                                                                              #
+#   Project: https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA                  #
+#                                                                              #
+#   This program is free software; you can redistribute it and/or modify it    #
+#  under the terms of the GNU General Public License version 3 as published    #
+#  by the Free Software Foundation.                                            #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful, but         #
+#  WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY  #
+#  or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License    #
+#  for more details.                                                           #
+# ##############################################################################
+
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from GMXMMPBSA.trajio import NetCDFFile, NetCDFWriter, _fit, supported, write_slices
+
+netcdf_file = pytest.importorskip('scipy.io').netcdf_file
+Rotation = pytest.importorskip('scipy.spatial.transform').Rotation
+
+MASSES = [14.01, 1.008, 12.01, 1.008, 12.01, 16.0, 14.01, 1.008, 12.01, 12.01, 16.0, 32.06]
+
+
+def _frames(nframes, natoms, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((nframes, natoms, 3)) * 20 - 10).astype(np.float32)
+
+
+def _prmtop(fname):
+    """ Topology with the atoms of MASSES in residues of 3 atoms """
+    parmed = pytest.importorskip('parmed')
+    struct = parmed.Structure()
+    atom_type = parmed.AtomType('CT', None, 12.01, 6)
+    atom_type.set_lj_params(1.9, 0.1)
+    for i, mass in enumerate(MASSES):
+        atom = parmed.Atom(name='A%d' % i, type='CT', mass=mass, charge=0.0, atomic_number=6)
+        atom.atom_type = atom_type
+        struct.add_atom(atom, 'ALA', i // 3 + 1)
+    parmed.amber.AmberParm.from_structure(struct).write_parm(fname)
+    return fname
+
+
+def _write_nc(fname, coords, blocks=1):
+    writer = NetCDFWriter(fname, coords.shape[1])
+    for block in np.array_split(coords, blocks):
+        writer.write(block)
+    writer.close()
+
+
+# -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+def test_netcdf_writer_amber_conventions(tmp_path):
+    coords = _frames(7, 5)
+    fname = str(tmp_path / 'chunk.nc')
+    _write_nc(fname, coords, blocks=3)
+    assert supported(fname)
+    f = netcdf_file(fname, 'r', mmap=False)
+    try:
+        # 64-bit offset NetCDF-3
+        assert f.version_byte == 2
+        assert f.dimensions['spatial'] == 3
+        assert f.dimensions['atom'] == 5
+        assert f.variables['coordinates'].shape == (7, 5, 3)
+        assert f.Conventions == b'AMBER'
+        assert f.ConventionVersion == b'1.0'
+        assert f.variables['coordinates'].units == b'angstrom'
+        assert f.variables['time'].units == b'picosecond'
+        assert f.variables['spatial'][:].tobytes() == b'xyz'
+        np.testing.assert_array_equal(f.variables['coordinates'][:], coords)
+        np.testing.assert_array_equal(f.variables['time'][:], np.arange(7))
+    finally:
+        f.close()
+    reader = NetCDFFile(fname)
+    try:
+        assert (len(reader), reader.natoms) == (7, 5)
+        np.testing.assert_array_equal(reader.read([6, 0]), coords[[6, 0]])
+    finally:
+        reader.close()
+
+
+def test_netcdf_writer_no_frames(tmp_path):
+    fname = str(tmp_path / 'empty.nc')
+    NetCDFWriter(fname, 4).close()
+    f = netcdf_file(fname, 'r', mmap=False)
+    try:
+        assert f.variables['coordinates'].shape == (0, 4, 3)
+    finally:
+        f.close()
+
+
+# -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+def test_fit_undoes_rigid_motion():
+    reference = _frames(1, len(MASSES))[0]
+    rotations = Rotation.random(5, random_state=1)
+    shifts = np.random.default_rng(2).random((5, 3)) * 30
+    coords = np.array([rotation.apply(reference) + shift for rotation, shift in zip(rotations, shifts)],
+                      dtype=np.float32)
+    # Fitting on a few atoms moves the whole frame
+    weights = np.array(MASSES) * (np.arange(len(MASSES)) < 6)
+    np.testing.assert_allclose(_fit(coords, reference, weights), np.repeat(reference[None], 5, axis=0), atol=1e-4)
+
+
+def test_fit_matches_weighted_superposition():
+    """ With noise, the fit is the mass-weighted least-squares rotation (no reflection) """
+    rng = np.random.default_rng(3)
+    reference = _frames(1, len(MASSES))[0].astype(np.float64)
+    coords = np.array([rotation.apply(reference) for rotation in Rotation.random(4, random_state=4)])
+    coords = (coords + rng.normal(0, 0.5, coords.shape) + 5).astype(np.float32)
+    # A mirrored frame must still be fitted with a proper rotation
+    coords[3] = coords[3] * [1, 1, -1]
+    weights = np.array(MASSES)
+    fitted = _fit(coords, reference, weights)
+    w = weights / weights.sum()
+    for frame, result in zip(coords.astype(np.float64), fitted):
+        center = w @ frame
+        rotation, _ = Rotation.align_vectors(reference - w @ reference, frame - center, weights=weights)
+        expected = rotation.apply(frame - center) + w @ reference
+        np.testing.assert_allclose(result, expected, atol=1e-3)
+        # The fitted frame is the original one moved rigidly
+        np.testing.assert_allclose(np.linalg.norm(result[1:] - result[0], axis=1),
+                                   np.linalg.norm(frame[1:] - frame[0], axis=1), atol=1e-3)
+
+
+@pytest.mark.skipif(shutil.which('cpptraj') is None, reason='cpptraj is not installed')
+def test_fit_matches_cpptraj(tmp_path):
+    prmtop = _prmtop(str(tmp_path / 'system.prmtop'))
+    coords = _frames(6, len(MASSES), seed=5)
+    _write_nc(str(tmp_path / 'in.nc'), coords)
+    with open(tmp_path / 'fit.in', 'w') as f:
+        f.write('parm %s\ntrajin %s\nrms first mass\ntrajout %s netcdf\nrun\n' %
+                (prmtop, tmp_path / 'in.nc', tmp_path / 'out.nc'))
+    subprocess.run(['cpptraj', '-i', str(tmp_path / 'fit.in')], check=True, stdout=subprocess.DEVNULL)
+    reader = NetCDFFile(str(tmp_path / 'out.nc'))
+    try:
+        expected = reader.read(range(len(reader)))
+    finally:
+        reader.close()
+    np.testing.assert_allclose(_fit(coords, coords[0], np.array(MASSES)), expected, atol=2e-3)
+
+
+# -#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#-#
+
+def test_write_slices(tmp_path):
+    prmtop = _prmtop(str(tmp_path / 'system.prmtop'))
+    coords = _frames(9, len(MASSES), seed=6)
+    _write_nc(str(tmp_path / 'in.nc'), coords)
+    frames = [1, 2, 4, 5, 7, 8]
+    outputs = [(str(tmp_path / 'complex.nc.%d'), None), (str(tmp_path / 'receptor.nc.%d'), ':3-4')]
+    written = write_slices(prmtop, [str(tmp_path / 'in.nc')], frames, 0, ':1-2', outputs, [4, 2], 1, True)
+    assert written == {str(tmp_path / 'complex.nc.1'): 4, str(tmp_path / 'complex.nc.2'): 2,
+                       str(tmp_path / 'receptor.nc.1'): 4, str(tmp_path / 'receptor.nc.2'): 2}
+    weights = np.array(MASSES) * (np.arange(len(MASSES)) < 6)
+    expected = _fit(coords[frames], coords[0], weights)
+    for chunk, chunk_frames in ((1, slice(0, 4)), (2, slice(4, 6))):
+        for basename, atoms in ((outputs[0][0], slice(None)), (outputs[1][0], slice(0, 6))):
+            reader = NetCDFFile(basename % chunk)
+            try:
+                np.testing.assert_allclose(reader.read(range(len(reader))), expected[chunk_frames, atoms],
+                                           atol=1e-5)
+            finally:
+                reader.close()